@@ -0,0 +1,195 @@
+"""
+End-to-end load test of the whole bot, as wired in bot/main.py, against the fake Bot API server.
+
+Owners post debt lists to groups through the bot, then thousands of simulated debtors press ✅ on them, some of them
+twice, while others chat in the groups and owners run /show. Everything goes over HTTP through PTB's HTTPXRequest,
+getUpdates long polling, the guard, the handlers, the database writer and the outbox, exactly like in production.
+
+Run with `python -m benchmarks.end_to_end`, see --help for the load and the faults to inject.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.pool import NullPool
+
+from benchmarks.fake_telegram import FakeTelegram
+from bot.database import (
+    add_debt_list,
+    get_db,
+    get_debt_list_message_info,
+    update_debt_list_group,
+    update_debt_list_status,
+)
+from bot.guard import counters as guard_counters
+from bot.main import build_application, build_scheduler
+from bot.models import Base, OutboxMessage, SessionLocal
+from bot.request import request_pools
+from bot.writer import database_writer
+from utils.utils import drain_outbox
+
+TOKEN = "1:fake"
+
+
+async def seed_debt_lists(args: argparse.Namespace, rng: random.Random) -> list:
+    """Create sent debt lists, returns (list_id, owner_id, group_id, debtor IDs) of each."""
+    debt_lists = []
+    for number in range(args.lists):
+        owner_id = rng.randint(1, args.users)
+        group_id = -(1 + number % args.groups)
+        debtors = rng.sample(range(1, args.users + 1), args.debtors_per_list)
+        list_id = await add_debt_list(
+            owner_id, f"dinner {number}", "98765432", debts=[(f"user{debtor}", 1_000) for debtor in debtors]
+        )
+        await update_debt_list_status(list_id, False)
+        # Queues the send, the message IDs come back from the fake server once the outbox is drained
+        await update_debt_list_group(list_id, group_id)
+        debt_lists.append((list_id, owner_id, group_id, debtors))
+    return debt_lists
+
+
+def pending_outbox() -> int:
+    db = next(get_db())
+    return db.scalar(select(func.count()).select_from(OutboxMessage).where(OutboxMessage.done_at.is_(None)))
+
+
+async def push_load(server: FakeTelegram, args: argparse.Namespace, debt_lists: list, rng: random.Random) -> list:
+    """Push every simulated update in a random order, returns the IDs of the button presses."""
+    actions = []
+    for list_id, owner_id, group_id, debtors in debt_lists:
+        message_id = get_debt_list_message_info(list_id)[1]
+        for debtor in debtors:
+            # A double tap is two presses right after each other
+            presses = 2 if rng.random() < args.double_taps else 1
+            actions.append(("press", debtor, group_id, message_id, f"pay:{list_id}", presses))
+            if rng.random() < args.chatter:
+                actions.append(("chat", debtor, group_id, None, "see you all next week", 1))
+        actions.append(("show", owner_id, None, None, "/show", 1))
+    rng.shuffle(actions)
+
+    presses = []
+    for kind, user_id, chat_id, message_id, data, times in actions:
+        if kind == "press":
+            for _ in range(times):
+                presses.append(await server.push_callback(user_id, chat_id, message_id, data))
+        elif kind == "chat":
+            await server.push_message(user_id, data, chat_id=chat_id)
+        else:
+            await server.push_command(user_id, data)
+    return presses
+
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    server = FakeTelegram(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+        chat_limit=args.chat_limit,
+        seed=args.seed,
+    )
+    await server.start()
+
+    app = build_application(token=TOKEN, api_url=server.url)
+    scheduler = build_scheduler(app)
+    await app.initialize()
+
+    start = time.perf_counter()
+    debt_lists = await seed_debt_lists(args, rng)
+    while pending_outbox():
+        await drain_outbox(app)
+    print(f"Posted {len(debt_lists)} debt lists in {time.perf_counter() - start:.1f} s")
+    server.calls.clear()
+    server.errors.clear()
+    sent_before = len(server.sent)
+
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+    scheduler.start()
+
+    start = time.perf_counter()
+    presses = await push_load(server, args, debt_lists, rng)
+    pushed = server.updates_pushed
+    deadline = start + args.timeout
+    # Done once every press was answered, or its answer failed with an injected error, and the outbox is empty
+    while time.perf_counter() < deadline and (
+        len(server.answered.keys() | server.failed_answers) < len(presses) or pending_outbox()
+    ):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    scheduler.shutdown(wait=False)
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    await server.stop()
+
+    latencies = sorted(
+        (server.answered[press] - server.pushed[press]) * 1000 for press in presses if press in server.answered
+    )
+    print(f"{pushed} updates from {args.users} users, {len(presses)} button presses, in {elapsed:.2f} s")
+    print(f"Throughput: {pushed / elapsed:.0f} updates/s, {len(server.sent) - sent_before} chat changes")
+    if latencies:
+        print(
+            f"Press answered in ms: p50 {statistics.median(latencies):.0f}, "
+            f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.0f}, max {latencies[-1]:.0f}"
+        )
+    print(
+        f"Unanswered presses: {len(presses) - len(latencies)} ({len(server.failed_answers)} by injected errors), "
+        f"outbox left: {pending_outbox()}"
+    )
+    print("Bot API calls:", dict(server.calls))
+    print("Injected errors:", dict(server.errors))
+    print("Guard:", dict(guard_counters))
+    print(f"Database writer: {database_writer.operations} writes in {database_writer.commits} commits")
+    for name, pool in request_pools.items():
+        metrics = pool.snapshot()
+        print(
+            f"HTTP pool {name}: {metrics['requests']} requests, {metrics['utilization']:.0%} utilization, "
+            f"peak {metrics['peak_in_use']}/{metrics['size']}, checkout wait mean "
+            f"{metrics['wait_seconds_mean'] * 1000:.1f} ms max {metrics['wait_seconds_max'] * 1000:.1f} ms, "
+            f"{metrics['pool_timeouts']} pool timeouts"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.end_to_end")
+    parser.add_argument("--users", type=int, default=3_000)
+    parser.add_argument("--lists", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--debtors-per-list", type=int, default=8)
+    parser.add_argument("--double-taps", type=float, default=0.1, help="Share of presses made twice")
+    parser.add_argument("--chatter", type=float, default=0.2, help="Share of debtors who also chat in the group")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every Bot API call")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--chat-limit", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=600, help="Give up waiting after this many seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    # Every request and job run is logged at INFO, which would drown out the results
+    for name in ("httpx", "apscheduler", "telegram"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    # A fresh database in a scratch directory. The engine's path was made absolute when bot/models.py was imported,
+    # so the sessions are bound to a new engine rather than changing directory
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'end_to_end.db')}", poolclass=NullPool)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+A local stand-in for the Telegram Bot API, so the bot can be driven end to end over real HTTP without touching
+Telegram.
+
+It implements what the bot uses: getMe, deleteWebhook, getUpdates (long polling), sendMessage, editMessageText,
+deleteMessage(s), answerCallbackQuery and answerInlineQuery. Tests and benchmarks push updates from simulated users
+with push_message, push_command and push_callback, and read what the bot did from the recorded calls.
+
+Latency, random server errors and flood control can be configured, flood control answers with 429 and retry_after the
+way Telegram does. Point the bot at it with `build_application(api_url=server.url)` or BOT_API_URL.
+
+Run standalone with `python -m benchmarks.fake_telegram --port 8081` and start the bot with
+BOT_API_URL=http://127.0.0.1:8081, then push updates with POST /control/pushMessage, /control/pushCommand and
+/control/pushCallback, and read counts from /control/stats.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qsl, urlsplit
+
+from bot.guard import TokenBucket
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Debt Tracker",
+    "username": "debt_tracker_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": True,
+    "supports_inline_queries": True,
+}
+# Methods that change chats, the ones Telegram applies flood control to
+CHAT_METHODS = {"sendMessage", "editMessageText", "deleteMessage", "deleteMessages"}
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+
+def _chat_id(params: dict) -> int:
+    return int(params["chat_id"]) if params.get("chat_id") else None
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+    return {"id": chat_id, "type": "group", "title": f"Group {chat_id}"}
+
+
+class FakeTelegram:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+        chat_limit: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            latency (float, optional): Seconds added to every call except getUpdates. Defaults to 0.
+            jitter (float, optional): Up to this many seconds of random extra latency. Defaults to 0.
+            error_rate (float, optional): Share of calls answered with a 500 error. Defaults to 0.
+            flood_rate (float, optional): Share of chat changing calls answered with 429. Defaults to 0.
+            retry_after (int, optional): The retry_after of 429 answers, in seconds. Defaults to 1.
+            chat_limit (float, optional): Chat changing calls allowed per chat per second, more are answered with
+                429, like Telegram's flood control. Defaults to 0, no limit.
+            seed (int, optional): Seed of the random errors. Defaults to 0.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_limit = TokenBucket(max(chat_limit, 1), chat_limit) if chat_limit else None
+        self.random = random.Random(seed)
+
+        self.calls = Counter()  # method -> successful calls
+        self.errors = Counter()  # HTTP status -> injected errors
+        self.sent = []  # (method, parameters, time) of every successful chat changing call
+        self.answered = {}  # callback query ID -> time it was answered
+        self.pushed = {}  # callback query ID -> time it was pushed
+        self.failed_answers = set()  # callback query IDs whose answer failed with an injected error
+        self.updates_pushed = 0
+
+        self._updates = []
+        self._new_update = asyncio.Condition()
+        self._next_update_id = 1
+        self._next_message_id = {}  # chat_id -> next message ID
+        self._next_callback_id = 1
+        self._server = None
+        self._connections = set()
+        self.url = None
+
+    # Simulated users
+
+    def _message(self, chat_id: int, sender: dict, text: str = None) -> dict:
+        message_id = self._next_message_id.get(chat_id, 1)
+        self._next_message_id[chat_id] = message_id + 1
+        message = {"message_id": message_id, "date": int(time.time()), "chat": _chat(chat_id), "from": sender}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    async def _push(self, update: dict) -> None:
+        async with self._new_update:
+            update["update_id"] = self._next_update_id
+            self._next_update_id += 1
+            self.updates_pushed += 1
+            self._updates.append(update)
+            self._new_update.notify_all()
+
+    async def push_message(self, user_id: int, text: str, chat_id: int = None) -> None:
+        """Push a text message from a user, in their private chat with the bot unless chat_id is given."""
+        await self._push({"message": self._message(chat_id or user_id, _user(user_id), text)})
+
+    async def push_command(self, user_id: int, command: str, chat_id: int = None) -> None:
+        """Push a command such as '/show', marked up the way Telegram does so CommandHandlers match it."""
+        message = self._message(chat_id or user_id, _user(user_id), command)
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        await self._push({"message": message})
+
+    async def push_callback(self, user_id: int, chat_id: int, message_id: int, data: str) -> str:
+        """
+        Push a press of an inline button on a message the bot sent.
+
+        Returns:
+            str: The callback query ID, answered holds when the bot answered it.
+        """
+        callback_id = str(self._next_callback_id)
+        self._next_callback_id += 1
+        message = {"message_id": message_id, "date": int(time.time()), "chat": _chat(chat_id), "from": BOT_USER}
+        self.pushed[callback_id] = time.perf_counter()
+        await self._push(
+            {
+                "callback_query": {
+                    "id": callback_id,
+                    "from": _user(user_id),
+                    "chat_instance": str(chat_id),
+                    "message": message,
+                    "data": data,
+                }
+            }
+        )
+        return callback_id
+
+    # Bot API
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        async with self._new_update:
+            # Updates before the offset have been confirmed by the bot and are forgotten, like Telegram does
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    def _send_message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message = self._message(chat_id, BOT_USER, params.get("text"))
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        return message
+
+    def _edit_message_text(self, params: dict):
+        if params.get("inline_message_id"):
+            return True
+        return {
+            "message_id": int(params["message_id"]),
+            "date": int(time.time()),
+            "edit_date": int(time.time()),
+            "chat": _chat(int(params["chat_id"])),
+            "from": BOT_USER,
+            "text": params.get("text"),
+        }
+
+    async def call(self, method: str, params: dict):
+        """Carry out a Bot API method. Returns (HTTP status, response body)."""
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+
+        delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors[500] += 1
+            if method == "answerCallbackQuery":
+                self.failed_answers.add(params["callback_query_id"])
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+        if method in CHAT_METHODS:
+            chat_id = params.get("chat_id")
+            flooded = self.flood_rate and self.random.random() < self.flood_rate
+            if self.chat_limit and chat_id is not None and not self.chat_limit.allow(int(chat_id)):
+                flooded = True
+            if flooded:
+                self.errors[429] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "sendMessage":
+            result = self._send_message(params)
+        elif method == "editMessageText":
+            result = self._edit_message_text(params)
+        elif method == "answerCallbackQuery":
+            self.answered.setdefault(params["callback_query_id"], time.perf_counter())
+            result = True
+        elif method in ("deleteWebhook", "deleteMessage", "deleteMessages", "answerInlineQuery", "setMyCommands"):
+            result = True
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+
+        self.calls[method] += 1
+        if method in CHAT_METHODS:
+            self.sent.append((method, params, time.perf_counter()))
+        return 200, {"ok": True, "result": result}
+
+    async def control(self, method: str, params: dict):
+        """Push updates or read statistics over HTTP, for driving a bot that runs in another process."""
+        if method == "pushMessage":
+            await self.push_message(int(params["user_id"]), params["text"], _chat_id(params))
+            result = True
+        elif method == "pushCommand":
+            await self.push_command(int(params["user_id"]), params["command"], _chat_id(params))
+            result = True
+        elif method == "pushCallback":
+            result = await self.push_callback(
+                int(params["user_id"]), int(params["chat_id"]), int(params["message_id"]), params["data"]
+            )
+        elif method == "stats":
+            result = {"calls": self.calls, "errors": self.errors, "answered": len(self.answered)}
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: control method not found"}
+        return 200, {"ok": True, "result": result}
+
+    # HTTP
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Keep-alive, one request after another, which is how httpx uses a pooled connection
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                url = urlsplit(target)
+                method = url.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(url.query))
+                if headers.get("content-type", "").startswith("application/json"):
+                    params.update(json.loads(body or b"{}"))
+                else:
+                    # PTB sends form fields, with objects such as reply_markup encoded as JSON
+                    for name, value in parse_qsl(body.decode()):
+                        params[name] = json.loads(value) if value[:1] in ("{", "[") else value
+
+                if url.path.startswith("/control/"):
+                    status, response = await self.control(method, params)
+                else:
+                    status, response = await self.call(method, params)
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                    "Connection: keep-alive\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Start listening, port 0 picks a free one. Returns the server's URL."""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.url = f"http://{host}:{self._server.sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def stop(self) -> None:
+        self._server.close()
+        # Idle keep-alive connections would otherwise be cut off when the event loop closes
+        for connection in list(self._connections):
+            connection.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+
+async def serve(args: argparse.Namespace) -> None:
+    server = FakeTelegram(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+        chat_limit=args.chat_limit,
+    )
+    print(f"Fake Bot API listening on {await server.start(args.host, args.port)}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fake_telegram")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls failing with 500")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Share of chat calls failing with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--chat-limit", type=float, default=0.0, help="Chat calls allowed per chat per second")
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,138 @@
+"""
+Benchmark for /groupstats: a group with a long history of sent and paid debt lists, read from the daily rollups,
+against the same numbers computed from the debts and the event log, which is what answering without rollups takes.
+
+Reports how long the background job takes to fill the rollups from the event log, then the median time of each read
+for a small group and for the large one, so the rollup read can be seen not to grow with the history.
+
+Run with `python -m benchmarks.group_stats`, see --help for the sizes.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy.orm import aliased
+from sqlalchemy.pool import NullPool
+
+from bot import analytics, database, events
+from bot.analytics import median_bucket, settle_bucket
+from bot.models import Base, Debt, DebtEvent, DebtList, SessionLocal
+
+LARGE_GROUP = -1
+SMALL_GROUP = -2
+
+
+def build_database(engine, lists: int, debts_per_list: int, seed: int) -> None:
+    """Lists sent over the last year, most of their debts paid between an hour and a few weeks later."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    debt_lists, debts, debt_events = [], [], []
+    debt_id = 0
+    for list_id in range(1, lists + 1):
+        group_id = SMALL_GROUP if list_id % 100 == 0 else LARGE_GROUP
+        sent_at = now - timedelta(seconds=rng.randint(0, 365 * 86400))
+        debt_lists.append(
+            {"list_id": list_id, "user_id": 1, "group_id": group_id, "debt_name": f"dinner {list_id}", "is_pending": False}
+        )
+        debt_events.append(
+            {"list_id": list_id, "kind": events.LIST_SENT, "created_at": sent_at, "payload": f'{{"group_id":{group_id}}}'}
+        )
+        for debtor in range(debts_per_list):
+            debt_id += 1
+            paid_at = sent_at + timedelta(seconds=int(rng.expovariate(1 / (3 * 86400))) + 60)
+            paid = paid_at < now and rng.random() < 0.9
+            debts.append(
+                {
+                    "debt_id": debt_id,
+                    "list_id": list_id,
+                    "owed_by_user_name": f"user{debtor}",
+                    "owed_by_user_name_lower": f"user{debtor}",
+                    "amount_minor": 1_000,
+                    "paid": paid,
+                    "paid_at": paid_at if paid else None,
+                }
+            )
+            if paid:
+                debt_events.append(
+                    {
+                        "list_id": list_id,
+                        "kind": events.DEBT_PAID,
+                        "created_at": paid_at,
+                        "payload": f'{{"debt_id":{debt_id}}}',
+                    }
+                )
+    # The log is in the order things happened
+    debt_events.sort(key=lambda event: event["created_at"])
+    with engine.begin() as conn:
+        conn.execute(insert(DebtList), debt_lists)
+        conn.execute(insert(Debt), debts)
+        conn.execute(insert(DebtEvent), debt_events)
+
+
+def scan_median_bucket(group_id: int, since: date) -> int:
+    # The median time to pay computed from every paid debt of the group and the time its list was sent
+    db = next(database.get_db())
+    sent = aliased(DebtEvent)
+    rows = db.execute(
+        select(Debt.paid_at, func.max(sent.created_at))
+        .join(DebtList, DebtList.list_id == Debt.list_id)
+        .join(sent, (sent.list_id == Debt.list_id) & (sent.kind == events.LIST_SENT))
+        .where(DebtList.group_id == group_id, Debt.paid == True, func.date(Debt.paid_at) >= since)
+        .group_by(Debt.debt_id)
+    ).all()
+    histogram = {}
+    for paid_at, sent_at in rows:
+        bucket = settle_bucket((paid_at - sent_at).total_seconds())
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return median_bucket(tuple(histogram.items()))
+
+
+def rollup_median_bucket(group_id: int, since: date) -> int:
+    return median_bucket(analytics.get_group_stats(group_id, since).settle_times)
+
+
+def measure(read, repeats: int) -> tuple:
+    """The median seconds of a read, and its result."""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = read()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.group_stats")
+    parser.add_argument("--lists", type=int, default=20_000, help="debt lists sent over a year")
+    parser.add_argument("--debts", type=int, default=8, help="debts per list")
+    parser.add_argument("--days", type=int, default=365, help="days the stats cover")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'group_stats.db')}", poolclass=NullPool)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+    build_database(engine, args.lists, args.debts, args.seed)
+
+    started = time.perf_counter()
+    applied = analytics.update_group_stats()
+    seconds = time.perf_counter() - started
+    print(f"Filled the rollups from {applied} events in {seconds:.2f} s ({applied / seconds:.0f} events/s)")
+
+    since = (datetime.utcnow() - timedelta(days=args.days - 1)).date()
+    print(f"{'group':>6} {'read':>7} {'median ms':>10} {'median bucket':>14}")
+    for name, group_id in (("small", SMALL_GROUP), ("large", LARGE_GROUP)):
+        for read_name, read in (("scan", scan_median_bucket), ("rollup", rollup_median_bucket)):
+            seconds, bucket = measure(lambda: read(group_id, since), args.repeats)
+            print(f"{name:>6} {read_name:>7} {seconds * 1000:>10.2f} {bucket:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Micro-benchmark for parse_debt_list on pasted lists of a few hundred lines.
+
+Run with `python -m benchmarks.parser`.
+"""
+
+import random
+import timeit
+
+from utils.utils import parse_debt_list
+
+LINE_COUNTS = [10, 100, 500, 1_000]
+
+
+def make_input(lines: int, seed: int = 0) -> str:
+    """Build a valid debt list mixing single debts, shared debts, splits and modifiers."""
+    rng = random.Random(seed)
+    body = []
+    for index in range(lines):
+        kind = rng.random()
+        amount = f"{rng.randint(1, 10_000) / 100:.2f}"
+        if kind < 0.7:
+            body.append(f"@user{rng.randrange(lines)} {amount}")
+        elif kind < 0.9:
+            handles = " ".join(f"@user{rng.randrange(lines)}" for _ in range(3))
+            body.append(f"{handles} {amount} /split")
+        elif kind < 0.95:
+            body.append(f"@user{index} @User{index} {amount}")
+        else:
+            body.append(rng.choice(["+10% service charge", "+9% GST", "x1.01"]))
+    return "Dinner\n98765432\n" + "\n".join(body)
+
+
+def main() -> None:
+    print(f"{'lines':>6} {'us/parse':>10} {'us/line':>8} {'debtors':>8}")
+    for lines in LINE_COUNTS:
+        text = make_input(lines)
+        success, result = parse_debt_list(text)
+        assert success, result
+        runs, total = timeit.Timer(lambda: parse_debt_list(text)).autorange()
+        per_parse = total / runs * 1e6
+        print(f"{lines:>6} {per_parse:>10.1f} {per_parse / lines:>8.2f} {len(result[2]):>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark for the read models: a large debt list and every debt list read as views from column queries, against the
+nested dicts built from ORM objects and the ORM objects themselves that the same reads returned before.
+
+Reports the median time of each read and the memory its result holds on to, measured with tracemalloc.
+
+Run with `python -m benchmarks.read_models`, see --help for the sizes.
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from bot import database
+from bot.models import Base, Debt, DebtList, SessionLocal
+
+
+def build_database(engine, lists: int, debts: int) -> None:
+    """One list with the given number of debts, and the given number of lists with 8 debts each."""
+    with engine.begin() as conn:
+        conn.execute(
+            insert(DebtList),
+            [
+                {
+                    "list_id": list_id,
+                    "user_id": 1,
+                    "group_id": -1,
+                    "debt_name": f"dinner {list_id}",
+                    "phone_number": "98765432",
+                    "is_pending": False,
+                }
+                for list_id in range(1, lists + 2)
+            ],
+        )
+        conn.execute(
+            insert(Debt),
+            [
+                {"list_id": 1, "owed_by_user_name": f"user{debtor}", "amount_minor": 1_000 + debtor, "paid": False}
+                for debtor in range(debts)
+            ]
+            + [
+                {"list_id": list_id, "owed_by_user_name": f"user{debtor}", "amount_minor": 1_000, "paid": False}
+                for list_id in range(2, lists + 2)
+                for debtor in range(8)
+            ],
+        )
+
+
+def dict_debt_list_info(list_id: int) -> dict:
+    # get_debt_list_info as it was: the list as an ORM object, its debts lazy loaded, copied into dicts
+    db: Session = next(database.get_db())
+    debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
+    total_minor, outstanding_minor = database.get_debt_list_totals(list_id)
+    return {
+        "list_id": debt_list.list_id,
+        "debt_name": debt_list.debt_name,
+        "phone_number": debt_list.phone_number,
+        "currency": debt_list.currency,
+        "debts": [
+            {"owed_by_user_name": debt.owed_by_user_name, "amount_minor": debt.amount_minor, "paid": debt.paid}
+            for debt in debt_list.debts
+        ],
+        "total_minor": total_minor,
+        "outstanding_minor": outstanding_minor,
+        "last_updated": debt_list.last_updated,
+    }
+
+
+def orm_all_debt_lists() -> list:
+    # get_all_debt_lists as it was
+    db: Session = next(database.get_db())
+    return db.query(DebtList).all()
+
+
+def measure(read, repeats: int) -> tuple:
+    """The median seconds of a read, and the bytes its result keeps allocated."""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        read()
+        timings.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    result = read()
+    # Whatever the read left for the garbage collector, such as its session, is not held by the result
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return statistics.median(timings), retained
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.read_models")
+    parser.add_argument("--debts", type=int, default=5_000, help="debts in the large list")
+    parser.add_argument("--lists", type=int, default=5_000, help="other debt lists")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'read_models.db')}", poolclass=NullPool)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+    build_database(engine, args.lists, args.debts)
+
+    reads = [
+        (f"list of {args.debts} debts", "dicts", lambda: dict_debt_list_info(1)),
+        (f"list of {args.debts} debts", "views", lambda: database.get_debt_list_info(1)),
+        (f"all {args.lists + 1} lists", "orm", orm_all_debt_lists),
+        (f"all {args.lists + 1} lists", "views", database.get_all_debt_lists),
+    ]
+    print(f"{'read':>22} {'model':>6} {'median ms':>10} {'retained KiB':>13}")
+    for name, model, read in reads:
+        seconds, retained = measure(read, args.repeats)
+        print(f"{name:>22} {model:>6} {seconds * 1000:>10.2f} {retained / 1024:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Runs the same random sequence of repository operations against the SQL and the memory backend, checks that both
+return the same results and queue the same side effects, and times them.
+
+The memory backend is the reference: any difference is printed with the operation it happened at. Debt list IDs are
+compared by the order the lists were created in.
+
+Now and then the newest list is sent to a group and deleted, and the next list sent to the same group, which once got
+the deleted list's ID and had its group message dropped as a duplicate of the deleted list's.
+
+Run with `python -m benchmarks.repository`, see --help for the number of operations.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from dataclasses import replace
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.pool import NullPool
+
+from bot.database import get_db
+from bot.models import Base, OutboxMessage, SessionLocal
+from bot.repository import MemoryRepository, Repository, SqlRepository
+
+USERS = 40
+GROUPS = 5
+
+
+def random_operations(count: int, seed: int) -> list:
+    """
+    Operations as (method, args), a ("list", n) argument stands for the n-th debt list created. Lists that were deleted
+    are only read, as ("list", None), since both backends leave writes to a missing list undefined.
+    """
+    rng = random.Random(seed)
+    names = [f"user{number}" for number in range(1, USERS * 2)]
+    operations = []
+    lists = 0
+    alive = []
+    pending = set()
+    # Normalized handles in each list, handles must be unique within a list, and the username each user has, since
+    # two users never have the same one
+    handles = {}
+    usernames = {}
+    # Users who may have debts linked to them, since they had a username or marked a debt as paid. They only ever change
+    # to a username that was never written in a list, otherwise a list could end up with two debts for one handle,
+    # which neither backend handles
+    linked = set()
+    written = set()
+
+    def any_list():
+        # Now and then one that does not exist (any more)
+        return ("list", rng.choice(alive)) if alive and rng.random() < 0.9 else ("list", None)
+
+    def handle():
+        name = rng.choice(names)
+        # Handles are written in any case, with or without the @
+        return rng.choice([name, name.upper(), f"@{name}"])
+
+    for _ in range(count):
+        roll = rng.random()
+        user_id = rng.randint(1, USERS)
+        group_id = -rng.randint(1, GROUPS)
+        if roll < 0.08:
+            taken = {name for other, name in usernames.items() if other != user_id}
+            if user_id in linked:
+                taken |= written - {usernames.get(user_id)}
+            username = rng.choice([name for name in names if name not in taken] + [None])
+            usernames[user_id] = username
+            if username:
+                linked.add(user_id)
+                written.add(username)
+                # The user's debts follow them to the new handle, in whichever lists they are
+                for names_in_list in handles.values():
+                    names_in_list.add(username)
+            operations.append(("add_or_update_user", (user_id, username, "First", "Last")))
+        elif roll < 0.12:
+            operations.append(("add_or_update_group", (group_id, f"group {-group_id}", "group")))
+        elif roll < 0.16:
+            operations.append(("associate_user_with_group", (user_id, group_id)))
+        elif roll < 0.24:
+            operations.append(("add_debt_list", (user_id, f"dinner {lists}", "98765432")))
+            alive.append(lists)
+            pending.add(lists)
+            handles[lists] = set()
+            lists += 1
+        elif roll < 0.30 and pending:
+            number = rng.choice(sorted(pending))
+            new_names = [name for name in names if name not in handles[number]]
+            debts = [(name, rng.randint(1, 10_000)) for name in rng.sample(new_names, min(6, len(new_names)))]
+            handles[number].update(name for name, _ in debts)
+            written.update(name for name, _ in debts)
+            operations.append(("add_debts_bulk", (("list", number), debts)))
+        elif roll < 0.36 and alive:
+            number = rng.choice(alive)
+            name = handle()
+            handles[number].add(name.lstrip("@").lower())
+            written.add(name.lstrip("@").lower())
+            operations.append(
+                ("add_or_update_debt", (("list", number), name, rng.randint(1, 10_000), rng.random() < 0.2))
+            )
+        elif roll < 0.42 and alive:
+            number = rng.choice(alive)
+            operations.append(("update_debt_list_status", (("list", number), False)))
+            pending.discard(number)
+        elif roll < 0.46 and alive:
+            operations.append(("update_debt_list_group", (("list", rng.choice(alive)), group_id)))
+        elif roll < 0.64:
+            linked.add(user_id)
+            operations.append(("update_debt_status", (any_list(), user_id, handle(), rng.random() < 0.7)))
+        elif roll < 0.70:
+            operations.append(("get_debt_status", (any_list(), user_id, handle())))
+        elif roll < 0.73 and alive:
+            number = rng.choice(alive)
+            operations.append(("delete_debt_list", (("list", number),)))
+            alive.remove(number)
+            pending.discard(number)
+        elif roll < 0.74:
+            # Delete the newest list after sending it, then send the next one to the same group
+            for number in (lists, lists + 1):
+                debts = [(name, rng.randint(1, 10_000)) for name in rng.sample(names, 3)]
+                written.update(name for name, _ in debts)
+                operations += [
+                    ("add_debt_list", (user_id, f"dinner {number}", "98765432")),
+                    ("add_debts_bulk", (("list", number), debts)),
+                    ("update_debt_list_status", (("list", number), False)),
+                    ("update_debt_list_group", (("list", number), group_id)),
+                ]
+                handles[number] = {name for name, _ in debts}
+            operations.insert(len(operations) - 4, ("delete_debt_list", (("list", lists),)))
+            alive.append(lists + 1)
+            lists += 2
+        elif roll < 0.75 and pending:
+            number = rng.choice(sorted(pending))
+            operations.append(("discard_pending_debt_list", (("list", number),)))
+            alive.remove(number)
+            pending.discard(number)
+        elif roll < 0.85:
+            operations.append(
+                (
+                    rng.choice(
+                        [
+                            "get_debt_list_info",
+                            "get_debt_list_name",
+                            "get_debt_list_totals",
+                            "get_debt_list_pending_status",
+                        ]
+                    ),
+                    (any_list(),),
+                )
+            )
+        else:
+            operations.append(
+                (
+                    rng.choice(["get_user_groups", "get_debt_lists_by_user_id", "user_has_pending_debt_list"]),
+                    (user_id,),
+                )
+            )
+            if rng.random() < 0.3:
+                operations.append(("is_user_in_group", (user_id, group_id)))
+                operations.append(("get_group_name", (group_id,)))
+    return operations
+
+
+class Runner:
+    """Runs operations on one backend, translating between list IDs and the order lists were created in."""
+
+    def __init__(self, repository: Repository, side_effects):
+        """
+        Args:
+            repository (Repository): The backend.
+            side_effects: Called with the number of side effects seen so far, returns the ones queued since.
+        """
+        self.repository = repository
+        self.side_effects = side_effects
+        self.list_ids = []
+        # Side effects as compared, with list IDs translated
+        self.queued = []
+        self.seconds = 0.0
+
+    def _resolve(self, argument):
+        if isinstance(argument, tuple) and argument and argument[0] == "list":
+            # A deleted list gets an ID no backend uses
+            return self.list_ids[argument[1]] if argument[1] is not None else 10**9
+        return argument
+
+    def _logical(self, list_id):
+        return self.list_ids.index(list_id) if list_id in self.list_ids else list_id
+
+    def _normalize(self, method: str, result):
+        if method == "add_debt_list":
+            return len(self.list_ids) - 1
+        if method == "get_debt_lists_by_user_id":
+            return sorted(self._logical(list_id) for list_id in result)
+        if method == "user_has_pending_debt_list":
+            # Which one is returned when a user has several pending lists is up to the backend
+            return bool(result)
+        if method == "get_debt_list_info" and result:
+            return replace(result, list_id=self._logical(result.list_id), last_updated=None)
+        if method in ("add_or_update_debt", "add_or_update_group"):
+            # Debt IDs differ between the backends for the same reason list IDs do
+            return None
+        return result
+
+    async def run(self, method: str, args: tuple):
+        args = tuple(self._resolve(argument) for argument in args)
+        started = time.perf_counter()
+        result = getattr(self.repository, method)(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        self.seconds += time.perf_counter() - started
+        if method == "add_debt_list":
+            self.list_ids.append(result)
+        self.queued.extend(self.side_effect(side_effect) for side_effect in self.side_effects(len(self.queued)))
+        return self._normalize(method, result)
+
+    def side_effect(self, side_effect: dict) -> tuple:
+        list_id = side_effect.get("list_id")
+        return (
+            side_effect["action"],
+            int(side_effect["chat_id"]) if side_effect.get("chat_id") is not None else None,
+            side_effect.get("message_id"),
+            self._logical(list_id) if list_id is not None else None,
+            side_effect.get("text"),
+        )
+
+
+def sql_side_effects(seen: int) -> list:
+    db = next(get_db())
+    query = select(OutboxMessage).order_by(OutboxMessage.outbox_id).offset(seen)
+    return [
+        {
+            "action": row.action,
+            "chat_id": row.chat_id,
+            "message_id": row.message_id,
+            "list_id": row.list_id,
+            "text": row.text,
+        }
+        for row in db.scalars(query)
+    ]
+
+
+async def compare(operations: list) -> int:
+    repository = MemoryRepository()
+    memory = Runner(repository, lambda seen: repository.side_effects[seen:])
+    sql = Runner(SqlRepository(), sql_side_effects)
+    differences = 0
+    for number, (method, args) in enumerate(operations):
+        expected = await memory.run(method, args)
+        actual = await sql.run(method, args)
+        if expected != actual:
+            differences += 1
+            if differences <= 10:
+                print(f"#{number} {method}{args}:\n  memory {expected!r}\n  sql    {actual!r}")
+
+    expected, actual = memory.queued, sql.queued
+    if expected != actual:
+        differences += 1
+        print(f"Side effects differ: memory queued {len(expected)}, sql {len(actual)}")
+        for left, right in zip(expected, actual):
+            if left != right:
+                print(f"  first difference: memory {left}, sql {right}")
+                break
+
+    print(f"{'backend':>8} {'operations':>11} {'seconds':>8} {'ops/s':>9}")
+    for name, runner in (("memory", memory), ("sql", sql)):
+        print(
+            f"{name:>8} {len(operations):>11} {runner.seconds:>8.3f} {len(operations) / runner.seconds:>9.0f}"
+        )
+    print(f"{len(expected)} side effects, {differences} differences")
+    return differences
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.repository")
+    parser.add_argument("--operations", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # A fresh database in a scratch directory. The engine's path was made absolute when bot/models.py was imported,
+    # so the sessions are bound to a new engine rather than changing directory
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'repository.db')}", poolclass=NullPool)
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+    differences = asyncio.run(compare(random_operations(args.operations, args.seed)))
+    raise SystemExit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
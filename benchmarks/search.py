@@ -0,0 +1,83 @@
+"""
+Benchmark for /find over a synthetic database with hundreds of thousands of debt lists, indexed by the same triggers
+the bot uses.
+
+Run with `python -m benchmarks.search`.
+"""
+
+import random
+import statistics
+import time
+
+from sqlalchemy import create_engine, insert, update
+
+from bot.database import search_debt_lists
+from bot.models import Base, Debt, DebtList, SessionLocal
+
+LISTS = 200_000
+USERS = 1_000
+DEBTS_PER_LIST = 4
+QUERIES = ["dinner", "ameens din", "bob", "mo", "karaoke night", "zzz"]
+
+WORDS = [
+    "dinner", "lunch", "breakfast", "supper", "movie", "night", "karaoke", "trip", "hotel", "taxi", "grab", "groceries",
+    "ameens", "prata", "steamboat", "bbq", "birthday", "gift", "concert", "tickets", "rent", "utilities", "bowling",
+]
+HANDLES = ["bob", "carl", "dina", "eve", "faith", "gabe", "hana", "ivan", "jo", "kai", "lee", "mo", "nat", "oli"]
+
+
+def build_database(engine, seed: int = 0) -> None:
+    """Fill the database with sent debt lists, so the triggers index every one of them."""
+    rng = random.Random(seed)
+    with engine.begin() as conn:
+        conn.execute(
+            insert(DebtList),
+            [
+                {
+                    "list_id": list_id,
+                    "user_id": rng.randrange(USERS),
+                    "debt_name": " ".join(rng.sample(WORDS, 2)),
+                    "phone_number": "98765432",
+                    "is_pending": True,
+                }
+                for list_id in range(1, LISTS + 1)
+            ],
+        )
+        conn.execute(
+            insert(Debt),
+            [
+                {
+                    "list_id": list_id,
+                    "owed_by_user_name": handle,
+                    "amount_minor": rng.randint(100, 10_000),
+                    "paid": False,
+                }
+                for list_id in range(1, LISTS + 1)
+                for handle in rng.sample(HANDLES, DEBTS_PER_LIST)
+            ],
+        )
+        # Sending a list to a group is what adds it to the index
+        conn.execute(update(DebtList).values(is_pending=False))
+
+
+def main() -> None:
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+
+    start = time.perf_counter()
+    build_database(engine)
+    print(f"Indexed {LISTS} lists in {time.perf_counter() - start:.1f} s")
+
+    print(f"{'query':>15} {'results':>8} {'p50 ms':>8} {'max ms':>8}")
+    for query in QUERIES:
+        timings = []
+        for user_id in range(0, USERS, 50):
+            start = time.perf_counter()
+            results, _ = search_debt_lists(user_id, query, limit=10)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{query:>15} {len(results):>8} {statistics.median(timings):>8.2f} {max(timings):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark for group debt simplification over synthetic groups of increasing size.
+
+Run with `python -m benchmarks.settlement`.
+"""
+
+import random
+import time
+
+from bot.settlement import plan_settlement
+
+# (members, debts) per synthetic group
+GROUP_SIZES = [(10, 100), (100, 1_000), (1_000, 10_000), (5_000, 50_000), (10_000, 100_000)]
+
+
+def make_group_balances(members: int, debts: int, seed: int = 0) -> dict:
+    """Net a random set of debts, in cents, between members into per-member balances."""
+    rng = random.Random(seed)
+    balances = {member: 0 for member in range(members)}
+    for _ in range(debts):
+        creditor, debtor = rng.sample(range(members), 2)
+        amount = rng.randint(100, 10_000)
+        balances[creditor] += amount
+        balances[debtor] -= amount
+    return balances
+
+
+def check_plan(balances: dict, transfers: list) -> float:
+    """Apply the transfers and return the largest balance left over."""
+    remaining = dict(balances)
+    for payer, payee, amount in transfers:
+        remaining[payer] += amount
+        remaining[payee] -= amount
+    return max(abs(amount) for amount in remaining.values())
+
+
+def main() -> None:
+    print(f"{'members':>8} {'debts':>8} {'net ms':>8} {'plan ms':>8} {'transfers':>10} {'residual':>10}")
+    for members, debts in GROUP_SIZES:
+        start = time.perf_counter()
+        balances = make_group_balances(members, debts)
+        netted = time.perf_counter()
+        transfers = plan_settlement(balances)
+        planned = time.perf_counter()
+        print(
+            f"{members:>8} {debts:>8} {(netted - start) * 1000:>8.1f}"
+            f" {(planned - netted) * 1000:>8.1f} {len(transfers):>10} {check_plan(balances, transfers):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Benchmark for writes with the debt lists sharded across more and more databases. First a burst of pay button presses on
+the lists of many groups, all in flight at once, committed by the database writer of each shard. Then one busy group
+gets a burst of its own while debtors in the other groups keep pressing on a schedule, and the time their presses take
+is reported, which is what sharding is for: a quiet group whose shard is not the busy one's is not queued behind the
+burst. Last, new debt lists are created in those groups one after another, the way the handlers create them, each taking
+its ID from its own shard.
+
+Sharding is measured by the quiet groups' latency, not by the total writes per second. The writes are bound by the
+CPU, statement building in SQLAlchemy under the GIL, rather than by fsync, since a burst is committed in a handful of
+groups, so more writer threads only compete for the GIL and the writes per second go down as shards are added, e.g.
+177, 147 and 138 at 1, 2 and 4 shards, while the quiet groups' median press went from 5.3 s to 60 and 32 ms. Their p99
+does not improve, it is the presses of the quiet groups that share the busy group's shard.
+
+Each shard count runs in a fresh interpreter, since SHARD_COUNT is read when the bot's modules are imported, on a
+database that is filled unsharded and then moved into its shards with `python -m bot.tools rebalance-shards`, which is
+timed too. Uses database files rather than memory, so every commit pays for its fsync like it does in production.
+
+Run with `python -m benchmarks.sharding`, see --help for the sizes.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+DEBTS_PER_LIST = 8
+# Seconds between the presses of the quiet groups
+QUIET_INTERVAL = 0.02
+
+
+def environment(directory: str, shard_count: int) -> dict:
+    return {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{os.path.join(directory, 'sharding.db')}",
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_DATABASE_URL": f"sqlite:///{os.path.join(directory, 'sharding.shard{shard}.db')}",
+    }
+
+
+def build_database(directory: str, groups: int, lists: int) -> None:
+    """An unsharded database, filled with plain SQL so the bot's modules stay out of this process."""
+    subprocess.run(
+        [sys.executable, "-c", "from bot.database import initialize_database; initialize_database()"],
+        env=environment(directory, 1),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    with sqlite3.connect(os.path.join(directory, "sharding.db")) as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, username_lower) VALUES (?, ?, ?)",
+            [(1, "Owner", "owner")]
+            + [(1_000 + debtor, f"User{debtor}", f"user{debtor}") for debtor in range(DEBTS_PER_LIST)],
+        )
+        conn.executemany(
+            "INSERT INTO groups (group_id, group_name, group_type) VALUES (?, ?, 'group')",
+            ((-group_id, f"group {group_id}") for group_id in range(1, groups + 1)),
+        )
+        conn.executemany(
+            "INSERT INTO debt_lists (list_id, user_id, group_id, debt_name, phone_number, is_pending, currency, "
+            "unpaid_count, unpaid_total_minor) VALUES (?, 1, ?, ?, '98765432', 0, 'SGD', ?, ?)",
+            (
+                (list_id, -(list_id % groups + 1), f"dinner {list_id}", DEBTS_PER_LIST, DEBTS_PER_LIST * 1_000)
+                for list_id in range(1, lists + 1)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO debts (list_id, owed_by_user_name, owed_by_user_name_lower, owed_by_user_id, amount_minor, "
+            "paid) VALUES (?, ?, ?, ?, 1000, 0)",
+            (
+                (list_id, f"User{debtor}", f"user{debtor}", 1_000 + debtor)
+                for list_id in range(1, lists + 1)
+                for debtor in range(DEBTS_PER_LIST)
+            ),
+        )
+        # As if the bot had handed out the IDs, see bot.models.DebtListId
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('debt_list_ids', ?)", (lists,))
+
+
+def presses(count: int, list_ids: list, seed: int) -> list:
+    """Debtors pressing ✅ and ❌ on random lists, a press is (list_id, user_id, user_name, paid)."""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(count):
+        debtor = rng.randrange(DEBTS_PER_LIST)
+        result.append((rng.choice(list_ids), 1_000 + debtor, f"user{debtor}", rng.random() < 0.7))
+    return result
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def child(groups: int, lists: int, count: int, creations: int) -> None:
+    """
+    Press every button at once, then press the buttons of one busy group at once while the other groups keep pressing
+    one at a time, then create lists, and print what each took as JSON.
+    """
+    from bot import database, shards
+
+    for shard in shards.every():
+        # Logging every statement would be most of what is timed
+        shard.engine.echo = False
+
+    async def press_all(burst: list) -> None:
+        await asyncio.gather(*(database.update_debt_status(*press) for press in burst))
+
+    started = time.perf_counter()
+    asyncio.run(press_all(presses(count, list(range(1, lists + 1)), seed=0)))
+    seconds = time.perf_counter() - started
+    commits = sum(shard.writer.commits for shard in shards.every())
+
+    # The lists of group -1, see build_database, and of every other group
+    busy = [list_id for list_id in range(1, lists + 1) if list_id % groups == 0]
+    quiet = presses(count, [list_id for list_id in range(1, lists + 1) if list_id % groups], seed=2)
+    latencies = []
+
+    async def press_timed(press: tuple) -> None:
+        started = time.perf_counter()
+        await database.update_debt_status(*press)
+        latencies.append(time.perf_counter() - started)
+
+    async def press_busy_and_quiet() -> None:
+        burst = asyncio.ensure_future(press_all(presses(count, busy, seed=1)))
+        # On a schedule rather than one after another, so a press that is held up does not hold up the next
+        pressed = []
+        for press in quiet:
+            if burst.done():
+                break
+            pressed.append(asyncio.ensure_future(press_timed(press)))
+            await asyncio.sleep(QUIET_INTERVAL)
+        await asyncio.gather(burst, *pressed)
+
+    asyncio.run(press_busy_and_quiet())
+
+    async def create_all() -> None:
+        for number in range(creations):
+            await database.add_debt_list(1, f"lunch {number}", "98765432", group_id=-(number % groups + 1))
+
+    started = time.perf_counter()
+    asyncio.run(create_all())
+    print(
+        json.dumps(
+            {
+                "seconds": seconds,
+                "commits": commits,
+                "quiet": len(latencies),
+                "quiet_p50": percentile(latencies, 0.5),
+                "quiet_p99": percentile(latencies, 0.99),
+                "creation_seconds": time.perf_counter() - started,
+            }
+        )
+    )
+
+
+def run(shard_count: int, groups: int, lists: int, count: int, creations: int) -> dict:
+    directory = tempfile.mkdtemp()
+    build_database(directory, groups, lists)
+    env = environment(directory, shard_count)
+
+    started = time.perf_counter()
+    if shard_count > 1:
+        subprocess.run(
+            [sys.executable, "-m", "bot.tools", "rebalance-shards", "--yes"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    rebalance = time.perf_counter() - started
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.sharding",
+            "--child",
+            f"--groups={groups}",
+            f"--lists={lists}",
+            f"--presses={count}",
+            f"--creations={creations}",
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return dict(json.loads(result.stdout.splitlines()[-1]), rebalance=rebalance)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.sharding")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8], help="shard counts to compare")
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--lists", type=int, default=2_000)
+    parser.add_argument("--presses", type=int, default=5_000)
+    parser.add_argument("--creations", type=int, default=1_000)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.groups, args.lists, args.presses, args.creations)
+        return
+
+    print(
+        f"{'shards':>6} {'presses':>8} {'seconds':>8} {'writes/s':>9} {'commits':>8} {'quiet':>6} {'quiet p50 ms':>13} "
+        f"{'quiet p99 ms':>13} {'creates/s':>10} {'rebalance s':>12}"
+    )
+    for shard_count in args.shards:
+        result = run(shard_count, args.groups, args.lists, args.presses, args.creations)
+        print(
+            f"{shard_count:>6} {args.presses:>8} {result['seconds']:>8.2f} "
+            f"{args.presses / result['seconds']:>9.0f} {result['commits']:>8} "
+            f"{result['quiet']:>6} {result['quiet_p50'] * 1000:>13.1f} {result['quiet_p99'] * 1000:>13.1f} "
+            f"{args.creations / result['creation_seconds']:>10.0f} {result['rebalance']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
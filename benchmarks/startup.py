@@ -0,0 +1,146 @@
+"""
+Benchmark for the bot's time to ready: each run starts a fresh interpreter that runs bot/main.py's startup on a
+database with many users, groups, open debt lists and chat settings, and reports how long each phase took.
+
+Startup as it was, checking the schema by inspecting every table and loading only the inline index, is compared
+against the stored schema version check and the concurrent warmup of every cache. After startup each run also times
+the first membership and settings lookups, which hit the database when their caches are cold.
+
+Run with `python -m benchmarks.startup`, see --help for the sizes. The bot's modules are only imported by the runs, so
+their import time is measured too.
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    "before": ["--full-schema-check", "--cold"],
+    "after": [],
+}
+
+
+def build_database(path: str, users: int, groups: int, memberships: int, lists: int, settings: int) -> None:
+    """An up to date database, filled with plain SQL so the bot's modules stay out of this process."""
+    subprocess.run(
+        [sys.executable, "-c", "from bot.database import initialize_database; initialize_database()"],
+        env={**os.environ, "DATABASE_URL": f"sqlite:///{path}"},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    rng = random.Random(0)
+    with sqlite3.connect(path) as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, username_lower) VALUES (?, ?, ?)",
+            ((user_id, f"User{user_id}", f"user{user_id}") for user_id in range(1, users + 1)),
+        )
+        conn.executemany(
+            "INSERT INTO groups (group_id, group_name, group_type) VALUES (?, ?, 'group')",
+            ((-group_id, f"group {group_id}") for group_id in range(1, groups + 1)),
+        )
+        pairs = {(rng.randint(1, users), -rng.randint(1, groups)) for _ in range(memberships)}
+        conn.executemany("INSERT INTO user_group (user_id, group_id) VALUES (?, ?)", sorted(pairs))
+        conn.executemany(
+            "INSERT INTO debt_lists (user_id, group_id, debt_name, is_pending, currency, unpaid_count, "
+            "unpaid_total_minor) VALUES (?, ?, ?, 0, 'SGD', 3, 3000)",
+            (
+                (rng.randint(1, users), -rng.randint(1, groups), f"dinner at place {number}")
+                for number in range(lists)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO chat_settings (chat_id, timezone, locale) VALUES (?, 'Europe/Berlin', 'en')",
+            ((chat_id,) for chat_id in rng.sample(range(1, users + 1), min(settings, users))),
+        )
+
+
+def run(path: str, mode: str) -> dict:
+    """Start the bot in a fresh interpreter, returning the seconds of each phase and of the first lookups."""
+    if "--full-schema-check" in MODES[mode]:
+        # A checksum no code has makes the next startup inspect every table, as it did before the version check
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA application_id = 0")
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", *MODES[mode]],
+        env={**os.environ, "DATABASE_URL": f"sqlite:///{path}", "BOT_TOKEN": "1:fake"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    seconds = json.loads(result.stdout.splitlines()[-1])
+    seconds["process"] = time.perf_counter() - started
+    return seconds
+
+
+def child(cold: bool) -> None:
+    """One startup, as bot/main.py runs it up to polling, then the first lookups, printed as JSON."""
+    import bot.main
+    from bot.database import is_user_in_group, load_inline_index
+    from bot.settings import chat_settings
+    from bot.startup import StartupTimer
+
+    timer = StartupTimer(bot.main.STARTED)
+    bot.main.time_imports(timer)
+    if cold:
+
+        def warm_caches() -> dict:
+            # Startup as it was: only the inline index was loaded
+            started = time.perf_counter()
+            load_inline_index()
+            return {"open debt lists": time.perf_counter() - started}
+
+        bot.main.warm_caches = warm_caches
+    bot.main.start_up(timer)
+    seconds = dict(timer.phases)
+    seconds["ready"] = timer.total
+
+    path = os.environ["DATABASE_URL"].removeprefix("sqlite:///")
+    with sqlite3.connect(path) as conn:
+        pairs = conn.execute("SELECT user_id, group_id FROM user_group ORDER BY random() LIMIT 1000").fetchall()
+    started = time.perf_counter()
+    for user_id, group_id in pairs:
+        is_user_in_group(user_id, group_id)
+        chat_settings(user_id)
+    seconds["first lookups"] = time.perf_counter() - started
+    print(json.dumps(seconds))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.startup")
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--groups", type=int, default=2_000)
+    parser.add_argument("--memberships", type=int, default=100_000)
+    parser.add_argument("--lists", type=int, default=20_000, help="open debt lists")
+    parser.add_argument("--settings", type=int, default=5_000, help="users with settings of their own")
+    parser.add_argument("--runs", type=int, default=5, help="startups of each mode")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--full-schema-check", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--cold", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.cold)
+        return
+
+    path = os.path.join(tempfile.mkdtemp(), "startup.db")
+    build_database(path, args.users, args.groups, args.memberships, args.lists, args.settings)
+
+    results = {mode: [run(path, mode) for _ in range(args.runs)] for mode in MODES}
+    phases = list(results["after"][0])
+    print(f"Median of {args.runs} startups, ms")
+    print(f"{'phase':>14} " + " ".join(f"{mode:>8}" for mode in MODES))
+    for phase in phases:
+        medians = [statistics.median(run[phase] for run in results[mode]) * 1000 for mode in MODES]
+        print(f"{phase:>14} " + " ".join(f"{median:>8.0f}" for median in medians))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for a burst of pay button presses, committed one by one from several threads the way every write used to
+be, and through the database writer's group commit.
+
+Uses a database file rather than memory, so every commit pays for its fsync like it does in production.
+
+Run with `python -m benchmarks.writes`.
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, insert, update
+from sqlalchemy.exc import OperationalError
+
+from bot import database
+from bot.models import Base, Debt, DebtList, SessionLocal
+from bot.writer import database_writer
+
+LISTS = 500
+DEBTS_PER_LIST = 8
+PRESSES = 2_000
+THREADS = 16
+
+
+def build_database(engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(
+            insert(DebtList),
+            [
+                {
+                    "list_id": list_id,
+                    "user_id": 1,
+                    "group_id": -1,
+                    "debt_name": f"dinner {list_id}",
+                    "phone_number": "98765432",
+                    "is_pending": True,
+                }
+                for list_id in range(1, LISTS + 1)
+            ],
+        )
+        conn.execute(
+            insert(Debt),
+            [
+                {
+                    "list_id": list_id,
+                    "owed_by_user_name": f"user{debtor}",
+                    "amount_minor": 1_000,
+                    "paid": False,
+                }
+                for list_id in range(1, LISTS + 1)
+                for debtor in range(DEBTS_PER_LIST)
+            ],
+        )
+        conn.execute(update(DebtList).values(is_pending=False))
+
+
+def presses(seed: int) -> list:
+    """Debtors pressing ✅ and ❌ on random lists, a press is (list_id, user_id, user_name, paid)."""
+    rng = random.Random(seed)
+    result = []
+    for _ in range(PRESSES):
+        debtor = rng.randrange(DEBTS_PER_LIST)
+        result.append((rng.randint(1, LISTS), 1_000 + debtor, f"user{debtor}", rng.random() < 0.7))
+    return result
+
+
+def commit_alone(press: tuple) -> bool:
+    # What every press did before the writer: its own session, its own transaction and its own fsync
+    db = SessionLocal()
+    try:
+        database._update_debt_status(db, *press, ())
+        db.commit()
+        return True
+    except OperationalError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+
+def run_alone(burst: list) -> tuple:
+    with ThreadPoolExecutor(THREADS) as executor:
+        outcomes = list(executor.map(commit_alone, burst))
+    return len(burst), outcomes.count(False)
+
+
+async def run_grouped(burst: list) -> tuple:
+    await asyncio.gather(*(database.update_debt_status(*press) for press in burst))
+    return len(burst), 0
+
+
+def main() -> None:
+    directory = tempfile.mkdtemp()
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'writes.db')}")
+    Base.metadata.create_all(bind=engine)
+    SessionLocal.configure(bind=engine)
+    build_database(engine)
+
+    print(f"{'mode':>20} {'presses':>8} {'failed':>7} {'seconds':>8} {'writes/s':>9} {'commits':>8}")
+    start = time.perf_counter()
+    done, failed = run_alone(presses(0))
+    elapsed = time.perf_counter() - start
+    print(f"{'commit per press':>20} {done:>8} {failed:>7} {elapsed:>8.2f} {done / elapsed:>9.0f} {done - failed:>8}")
+
+    start = time.perf_counter()
+    done, failed = asyncio.run(run_grouped(presses(1)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{'group commit':>20} {done:>8} {failed:>7} {elapsed:>8.2f} {done / elapsed:>9.0f} {database_writer.commits:>8}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Group analytics for /groupstats, read only from rollups, so the command costs the same however long a group's history is.
+
+The rollups are kept per group and UTC day by update_group_stats, a background job that applies the event log from
+where it stopped last time: lists sent, debts paid and unpaid. How long debts took to be paid is kept as
+a histogram over the buckets below, which is all a median needs, with a total per debtor for the average.
+"""
+
+import json
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from datetime import date
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import events, shards
+from .database import get_db
+from .models import (
+    Balance,
+    Debt,
+    DebtEvent,
+    DebtList,
+    GroupDailyStats,
+    GroupDebtorStats,
+    GroupSettleTimes,
+    RollupState,
+)
+from .views import GroupStatsView
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# Upper bounds of the buckets of the time a debt took to be paid, in seconds, the last bucket is everything longer
+SETTLE_BUCKET_BOUNDS = (HOUR, 6 * HOUR, 12 * HOUR, DAY, 2 * DAY, 3 * DAY, 7 * DAY, 14 * DAY, 30 * DAY)
+
+
+def settle_bucket(seconds: float) -> int:
+    """The bucket of a debt that took the given number of seconds to be paid."""
+    return bisect_right(SETTLE_BUCKET_BOUNDS, seconds)
+
+
+def median_bucket(histogram: tuple) -> int:
+    """
+    The bucket the median of a histogram falls in.
+
+    Args:
+        histogram (tuple): (bucket, debts) pairs, in any order.
+
+    Returns:
+        int: The bucket, or None if the histogram is empty.
+    """
+    total = sum(debts for _, debts in histogram)
+    if total <= 0:
+        return None
+    seen = 0
+    for bucket, debts in sorted(histogram):
+        seen += debts
+        if seen * 2 >= total:
+            return bucket
+    return None
+
+
+# Rollups
+GROUP_STATS_ROLLUP = "group_stats"
+
+
+def _payment_undone(db: Session, list_id: int, debt_id: int, event_id: int) -> tuple:
+    """The (event_id, created_at) of the payment of a debt that an unpaid event undoes, or None."""
+    for paid_event_id, created_at, payload in db.execute(
+        select(DebtEvent.event_id, DebtEvent.created_at, DebtEvent.payload)
+        .where(
+            DebtEvent.list_id == list_id,
+            DebtEvent.kind == events.DEBT_PAID,
+            DebtEvent.event_id < event_id,
+        )
+        .order_by(DebtEvent.event_id.desc())
+    ):
+        if json.loads(payload)["debt_id"] == debt_id:
+            return paid_event_id, created_at
+    return None
+
+
+def _upsert_sums(db: Session, table, key_columns: tuple, rows: dict) -> None:
+    # Adds to the existing row of each key, or inserts it
+    if not rows:
+        return
+    columns = table.__table__.c
+    value_columns = list(next(iter(rows.values())))
+    statement = sqlite_insert(table).values(
+        [dict(zip(key_columns, key), **values) for key, values in rows.items()]
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[columns[name] for name in key_columns],
+            set_={name: columns[name] + statement.excluded[name] for name in value_columns},
+        )
+    )
+
+
+def _apply_group_stats_batch(db: Session, batch_size: int) -> int:
+    """Apply the next batch of events to the rollups and move the watermark, returns the number of events applied."""
+    last_event_id = (
+        db.scalar(select(RollupState.last_event_id).where(RollupState.name == GROUP_STATS_ROLLUP)) or 0
+    )
+    rows = db.execute(
+        select(DebtEvent.event_id, DebtEvent.list_id, DebtEvent.kind, DebtEvent.created_at, DebtEvent.payload)
+        .where(
+            DebtEvent.event_id > last_event_id,
+            DebtEvent.kind.in_((events.LIST_SENT, events.DEBT_PAID, events.DEBT_UNPAID)),
+        )
+        .order_by(DebtEvent.event_id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+
+    # Lists sent as (list_id, group_id, day), and payments as (sign, list_id, debt_id, paid event ID, paid at)
+    sent = []
+    payments = []
+    for event_id, list_id, kind, created_at, payload in rows:
+        payload = json.loads(payload)
+        if kind == events.LIST_SENT:
+            sent.append((list_id, payload["group_id"], created_at.date()))
+        elif kind == events.DEBT_PAID:
+            payments.append((1, list_id, payload["debt_id"], event_id, created_at))
+        else:
+            # Taken back from the day the debt was paid, as it was counted then
+            undone = _payment_undone(db, list_id, payload["debt_id"], event_id)
+            if undone is not None:
+                payments.append((-1, list_id, payload["debt_id"], *undone))
+
+    # Everything the batch needs is read with one query per table. Debts that are gone, with the list they were in,
+    # are skipped, the job runs long before settled lists are archived
+    list_ids = {list_id for list_id, _, _ in sent} | {payment[1] for payment in payments}
+    currencies = dict(
+        db.execute(select(DebtList.list_id, DebtList.currency).where(DebtList.list_id.in_(list_ids))).all()
+    )
+    debts = {
+        row.debt_id: row
+        for row in db.execute(
+            select(
+                Debt.debt_id,
+                DebtList.group_id,
+                DebtList.currency,
+                Debt.owed_by_user_name_lower,
+                Debt.amount_minor,
+            )
+            .join(DebtList, DebtList.list_id == Debt.list_id)
+            .where(Debt.debt_id.in_({payment[2] for payment in payments}))
+        )
+    }
+    # Times each list was sent, oldest first. Debts are timed from the last time their list was sent before they were
+    # paid, lists that predate the event log have no such time and only count towards the totals
+    sent_times = defaultdict(list)
+    for list_id, event_id, created_at in db.execute(
+        select(DebtEvent.list_id, DebtEvent.event_id, DebtEvent.created_at)
+        .where(DebtEvent.list_id.in_({payment[1] for payment in payments}), DebtEvent.kind == events.LIST_SENT)
+        .order_by(DebtEvent.event_id)
+    ):
+        sent_times[list_id].append((event_id, created_at))
+
+    daily = defaultdict(lambda: {"lists_sent": 0, "debts_paid": 0, "amount_paid_minor": 0})
+    settle_times = Counter()
+    debtors = defaultdict(lambda: {"debts_paid": 0, "settle_seconds": 0})
+    for list_id, group_id, day in sent:
+        if list_id in currencies:
+            daily[(group_id, day, currencies[list_id])]["lists_sent"] += 1
+    for sign, list_id, debt_id, paid_event_id, paid_at in payments:
+        debt = debts.get(debt_id)
+        if debt is None or debt.group_id is None:
+            continue
+        day = paid_at.date()
+        daily[(debt.group_id, day, debt.currency)]["debts_paid"] += sign
+        daily[(debt.group_id, day, debt.currency)]["amount_paid_minor"] += sign * debt.amount_minor
+        sent_at = next(
+            (created_at for event_id, created_at in reversed(sent_times[list_id]) if event_id < paid_event_id), None
+        )
+        if sent_at is None:
+            continue
+        settle_seconds = int((paid_at - sent_at).total_seconds())
+        settle_times[(debt.group_id, day, settle_bucket(settle_seconds))] += sign
+        debtors[(debt.group_id, day, debt.owed_by_user_name_lower)]["debts_paid"] += sign
+        debtors[(debt.group_id, day, debt.owed_by_user_name_lower)]["settle_seconds"] += sign * settle_seconds
+
+    _upsert_sums(db, GroupDailyStats, ("group_id", "day", "currency"), daily)
+    _upsert_sums(
+        db,
+        GroupSettleTimes,
+        ("group_id", "day", "bucket"),
+        {key: {"debts": count} for key, count in settle_times.items()},
+    )
+    _upsert_sums(db, GroupDebtorStats, ("group_id", "day", "debtor_name"), debtors)
+    watermark = sqlite_insert(RollupState).values(name=GROUP_STATS_ROLLUP, last_event_id=rows[-1].event_id)
+    db.execute(
+        watermark.on_conflict_do_update(
+            index_elements=[RollupState.name], set_={"last_event_id": watermark.excluded.last_event_id}
+        )
+    )
+    return len(rows)
+
+
+@shards.fan_out(sum)
+def update_group_stats(batch_size: int = 1000) -> int:
+    """
+    Bring the group analytics rollups up to date by applying the events logged since the last run: lists sent, and
+    debts paid and unpaid. Each batch of events is applied in one operation on the database writer together with the ID
+    of its last event, so an interrupted run picks up exactly where it stopped. The first run applies the whole event
+    log. Blocks until every batch is committed.
+
+    Args:
+        batch_size (int, optional): The number of events applied per transaction. Defaults to 1000.
+
+    Returns:
+        int: The number of events applied.
+    """
+    writer = shards.current().writer
+    applied = 0
+    while True:
+        count = writer.run(_apply_group_stats_batch, batch_size)
+        applied += count
+        if count < batch_size:
+            return applied
+
+
+@shards.by_group
+def get_group_stats(group_id: int, since: date, top: int = 5, min_debts: int = 2) -> GroupStatsView:
+    """
+    Read a group's analytics from the rollups and the balances, without touching its debts.
+
+    Args:
+        group_id (int): The ID of the group.
+        since (date): The first UTC day counted.
+        top (int, optional): The number of slowest payers and top debtors. Defaults to 5.
+        min_debts (int, optional): The fewest debts a debtor must have paid to be ranked by how long they take. Defaults to 2.
+
+    Returns:
+        GroupStatsView: The group's analytics.
+    """
+    db: Session = next(get_db())
+    paid = db.execute(
+        select(
+            GroupDailyStats.currency,
+            func.sum(GroupDailyStats.lists_sent),
+            func.sum(GroupDailyStats.debts_paid),
+            func.sum(GroupDailyStats.amount_paid_minor),
+        )
+        .where(GroupDailyStats.group_id == group_id, GroupDailyStats.day >= since)
+        .group_by(GroupDailyStats.currency)
+        .order_by(GroupDailyStats.currency)
+    ).all()
+    settle_times = db.execute(
+        select(GroupSettleTimes.bucket, func.sum(GroupSettleTimes.debts))
+        .where(GroupSettleTimes.group_id == group_id, GroupSettleTimes.day >= since)
+        .group_by(GroupSettleTimes.bucket)
+        .having(func.sum(GroupSettleTimes.debts) > 0)
+    ).all()
+    debts_paid = func.sum(GroupDebtorStats.debts_paid)
+    settle_seconds = func.sum(GroupDebtorStats.settle_seconds)
+    slowest_payers = db.execute(
+        select(GroupDebtorStats.debtor_name, debts_paid, settle_seconds)
+        .where(GroupDebtorStats.group_id == group_id, GroupDebtorStats.day >= since)
+        .group_by(GroupDebtorStats.debtor_name)
+        .having(debts_paid >= min_debts)
+        .order_by((settle_seconds * 1.0 / debts_paid).desc())
+        .limit(top)
+    ).all()
+    outstanding = db.execute(
+        select(Balance.currency, func.sum(Balance.amount_minor))
+        .where(Balance.group_id == group_id)
+        .group_by(Balance.currency)
+        .order_by(Balance.currency)
+    ).all()
+    owed = func.sum(Balance.amount_minor)
+    top_debtors = db.execute(
+        select(Balance.debtor_name, Balance.currency, owed)
+        .where(Balance.group_id == group_id)
+        .group_by(Balance.debtor_name, Balance.currency)
+        .order_by(owed.desc())
+        .limit(top)
+    ).all()
+    return GroupStatsView(
+        lists_sent=sum(row[1] for row in paid),
+        paid=tuple((currency, debts, amount_minor) for currency, _, debts, amount_minor in paid if debts),
+        settle_times=tuple(tuple(row) for row in settle_times),
+        slowest_payers=tuple(tuple(row) for row in slowest_payers),
+        outstanding=tuple(tuple(row) for row in outstanding if row[1]),
+        top_debtors=tuple(tuple(row) for row in top_debtors),
+    )
@@ -0,0 +1,153 @@
+"""
+Archiving of settled debt lists. Lists that have been settled and unchanged for a while are moved out of debt_lists and
+debts, which the bot works on all the time, into archived_debt_lists, where search still finds them, and deleted for good
+once they are older still. Both run in small batches from the archive_debt_lists job in utils/utils.py.
+"""
+
+import json
+import time
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from . import events, shards
+from .database import event_row
+from .models import ArchivedDebtList, Debt, DebtEvent, DebtList
+
+
+def _archive_settled_batch(db: Session, older_than_days: int, batch_size: int) -> int:
+    # Deleting the lists first takes the write lock and only removes lists that are still settled, so a debt that
+    # was marked unpaid since the sweep started is never archived
+    archived_lists = db.execute(
+        delete(DebtList)
+        .where(
+            DebtList.list_id.in_(
+                select(DebtList.list_id)
+                .where(
+                    DebtList.unpaid_count == 0,
+                    DebtList.is_pending == False,
+                    DebtList.last_updated < func.datetime("now", f"-{older_than_days} days"),
+                )
+                .limit(batch_size)
+            ),
+            DebtList.unpaid_count == 0,
+        )
+        .returning(
+            DebtList.list_id,
+            DebtList.user_id,
+            DebtList.group_id,
+            DebtList.debt_name,
+            DebtList.phone_number,
+            DebtList.currency,
+            DebtList.last_updated,
+        )
+    ).all()
+    if not archived_lists:
+        # The writer commits straight after, which releases the write lock the delete took even though it removed
+        # nothing, so it does not lock out the purge
+        return 0
+
+    list_ids = [debt_list.list_id for debt_list in archived_lists]
+    debts = {list_id: [] for list_id in list_ids}
+    for list_id, name, user_id, amount_minor in db.execute(
+        select(
+            Debt.list_id, Debt.owed_by_user_name, Debt.owed_by_user_id, Debt.amount_minor
+        )
+        .where(Debt.list_id.in_(list_ids))
+        .order_by(Debt.debt_id)
+    ):
+        debts[list_id].append([name, user_id, amount_minor])
+
+    db.execute(
+        insert(ArchivedDebtList),
+        [
+            {
+                "list_id": debt_list.list_id,
+                "user_id": debt_list.user_id,
+                "group_id": debt_list.group_id,
+                "debt_name": debt_list.debt_name,
+                "currency": debt_list.currency,
+                "total_minor": sum(debt[2] for debt in debts[debt_list.list_id]),
+                "settled_at": debt_list.last_updated,
+                "data": json.dumps(
+                    {
+                        "phone_number": debt_list.phone_number,
+                        "debts": debts[debt_list.list_id],
+                    },
+                    separators=(",", ":"),
+                    ensure_ascii=False,
+                ),
+            }
+            for debt_list in archived_lists
+        ],
+    )
+    # Every archived debt is paid, so removing them does not change the unpaid counters or the balances rollup
+    db.execute(delete(Debt).where(Debt.list_id.in_(list_ids)))
+    db.execute(
+        insert(DebtEvent), [event_row(list_id, events.LIST_ARCHIVED) for list_id in list_ids]
+    )
+    return len(list_ids)
+
+
+@shards.fan_out(sum)
+def archive_settled_debt_lists(
+    older_than_days: int, batch_size: int = 200, pause: float = 0.1
+) -> int:
+    """
+    Move settled debt lists that have not changed for a while from debt_lists and debts into archived_debt_lists. The lists are moved in small batches, one operation on the database writer each, with a pause in between so the bot's own writes are never held up for long. Blocks until every batch is committed.
+
+    Args:
+        older_than_days (int): Only lists last updated more than this many days ago are archived.
+        batch_size (int, optional): The number of lists moved per transaction. Defaults to 200.
+        pause (float, optional): Seconds to sleep between batches. Defaults to 0.1.
+
+    Returns:
+        int: The number of debt lists archived.
+    """
+    writer = shards.current().writer
+    archived = 0
+    while True:
+        count = writer.run(_archive_settled_batch, older_than_days, batch_size)
+        archived += count
+        if count < batch_size:
+            return archived
+        time.sleep(pause)
+
+
+@shards.fan_out(sum)
+def purge_archived_debt_lists(
+    retention_days: int, batch_size: int = 200, pause: float = 0.1
+) -> int:
+    """
+    Delete archived debt lists that were archived more than retention_days ago, in batches.
+
+    Args:
+        retention_days (int): How long archived lists are kept. 0 keeps them forever.
+        batch_size (int, optional): The number of archived lists deleted per transaction. Defaults to 200.
+        pause (float, optional): Seconds to sleep between batches. Defaults to 0.1.
+
+    Returns:
+        int: The number of archived debt lists deleted.
+    """
+    if retention_days <= 0:
+        return 0
+    writer = shards.current().writer
+    purged = 0
+    while True:
+        count = writer.run(_purge_archived_batch, retention_days, batch_size)
+        purged += count
+        if count < batch_size:
+            return purged
+        time.sleep(pause)
+
+
+def _purge_archived_batch(db: Session, retention_days: int, batch_size: int) -> int:
+    return db.execute(
+        delete(ArchivedDebtList).where(
+            ArchivedDebtList.list_id.in_(
+                select(ArchivedDebtList.list_id)
+                .where(ArchivedDebtList.archived_at < func.datetime("now", f"-{retention_days} days"))
+                .limit(batch_size)
+            )
+        )
+    ).rowcount
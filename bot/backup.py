@@ -0,0 +1,228 @@
+"""
+Online backups of the bot's SQLite database.
+
+Backups use SQLite's backup API, which copies the database a few pages at a time and only holds a read lock for the
+duration of each step, so the bot keeps working while a backup is taken. Each snapshot is checked with
+`PRAGMA integrity_check` before it is gzipped into the backup directory, and only the newest ones are kept.
+
+With sharding on, a backup is a set of one file per shard taken in the same run and named after the same time, see
+set_paths(). Shard 0's file names the set and is only written once every other shard's is, so a set that is listed is
+complete. Restoring replaces every shard from its file in the set. A list moving between shards while the set was taken
+is left half moved in it, which the bot finishes when it starts, like after a crash, see bot/rebalance.py.
+"""
+
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import List
+
+from . import shards
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX = "debt_tracker-"
+BACKUP_SUFFIX = ".db.gz"
+
+# Figures of the last backup taken by this process, and how many were taken or failed, for logging and monitoring
+metrics = {
+    "backups": 0,
+    "failures": 0,
+    "last_duration_seconds": None,
+    "last_size_bytes": None,
+    "last_compressed_bytes": None,
+    "last_backup_at": None,
+}
+
+
+def set_paths(path: str, shard_count: int = None) -> List[str]:
+    """
+    The paths of the files of a backup set, one per shard, given the path of the set, which is shard 0's file.
+
+    Args:
+        path (str): The path of the backup set.
+        shard_count (int, optional): The number of shards. Defaults to the number the bot runs with.
+
+    Returns:
+        List[str]: The path of each shard's backup, in shard order.
+    """
+    stem = path[: -len(BACKUP_SUFFIX)] if path.endswith(BACKUP_SUFFIX) else path
+    return [path] + [
+        f"{stem}-shard{index}{BACKUP_SUFFIX}" for index in range(1, shard_count or len(shards.every()))
+    ]
+
+
+def _copy(source: sqlite3.Connection, target: sqlite3.Connection, pages: int, pause: float) -> None:
+    # Sleeping between steps, while no lock is held, gives the bot's writers a chance to get in
+    def progress(status, remaining, total):
+        if remaining and pause:
+            time.sleep(pause)
+
+    source.backup(target, pages=pages, progress=progress)
+
+
+def _check_integrity(connection: sqlite3.Connection) -> None:
+    problems = [row[0] for row in connection.execute("PRAGMA integrity_check")]
+    if problems != ["ok"]:
+        raise sqlite3.DatabaseError("Integrity check failed: " + "; ".join(problems[:10]))
+
+
+def list_backups(directory: str) -> List[str]:
+    """
+    List the backups in a directory.
+
+    Args:
+        directory (str): The backup directory.
+
+    Returns:
+        List[str]: The paths of the backups, newest first. With sharding on, these are the paths of the sets.
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = [
+        name
+        for name in os.listdir(directory)
+        if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX) and "-shard" not in name
+    ]
+    # The timestamp in the name sorts in the order the backups were taken
+    return [os.path.join(directory, name) for name in sorted(names, reverse=True)]
+
+
+def _snapshot(shard: shards.Shard, directory: str, pages: int, pause: float) -> str:
+    # Copies and checks one shard's database into a temporary file in the backup directory, and returns its path
+    descriptor, snapshot_path = tempfile.mkstemp(dir=directory, suffix=".db")
+    os.close(descriptor)
+    try:
+        source = sqlite3.connect(shard.engine.url.database)
+        snapshot = sqlite3.connect(snapshot_path)
+        try:
+            _copy(source, snapshot, pages, pause)
+            _check_integrity(snapshot)
+        finally:
+            snapshot.close()
+            source.close()
+    except Exception:
+        os.remove(snapshot_path)
+        raise
+    return snapshot_path
+
+
+def create_backup(directory: str, keep: int, pages: int = 256, pause: float = 0.05) -> dict:
+    """
+    Take a backup of the database, of every shard when sharding is on, while the bot is running, verify it and
+    compress it into the backup directory, then delete all but the newest backups.
+
+    Args:
+        directory (str): The backup directory, created if it does not exist.
+        keep (int): The number of backups to keep, 0 keeps all of them.
+        pages (int, optional): Pages copied per step. Defaults to 256.
+        pause (float, optional): Seconds to wait between steps. Defaults to 0.05.
+
+    Returns:
+        dict: path, size_bytes, compressed_bytes and duration_seconds of the backup, summed over its shards.
+
+    Raises:
+        sqlite3.DatabaseError: When a copy fails the integrity check, no backup is kept then.
+    """
+    os.makedirs(directory, exist_ok=True)
+    started = time.monotonic()
+    taken_at = datetime.now(timezone.utc)
+    path = os.path.join(directory, f"{BACKUP_PREFIX}{taken_at:%Y%m%d-%H%M%S}{BACKUP_SUFFIX}")
+    paths = set_paths(path)
+
+    snapshot_paths = []
+    try:
+        for shard in shards.every():
+            snapshot_paths.append(_snapshot(shard, directory, pages, pause))
+
+        size = 0
+        for snapshot_path, shard_path in zip(snapshot_paths, paths):
+            size += os.path.getsize(snapshot_path)
+            with open(snapshot_path, "rb") as plain, gzip.open(shard_path + ".part", "wb") as compressed:
+                shutil.copyfileobj(plain, compressed)
+        # Only complete files get their backup name, shard 0's last, so a crash never leaves a truncated backup behind
+        for shard_path in reversed(paths):
+            os.replace(shard_path + ".part", shard_path)
+    except Exception:
+        metrics["failures"] += 1
+        for shard_path in paths:
+            if os.path.exists(shard_path + ".part"):
+                os.remove(shard_path + ".part")
+        raise
+    finally:
+        for snapshot_path in snapshot_paths:
+            os.remove(snapshot_path)
+
+    for old_backup in list_backups(directory)[keep:] if keep else []:
+        for old_path in set_paths(old_backup):
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    result = {
+        "path": path,
+        "size_bytes": size,
+        "compressed_bytes": sum(os.path.getsize(shard_path) for shard_path in paths),
+        "duration_seconds": time.monotonic() - started,
+    }
+    metrics.update(
+        backups=metrics["backups"] + 1,
+        last_duration_seconds=result["duration_seconds"],
+        last_size_bytes=result["size_bytes"],
+        last_compressed_bytes=result["compressed_bytes"],
+        last_backup_at=taken_at,
+    )
+    return result
+
+
+def restore_backup(path: str, pages: int = 256) -> None:
+    """
+    Replace the contents of the database, of every shard when sharding is on, with a backup. Every file of the backup
+    is verified before anything is overwritten. The bot should be stopped first, it migrates the restored database to
+    the current schema when it starts again.
+
+    Args:
+        path (str): The path of the backup, gzipped or not, the path of the set when sharding is on.
+        pages (int, optional): Pages copied per step. Defaults to 256.
+
+    Raises:
+        FileNotFoundError: When the backup has no file for one of the shards.
+        ValueError: When the backup was taken with more shards than the bot runs with.
+        sqlite3.DatabaseError: When a file of the backup fails the integrity check.
+    """
+    paths = set_paths(path)
+    missing = [shard_path for shard_path in paths if not os.path.exists(shard_path)]
+    if missing:
+        raise FileNotFoundError(f"The backup has no file for every shard, missing {', '.join(missing)}")
+    if os.path.exists(set_paths(path, len(paths) + 1)[-1]):
+        raise ValueError(f"{path} was taken with more than {len(paths)} shard(s), set SHARD_COUNT to match")
+
+    snapshot_paths = []
+    try:
+        for shard_path in paths:
+            descriptor, snapshot_path = tempfile.mkstemp(suffix=".db")
+            os.close(descriptor)
+            snapshot_paths.append(snapshot_path)
+            opener = gzip.open if shard_path.endswith(".gz") else open
+            with opener(shard_path, "rb") as backup, open(snapshot_path, "wb") as plain:
+                shutil.copyfileobj(backup, plain)
+            with closing(sqlite3.connect(snapshot_path)) as snapshot:
+                _check_integrity(snapshot)
+
+        for shard, snapshot_path in zip(shards.every(), snapshot_paths):
+            snapshot = sqlite3.connect(snapshot_path)
+            target = sqlite3.connect(shard.engine.url.database)
+            try:
+                # Copying into the live file through SQLite, rather than over it, keeps its locking and journal intact
+                _copy(snapshot, target, pages, 0)
+            finally:
+                target.close()
+                snapshot.close()
+    finally:
+        for snapshot_path in snapshot_paths:
+            os.remove(snapshot_path)
+    logger.info("Restored the database from %s", path)
@@ -1,41 +1,498 @@
+import asyncio
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import islice
+from operator import attrgetter, itemgetter
+from typing import Iterable, Iterator
+
+from sqlalchemy import (
+    DateTime,
+    String,
+    case,
+    cast,
+    delete,
+    func,
+    insert,
+    inspect,
+    literal,
+    or_,
+    select,
+    text,
+    tuple_,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from .models import engine, SessionLocal, User, Group, DebtList, Debt
+
+from config.config import DEFAULT_CURRENCY
+from . import events, outbox, shards
+from .inline_index import open_debt_lists_index
+from .membership import group_memberships
+from .writer import after_commit
+from .models import (
+    ArchivedDebtList,
+    Balance,
+    ChatSettings,
+    DebtEvent,
+    DebtListId,
+    OutboxMessage,
+    User,
+    Group,
+    DebtList,
+    Debt,
+    normalize_username,
+    user_group_association,
+)
+from .views import (
+    DebtListView,
+    DebtView,
+    GroupView,
+    SearchResultView,
+)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
 
 
 def get_db():
-    db = SessionLocal()
+    db = shards.current().session_factory()
     try:
         yield db
     finally:
         db.close()
 
 
+# Event log
+
+_event_batch_id: ContextVar[int] = ContextVar("event_batch_id", default=None)
+
+
+@contextmanager
+def event_batch():
+    """
+    Group the events recorded inside the block into one batch, so that /undo treats them as a single operation.
+    """
+    # 63 random bits, so the ID fits in an SQLite integer
+    token = _event_batch_id.set(uuid.uuid4().int >> 65)
+    try:
+        yield
+    finally:
+        _event_batch_id.reset(token)
+
+
+def event_row(list_id: int, kind: int, actor_id: int = None, **payload) -> dict:
+    return {
+        "list_id": int(list_id),
+        "kind": kind,
+        "actor_id": actor_id,
+        "batch_id": _event_batch_id.get(),
+        "payload": events.encode_payload(payload),
+    }
+
+
+def record_event(db: Session, list_id: int, kind: int, actor_id: int = None, **payload) -> None:
+    # Added to the session of the change being recorded, so both are committed or rolled back together
+    db.add(DebtEvent(**event_row(list_id, kind, actor_id, **payload)))
+
+
 # User operations
-def add_or_update_user(
+
+# user_id -> (username, first_name, last_name) last saved by this process
+_saved_users = {}
+
+
+async def add_or_update_user(
     user_id: int, username: str, first_name: str, last_name: str
 ) -> int:
-    db: Session = next(get_db())
+    """
+    Save a user's current details, and move their debts and balances along if their username changed. Runs on the database writer, it is called for every group message.
+
+    When sharding is on the user is saved to every shard, each on its own writer, since every shard matches its debts to users by handle. Details this process already saved are not written again, so the usual group message costs no write at all, sharded or not.
+
+    Args:
+        user_id (int): The ID of the user.
+        username (str): The user's current username, may be None.
+        first_name (str): The user's first name.
+        last_name (str): The user's last name.
+
+    Returns:
+        int: The ID of the user.
+    """
+    details = (username, first_name, last_name)
+    if _saved_users.get(user_id) == details:
+        return user_id
+    await asyncio.gather(
+        *(
+            shard.writer.execute(_add_or_update_user, user_id, username, first_name, last_name)
+            for shard in shards.every()
+        )
+    )
+    _saved_users[user_id] = details
+    return user_id
+
+
+def _add_or_update_user(
+    db: Session, user_id: int, username: str, first_name: str, last_name: str
+) -> int:
+    username_lower = normalize_username(username)
+    # A handle names one account at a time, so whoever was saved with it before has given it up
+    previous_holders = take_over_handle(db, user_id, username_lower)
+    if previous_holders:
+        # Their saved details no longer match the database, so the next time they are seen they are saved again
+        after_commit(db, lambda: [_saved_users.pop(holder, None) for holder in previous_holders])
     # Try to fetch the existing user
     user = db.query(User).filter(User.user_id == user_id).first()
+    previous_username_lower = None
     if user:
+        previous_username_lower = user.username_lower
+        username_changed = previous_username_lower != username_lower
         # Update existing user details
         user.username = username
+        user.username_lower = username_lower
         user.first_name = first_name
         user.last_name = last_name
     else:
+        username_changed = True
         # Create a new User instance and add it to the session
         user = User(
             user_id=user_id,
             username=username,
+            username_lower=username_lower,
             first_name=first_name,
             last_name=last_name,
         )
         db.add(user)
 
-    # Commit the session to save changes
-    db.commit()
+    if username_changed or previous_holders:
+        link_debts_to_user(db, user_id, username, username_lower)
+        # Balances are keyed by the debtor's handle, so move them to the new one
+        rebuild_debtor_balances(
+            db, user_id, [previous_username_lower, username_lower]
+        )
+
+    # Committed by the writer, together with whatever else it has queued
+    return user_id
+
+
+def take_over_handle(db: Session, user_id: int, username_lower: str) -> list:
+    """
+    Take a handle away from the other users still saved with it, who have since renamed without the bot seeing it, along with the debts written for the handle that were linked to them. The caller is responsible for committing and for rebuilding the balances of the handle.
+
+    Args:
+        db (Session): The session to run the updates in.
+        user_id (int): The ID of the user who holds the handle now.
+        username_lower (str): The normalized form of the user's current username.
+
+    Returns:
+        list: The IDs of the users the handle was taken from.
+    """
+    if not username_lower:
+        return []
+    previous_holders = list(
+        db.scalars(
+            select(User.user_id).where(User.username_lower == username_lower, User.user_id != user_id)
+        )
+    )
+    if previous_holders:
+        db.execute(update(User).where(User.user_id.in_(previous_holders)).values(username_lower=None))
+        db.execute(
+            update(Debt)
+            .where(
+                Debt.owed_by_user_id.in_(previous_holders),
+                Debt.owed_by_user_name_lower == username_lower,
+            )
+            .values(owed_by_user_id=user_id)
+        )
+    return previous_holders
+
+
+def users_by_handle(db: Session, names_lower: Iterable) -> dict:
+    """
+    Resolve normalized handles to the users who hold them. A handle that more than one saved user still holds, as old databases can have from when handles were case sensitive, resolves to no one until its holder is seen again.
+
+    Args:
+        db (Session): The session to run the query in.
+        names_lower (Iterable): Normalized handles.
+
+    Returns:
+        dict: username_lower -> user_id of the handles held by exactly one user.
+    """
+    holders = {}
+    for username_lower, user_id in db.query(User.username_lower, User.user_id).filter(
+        User.username_lower.in_(set(names_lower))
+    ):
+        holders.setdefault(username_lower, []).append(user_id)
+    return {username_lower: user_ids[0] for username_lower, user_ids in holders.items() if len(user_ids) == 1}
+
 
-    return user.user_id
+def link_debts_to_user(
+    db: Session, user_id: int, username: str, username_lower: str
+) -> None:
+    """
+    Link debts to a user by ID and keep their displayed username current. Debts that were written for the user's handle before the bot saw them get linked, and debts that are already linked follow the user's new handle. The caller is responsible for committing.
+
+    Args:
+        db (Session): The session to run the updates in.
+        user_id (int): The ID of the user.
+        username (str): The user's current username.
+        username_lower (str): The normalized form of the user's current username.
+    """
+    if username_lower:
+        db.execute(
+            update(Debt)
+            .where(
+                Debt.owed_by_user_id.is_(None),
+                Debt.owed_by_user_name_lower == username_lower,
+            )
+            .values(owed_by_user_id=user_id)
+        )
+        db.execute(
+            update(Debt)
+            .where(
+                Debt.owed_by_user_id == user_id,
+                Debt.owed_by_user_name_lower.is_not(username_lower),
+            )
+            .values(owed_by_user_name=username, owed_by_user_name_lower=username_lower)
+        )
+    # A user who removed their username keeps the debts under the handle they were written for, debts and balances
+    # are keyed by handle
+
+
+def _outstanding_balances_query():
+    """Build a query that recomputes the balances rollup from the debts table."""
+    return (
+        select(
+            DebtList.group_id,
+            DebtList.user_id.label("creditor_id"),
+            Debt.owed_by_user_name_lower.label("debtor_name"),
+            DebtList.currency,
+            func.max(Debt.owed_by_user_id).label("debtor_user_id"),
+            func.sum(Debt.amount_minor).label("amount_minor"),
+        )
+        .join(DebtList, DebtList.list_id == Debt.list_id)
+        .where(DebtList.group_id.is_not(None), Debt.paid == False)
+        .group_by(
+            DebtList.group_id,
+            DebtList.user_id,
+            Debt.owed_by_user_name_lower,
+            DebtList.currency,
+        )
+    )
+
+
+def rebuild_debtor_balances(db: Session, user_id: int, debtor_names: list) -> None:
+    """
+    Recompute the balance rows of a single debtor from their debts. Used when a debtor's handle changes, since balances are keyed by handle. The caller is responsible for committing.
+
+    Args:
+        db (Session): The session to run the updates in.
+        user_id (int): The ID of the debtor.
+        debtor_names (list): Every normalized handle the debtor's balances may be stored under.
+    """
+    debtor_names = [name for name in debtor_names if name]
+    db.execute(
+        delete(Balance).where(
+            or_(
+                Balance.debtor_user_id == user_id,
+                Balance.debtor_name.in_(debtor_names),
+            )
+        )
+    )
+    recomputed = _outstanding_balances_query().where(
+        or_(
+            Debt.owed_by_user_id == user_id,
+            Debt.owed_by_user_name_lower.in_(debtor_names),
+        )
+    )
+    rows = [row._asdict() for row in db.execute(recomputed)]
+    if rows:
+        db.execute(insert(Balance), rows)
+
+
+@shards.fan_out(shards.concat)
+def check_balances(fix: bool = False) -> list:
+    """
+    Compare the balances rollup against a full recomputation from the debts table.
+
+    Args:
+        fix (bool, optional): Whether to replace the rollup with the recomputed balances when they differ. Defaults to False.
+
+    Returns:
+        list: A list of ((group_id, creditor_id, debtor_name, currency), stored, actual) tuples for every mismatched balance, where a missing balance is reported as 0.
+    """
+    if fix:
+        # Compared and fixed in one transaction, so nothing the bot writes in between is overwritten
+        return shards.current().writer.run(_check_balances, fix)
+    return _check_balances(next(get_db()), fix)
+
+
+def _check_balances(db: Session, fix: bool) -> list:
+    stored = {
+        (row.group_id, row.creditor_id, row.debtor_name, row.currency): row.amount_minor
+        for row in db.query(Balance).all()
+    }
+    recomputed = [row._asdict() for row in db.execute(_outstanding_balances_query())]
+    actual = {
+        (
+            row["group_id"],
+            row["creditor_id"],
+            row["debtor_name"],
+            row["currency"],
+        ): row["amount_minor"]
+        for row in recomputed
+    }
+
+    mismatches = []
+    for key in sorted(stored.keys() | actual.keys(), key=str):
+        if stored.get(key, 0) != actual.get(key, 0):
+            mismatches.append((key, stored.get(key, 0), actual.get(key, 0)))
+
+    if fix and mismatches:
+        db.execute(delete(Balance))
+        if recomputed:
+            db.execute(insert(Balance), recomputed)
+    return mismatches
+
+
+@shards.fan_out(shards.union)
+def get_user_balances(user_id: int) -> dict:
+    """
+    Retrieve the net amounts between a user and everyone they share debts with, per group.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        dict: A mapping of group ID to a list of (counterparty, currency, amount_minor) tuples, where counterparty is a display name and a positive amount means the counterparty owes the user.
+    """
+    db: Session = next(get_db())
+    username_lower = (
+        db.query(User.username_lower).filter(User.user_id == user_id).scalar()
+    )
+
+    # Net each counterparty by user ID where it is known, and by handle otherwise
+    owed_to_user = select(
+        Balance.group_id,
+        Balance.currency,
+        func.coalesce(
+            cast(Balance.debtor_user_id, String), "@" + Balance.debtor_name
+        ).label("counterparty"),
+        Balance.amount_minor,
+    ).where(Balance.creditor_id == user_id)
+    owed_by_user_conditions = [Balance.debtor_user_id == user_id]
+    if username_lower:
+        owed_by_user_conditions.append(
+            (Balance.debtor_user_id.is_(None))
+            & (Balance.debtor_name == username_lower)
+        )
+    owed_by_user = select(
+        Balance.group_id,
+        Balance.currency,
+        cast(Balance.creditor_id, String).label("counterparty"),
+        (-Balance.amount_minor).label("amount_minor"),
+    ).where(or_(*owed_by_user_conditions))
+    both = union_all(owed_to_user, owed_by_user).subquery()
+    net = db.execute(
+        select(
+            both.c.group_id,
+            both.c.currency,
+            both.c.counterparty,
+            func.sum(both.c.amount_minor).label("amount_minor"),
+        )
+        .group_by(both.c.group_id, both.c.currency, both.c.counterparty)
+        .having(func.sum(both.c.amount_minor) != 0)
+    ).all()
+
+    counterparty_ids = {
+        int(row.counterparty) for row in net if not row.counterparty.startswith("@")
+    }
+    names = {
+        str(user.user_id): f"@{user.username}" if user.username else user.first_name
+        for user in db.query(User).filter(User.user_id.in_(counterparty_ids))
+    }
+
+    balances = {}
+    for row in net:
+        balances.setdefault(row.group_id, []).append(
+            (
+                names.get(row.counterparty, row.counterparty),
+                row.currency,
+                row.amount_minor,
+            )
+        )
+    return balances
+
+
+@shards.by_group
+def get_group_member_balances(group_id: int) -> dict:
+    """
+    Retrieve the net balance of every member of a group across all the group's outstanding debts.
+
+    Args:
+        group_id (int): The ID of the group.
+
+    Returns:
+        dict: A mapping of currency to a mapping of member display name to net balance in minor units. Positive means the member is owed money, negative means the member owes money.
+    """
+    db: Session = next(get_db())
+    credits = db.execute(
+        select(
+            Balance.creditor_id,
+            Balance.currency,
+            func.sum(Balance.amount_minor).label("amount_minor"),
+        )
+        .where(Balance.group_id == group_id)
+        .group_by(Balance.creditor_id, Balance.currency)
+    ).all()
+    debits = db.execute(
+        select(
+            Balance.debtor_name,
+            Balance.currency,
+            func.sum(Balance.amount_minor).label("amount_minor"),
+        )
+        .where(Balance.group_id == group_id)
+        .group_by(Balance.debtor_name, Balance.currency)
+    ).all()
+
+    creditors = {}
+    display_names = {}
+    creditor_ids = {row.creditor_id for row in credits}
+    for user in db.query(User).filter(User.user_id.in_(creditor_ids)):
+        creditors[user.user_id] = user.username_lower or f"id:{user.user_id}"
+        if not user.username_lower:
+            display_names[creditors[user.user_id]] = user.first_name
+
+    # Members are identified by normalized handle, so debts and credits of the same person net out
+    net = {}
+    for row in credits:
+        if row.creditor_id not in creditors:
+            creditors[row.creditor_id] = f"id:{row.creditor_id}"
+            display_names[creditors[row.creditor_id]] = f"User {row.creditor_id}"
+        creditor = creditors[row.creditor_id]
+        members = net.setdefault(row.currency, {})
+        members[creditor] = members.get(creditor, 0) + row.amount_minor
+    for row in debits:
+        members = net.setdefault(row.currency, {})
+        members[row.debtor_name] = members.get(row.debtor_name, 0) - row.amount_minor
+
+    handles = {member for members in net.values() for member in members}
+    for user in db.query(User).filter(User.username_lower.in_(handles)):
+        display_names[user.username_lower] = f"@{user.username}"
+    return {
+        currency: {
+            display_names.get(member, f"@{member}"): amount_minor
+            for member, amount_minor in members.items()
+            if amount_minor
+        }
+        for currency, members in net.items()
+    }
 
 
 def get_user_groups(user_id: int) -> list:
@@ -46,18 +503,16 @@ def get_user_groups(user_id: int) -> list:
         user_id (int): The ID of the user.
 
     Returns:
-        list: A list of dictionaries containing the group ID and group name.
+        list: A list of GroupView, empty if the user is unknown or in no group.
 
     """
     db: Session = next(get_db())
-    user: User = db.query(User).filter(User.user_id == user_id).first()
-    # check if user is not associated with any group
-    if not user:
-        return []
-    return [
-        {"group_id": group.group_id, "group_name": group.group_name}
-        for group in user.groups
-    ]
+    rows = db.execute(
+        select(Group.group_id, Group.group_name)
+        .join(user_group_association, user_group_association.c.group_id == Group.group_id)
+        .where(user_group_association.c.user_id == user_id)
+    )
+    return [GroupView(group_id, group_name) for group_id, group_name in rows]
 
 
 def is_user_in_group(user_id: int, group_id: int) -> bool:
@@ -71,27 +526,49 @@ def is_user_in_group(user_id: int, group_id: int) -> bool:
     Returns:
         bool: True if the user is a member of the group, False otherwise.
     """
+    # Memberships are never removed, so only the ones not seen yet need the database
+    if group_memberships.contains(user_id, group_id):
+        return True
     db: Session = next(get_db())
-    user = db.query(User).filter(User.user_id == user_id).first()
-    group = db.query(Group).filter(Group.group_id == group_id).first()
-    if user and group:
-        return group in user.groups
-    return False
+    is_member = db.execute(
+        select(literal(1)).where(
+            user_group_association.c.user_id == user_id,
+            user_group_association.c.group_id == group_id,
+        )
+    ).first() is not None
+    if is_member:
+        group_memberships.add(user_id, group_id)
+    return is_member
 
 
-def add_or_update_group(group_id: int, group_name: str, group_type: str) -> Group:
+def load_group_memberships() -> None:
     """
-    Add or update a group in the database.
+    Fill the in-memory set of memberships checked on every group message. Called once at startup, memberships found or
+    added later are added to it as they are.
+    """
+    db: Session = next(get_db())
+    # One row per group rather than per membership, which takes a fraction of the time to fetch
+    rows = db.execute(
+        select(user_group_association.c.group_id, func.group_concat(user_group_association.c.user_id))
+        .where(user_group_association.c.user_id.isnot(None))
+        .group_by(user_group_association.c.group_id)
+    )
+    group_memberships.load((group_id, map(int, user_ids.split(","))) for group_id, user_ids in rows)
+
+
+async def add_or_update_group(group_id: int, group_name: str, group_type: str) -> None:
+    """
+    Add or update a group in the database, on the database writer.
 
     Args:
         group_id (int): The ID of the group.
         group_name (str): The name of the group.
         group_type (str): The type of the group.
-
-    Returns:
-        Group: The updated or newly created group object.
     """
-    db: Session = next(get_db())
+    await shards.current().writer.execute(_add_or_update_group, group_id, group_name, group_type)
+
+
+def _add_or_update_group(db: Session, group_id: int, group_name: str, group_type: str) -> None:
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if group:
         group.group_name = group_name
@@ -99,12 +576,13 @@ def add_or_update_group(group_id: int, group_name: str, group_type: str) -> Grou
     else:
         group = Group(group_id=group_id, group_name=group_name, group_type=group_type)
         db.add(group)
-    db.commit()
-    return group
 
 
-def associate_user_with_group(user_id: int, group_id: int) -> None:
-    db: Session = next(get_db())
+async def associate_user_with_group(user_id: int, group_id: int) -> None:
+    await shards.current().writer.execute(_associate_user_with_group, user_id, group_id)
+
+
+def _associate_user_with_group(db: Session, user_id: int, group_id: int) -> None:
     user = db.query(User).filter(User.user_id == user_id).first()
     group = db.query(Group).filter(Group.group_id == group_id).first()
     if not user or not group:
@@ -116,7 +594,7 @@ def associate_user_with_group(user_id: int, group_id: int) -> None:
     if group not in user.groups:
         # If not, add the group to the user's groups collection
         user.groups.append(group)
-        db.commit()
+    after_commit(db, lambda: group_memberships.add(user_id, group_id))
 
 
 def get_group_name(group_id: int) -> str:
@@ -127,6 +605,71 @@ def get_group_name(group_id: int) -> str:
     return ""  # TODO: Should return some error instead
 
 
+def get_chat_settings(chat_id: int) -> dict:
+    """
+    Get the settings a user or group has chosen.
+
+    Args:
+        chat_id (int): The ID of the user or group.
+
+    Returns:
+        dict: The timezone, locale and amount_style, each None if not chosen, or None if nothing was ever chosen.
+    """
+    db: Session = next(get_db())
+    settings = db.get(ChatSettings, chat_id)
+    if not settings:
+        return None
+    return {
+        "timezone": settings.timezone,
+        "locale": settings.locale,
+        "amount_style": settings.amount_style,
+    }
+
+
+def get_all_chat_settings() -> list:
+    """
+    Get the settings of every user and group that has chosen any.
+
+    Returns:
+        list: (chat_id, timezone, locale, amount_style) tuples, each setting None if not chosen.
+    """
+    db: Session = next(get_db())
+    return db.execute(
+        select(ChatSettings.chat_id, ChatSettings.timezone, ChatSettings.locale, ChatSettings.amount_style)
+    ).all()
+
+
+async def save_chat_settings(chat_id: int, **changes) -> None:
+    """
+    Store some of a user's or group's settings, keeping the others, on the database writer. A value of None goes back to the default.
+
+    Args:
+        chat_id (int): The ID of the user or group.
+        **changes: New values for timezone, locale or amount_style.
+    """
+    await shards.current().writer.execute(_save_chat_settings, chat_id, changes)
+
+
+def _save_chat_settings(db: Session, chat_id: int, changes: dict) -> None:
+    db.execute(
+        sqlite_insert(ChatSettings)
+        .values(chat_id=chat_id, **changes)
+        .on_conflict_do_update(
+            index_elements=[ChatSettings.chat_id],
+            set_={**changes, "updated_at": func.now()},
+        )
+    )
+
+
+async def delete_chat_settings(chat_id: int) -> None:
+    await shards.current().writer.execute(_delete_chat_settings, chat_id)
+
+
+def _delete_chat_settings(db: Session, chat_id: int) -> None:
+    db.execute(delete(ChatSettings).where(ChatSettings.chat_id == chat_id))
+
+
+@shards.fan_out(shards.first)
 def user_has_pending_debt_list(user_id: int) -> bool:
     db: Session = next(get_db())
     debt_lists = (
@@ -137,74 +680,521 @@ def user_has_pending_debt_list(user_id: int) -> bool:
     return debt_lists[0].list_id if debt_lists else 0
 
 
-def add_debt_list(
+def new_list_id(db: Session) -> int:
+    """
+    The ID of a new debt list in the bound shard, taken in the transaction that creates the list. Never one that was
+    handed out before, see DebtListId, and unique across shards, see shards.global_id().
+    """
+    local_id = db.scalar(insert(DebtListId).returning(DebtListId.list_id))
+    db.execute(delete(DebtListId).where(DebtListId.list_id == local_id))
+    return shards.global_id(local_id)
+
+
+@shards.by_owner
+async def add_debt_list(
     user_id: int,
     debt_name: str,
     phone_number: str,
     group_id: int = None,
+    currency: str = DEFAULT_CURRENCY,
+    debts: Iterable = (),
 ) -> int:
     """
-    Adds a debt list for a user in the database.
+    Adds a debt list for a user in the database, with its debts, in one operation on the database writer.
 
     Args:
         user_id (int): The ID of the user.
         debt_name (str): The name of the debt.
         phone_number (str): The phone number associated with the debt.
         group_id (int, optional): The ID of the group the debt belongs to. Defaults to None.
+        currency (str, optional): The ISO 4217 code of the currency the debts are in. Defaults to DEFAULT_CURRENCY.
+        debts (Iterable, optional): (owed_by_user_name, amount_minor) tuples to add to the list, a handle that comes up again replaces what it owes. Defaults to ().
 
     Returns:
         DebtList: The ID of the newly created debt list.
 
     """
-    db: Session = next(get_db())
+    return await shards.current().writer.execute(
+        _add_debt_list, user_id, debt_name, phone_number, group_id, currency, list(debts)
+    )
+
+
+def _add_debt_list(
+    db: Session, user_id: int, debt_name: str, phone_number: str, group_id: int, currency: str, debts: list
+) -> int:
     debt_list = DebtList(
+        list_id=new_list_id(db),
         user_id=user_id,
         group_id=group_id,
         debt_name=debt_name,
         phone_number=phone_number,
+        currency=currency,
     )
     db.add(debt_list)
-    db.commit()
+    db.flush()
+    record_event(
+        db,
+        debt_list.list_id,
+        events.LIST_CREATED,
+        user_id,
+        user_id=user_id,
+        debt_name=debt_name,
+        phone_number=phone_number,
+        currency=currency,
+        group_id=group_id,
+        pending=True,
+    )
+    for owed_by_user_name, amount_minor in debts:
+        _add_or_update_debt(db, debt_list.list_id, owed_by_user_name, amount_minor, False, user_id)
     return debt_list.list_id
 
 
-def update_debt_list_group(list_id: int, group_id: int) -> None:
-    db: Session = next(get_db())
+@shards.by_list
+async def update_debt_list_group(list_id: int, group_id: int) -> bool:
+    """
+    Send a debt list to a group: set its group and queue its group message, on the database writer. A list is only ever
+    sent once, a second press of a group button, for the same group or another, changes nothing. When sharding is on, a
+    draft sent to a group of another shard is then moved there, and its group message is queued in that shard.
+
+    Args:
+        list_id (int): The ID of the debt list.
+        group_id (int): The ID of the group.
+
+    Returns:
+        bool: Whether the list was sent, False if it does not exist or was already sent.
+    """
+    source = shards.current()
+    target = shards.for_group(group_id)
+    sent = await source.writer.execute(_update_debt_list_group, list_id, group_id, target is source)
+    if sent and target is not source:
+        # Imported here, bot/rebalance.py imports this module
+        from .rebalance import move_debt_list
+
+        # The group is set first, so a move that is cut short is finished at the next start, see finish_moves(). The
+        # move waits on the writers of both shards, so it runs off the event loop
+        await asyncio.to_thread(move_debt_list, list_id, target)
+    return sent
+
+
+def _update_debt_list_group(db: Session, list_id: int, group_id: int, queue: bool = True) -> bool:
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
-    if debt_list:
-        debt_list.group_id = group_id
-        db.commit()
-    else:
-        # TODO
-        pass
+    if debt_list is None or debt_list.group_id is not None:
+        # Checked in the transaction that sets the group, so two presses cannot both get past it. A second send would
+        # queue a message the list has no room for, the outbox would store the first and delete the second
+        return False
+    debt_list.group_id = group_id
+    record_event(
+        db, list_id, events.LIST_SENT, debt_list.user_id, group_id=int(group_id)
+    )
+    if not queue:
+        # The list is about to move to its group's shard, which queues the message
+        return True
+    # Posted by the outbox drainer, which stores the message ID on the list. The key names the event that
+    # created the list as it is now, so a list restored by /undo is not mistaken for one whose message was
+    # already queued
+    created = _creation_event_id(db, list_id)
+    outbox.enqueue(
+        db, [outbox.send_debt_list(group_id, list_id, key=f"send:{list_id}:{created}:{group_id}")]
+    )
+    after_commit(db, lambda: refresh_inline_index(debt_list))
+    return True
+
+
+def _creation_event_id(db: Session, list_id: int) -> int:
+    # The LIST_CREATED or LIST_SNAPSHOT event that started the list as it is now, 0 for lists older than the event log
+    return (
+        db.scalar(
+            select(func.max(DebtEvent.event_id)).where(
+                DebtEvent.list_id == list_id,
+                DebtEvent.kind.in_((events.LIST_CREATED, events.LIST_SNAPSHOT)),
+            )
+        )
+        or 0
+    )
+
+
+# The columns of a DebtListView that come from the debt_lists table, in the order of its fields
+DEBT_LIST_COLUMNS = (
+    DebtList.list_id,
+    DebtList.user_id,
+    DebtList.group_id,
+    DebtList.debt_name,
+    DebtList.phone_number,
+    DebtList.currency,
+    DebtList.is_pending,
+)
+
+
+def _debt_list_headers(db: Session, *conditions) -> list:
+    """Views of the debt lists matching the conditions, with their totals but without their debts."""
+    rows = db.execute(
+        select(
+            *DEBT_LIST_COLUMNS,
+            DebtList.total_minor,
+            DebtList.unpaid_total_minor,
+            DebtList.last_updated,
+        ).where(*conditions)
+    )
+    return [DebtListView(*row) for row in rows]
+
+
+def debt_list_views(db: Session, rows: list) -> list:
+    """
+    Views of debt lists with their debts, which are fetched for all of them in one query.
+
+    Args:
+        db (Session): The session to query in.
+        rows (list): Rows of DEBT_LIST_COLUMNS followed by last_updated.
 
+    Returns:
+        list: A DebtListView for every row, in the same order, with totals summed from the debts.
+    """
+    if not rows:
+        return []
+    debts = {row[0]: [] for row in rows}
+    for list_id, owed_by_user_name, amount_minor, paid in db.execute(
+        select(Debt.list_id, Debt.owed_by_user_name, Debt.amount_minor, Debt.paid)
+        .where(Debt.list_id.in_(list(debts)))
+        .order_by(Debt.list_id, Debt.debt_id)
+    ):
+        debts[list_id].append(DebtView(owed_by_user_name, amount_minor, paid))
+
+    views = []
+    for list_id, user_id, group_id, debt_name, phone_number, currency, is_pending, last_updated in rows:
+        list_debts = tuple(debts[list_id])
+        views.append(
+            DebtListView(
+                list_id,
+                user_id,
+                group_id,
+                debt_name,
+                phone_number,
+                currency,
+                is_pending,
+                total_minor=sum(debt.amount_minor or 0 for debt in list_debts),
+                outstanding_minor=sum(debt.amount_minor or 0 for debt in list_debts if not debt.paid),
+                last_updated=last_updated,
+                debts=list_debts,
+            )
+        )
+    return views
 
+
+@shards.fan_out(shards.concat)
 def get_all_debt_lists() -> list:
+    """
+    Retrieve every debt list, without their debts.
+
+    Returns:
+        list: A list of DebtListView.
+    """
     db: Session = next(get_db())
-    debt_lists = db.query(DebtList).all()
-    return debt_lists
+    return _debt_list_headers(db)
+
 
+@shards.fan_out(shards.concat)
+def get_open_debt_lists() -> list:
+    """
+    Retrieve the debt lists that have been sent to a group and still have unpaid debts, without their debts.
 
-def get_debt_list_info(list_id: int) -> dict:
+    Returns:
+        list: A list of DebtListView.
+    """
     db: Session = next(get_db())
-    debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
-    if debt_list:
-        return {
-            "debt_name": debt_list.debt_name,
-            "phone_number": debt_list.phone_number,
-            "debts": [
-                {
-                    "owed_by_user_name": debt.owed_by_user_name,
-                    "amount": debt.amount,
-                    "paid": debt.paid,
-                }
-                for debt in debt_list.debts
-            ],
-            "last_updated": debt_list.last_updated,
-        }
-    return []
+    return _debt_list_headers(db, *_open_debt_list_conditions())
 
 
+def _open_debt_list_conditions() -> tuple:
+    return (
+        DebtList.unpaid_count > 0,
+        DebtList.is_pending == False,
+        DebtList.group_id.is_not(None),
+    )
+
+
+def refresh_inline_index(debt_list: DebtList) -> None:
+    # Called after a list is sent, paid or unpaid, so that inline queries only ever offer open lists
+    if debt_list.unpaid_count > 0 and not debt_list.is_pending and debt_list.group_id is not None:
+        open_debt_lists_index.add(debt_list.list_id, debt_list.user_id, debt_list.debt_name)
+    else:
+        open_debt_lists_index.remove(debt_list.list_id)
+
+
+def load_inline_index() -> None:
+    """
+    Fill the in-memory prefix index used by inline queries with every open debt list. Called once at startup, the index is kept up to date by the functions that send, pay and delete lists from then on.
+    """
+    open_debt_lists_index.load(_open_debt_list_entries())
+
+
+def search_open_debt_lists(user_id: int, query: str, limit: int = 50) -> list:
+    """
+    Find a user's open debt lists for an inline query in the in-memory prefix index, without touching the database.
+
+    Args:
+        user_id (int): The ID of the user.
+        query (str): Every word must be a prefix of a word in the list's name, an empty query matches every open list.
+        limit (int, optional): The most lists to return. Defaults to 50, the most Telegram shows.
+
+    Returns:
+        list: The IDs of the matching lists, newest first.
+    """
+    return open_debt_lists_index.search(user_id, query, limit=limit)
+
+
+@shards.fan_out(shards.concat)
+def _open_debt_list_entries() -> list:
+    db: Session = next(get_db())
+    return (
+        db.query(DebtList.list_id, DebtList.user_id, DebtList.debt_name)
+        .filter(*_open_debt_list_conditions())
+        .all()
+    )
+
+
+@shards.by_list
+def get_debt_list_unpaid_count(list_id: int) -> int:
+    db: Session = next(get_db())
+    unpaid_count = (
+        db.query(DebtList.unpaid_count).filter(DebtList.list_id == list_id).scalar()
+    )
+    return unpaid_count or 0
+
+
+@shards.fan_out(shards.concat)
+def check_debt_list_counters(fix: bool = False) -> list:
+    """
+    Compare the unpaid counters stored on every debt list against the debts they summarize.
+
+    Args:
+        fix (bool, optional): Whether to overwrite mismatched counters with the recomputed values. Defaults to False.
+
+    Returns:
+        list: A list of (list_id, stored, actual) tuples for every mismatched debt list, where stored and actual are (unpaid_count, unpaid_total_minor) tuples.
+    """
+    if fix:
+        return shards.current().writer.run(_check_debt_list_counters, fix)
+    return _check_debt_list_counters(next(get_db()), fix)
+
+
+def _check_debt_list_counters(db: Session, fix: bool) -> list:
+    unpaid = (
+        select(
+            Debt.list_id,
+            func.sum(case((Debt.paid == False, 1), else_=0)).label("unpaid_count"),
+            func.sum(case((Debt.paid == False, Debt.amount_minor), else_=0)).label(
+                "unpaid_total_minor"
+            ),
+        )
+        .group_by(Debt.list_id)
+        .subquery()
+    )
+    rows = db.execute(
+        select(
+            DebtList.list_id,
+            DebtList.unpaid_count,
+            DebtList.unpaid_total_minor,
+            func.coalesce(unpaid.c.unpaid_count, 0),
+            func.coalesce(unpaid.c.unpaid_total_minor, 0),
+        ).outerjoin(unpaid, unpaid.c.list_id == DebtList.list_id)
+    ).all()
+
+    mismatches = []
+    for list_id, stored_count, stored_total, actual_count, actual_total in rows:
+        if (stored_count, stored_total) != (actual_count, actual_total):
+            mismatches.append(
+                (list_id, (stored_count, stored_total), (actual_count, actual_total))
+            )
+            if fix:
+                db.execute(
+                    update(DebtList)
+                    .where(DebtList.list_id == list_id)
+                    .values(
+                        unpaid_count=actual_count, unpaid_total_minor=actual_total
+                    )
+                )
+    return mismatches
+
+
+@shards.by_list
+def get_debt_list_totals(list_id: int) -> tuple[int, int]:
+    """
+    Sum the amounts of a debt list in the database, using the covering index on (list_id, paid, amount_minor).
+
+    Args:
+        list_id (int): The ID of the debt list.
+
+    Returns:
+        tuple[int, int]: The total and the outstanding amount of the debt list, in minor units.
+    """
+    db: Session = next(get_db())
+    total, outstanding = db.execute(
+        select(
+            func.coalesce(func.sum(Debt.amount_minor), 0),
+            func.coalesce(
+                func.sum(case((Debt.paid == False, Debt.amount_minor), else_=0)), 0
+            ),
+        ).where(Debt.list_id == list_id)
+    ).one()
+    return total, outstanding
+
+
+@shards.by_list
+def get_debt_list_info(list_id: int) -> DebtListView:
+    """
+    Retrieve a debt list with its debts and totals.
+
+    Args:
+        list_id (int): The ID of the debt list.
+
+    Returns:
+        DebtListView: The debt list, or None if there is no such list.
+    """
+    db: Session = next(get_db())
+    rows = db.execute(
+        select(*DEBT_LIST_COLUMNS, DebtList.last_updated).where(DebtList.list_id == list_id)
+    ).all()
+    views = debt_list_views(db, rows)
+    return views[0] if views else None
+
+
+def get_debt_list_page(
+    user_id: int,
+    status: str = "all",
+    before: tuple = None,
+    after: tuple = None,
+    page_size: int = 5,
+) -> tuple[list, bool, bool]:
+    """
+    Retrieve one page of a user's debt lists, newest first, using keyset pagination on (last_updated, list_id). The lists are fetched in one query and their debts in another. When sharding is on, each shard's page is fetched and the page is made from the lists that come first among them.
+
+    Args:
+        user_id (int): The ID of the user.
+        status (str, optional): "open" for lists with unpaid debts, "settled" for lists without, or "all". Defaults to "all".
+        before (tuple, optional): A (last_updated, list_id) cursor to fetch the page of lists older than. Defaults to None.
+        after (tuple, optional): A (last_updated, list_id) cursor to fetch the page of lists newer than. Defaults to None, which together with before fetches the newest page.
+        page_size (int, optional): The number of lists per page. Defaults to 5.
+
+    Returns:
+        tuple[list, bool, bool]: The debt lists on the page as DebtListView, whether there are newer lists, and whether there are older lists.
+    """
+    # Fetch one extra list to find out whether there is another page in this direction
+    views = sorted(
+        _debt_list_page_views(user_id, status, before, after, page_size + 1),
+        key=attrgetter("last_updated", "list_id"),
+        reverse=after is None,
+    )
+    has_more = len(views) > page_size
+    views = views[:page_size]
+    if after is not None:
+        views.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = before is not None, has_more
+    return views, has_newer, has_older
+
+
+@shards.fan_out(shards.concat)
+def _debt_list_page_views(user_id: int, status: str, before: tuple, after: tuple, limit: int) -> list:
+    # Up to limit of the user's lists next to the cursor, in the order they are paged in
+    db: Session = next(get_db())
+    key = tuple_(DebtList.last_updated, DebtList.list_id)
+
+    def cursor(value: tuple):
+        # last_updated is written by SQLite's CURRENT_TIMESTAMP, so compare against the same text format
+        last_updated, list_id = value
+        return tuple_(
+            literal(last_updated.strftime("%Y-%m-%d %H:%M:%S"), String), literal(list_id)
+        )
+
+    query = select(*DEBT_LIST_COLUMNS, DebtList.last_updated).where(DebtList.user_id == user_id)
+    if status == "open":
+        query = query.where(DebtList.unpaid_count > 0)
+    elif status == "settled":
+        query = query.where(DebtList.unpaid_count == 0)
+
+    if after is not None:
+        query = query.where(key > cursor(after)).order_by(
+            DebtList.last_updated.asc(), DebtList.list_id.asc()
+        )
+    else:
+        if before is not None:
+            query = query.where(key < cursor(before))
+        query = query.order_by(DebtList.last_updated.desc(), DebtList.list_id.desc())
+
+    return debt_list_views(db, db.execute(query.limit(limit)).all())
+
+
+def _search_match_expression(user_id: int, query: str) -> str:
+    # Quote every word so user input can never be read as FTS5 syntax, and match word prefixes
+    terms = " ".join(f'"{word}"*' for word in re.findall(r"\w+", query))
+    if not terms:
+        return None
+    return f"owner:u{user_id} AND {{debt_name debtors}}: ({terms})"
+
+
+def search_debt_lists(user_id: int, query: str, offset: int = 0, limit: int = 5) -> tuple[list, bool]:
+    """
+    Full-text search over the names and debtors of a user's debt lists, including archived ones. Results are ranked with BM25, weighting matches in the debt name above matches in the debtors. When sharding is on, each shard's best results are merged by their scores, which each shard computes against its own index.
+
+    Args:
+        user_id (int): The ID of the user whose lists are searched.
+        query (str): The words to search for. Every word must match, as a prefix of a word in the list.
+        offset (int, optional): The number of results to skip. Defaults to 0.
+        limit (int, optional): The number of results to return. Defaults to 5.
+
+    Returns:
+        tuple[list, bool]: The results as SearchResultView, and whether there are more results.
+    """
+    match = _search_match_expression(user_id, query)
+    if match is None:
+        return [], False
+    # Fetch one extra result to find out whether there are more
+    ranked = sorted(_ranked_search_results(match, offset + limit + 1), key=itemgetter(0))
+    results = [result for _, result in ranked[offset : offset + limit + 1]]
+    return results[:limit], len(results) > limit
+
+
+@shards.fan_out(shards.concat)
+def _ranked_search_results(match: str, limit: int) -> list:
+    # (score, SearchResultView) of the best results, lower scores are better
+    db: Session = next(get_db())
+    rows = db.execute(
+        text(
+            """
+            SELECT debt_list_fts.rowid AS list_id,
+                   debt_list_fts.archived AS archived,
+                   COALESCE(debt_lists.debt_name, archived_debt_lists.debt_name) AS debt_name,
+                   COALESCE(debt_lists.currency, archived_debt_lists.currency) AS currency,
+                   COALESCE(
+                       (SELECT SUM(debts.amount_minor) FROM debts
+                        WHERE debts.list_id = debt_lists.list_id),
+                       archived_debt_lists.total_minor, 0
+                   ) AS total_minor,
+                   COALESCE(debt_lists.unpaid_total_minor, 0) AS outstanding_minor,
+                   COALESCE(debt_lists.last_updated, archived_debt_lists.settled_at) AS last_updated,
+                   bm25(debt_list_fts, 10.0, 1.0, 0.0) AS score
+            FROM debt_list_fts
+            LEFT JOIN debt_lists
+                ON debt_lists.list_id = debt_list_fts.rowid AND NOT debt_list_fts.archived
+            LEFT JOIN archived_debt_lists
+                ON archived_debt_lists.list_id = debt_list_fts.rowid AND debt_list_fts.archived
+            WHERE debt_list_fts MATCH :match
+            ORDER BY score
+            LIMIT :limit
+            """
+        ).columns(last_updated=DateTime),
+        {"match": match, "limit": limit},
+    ).mappings().all()
+    results = []
+    for row in rows:
+        row = dict(row)
+        score = row.pop("score")
+        results.append((score, SearchResultView(**dict(row, archived=bool(row["archived"])))))
+    return results
+
+
+@shards.fan_out(lambda results: sorted(shards.concat(results)))
 def get_debt_lists_by_user_id(user_id: int) -> list:
     """
     Retrieve a list of debt lists by user ID.
@@ -220,6 +1210,7 @@ def get_debt_lists_by_user_id(user_id: int) -> list:
     return [debt_list.list_id for debt_list in debt_lists]
 
 
+@shards.by_list
 def get_debt_list_pending_status(list_id: int) -> bool:
     db: Session = next(get_db())
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
@@ -228,28 +1219,202 @@ def get_debt_list_pending_status(list_id: int) -> bool:
     return False  # TODO: Should return some error instead
 
 
-def update_debt_list_status(list_id: int, is_pending: bool) -> None:
-    db: Session = next(get_db())
+@shards.by_list
+async def update_debt_list_status(list_id: int, is_pending: bool) -> None:
+    await shards.current().writer.execute(_update_debt_list_status, list_id, is_pending)
+
+
+def _update_debt_list_status(db: Session, list_id: int, is_pending: bool) -> None:
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
     if debt_list:
         debt_list.is_pending = is_pending
-        db.commit()
+        record_event(
+            db, list_id, events.LIST_PENDING, debt_list.user_id, pending=is_pending
+        )
     else:
         # TODO: Do something with error
         pass
 
 
-def update_debt_list_message_info(list_id: int, message_id: int) -> None:
-    db: Session = next(get_db())
+@shards.by_list
+async def update_debt_list_message_info(list_id: int, message_id: int) -> None:
+    await shards.current().writer.execute(_set_debt_list_message_id, list_id, message_id)
+
+
+def _set_debt_list_message_id(db: Session, list_id: int, message_id: int) -> None:
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
     if debt_list:
         debt_list.message_id = message_id
-        db.commit()
     else:
         # TODO: Do something with error
         pass
 
 
+@shards.by_list
+async def resend_debt_list(list_id: int) -> None:
+    """
+    Queue the replacement of a debt list's group message with a new one at the bottom of the chat, on the database writer.
+
+    Args:
+        list_id (int): The ID of the debt list.
+    """
+    await shards.current().writer.execute(_resend_debt_list, list_id)
+
+
+def _resend_debt_list(db: Session, list_id: int) -> None:
+    debt_list = db.get(DebtList, list_id)
+    if debt_list is None or debt_list.group_id is None:
+        return
+    side_effects = []
+    if debt_list.message_id:
+        side_effects.append(outbox.delete_message(debt_list.group_id, debt_list.message_id))
+    side_effects.append(
+        outbox.send_debt_list(
+            debt_list.group_id,
+            list_id,
+            # Replacing the same message twice, e.g. when the job is retried, posts it only once
+            key=f"resend:{list_id}:{debt_list.message_id}" if debt_list.message_id else None,
+        )
+    )
+    outbox.enqueue(db, side_effects)
+    debt_list.message_id = None
+
+
+def _due_first(results: list) -> list:
+    return sorted(shards.concat(results), key=itemgetter("next_attempt_at", "outbox_id"))
+
+
+@shards.fan_out(_due_first)
+def get_due_outbox_messages(limit: int) -> list:
+    """
+    Retrieve the queued side effects that are due, oldest first.
+
+    Args:
+        limit (int): The most side effects to return, from each shard when sharding is on.
+
+    Returns:
+        list: The side effects as dicts with the columns of the outbox table, and the index of the shard they are queued in as shard.
+    """
+    db: Session = next(get_db())
+    shard = shards.current().index
+    return [
+        dict(row, shard=shard)
+        for row in db.execute(
+            select(OutboxMessage.__table__)
+            .where(OutboxMessage.done_at.is_(None), OutboxMessage.next_attempt_at <= func.now())
+            .order_by(OutboxMessage.next_attempt_at, OutboxMessage.outbox_id)
+            .limit(limit)
+        ).mappings()
+    ]
+
+
+async def finish_outbox_messages(results: list, max_attempts: int) -> None:
+    """
+    Record the outcome of a batch of side effects in one transaction on the database writer, storing the IDs of sent debt list messages on their lists. When sharding is on, the outcomes are recorded in the shards the side effects were queued in, one transaction each.
+
+    Args:
+        results (list): (side effect, outcome) pairs, the side effects as get_due_outbox_messages returned them. The outcome is ("done", sent message ID or None), ("retry", delay in seconds, error) or ("failed", error).
+        max_attempts (int): Side effects that have been tried this many times are given up on instead of retried.
+    """
+    by_shard = {shard.index: [] for shard in shards.every()}
+    for side_effect, outcome in results:
+        by_shard[side_effect.get("shard", 0)].append((side_effect, outcome))
+    await asyncio.gather(
+        *(
+            shard.writer.execute(_finish_outbox_messages, by_shard[shard.index], max_attempts)
+            for shard in shards.every()
+            if by_shard[shard.index]
+        )
+    )
+
+
+def _finish_outbox_messages(db: Session, results: list, max_attempts: int) -> None:
+    for side_effect, outcome in results:
+        outbox_id = side_effect["outbox_id"]
+        if outcome[0] == "done":
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.outbox_id == outbox_id)
+                .values(done_at=func.now(), attempts=OutboxMessage.attempts + 1)
+            )
+            sent_message_id = outcome[1]
+            if side_effect["action"] == outbox.SEND_DEBT_LIST and sent_message_id:
+                written = db.execute(
+                    update(DebtList)
+                    .where(
+                        DebtList.list_id == side_effect["list_id"],
+                        DebtList.message_id.is_(None),
+                    )
+                    .values(message_id=sent_message_id)
+                ).rowcount
+                if not written:
+                    # The list was deleted, or already has a message, while this one was being sent
+                    outbox.enqueue(
+                        db, [outbox.delete_message(side_effect["chat_id"], sent_message_id)]
+                    )
+        elif outcome[0] == "retry" and side_effect["attempts"] + 1 < max_attempts:
+            _, delay, error = outcome
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.outbox_id == outbox_id)
+                .values(
+                    attempts=OutboxMessage.attempts + 1,
+                    next_attempt_at=func.datetime("now", f"+{int(delay)} seconds"),
+                    error=error,
+                )
+            )
+        else:
+            db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.outbox_id == outbox_id)
+                .values(
+                    attempts=OutboxMessage.attempts + 1,
+                    done_at=func.now(),
+                    error=outcome[-1],
+                )
+            )
+
+
+@shards.fan_out(sum)
+def prune_outbox_messages(retention_days: int, batch_size: int = 500, pause: float = 0.1) -> int:
+    """
+    Delete side effects that were carried out, or given up on, more than retention_days ago, in batches. Their
+    idempotency keys only have to outlive the retries of the operation that queued them.
+
+    Args:
+        retention_days (int): How long finished side effects are kept. 0 keeps them forever.
+        batch_size (int, optional): The number of side effects deleted per transaction. Defaults to 500.
+        pause (float, optional): Seconds to sleep between batches. Defaults to 0.1.
+
+    Returns:
+        int: The number of side effects deleted.
+    """
+    if retention_days <= 0:
+        return 0
+    writer = shards.current().writer
+    pruned = 0
+    while True:
+        # One operation on the writer per batch, so the bot's own writes go in between
+        count = writer.run(_prune_outbox_batch, retention_days, batch_size)
+        pruned += count
+        if count < batch_size:
+            return pruned
+        time.sleep(pause)
+
+
+def _prune_outbox_batch(db: Session, retention_days: int, batch_size: int) -> int:
+    return db.execute(
+        delete(OutboxMessage).where(
+            OutboxMessage.outbox_id.in_(
+                select(OutboxMessage.outbox_id)
+                .where(OutboxMessage.done_at < func.datetime("now", f"-{retention_days} days"))
+                .limit(batch_size)
+            )
+        )
+    ).rowcount
+
+
+@shards.by_list
 def get_debt_list_name(list_id: int) -> str:
     db: Session = next(get_db())
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
@@ -258,6 +1423,7 @@ def get_debt_list_name(list_id: int) -> str:
     return ""  # TODO: Should return some error instead
 
 
+@shards.by_list
 def get_debt_list_message_info(list_id: int) -> tuple[int, int]:
     db: Session = next(get_db())
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
@@ -266,16 +1432,12 @@ def get_debt_list_message_info(list_id: int) -> tuple[int, int]:
     return 0, 0  # TODO: Should return some error instead
 
 
-def delete_debt_list_message_info(list_id: int) -> None:
-    db: Session = next(get_db())
-    debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
-    if debt_list:
-        debt_list.message_id = None
-        db.commit()
-    else:
-        pass  # TODO: Do something with error
+@shards.by_list
+async def delete_debt_list_message_info(list_id: int) -> None:
+    await shards.current().writer.execute(_set_debt_list_message_id, list_id, None)
 
 
+@shards.by_list
 def get_debt_list_user_id(list_id: int) -> int:
     db: Session = next(get_db())
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
@@ -284,44 +1446,211 @@ def get_debt_list_user_id(list_id: int) -> int:
     return 0  # TODO: Should return some error instead
 
 
-def delete_debt_list(list_id: int) -> None:
-    db: Session = next(get_db())
+@shards.by_list
+async def delete_debt_list(list_id: int) -> None:
+    await shards.current().writer.execute(_delete_debt_list, list_id)
+
+
+def _delete_debt_list(db: Session, list_id: int) -> None:
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
     if debt_list:
+        if debt_list.message_id:
+            outbox.enqueue(db, [outbox.delete_message(debt_list.group_id, debt_list.message_id)])
         db.delete(debt_list)
-        db.commit()
+        record_event(db, list_id, events.LIST_DELETED, debt_list.user_id)
+        after_commit(db, lambda: open_debt_lists_index.remove(list_id))
     else:
         # TODO: Do something with error
         pass
 
 
-def add_or_update_debt(
-    list_id: int, owed_by_user_name: int, amount: float, paid: bool = False
+@shards.by_list
+async def add_or_update_debt(
+    list_id: int, owed_by_user_name: str, amount_minor: int, paid: bool = False
 ) -> int:
-    db: Session = next(get_db())
+    return await shards.current().writer.execute(
+        _add_or_update_debt, list_id, owed_by_user_name, amount_minor, paid
+    )
+
+
+def _add_or_update_debt(
+    db: Session, list_id: int, owed_by_user_name: str, amount_minor: int, paid: bool, actor_id: int = None
+) -> int:
+    owed_by_user_name_lower = normalize_username(owed_by_user_name)
     debt = (
         db.query(Debt)
-        .filter(Debt.list_id == list_id, Debt.owed_by_user_name == owed_by_user_name)
+        .filter(
+            Debt.list_id == list_id,
+            Debt.owed_by_user_name_lower == owed_by_user_name_lower,
+        )
         .first()
     )
     if debt:
         debt.owed_by_user_name = owed_by_user_name
-        debt.amount = amount
+        debt.amount_minor = amount_minor
         debt.paid = paid
     else:
+        # Link the debt to the debtor straight away if the bot has already seen them
+        owed_by_user_id = users_by_handle(db, [owed_by_user_name_lower]).get(owed_by_user_name_lower)
         debt = Debt(
             list_id=list_id,
             owed_by_user_name=owed_by_user_name,
-            amount=amount,
+            owed_by_user_name_lower=owed_by_user_name_lower,
+            owed_by_user_id=owed_by_user_id,
+            amount_minor=amount_minor,
             paid=paid,
         )
         db.add(debt)
-    db.commit()
+    db.flush()
+    if actor_id is None:
+        actor_id = db.query(DebtList.user_id).filter(DebtList.list_id == list_id).scalar()
+    record_event(
+        db,
+        list_id,
+        events.DEBT_SET,
+        actor_id,
+        debt_id=debt.debt_id,
+        name=owed_by_user_name,
+        amount_minor=amount_minor,
+        paid=paid,
+    )
     return debt.debt_id
 
 
-def associate_debt_with_debt_list(debt_id: int, list_id: int) -> None:
-    db: Session = next(get_db())
+@shards.by_list
+def add_debts_bulk(list_id: int, debts: Iterable, chunk_size: int = 500) -> int:
+    """
+    Insert debts into a pending debt list in chunks, one operation on the database writer per chunk. The debts are consumed lazily, so an arbitrarily long stream of debts is inserted with bounded memory. This blocks until every chunk is committed, so it is run off the event loop.
+
+    The inserts bypass the ORM, so the unpaid counters are updated here directly. Pending lists do not count towards group balances, so the balances rollup does not need updating.
+
+    Args:
+        list_id (int): The ID of the pending debt list.
+        debts (Iterable): (owed_by_user_name, amount_minor) tuples with unique handles.
+        chunk_size (int, optional): The number of debts to insert per transaction. Defaults to 500.
+
+    Returns:
+        int: The number of debts inserted.
+    """
+    writer = shards.current().writer
+    owner_id = get_debt_list_user_id(list_id)
+    inserted = 0
+    for chunk in batched(debts, chunk_size):
+        inserted += writer.run(_add_debts_chunk, list_id, owner_id, chunk)
+    return inserted
+
+
+def _add_debts_chunk(db: Session, list_id: int, owner_id: int, chunk: list) -> int:
+    names_lower = [normalize_username(name) for name, _ in chunk]
+    # Resolve every debtor in the chunk with one query
+    user_ids = users_by_handle(db, names_lower)
+    debt_ids = db.scalars(
+        insert(Debt).returning(Debt.debt_id, sort_by_parameter_order=True),
+        [
+            {
+                "list_id": list_id,
+                "owed_by_user_name": name,
+                "owed_by_user_name_lower": name_lower,
+                "owed_by_user_id": user_ids.get(name_lower),
+                "amount_minor": amount_minor,
+                "paid": False,
+            }
+            for (name, amount_minor), name_lower in zip(chunk, names_lower)
+        ],
+    ).all()
+    db.execute(
+        insert(DebtEvent),
+        [
+            event_row(
+                list_id,
+                events.DEBT_SET,
+                owner_id,
+                debt_id=debt_id,
+                name=name,
+                amount_minor=amount_minor,
+                paid=False,
+            )
+            for debt_id, (name, amount_minor) in zip(debt_ids, chunk)
+        ],
+    )
+    db.execute(
+        update(DebtList)
+        .where(DebtList.list_id == list_id)
+        .values(
+            unpaid_count=DebtList.unpaid_count + len(chunk),
+            unpaid_total_minor=DebtList.unpaid_total_minor
+            + sum(amount_minor for _, amount_minor in chunk),
+        )
+    )
+    return len(chunk)
+
+
+@shards.by_list
+async def discard_pending_debt_list(list_id: int) -> None:
+    """
+    Delete a pending debt list and its debts without loading them, e.g. after a failed import, on the database writer.
+
+    Args:
+        list_id (int): The ID of the pending debt list.
+    """
+    await shards.current().writer.execute(_discard_pending_debt_list, list_id)
+
+
+def _discard_pending_debt_list(db: Session, list_id: int) -> None:
+    db.execute(delete(Debt).where(Debt.list_id == list_id))
+    deleted = db.execute(
+        delete(DebtList).where(DebtList.list_id == list_id, DebtList.is_pending == True)
+    ).rowcount
+    if deleted:
+        # Recorded without an actor, since a discarded draft is not something /undo should bring back
+        record_event(db, list_id, events.LIST_DELETED)
+
+
+async def clear_debt_lists(user_id: int) -> int:
+    """
+    Delete every debt list a user owns, archived ones included, in one transaction on the database writer, which also queues the deletion of their group messages. The deletions are one event batch, so /undo brings back everything this cleared. When sharding is on, each shard deletes its lists in one transaction of its own writer.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int: The number of debt lists deleted.
+    """
+    with event_batch():
+        counts = await asyncio.gather(
+            *(shard.writer.execute(_clear_debt_lists, user_id) for shard in shards.every())
+        )
+    return sum(counts)
+
+
+def _clear_debt_lists(db: Session, user_id: int) -> int:
+    debt_lists = db.query(DebtList).filter(DebtList.user_id == user_id).all()
+    for debt_list in debt_lists:
+        if debt_list.message_id:
+            outbox.enqueue(db, [outbox.delete_message(debt_list.group_id, debt_list.message_id)])
+        db.delete(debt_list)
+        record_event(db, debt_list.list_id, events.LIST_DELETED, user_id)
+    archived_ids = db.scalars(
+        delete(ArchivedDebtList)
+        .where(ArchivedDebtList.user_id == user_id)
+        .returning(ArchivedDebtList.list_id)
+    ).all()
+    if archived_ids:
+        db.execute(
+            insert(DebtEvent),
+            [event_row(list_id, events.LIST_DELETED, user_id) for list_id in archived_ids],
+        )
+    list_ids = [debt_list.list_id for debt_list in debt_lists]
+    after_commit(db, lambda: [open_debt_lists_index.remove(list_id) for list_id in list_ids])
+    return len(debt_lists) + len(archived_ids)
+
+
+@shards.by_list
+async def associate_debt_with_debt_list(debt_id: int, list_id: int) -> None:
+    await shards.current().writer.execute(_associate_debt_with_debt_list, debt_id, list_id)
+
+
+def _associate_debt_with_debt_list(db: Session, debt_id: int, list_id: int) -> None:
     debt = db.query(Debt).filter(Debt.debt_id == debt_id).first()
     debt_list = db.query(DebtList).filter(DebtList.list_id == list_id).first()
     if not debt or not debt_list:
@@ -331,41 +1660,139 @@ def associate_debt_with_debt_list(debt_id: int, list_id: int) -> None:
 
     if debt not in debt_list.debts:
         debt_list.debts.append(debt)
-        db.commit()
 
 
-def update_debt_status(list_id: int, user_name: str, paid: bool):
-    db: Session = next(get_db())
+def _find_debt_for_user(db: Session, list_id: int, user_id: int, user_name: str):
+    """
+    Find the debt a user owes in a debt list. Debts linked to the user's ID are matched first. A debt that is only known by handle is matched case-insensitively and then linked to the user, so later lookups go by ID.
 
-    debt = db.query(Debt).filter(Debt.list_id == list_id)
-    if not debt.first():
-        return False, "That debt list does not exist"
+    Args:
+        db (Session): The session to query with.
+        list_id (int): The ID of the debt list.
+        user_id (int): The ID of the user.
+        user_name (str): The user's current username, may be None.
 
-    debt = debt.filter(Debt.owed_by_user_name == user_name).first()
-    if not debt:
-        return False, "You are not in that debt list"
+    Returns:
+        Debt: The debt, or None if the user is not in the debt list.
+    """
+    user_name_lower = normalize_username(user_name)
+    conditions = [Debt.owed_by_user_id == user_id]
+    if user_name_lower:
+        conditions.append(
+            (Debt.owed_by_user_id.is_(None))
+            & (Debt.owed_by_user_name_lower == user_name_lower)
+        )
+    debt = (
+        db.query(Debt)
+        .filter(Debt.list_id == list_id, or_(*conditions))
+        .order_by(Debt.owed_by_user_id.is_(None))
+        .first()
+    )
+    if debt and debt.owed_by_user_id is None:
+        debt.owed_by_user_id = user_id
+    return debt
+
+
+@shards.by_list
+async def update_debt_status(
+    list_id: int, user_id: int, user_name: str, paid: bool, side_effects: Iterable[dict] = ()
+):
+    """
+    Mark a user's debt in a debt list as paid or unpaid. When this settles the list, its group message is deleted and the owner is told, and when it reopens a settled list, the list is posted to its group again. These messages, and the given side effects, are queued in the same transaction. Runs on the database writer, so a burst of presses is committed together.
+
+    Args:
+        list_id (int): The ID of the debt list.
+        user_id (int): The ID of the user.
+        user_name (str): The user's current username, may be None.
+        paid (bool): Whether the debt is paid.
+        side_effects (Iterable[dict], optional): Outbox side effects to queue with the change, see bot/outbox.py. Defaults to ().
+
+    Returns:
+        tuple[bool, str]: Whether the debt was updated, and the key of the message to show the user if not.
+    """
+    return await shards.current().writer.execute(
+        _update_debt_status, list_id, user_id, user_name, paid, side_effects
+    )
+
+
+def _update_debt_status(
+    db: Session, list_id: int, user_id: int, user_name: str, paid: bool, side_effects: Iterable[dict]
+):
+    if not db.query(Debt.debt_id).filter(Debt.list_id == list_id).first():
+        return False, "listNotFound"
 
+    debt = _find_debt_for_user(db, list_id, user_id, user_name)
+    if not debt:
+        return False, "notInList"
+
+    changed = debt.paid != paid
+    if changed:
+        record_event(
+            db,
+            list_id,
+            events.DEBT_PAID if paid else events.DEBT_UNPAID,
+            user_id,
+            debt_id=debt.debt_id,
+        )
     debt.paid = paid
-    db.commit()
+    db.flush()
+    outbox.enqueue(db, side_effects)
+
+    debt_list = debt.debt_list
+    # The counters were updated by the listeners during the flush
+    db.refresh(debt_list, ["unpaid_count"])
+    if changed and paid and debt_list.unpaid_count == 0:
+        if debt_list.message_id:
+            outbox.enqueue(db, [outbox.delete_message(debt_list.group_id, debt_list.message_id)])
+            debt_list.message_id = None
+        outbox.enqueue(
+            db,
+            [outbox.notify(debt_list.user_id, "listSettled", list_id=debt_list.list_id)],
+        )
+    elif changed and not paid and debt_list.unpaid_count == 1:
+        # Only possible from a copy posted in inline mode, since settling deletes the group message
+        if debt_list.group_id is not None and not debt_list.message_id and not debt_list.is_pending:
+            outbox.enqueue(db, [outbox.send_debt_list(debt_list.group_id, debt_list.list_id)])
+    after_commit(db, lambda: refresh_inline_index(debt_list))
     return True, "No Error"
 
 
-def get_debt_status(list_id: int, user_name: str) -> bool:
+@shards.by_list
+def get_debt_status(list_id: int, user_id: int, user_name: str) -> bool:
     db: Session = next(get_db())
 
-    debt = db.query(Debt).filter(Debt.list_id == list_id)
-    if not debt.first():
-        return False, "That debt list does not exist"
+    if not db.query(Debt.debt_id).filter(Debt.list_id == list_id).first():
+        return False, "listNotFound"
 
-    debt = debt.filter(Debt.owed_by_user_name == user_name).first()
+    # A debt only matched by handle is linked to the user by update_debt_status, this only reads
+    debt = _find_debt_for_user(db, list_id, user_id, user_name)
     if not debt:
-        return False, "You are not in that debt list"
+        return False, "notInList"
 
     return True, debt.paid
 
 
 def initialize_database():
+    # Every shard has the whole schema, so that any function in this module can run on any shard
+    for shard in shards.every():
+        _initialize_schema(shard.engine)
+
+
+def _initialize_schema(engine) -> None:
     from .models import Base
 
+    from .migrations import is_schema_current, mark_up_to_date, run_migrations, stamp_schema_checksum
+
+    # Two pragmas instead of inspecting every table, for a database that was brought up to date by this code before
+    if is_schema_current(engine):
+        return
+
+    is_new_database = not inspect(engine).has_table(User.__tablename__)
     # Create all database tables that are defined by classes in models.py
     Base.metadata.create_all(bind=engine)
+    if is_new_database:
+        mark_up_to_date(engine)
+    else:
+        # Add columns and indexes that create_all does not add to existing tables
+        run_migrations(engine)
+    stamp_schema_checksum(engine)
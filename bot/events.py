@@ -0,0 +1,133 @@
+"""
+Kinds of events in the append-only debt event log and how to replay them.
+
+Every change to a debt list is recorded in debt_events, in the same transaction as the change itself. Replaying the
+events of a list in order rebuilds its state at any point in time, which is what /undo and `python -m bot.tools replay`
+use. Payloads are compact JSON and only hold what the event changed.
+"""
+
+import json
+from typing import Iterable, Tuple
+
+LIST_CREATED = 1  # user_id, debt_name, phone_number, currency, group_id, pending
+DEBT_SET = 2  # debt_id, name, amount_minor, paid: a debt was added, or changed by re-entering the list
+DEBT_PAID = 3  # debt_id
+DEBT_UNPAID = 4  # debt_id
+LIST_PENDING = 5  # pending: the list was confirmed, or put back to pending
+LIST_SENT = 6  # group_id
+LIST_DELETED = 7
+LIST_ARCHIVED = 8
+# The complete state of a list: written when a list is restored by /undo, and for lists that predate the event log
+LIST_SNAPSHOT = 9
+
+EVENT_NAMES = {
+    LIST_CREATED: "created",
+    DEBT_SET: "debt set",
+    DEBT_PAID: "paid",
+    DEBT_UNPAID: "unpaid",
+    LIST_PENDING: "pending",
+    LIST_SENT: "sent",
+    LIST_DELETED: "deleted",
+    LIST_ARCHIVED: "archived",
+    LIST_SNAPSHOT: "snapshot",
+}
+
+
+def encode_payload(payload: dict) -> str:
+    if not payload:
+        return None
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def snapshot_payload(state: dict) -> dict:
+    """Turn a replayed list state into a LIST_SNAPSHOT payload, with debts as [debt_id, name, amount_minor, paid]."""
+    payload = {key: value for key, value in state.items() if key != "debts"}
+    payload["debts"] = [
+        [debt_id, debt["name"], debt["amount_minor"], debt["paid"]]
+        for debt_id, debt in state["debts"].items()
+    ]
+    return payload
+
+
+def remap_debt_ids(kind: int, payload: dict, debt_ids: dict) -> dict:
+    """
+    Rewrite the debt IDs in a decoded payload, for events copied to a database where the debts got new IDs.
+
+    Args:
+        kind (int): The kind of event.
+        payload (dict): The decoded payload.
+        debt_ids (dict): Old debt ID -> new debt ID. IDs that are not in it are kept, e.g. those of archived debts.
+
+    Returns:
+        dict: The payload with the new debt IDs.
+    """
+    if kind in (DEBT_SET, DEBT_PAID, DEBT_UNPAID):
+        return dict(payload, debt_id=debt_ids.get(payload["debt_id"], payload["debt_id"]))
+    if kind == LIST_SNAPSHOT:
+        return dict(
+            payload, debts=[[debt_ids.get(debt[0], debt[0]), *debt[1:]] for debt in payload.get("debts", [])]
+        )
+    return payload
+
+
+def apply_event(states: dict, list_id: int, kind: int, payload: dict) -> None:
+    """
+    Apply one event to the replayed states of debt lists.
+
+    Args:
+        states (dict): list_id -> state, where a state has the list's fields, archived and deleted flags, and its debts as debt_id -> {name, amount_minor, paid}.
+        list_id (int): The ID of the list the event is about.
+        kind (int): The kind of event.
+        payload (dict): The decoded payload of the event.
+    """
+    if kind in (LIST_CREATED, LIST_SNAPSHOT):
+        # A snapshot replaces whatever came before, including a deleted list whose ID was reused
+        state = {
+            key: value
+            for key, value in payload.items()
+            if key in ("user_id", "debt_name", "phone_number", "currency", "group_id", "pending")
+        }
+        state.update(archived=payload.get("archived", False), deleted=False, debts={})
+        for debt_id, name, amount_minor, paid in payload.get("debts", []):
+            state["debts"][debt_id] = {"name": name, "amount_minor": amount_minor, "paid": paid}
+        states[list_id] = state
+        return
+
+    state = states.get(list_id)
+    if state is None:
+        # The list's earlier events were not recorded, there is nothing to apply this to
+        return
+    if kind == DEBT_SET:
+        state["debts"][payload["debt_id"]] = {
+            "name": payload["name"],
+            "amount_minor": payload["amount_minor"],
+            "paid": payload["paid"],
+        }
+    elif kind in (DEBT_PAID, DEBT_UNPAID):
+        debt = state["debts"].get(payload["debt_id"])
+        if debt is not None:
+            debt["paid"] = kind == DEBT_PAID
+    elif kind == LIST_PENDING:
+        state["pending"] = payload["pending"]
+    elif kind == LIST_SENT:
+        state["group_id"] = payload["group_id"]
+    elif kind == LIST_DELETED:
+        state["deleted"] = True
+    elif kind == LIST_ARCHIVED:
+        state["archived"] = True
+
+
+def replay(events: Iterable[Tuple[int, int, str]]) -> dict:
+    """
+    Rebuild the state of debt lists from their events.
+
+    Args:
+        events (Iterable[Tuple[int, int, str]]): (list_id, kind, payload) rows in the order they were recorded.
+
+    Returns:
+        dict: list_id -> state, see apply_event. Deleted lists are included, with deleted set.
+    """
+    states = {}
+    for list_id, kind, payload in events:
+        apply_event(states, list_id, kind, json.loads(payload) if payload else {})
+    return states
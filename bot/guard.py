@@ -0,0 +1,90 @@
+"""
+Front-line protection against duplicate button presses and users who flood the bot.
+
+Both checks are kept in memory and run before any handler, so updates they drop never reach the database. The
+counters record how many updates were let through and how many were shed, and are logged periodically.
+"""
+
+import time
+from collections import Counter, OrderedDict
+
+# Number of updates seen, let through, dropped as duplicate presses, and dropped by the rate limit
+counters = Counter()
+
+
+class CallbackDeduplicator:
+    """Remembers recent button presses, so a second press of the same button within the window can be dropped."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._seen = OrderedDict()  # (user_id, callback data) -> time of the press, oldest first
+
+    def is_duplicate(self, user_id: int, data: str, now: float = None) -> bool:
+        """
+        Check a button press against the recent ones, and remember it.
+
+        Args:
+            user_id (int): The ID of the user who pressed the button.
+            data (str): The callback data of the button, which holds the action and the list it is for.
+            now (float, optional): The current time.monotonic(). Defaults to now.
+
+        Returns:
+            bool: Whether the same user pressed the same button within the window.
+        """
+        now = time.monotonic() if now is None else now
+        # Presses are kept in the order they were made, so expired ones are always at the front
+        while self._seen:
+            key, pressed_at = next(iter(self._seen.items()))
+            if now - pressed_at < self.window:
+                break
+            del self._seen[key]
+
+        key = (user_id, data)
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+
+class TokenBucket:
+    """
+    Per-user token buckets: every update takes a token, and tokens come back at a steady rate up to the bucket's size,
+    so users can send short bursts but not a sustained flood.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._buckets = {}  # user_id -> (tokens, time of the last update)
+        self._last_prune = time.monotonic()
+
+    def allow(self, user_id: int, now: float = None) -> bool:
+        """
+        Take a token from a user's bucket.
+
+        Args:
+            user_id (int): The ID of the user.
+            now (float, optional): The current time.monotonic(). Defaults to now.
+
+        Returns:
+            bool: Whether the user had a token left, False means the update should be dropped.
+        """
+        now = time.monotonic() if now is None else now
+        tokens, updated_at = self._buckets.get(user_id, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated_at) * self.refill_per_second)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        self._prune(now)
+        return allowed
+
+    def _prune(self, now: float) -> None:
+        # Buckets that have refilled completely are the same as no bucket, forget them so idle users take no memory
+        full_after = self.capacity / self.refill_per_second
+        if now - self._last_prune < full_after:
+            return
+        self._last_prune = now
+        self._buckets = {
+            user_id: bucket
+            for user_id, bucket in self._buckets.items()
+            if now - bucket[1] < full_after
+        }
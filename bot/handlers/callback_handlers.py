@@ -1,23 +1,18 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
-from utils.utils import delete_message, get_debt_list_string, is_all_debt_paid
-
-from bot.database import (
-    delete_debt_list,
-    get_debt_list_message_info,
-    get_debt_list_user_id,
-    get_debt_lists_by_user_id,
-    get_user_groups,
-    update_debt_list_message_info,
-    update_debt_list_status,
-    update_debt_list_group,
-    get_group_name,
-    get_debt_list_pending_status,
-    get_debt_list_name,
-    get_debt_status,
-    update_debt_status,
+from telegram.error import BadRequest
+from utils.utils import (
+    SHOW_STATUSES,
+    decode_page_cursor,
+    get_debt_list_page_message,
+    get_search_results_message,
+    kick_outbox,
 )
 
+from bot import outbox
+from bot.repository import Repository
+from bot.settings import chat_settings
+
 
 async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -30,35 +25,37 @@ async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     callback_query = update.callback_query
     await callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
 
     # Pull out the debt list ID from the callback data
     debt_list_id = callback_query.data.split(":")[1]
+    settings = chat_settings(update.effective_chat.id)
 
-    if not get_debt_list_pending_status(debt_list_id):
+    if not repository.get_debt_list_pending_status(debt_list_id):
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="That debt list does not exist or has already been confirmed",
+            text=settings.text("listNotPending"),
         )
         return
 
     # Get all the group the user is in and create a button for each group
     user_id = update.effective_user.id
-    groups = get_user_groups(user_id)
+    groups = repository.get_user_groups(user_id)
 
     if not groups:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="You are not in any groups. Add me to a group and send a message to the group (so I know you are in the group)",
+            text=settings.text("noGroups"),
         )
         return
 
     buttons = [
         [
             InlineKeyboardButton(
-                group.get("group_name"),
-                callback_data=f"sendToGroup:{group.get('group_id')}:{debt_list_id}",
+                group.group_name,
+                callback_data=f"sendToGroup:{group.group_id}:{debt_list_id}",
             )
         ]
         for group in groups
@@ -66,12 +63,12 @@ async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_
     reply_markup = InlineKeyboardMarkup(buttons)
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Choose which group to send this list to:",
+        text=settings.text("chooseGroup"),
         reply_markup=reply_markup,
     )
 
     # Update the debt list status to confirmed in the database
-    update_debt_list_status(debt_list_id, is_pending=False)
+    await repository.update_debt_list_status(debt_list_id, is_pending=False)
 
     # Remove last line from original message
     message: str = callback_query.message.text
@@ -98,30 +95,40 @@ async def handle_send_to_group_callback(
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
 
     _, group_id, debt_list_id = update.callback_query.data.split(":")
 
-    message = get_debt_list_string(debt_list_id)
-    pay_button = InlineKeyboardButton("✅", callback_data=f"pay:{debt_list_id}")
-    unpay_button = InlineKeyboardButton("❌", callback_data=f"unpay:{debt_list_id}")
-    buttons = [[pay_button, unpay_button]]
-    reply_markup = InlineKeyboardMarkup(buttons)
-
-    debt_list_message = await context.bot.send_message(
-        chat_id=group_id,
-        text=message,
-        reply_markup=reply_markup,
-    )
-
-    update_debt_list_group(debt_list_id, group_id)
-    update_debt_list_message_info(debt_list_id, debt_list_message.message_id)
+    # Queues the group message in the same transaction, the outbox posts it and stores its message ID
+    settings = chat_settings(update.effective_chat.id)
+    if not await repository.update_debt_list_group(debt_list_id, group_id):
+        # Another group button of the same list was pressed before
+        await context.bot.edit_message_text(
+            chat_id=update.effective_chat.id,
+            message_id=update.callback_query.message.message_id,
+            text=settings.text("alreadySent"),
+        )
+        return
+    kick_outbox(context)
 
     # Modify the message to indicate that the debt list has been sent to the group
     await context.bot.edit_message_text(
         chat_id=update.effective_chat.id,
         message_id=update.callback_query.message.message_id,
-        text="The debt list has been sent to:\n\n" + get_group_name(group_id),
+        text=settings.text("sentToGroup", group=repository.get_group_name(group_id)),
+    )
+
+
+def _edit_pressed_debt_list(update: Update, list_id: int) -> dict:
+    # The button was pressed either on the group's copy of the list or on one posted in inline mode
+    callback_query = update.callback_query
+    if callback_query.inline_message_id:
+        return outbox.edit_debt_list(list_id, inline_message_id=callback_query.inline_message_id)
+    return outbox.edit_debt_list(
+        list_id,
+        chat_id=callback_query.message.chat_id,
+        message_id=callback_query.message.message_id,
     )
 
 
@@ -136,18 +143,22 @@ async def handle_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
 
     _, list_id = update.callback_query.data.split(":")
+    user_id = update.effective_user.id
     user_name = update.effective_user.username
+    # Replies go to the user's private chat
+    settings = chat_settings(user_id)
 
-    success, result = get_debt_status(list_id, user_name)
+    success, result = repository.get_debt_status(list_id, user_id, user_name)
 
     if not success:
         try:
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"An error occurred: {result}",
+                text=settings.text(result),
             )
         finally:  # TODO: Be better
             return
@@ -156,19 +167,18 @@ async def handle_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         try:
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"You have already marked this debt ({get_debt_list_name(list_id)}) as paid.",
+                text=settings.text("alreadyPaid", name=repository.get_debt_list_name(list_id)),
             )
         finally:  # TODO: Be better
             return
 
-    group_id = update.effective_chat.id
-    user_id = update.effective_user.id
-
-    success, result = update_debt_status(list_id, user_name, True)
+    success, result = await repository.update_debt_status(
+        list_id, user_id, user_name, True, side_effects=[_edit_pressed_debt_list(update, list_id)]
+    )
     if not success:
         await context.bot.send_message(
             chat_id=update.effective_user.id,
-            text=f"An error occurred: {result}",
+            text=settings.text(result),
         )
         return
 
@@ -176,30 +186,13 @@ async def handle_pay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Send message to user to confirm payment
         await context.bot.send_message(
             chat_id=user_id,
-            text=f"You have marked the debt ({get_debt_list_name(list_id)}) as paid.",
+            text=settings.text("markedPaid", name=repository.get_debt_list_name(list_id)),
         )
     finally:  # TODO: Be better
         pass
 
-    message = get_debt_list_string(list_id)
-    await context.bot.edit_message_text(
-        chat_id=group_id,
-        message_id=update.callback_query.message.message_id,
-        text=message,
-        reply_markup=update.callback_query.message.reply_markup,  # Keep the same inline keyboard
-    )
-
-    if is_all_debt_paid(list_id):
-        # Delete the debt list message
-        group_id, message_id = get_debt_list_message_info(list_id)
-        await delete_message(context.bot, list_id, group_id, message_id)
-
-        debt_owner_id = get_debt_list_user_id(list_id)
-        message = get_debt_list_string(list_id)
-        await context.bot.send_message(
-            chat_id=debt_owner_id,
-            text=f"This debt has been settled:\n\n{message}",
-        )
+    # The updated list, and the group message deletion and owner notice if this settled it, were queued with the change
+    kick_outbox(context)
 
 
 async def handle_unpay_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -213,17 +206,21 @@ async def handle_unpay_callback(update: Update, context: ContextTypes.DEFAULT_TY
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
 
     _, list_id = update.callback_query.data.split(":")
+    user_id = update.effective_user.id
     user_name = update.effective_user.username
+    # Replies go to the user's private chat
+    settings = chat_settings(user_id)
 
-    success, result = get_debt_status(list_id, user_name)
+    success, result = repository.get_debt_status(list_id, user_id, user_name)
     if not success:
         try:
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"An error occurred: {result}",
+                text=settings.text(result),
             )
         finally:  # TODO: Be better
             return
@@ -232,36 +229,29 @@ async def handle_unpay_callback(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"You have already marked this debt ({get_debt_list_name(list_id)}) as unpaid.",
+                text=settings.text("alreadyUnpaid", name=repository.get_debt_list_name(list_id)),
             )
         finally:  # TODO: Be better
             return
 
-    group_id = update.effective_chat.id
-    user_id = update.effective_user.id
-
-    sucess, result = update_debt_status(list_id, user_name, False)
+    success, result = await repository.update_debt_status(
+        list_id, user_id, user_name, False, side_effects=[_edit_pressed_debt_list(update, list_id)]
+    )
     if not success:
         try:
             await context.bot.send_message(
                 chat_id=update.effective_user.id,
-                text=f"An error occurred: {result}",
+                text=settings.text(result),
             )
         finally:  # TODO: Be better
             return
 
-    message = get_debt_list_string(list_id)
-    await context.bot.edit_message_text(
-        chat_id=group_id,
-        message_id=update.callback_query.message.message_id,
-        text=message,
-        reply_markup=update.callback_query.message.reply_markup,  # Keep the same inline keyboard
-    )
+    kick_outbox(context)
 
     # Send message to user to confirm payment
     await context.bot.send_message(
         chat_id=user_id,
-        text=f"You have marked the debt ({get_debt_list_name(list_id)}) as unpaid.",
+        text=settings.text("markedUnpaid", name=repository.get_debt_list_name(list_id)),
     )
 
 
@@ -278,25 +268,93 @@ async def handle_confirm_clear_callback(
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
 
-    debt_lists = get_debt_lists_by_user_id(update.effective_user.id)
-    if debt_lists:
-        for list_id in debt_lists:
-            group_id, message_id = get_debt_list_message_info(list_id)
-            await delete_message(context.bot, list_id, group_id, message_id)
-            delete_debt_list(list_id)
+    # Also queues the deletion of the group messages
+    cleared = await repository.clear_debt_lists(update.effective_user.id)
+    kick_outbox(context)
+    settings = chat_settings(update.effective_chat.id)
+    if cleared:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="All your debt lists have been cleared.",
+            text=settings.text("cleared"),
         )
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="You have no debt lists to clear.",
+            text=settings.text("nothingToClear"),
         )
     await context.bot.edit_message_text(
         chat_id=update.effective_chat.id,
         message_id=update.callback_query.message.message_id,
         text=update.callback_query.message.text,
     )
+
+
+async def handle_show_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles the navigation and filter buttons under a '/show' message by replacing the message with the requested page.
+
+    Args:
+        update (Update): The update object containing information about the callback query.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
+
+    # show:<status> or show:<status>:<before|after>:<last_updated>:<list_id>
+    _, status, *page = update.callback_query.data.split(":", 2)
+    if status not in SHOW_STATUSES:
+        return
+    before = after = None
+    if page:
+        direction, cursor = page[0].split(":", 1)
+        if direction == "before":
+            before = decode_page_cursor(cursor)
+        else:
+            after = decode_page_cursor(cursor)
+
+    message, reply_markup = get_debt_list_page_message(
+        repository, update.effective_user.id, status, before=before, after=after
+    )
+    try:
+        await update.callback_query.edit_message_text(
+            text=message, reply_markup=reply_markup
+        )
+    except BadRequest as error:
+        # Pressing the filter that is already shown does not change the message
+        if "not modified" not in str(error):
+            raise
+
+
+async def handle_find_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles the page buttons under a '/find' message by replacing the message with the requested page of results.
+
+    Args:
+        update (Update): The update object containing information about the callback query.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    await update.callback_query.answer()  # Answer the callback query to stop the loading animation on the button.
+
+    query = context.user_data.get("find_query")
+    if not query:
+        # The query is only kept in memory, so it is lost when the bot restarts
+        await update.callback_query.edit_message_text(
+            text=chat_settings(update.effective_user.id).text("searchExpired")
+        )
+        return
+
+    _, offset = update.callback_query.data.split(":")
+    message, reply_markup = get_search_results_message(
+        repository, update.effective_user.id, query, offset=max(int(offset), 0)
+    )
+    await update.callback_query.edit_message_text(text=message, reply_markup=reply_markup)
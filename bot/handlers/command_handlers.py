@@ -1,13 +1,23 @@
+from datetime import datetime
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
-from utils.utils import check_and_resend_debt_lists, get_debt_list_string
-
-from bot.database import (
-    add_or_update_user,
-    get_user_groups,
-    get_debt_lists_by_user_id,
+from utils.utils import (
+    SHOW_STATUSES,
+    check_and_resend_debt_lists,
+    get_debt_list_page_message,
+    get_search_results_message,
+    kick_outbox,
 )
 
+from config.config import DEFAULT_CURRENCY
+from bot.repository import Repository
+from bot.settings import chat_settings, reset_chat_settings, update_chat_settings
+
+
+# '/settings <name> <value>' -> the setting it changes
+SETTING_NAMES = {"timezone": "timezone", "language": "locale", "amounts": "amount_style"}
+
 
 async def handle_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -21,13 +31,14 @@ async def handle_command_start(update: Update, context: ContextTypes.DEFAULT_TYP
         None
 
     """
+    repository: Repository = context.bot_data["repository"]
     user_id = update.effective_user.id
     user_username = update.effective_user.username
     user_first_name = update.effective_user.first_name
     user_last_name = update.effective_user.last_name
 
     # Add or update the user in the database
-    add_or_update_user(
+    await repository.add_or_update_user(
         user_id=user_id,
         username=user_username,
         first_name=user_first_name,
@@ -36,14 +47,14 @@ async def handle_command_start(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Welcome to the Debt Tracker Bot! Start by sending a list of debts in this format:\n\nMacDonalds\n98765432\n@user1 9.6\n@user2 5.4\n@user3 3.0",
+        text=chat_settings(update.effective_chat.id).text("start"),
     )
 
 
 async def handle_command_example(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Send a message with the following format:\n\nDEBT_NAME\nPHONE_NUMBER\n@user_handle AMOUNT_OWED\n@user_handle AMOUNT_OWED\n@user_handle AMOUNT_OWED\n\nExample:\n\nMacDonalds\n98765432\n@user1 9.6\n@user2 5.4\n@user3 3.0",
+        text=chat_settings(update.effective_chat.id).text("example"),
     )
 
 
@@ -58,25 +69,55 @@ async def handle_command_get_groups(update: Update, context: ContextTypes.DEFAUL
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     user_id = update.effective_user.id
-    groups = get_user_groups(user_id)
+    settings = chat_settings(update.effective_chat.id)
+    groups = repository.get_user_groups(user_id)
     if groups:
-        groups_message = "You're in the following groups:\n\n"
-        groups_message += "\n".join([group.get("group_name") for group in groups])
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=groups_message,
+            text=settings.text(
+                "groupsList", groups="\n".join([group.group_name for group in groups])
+            ),
         )
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="I couldn't find any groups. If we are in the same group, please make sure I have access to messages and that you have sent a message in the group.",
+            text=settings.text("groupsNone"),
         )
 
 
 async def handle_command_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Handle the '/show' command by retrieving the debt lists for the user and sending them as a message.
+    Handle the '/show' command by sending the newest page of the user's debt lists. An optional argument filters the lists: '/show open', '/show settled' or '/show all'.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    status = context.args[0].lower() if context.args else "all"
+    if status not in SHOW_STATUSES:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=chat_settings(update.effective_chat.id).text("showUsage"),
+        )
+        return
+
+    message, reply_markup = get_debt_list_page_message(repository, update.effective_user.id, status)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+
+
+async def handle_command_find(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/find <query>' command by searching the names and debtors of the user's debt lists, including archived ones.
 
     Args:
         update (Update): The update object containing information about the incoming message.
@@ -85,14 +126,55 @@ async def handle_command_show(update: Update, context: ContextTypes.DEFAULT_TYPE
     Returns:
         None
     """
-    debt_lists = get_debt_lists_by_user_id(update.effective_user.id)
-    if debt_lists:
-        message = "Here are your debt lists:\n\n"
-        message += "\n\n###################################\n\n".join(
-            [get_debt_list_string(list_id) for list_id in debt_lists]
+    repository: Repository = context.bot_data["repository"]
+    query = " ".join(context.args).strip()
+    if not query:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=chat_settings(update.effective_chat.id).text("findUsage"),
         )
+        return
+
+    # Kept for the page buttons, which cannot carry the query themselves
+    context.user_data["find_query"] = query
+    message, reply_markup = get_search_results_message(repository, update.effective_user.id, query)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
+
+
+async def handle_command_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/balance' command by showing the net amount the user owes or is owed by each person, per group.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    settings = chat_settings(update.effective_chat.id)
+    balances = repository.get_user_balances(update.effective_user.id)
+    if balances:
+        sections = []
+        for group_id, group_balances in balances.items():
+            lines = [repository.get_group_name(group_id) or settings.text("unknownGroup")]
+            for counterparty, currency, amount_minor in sorted(
+                group_balances, key=lambda balance: -balance[2]
+            ):
+                amount = settings.money(abs(amount_minor), currency)
+                if amount_minor > 0:
+                    lines.append(settings.text("balanceOwesYou", name=counterparty, amount=amount))
+                else:
+                    lines.append(settings.text("balanceYouOwe", name=counterparty, amount=amount))
+            sections.append("\n".join(lines))
+        message = settings.text("balancesTitle") + "\n\n" + "\n\n".join(sections)
     else:
-        message = "You do not have any debt lists."
+        message = settings.text("balancesNone")
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -111,18 +193,48 @@ async def handle_command_clear(update: Update, context: ContextTypes.DEFAULT_TYP
     Returns:
         None
     """
+    settings = chat_settings(update.effective_chat.id)
     # Send a confirmation message to the user with a button to press to confirm the action
-    confirm_button = InlineKeyboardButton("Confirm ✅", callback_data="confirmClear")
+    confirm_button = InlineKeyboardButton(settings.text("confirmButton"), callback_data="confirmClear")
     keyboard = [[confirm_button]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Are you sure you want to delete all your debt lists?",
+        text=settings.text("clearConfirm"),
         reply_markup=reply_markup,
     )
 
 
+async def handle_command_undo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the command "/undo" to restore the debt lists the user deleted most recently, such as everything removed by an accidental "/clear". Restored lists that still have unpaid debts are posted to their group again.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing bot-related information.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    settings = chat_settings(update.effective_chat.id)
+    restored = await repository.undo_last_deletion(update.effective_user.id)
+    if not restored:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=settings.text("undoNothing"),
+        )
+        return
+
+    # Open lists were queued to be posted to their group again when they were restored
+    kick_outbox(context)
+
+    message = settings.text("undoRestored", count=len(restored)) + "\n\n"
+    message += "\n".join(repository.get_debt_list_name(list_id) for list_id in restored)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
 async def handle_command_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle the command "/help" to show the user a list of available commands.
@@ -134,15 +246,52 @@ async def handle_command_help(update: Update, context: ContextTypes.DEFAULT_TYPE
     Returns:
         None
     """
-    message = "Here are the available commands:\n\n"
-    message += "/example - Get an example on how to use the bot\n"
-    message += "/getgroups - Get a list of groups you are in\n"
-    message += "/show - Show all your debt lists\n"
-    message += "/clear - Clear all your debt lists\n"
-    message += "/help - Show this message\n"
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=message,
+        text=chat_settings(update.effective_chat.id).text("help"),
+    )
+
+
+async def handle_command_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/settings' command, which shows or changes the time zone, language and amount format of the chat it is
+    sent in: the user's own in a private chat, the group's in a group. For example '/settings timezone Europe/Berlin',
+    '/settings language en', '/settings amounts comma' or '/settings reset'.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing bot-related information.
+
+    Returns:
+        None
+    """
+    chat_id = update.effective_chat.id
+    settings = chat_settings(chat_id)
+    name, *values = [arg.strip() for arg in context.args] or [None]
+    try:
+        if name is None:
+            pass
+        elif name.lower() == "reset":
+            settings = await reset_chat_settings(chat_id)
+        elif name.lower() in SETTING_NAMES and len(values) == 1:
+            settings = await update_chat_settings(chat_id, **{SETTING_NAMES[name.lower()]: values[0]})
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=settings.text("settingsUsage"))
+            return
+    except ValueError as error:
+        await context.bot.send_message(chat_id=chat_id, text=settings.text("settingsInvalid", error=settings.error(error)))
+        return
+
+    message = settings.text(
+        "settingsCurrent",
+        timezone=settings.timezone.key,
+        now=datetime.now(settings.timezone),
+        locale=settings.locale,
+        example=settings.money(123456789, DEFAULT_CURRENCY),
+    )
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=message + "\n\n" + settings.text("settingsUsage"),
     )
 
 
@@ -160,7 +309,7 @@ async def handle_resend_all_command(update: Update, context: ContextTypes.DEFAUL
     await check_and_resend_debt_lists(context)
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="All debt lists have been resent.",
+        text=chat_settings(update.effective_chat.id).text("resent"),
     )
 
 
@@ -177,5 +326,5 @@ async def handle_unknown_command(update: Update, context: ContextTypes.DEFAULT_T
     """
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Sorry, I dont understand that command. Use /help for a list of commands",
+        text=chat_settings(update.effective_chat.id).text("invalidCommand"),
     )
@@ -0,0 +1,69 @@
+from telegram import Update
+from telegram.ext import ContextTypes
+from utils.utils import MAX_MESSAGE_LENGTH, get_group_stats_message, truncate_message
+
+from bot.repository import Repository
+from bot.settings import chat_settings
+from bot.settlement import plan_settlement
+
+
+async def handle_command_settle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/settle' command in a group by posting the fewest transfers that settle every outstanding debt in the group, across all of its debt lists.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    settings = chat_settings(update.effective_chat.id)
+    balances_by_currency = repository.get_group_member_balances(update.effective_chat.id)
+    lines = []
+    for currency, balances in sorted(balances_by_currency.items()):
+        lines.extend(
+            settings.text(
+                "settleTransfer", payer=payer, payee=payee, amount=settings.money(amount_minor, currency)
+            )
+            for payer, payee, amount_minor in plan_settlement(balances)
+        )
+    if lines:
+        header = settings.text("settleTitle") + "\n\n"
+        message = header + "\n".join(lines)
+        if len(message) > MAX_MESSAGE_LENGTH:
+            # Everything has to fit in one Telegram message: as many whole transfers as fit, then how many were left out
+            room = MAX_MESSAGE_LENGTH - len(header) - len("\n\n" + settings.text("settleMore", count=len(lines)))
+            shown = 0
+            while shown < len(lines) and len(lines[shown]) + 1 <= room:
+                room -= len(lines[shown]) + 1
+                shown += 1
+            message = (
+                header + "\n".join(lines[:shown]) + "\n\n" + settings.text("settleMore", count=len(lines) - shown)
+            )
+    else:
+        message = settings.text("settleNone")
+
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=truncate_message(message),
+    )
+
+
+async def handle_command_group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/groupstats' command in a group by posting how many lists were sent and paid there lately, how long debts take to be paid, who owes the most and who takes longest to pay.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=get_group_stats_message(repository, update.effective_chat.id),
+    )
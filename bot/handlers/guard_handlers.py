@@ -0,0 +1,61 @@
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+from config.config import (
+    CALLBACK_DEDUP_SECONDS,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_PER_SECOND,
+)
+
+from bot.guard import CallbackDeduplicator, TokenBucket, counters
+from bot.messages import render
+
+callback_deduplicator = CallbackDeduplicator(CALLBACK_DEDUP_SECONDS)
+rate_limiter = TokenBucket(RATE_LIMIT_BURST, RATE_LIMIT_PER_SECOND)
+# Users who have been told they are being throttled, so a flood is answered with one message rather than many
+_warned_users = set()
+
+
+async def handle_guard_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs before every other handler and stops duplicate button presses and updates from users who are over their rate limit from going any further. Neither check touches the database.
+
+    Args:
+        update (Update): The incoming update.
+        context (ContextTypes.DEFAULT_TYPE): The context object for the current update.
+
+    Returns:
+        None
+
+    Raises:
+        ApplicationHandlerStop: When the update is dropped.
+    """
+    counters["updates"] += 1
+    user = update.effective_user
+    if user is None:
+        counters["allowed"] += 1
+        return
+    callback_query = update.callback_query
+
+    # A double-tap on ✅ or ❌ would run the whole pay/unpay path twice for the same result
+    if callback_query and callback_deduplicator.is_duplicate(user.id, callback_query.data):
+        counters["duplicate_callbacks"] += 1
+        await callback_query.answer()
+        raise ApplicationHandlerStop
+
+    if not rate_limiter.allow(user.id):
+        counters["throttled"] += 1
+        if callback_query:
+            # In the default language, since looking up the user's could mean reading the database
+            await callback_query.answer(render("throttledPress"))
+        elif (
+            update.message
+            and update.effective_chat.type == update.effective_chat.PRIVATE
+            and user.id not in _warned_users
+        ):
+            _warned_users.add(user.id)
+            await update.message.reply_text(render("throttledMessage"))
+        # Inline queries and group messages are dropped without an answer
+        raise ApplicationHandlerStop
+
+    _warned_users.discard(user.id)
+    counters["allowed"] += 1
@@ -0,0 +1,53 @@
+from telegram import InlineQueryResultArticle, InputTextMessageContent, Update
+from telegram.ext import ContextTypes
+from config.config import INLINE_CACHE_TIME, INLINE_RESULT_LIMIT
+from utils.utils import build_pay_keyboard, format_debt_list, truncate_message
+
+from bot.repository import Repository
+from bot.settings import chat_settings
+
+
+async def handle_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles inline queries ('@bot <prefix>' in any chat) by offering the user's open debt lists whose name matches the prefix, ready to post with pay/unpay buttons.
+
+    Args:
+        update (Update): The update object containing the inline query.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    inline_query = update.inline_query
+    # Matching is done in memory, only the lists that are offered are read
+    list_ids = repository.search_open_debt_lists(
+        inline_query.from_user.id, inline_query.query, limit=INLINE_RESULT_LIMIT
+    )
+
+    # Where the list will be posted is not known yet, so it is rendered in the user's own settings
+    settings = chat_settings(inline_query.from_user.id)
+    results = []
+    for list_id in list_ids:
+        debt_list_info = repository.get_debt_list_info(list_id)
+        if not debt_list_info:
+            continue
+        currency = debt_list_info.currency
+        results.append(
+            InlineQueryResultArticle(
+                id=str(list_id),
+                title=debt_list_info.debt_name,
+                description=settings.text(
+                    "inlineDescription",
+                    outstanding=settings.money(debt_list_info.outstanding_minor, currency),
+                    total=settings.amount(debt_list_info.total_minor, currency),
+                ),
+                input_message_content=InputTextMessageContent(
+                    truncate_message(format_debt_list(debt_list_info, settings))
+                ),
+                reply_markup=build_pay_keyboard(list_id),
+            )
+        )
+
+    # The results depend on who is asking, so Telegram must not share its cached answer between users
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
@@ -1,18 +1,10 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
+from config.config import DEFAULT_CURRENCY
 from utils.utils import parse_debt_list
 
-from bot.database import (
-    add_or_update_user,
-    add_or_update_group,
-    delete_debt_list,
-    is_user_in_group,
-    associate_user_with_group,
-    add_debt_list,
-    add_or_update_debt,
-    associate_debt_with_debt_list,
-    user_has_pending_debt_list,
-)
+from bot.repository import Repository
+from bot.settings import chat_settings
 
 
 async def handle_parse_and_check_input(
@@ -28,42 +20,41 @@ async def handle_parse_and_check_input(
     Returns:
         None
     """
-    success, result = parse_debt_list(update.message.text)
+    repository: Repository = context.bot_data["repository"]
+    currency = DEFAULT_CURRENCY
+    settings = chat_settings(update.effective_chat.id)
+    success, result = parse_debt_list(update.message.text, currency, settings)
     user_id = update.effective_user.id
 
     if not success:
         await context.bot.send_message(chat_id=user_id, text=result)
         return
 
-    list_id = user_has_pending_debt_list(user_id)
+    list_id = repository.user_has_pending_debt_list(user_id)
     if list_id:
-        delete_debt_list(list_id)
+        # Replaced rather than deleted, so /undo does not bring the old draft back
+        await repository.discard_pending_debt_list(list_id)
 
     debt_name, phone_number, debts = result
 
-    # Create new debt list
-    debt_list_id = add_debt_list(
-        user_id=user_id, debt_name=debt_name, phone_number=phone_number
+    # Create new debt list, with its debts in the same write
+    debt_list_id = await repository.add_debt_list(
+        user_id=user_id,
+        debt_name=debt_name,
+        phone_number=phone_number,
+        currency=currency,
+        debts=debts,
     )
 
-    # Create the debts
-    for debt in debts:
-        debt_id = add_or_update_debt(
-            list_id=debt_list_id,
-            owed_by_user_name=debt[0],
-            amount=debt[1],
-        )
-        associate_debt_with_debt_list(debt_id, debt_list_id)
-
-    message = "Here's the debt list you entered:\n\n"
+    message = settings.text("enteredList") + "\n\n"
     for debt in debts:
-        message += f"{debt[0]} - {debt[1]}\n"
-    message += "\nPlease confirm that the information is correct."
+        message += settings.text("enteredDebt", handle=debt[0], amount=settings.amount(debt[1], currency)) + "\n"
+    message += "\n" + settings.text("confirmPrompt")
 
     # TODO: Abstract this?
     # Create inline keyboard with confirm button
     confirm_button = InlineKeyboardButton(
-        "Confirm ✅", callback_data=f"confirmInput:{debt_list_id}"
+        settings.text("confirmButton"), callback_data=f"confirmInput:{debt_list_id}"
     )
     keyboard = [[confirm_button]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -88,6 +79,7 @@ async def handle_save_user_group_info(
     Returns:
         None
     """
+    repository: Repository = context.bot_data["repository"]
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
@@ -98,20 +90,21 @@ async def handle_save_user_group_info(
         update.effective_chat.type
     )  # 'private', 'group', 'supergroup', or 'channel'
 
-    if is_user_in_group(user_id=user_id, group_id=group_id):
-        return
-
-    add_or_update_user(
+    # Always save the user so that debts follow them when they change their username
+    await repository.add_or_update_user(
         user_id=user_id,
         username=username,
         first_name=first_name,
         last_name=last_name,
     )
 
-    add_or_update_group(
+    if repository.is_user_in_group(user_id=user_id, group_id=group_id):
+        return
+
+    await repository.add_or_update_group(
         group_id=group_id,
         group_name=chat_title,
         group_type=chat_type,
     )
 
-    associate_user_with_group(user_id=user_id, group_id=group_id)
+    await repository.associate_user_with_group(user_id=user_id, group_id=group_id)
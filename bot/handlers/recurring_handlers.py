@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.ext import ContextTypes
+from telegram.error import BadRequest
+from utils.utils import get_recurring_debt_lists_message
+
+from bot.recurring import next_due, parse_schedule
+from bot.repository import Repository
+from bot.settings import chat_settings
+
+
+async def handle_command_repeat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle the '/repeat' command, which posts the debt list the user sent last to its group again on a schedule:
+    '/repeat monthly 1', '/repeat weekly fri' or '/repeat cron 0 18 * * sun'. Without a schedule it shows the user's
+    recurring debt lists, with buttons to stop them.
+
+    Args:
+        update (Update): The update object containing information about the incoming message.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    user_id = update.effective_user.id
+    settings = chat_settings(update.effective_chat.id)
+    if not context.args:
+        message, reply_markup = get_recurring_debt_lists_message(repository, user_id)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=message,
+            reply_markup=reply_markup,
+        )
+        return
+
+    debt_list = repository.get_last_sent_debt_list(user_id)
+    if debt_list is None:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=settings.text("repeatNoList"),
+        )
+        return
+
+    # The schedule is in the user's time zone, so "monthly 1" is the first of the month where they are
+    timezone_name = settings.timezone.key
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    try:
+        schedule = parse_schedule(context.args, timezone_name, now)
+    except ValueError as error:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=settings.text("repeatInvalid", error=settings.error(error)) + "\n\n" + settings.text("repeatUsage"),
+        )
+        return
+
+    first_due = next_due(schedule, timezone_name, now)
+    await repository.add_recurring_debt_list(debt_list, schedule, timezone_name, first_due)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=settings.text(
+            "repeatCreated",
+            name=debt_list.debt_name,
+            group=repository.get_group_name(debt_list.group_id) or settings.text("unknownGroup"),
+            due=settings.local_time(first_due),
+        ),
+    )
+
+
+async def handle_stop_recurring_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles the stop buttons under a '/repeat' message by stopping the recurring debt list and showing the rest.
+
+    Args:
+        update (Update): The update object containing information about the callback query.
+        context (ContextTypes.DEFAULT_TYPE): The context object containing the bot's context.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    user_id = update.effective_user.id
+    _, recurring_id = update.callback_query.data.split(":")
+    # Owners can only stop their own, and a second press finds nothing to stop
+    stopped = await repository.delete_recurring_debt_list(int(recurring_id), user_id)
+    await update.callback_query.answer(
+        chat_settings(user_id).text("recurringStopped" if stopped else "recurringNotFound")
+    )
+
+    message, reply_markup = get_recurring_debt_lists_message(repository, user_id)
+    try:
+        await update.callback_query.edit_message_text(text=message, reply_markup=reply_markup)
+    except BadRequest as error:
+        # A second press of the same button leaves the message as it is
+        if "not modified" not in str(error):
+            raise
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import tempfile
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import ContextTypes
+from config.config import DEFAULT_CURRENCY, IMPORT_CHUNK_SIZE, MAX_IMPORT_FILE_SIZE
+from utils.importer import (
+    ImportErrors,
+    iter_debt_rows,
+    iter_document_rows,
+    parse_document_caption,
+    supported_extensions,
+)
+
+from bot.repository import Repository
+from bot.settings import chat_settings
+
+
+async def handle_document_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handles a debt list uploaded as a CSV or XLSX document. The caption holds the debt name and phone number, and each row of the document holds a handle and an amount. The rows are streamed into a new pending debt list, and the user is asked to confirm it like a pasted list.
+
+    Args:
+        update (Update): The update object containing the user's document.
+        context (ContextTypes.DEFAULT_TYPE): The context object for handling the update.
+
+    Returns:
+        None
+    """
+    repository: Repository = context.bot_data["repository"]
+    user_id = update.effective_user.id
+    document = update.message.document
+    currency = DEFAULT_CURRENCY
+    settings = chat_settings(user_id)
+
+    success, result = parse_document_caption(update.message.caption, settings)
+    if not success:
+        await context.bot.send_message(chat_id=user_id, text=result)
+        return
+    debt_name, phone_number = result
+
+    extension = os.path.splitext(document.file_name or "")[1].lower()
+    if extension not in supported_extensions():
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=settings.text("uploadUnsupported", extensions=" or ".join(supported_extensions())),
+        )
+        return
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await context.bot.send_message(
+            chat_id=user_id, text=settings.text("uploadTooLarge")
+        )
+        return
+
+    list_id = repository.user_has_pending_debt_list(user_id)
+    if list_id:
+        # Replaced rather than deleted, so /undo does not bring the old draft back
+        await repository.discard_pending_debt_list(list_id)
+
+    debt_list_id = await repository.add_debt_list(
+        user_id=user_id,
+        debt_name=debt_name,
+        phone_number=phone_number,
+        currency=currency,
+    )
+
+    errors = ImportErrors()
+    preview = []
+
+    def debts(path):
+        for debt in iter_debt_rows(
+            iter_document_rows(path, document.file_name), currency, errors
+        ):
+            if len(preview) < 20:
+                preview.append(debt)
+            yield debt
+
+    telegram_file = await document.get_file()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f"upload{extension}")
+        await telegram_file.download_to_drive(path)
+        try:
+            # Run the import off the event loop, it can take a while for large files
+            count = await asyncio.to_thread(
+                repository.add_debts_bulk, debt_list_id, debts(path), IMPORT_CHUNK_SIZE
+            )
+        except Exception:
+            logging.exception("Failed to import %s", document.file_name)
+            await repository.discard_pending_debt_list(debt_list_id)
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=settings.text("uploadUnreadable"),
+            )
+            return
+
+    if errors or not count:
+        await repository.discard_pending_debt_list(debt_list_id)
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=errors.report(settings) if errors else settings.text("uploadEmpty"),
+        )
+        return
+
+    total_minor, _ = repository.get_debt_list_totals(debt_list_id)
+    message = settings.text("uploadedList", count=count) + "\n\n"
+    for debt in preview:
+        message += settings.text("enteredDebt", handle=debt[0], amount=settings.amount(debt[1], currency)) + "\n"
+    if count > len(preview):
+        message += settings.text("uploadMore", count=count - len(preview)) + "\n"
+    message += "\n" + settings.text("uploadTotal", total=settings.money(total_minor, currency)) + "\n"
+    message += "\n" + settings.text("confirmPrompt")
+
+    confirm_button = InlineKeyboardButton(
+        settings.text("confirmButton"), callback_data=f"confirmInput:{debt_list_id}"
+    )
+    reply_markup = InlineKeyboardMarkup([[confirm_button]])
+
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=message,
+        reply_markup=reply_markup,
+    )
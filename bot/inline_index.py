@@ -0,0 +1,103 @@
+"""
+In-memory prefix index of each user's open debt lists, used to answer inline queries without touching the database.
+
+Every user has a sorted array of (word, list_id) pairs, one per word of each open list's name, so the lists matching a
+prefix are a contiguous range found with two binary searches.
+"""
+
+import re
+import threading
+from bisect import bisect_left, insort
+from typing import Iterable, List, Tuple
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", (text or "").casefold())
+
+
+def _index_words(debt_name: str) -> List[str]:
+    # The empty word matches every list, so an empty query is a range lookup like any other
+    return [""] + _words(debt_name)
+
+
+class DebtListPrefixIndex:
+    def __init__(self):
+        self._entries = {}  # user_id -> sorted list of (word, list_id)
+        self._lists = {}  # list_id -> (user_id, words)
+        # Updated from the event loop and from jobs on the scheduler's thread pool
+        self._lock = threading.Lock()
+
+    def load(self, debt_lists: Iterable[Tuple[int, int, str]]) -> None:
+        """
+        Replace the contents of the index.
+
+        Args:
+            debt_lists (Iterable[Tuple[int, int, str]]): (list_id, user_id, debt_name) of every open debt list.
+        """
+        entries, lists = {}, {}
+        for list_id, user_id, debt_name in debt_lists:
+            words = _index_words(debt_name)
+            lists[list_id] = (user_id, words)
+            entries.setdefault(user_id, []).extend((word, list_id) for word in words)
+        for user_entries in entries.values():
+            user_entries.sort()
+        with self._lock:
+            self._entries, self._lists = entries, lists
+
+    def add(self, list_id: int, user_id: int, debt_name: str) -> None:
+        with self._lock:
+            self._remove(list_id)
+            words = _index_words(debt_name)
+            self._lists[list_id] = (user_id, words)
+            user_entries = self._entries.setdefault(user_id, [])
+            for word in words:
+                insort(user_entries, (word, list_id))
+
+    def remove(self, list_id: int) -> None:
+        with self._lock:
+            self._remove(list_id)
+
+    def _remove(self, list_id: int) -> None:
+        if list_id not in self._lists:
+            return
+        user_id, words = self._lists.pop(list_id)
+        user_entries = self._entries[user_id]
+        for word in words:
+            del user_entries[bisect_left(user_entries, (word, list_id))]
+        if not user_entries:
+            del self._entries[user_id]
+
+    def search(self, user_id: int, query: str, limit: int = 50) -> List[int]:
+        """
+        Find a user's open debt lists where every word of the query is a prefix of a word in the list's name.
+
+        Args:
+            user_id (int): The ID of the user.
+            query (str): The query, an empty query matches every open list.
+            limit (int, optional): The maximum number of lists to return. Defaults to 50, the most Telegram shows.
+
+        Returns:
+            List[int]: The IDs of the matching lists, newest first.
+        """
+        prefixes = _words(query)
+        # Narrow down with the longest prefix, then check the others against each candidate's words
+        longest = max(prefixes, key=len, default="")
+        with self._lock:
+            user_entries = self._entries.get(user_id, [])
+            start = bisect_left(user_entries, (longest,))
+            end = bisect_left(
+                user_entries, (longest + "\U0010ffff",) if longest else ("\x00",)
+            )
+            list_ids = {
+                list_id
+                for _, list_id in user_entries[start:end]
+                if all(
+                    any(word.startswith(prefix) for word in self._lists[list_id][1])
+                    for prefix in prefixes
+                )
+            }
+        return sorted(list_ids, reverse=True)[:limit]
+
+
+# Shared by the database functions that open, settle and delete lists, and the inline query handler
+open_debt_lists_index = DebtListPrefixIndex()
@@ -1,22 +1,81 @@
+import time
+
+# Taken before the imports, which are the slowest part of startup
+STARTED = time.perf_counter()
+
+import importlib
+import logging
+
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from config.config import BOT_TOKEN
+from config.config import (
+    ARCHIVE_INTERVAL_HOURS,
+    BACKUP_INTERVAL_HOURS,
+    BOT_API_CONNECT_TIMEOUT,
+    BOT_API_HTTP2,
+    BOT_API_KEEPALIVE_EXPIRY,
+    BOT_API_POOL_SIZE,
+    BOT_API_POOL_TIMEOUT,
+    BOT_API_READ_TIMEOUT,
+    BOT_API_URL,
+    BOT_API_WRITE_TIMEOUT,
+    BOT_TOKEN,
+    CONCURRENT_UPDATES,
+    GET_UPDATES_CONNECT_TIMEOUT,
+    GET_UPDATES_POOL_SIZE,
+    GET_UPDATES_POOL_TIMEOUT,
+    GET_UPDATES_READ_TIMEOUT,
+    GET_UPDATES_WRITE_TIMEOUT,
+    GROUP_STATS_INTERVAL_MINUTES,
+    GUARD_REPORT_MINUTES,
+    OUTBOX_POLL_SECONDS,
+    RECURRING_POLL_MINUTES,
+    REQUEST_METRICS_MINUTES,
+)
 from bot.database import initialize_database
-from utils.utils import check_and_resend_debt_lists
+from bot.rebalance import finish_moves
+from bot.shards import check_placements
+from bot.repository import Repository, create_repository
+from bot.request import InstrumentedRequest
+from bot.startup import StartupTimer, warm_caches
+from utils.utils import (
+    archive_debt_lists,
+    backup_database,
+    check_and_resend_debt_lists,
+    drain_outbox,
+    log_guard_counters,
+    log_request_pool_metrics,
+    materialize_recurring_debt_lists,
+    prune_outbox,
+    roll_up_group_stats,
+)
 
+from telegram import Update
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
+    ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
+# Taken before the handlers are imported, so startup reports their import time apart from the rest, see time_imports()
+HANDLERS_STARTED = time.perf_counter()
+
+# Handlers that most updates need. The rest are registered with deferred(), which imports them on first use
 from bot.handlers.command_handlers import (
     handle_command_example,
     handle_command_start,
     handle_command_get_groups,
     handle_command_show,
+    handle_command_find,
+    handle_command_balance,
+    handle_command_settings,
     handle_command_clear,
+    handle_command_undo,
     handle_command_help,
     handle_resend_all_command,
     handle_unknown_command,
@@ -27,26 +86,98 @@ from bot.handlers.callback_handlers import (
     handle_send_to_group_callback,
     handle_pay_callback,
     handle_unpay_callback,
+    handle_show_page_callback,
+    handle_find_page_callback,
 )
+from bot.handlers.guard_handlers import handle_guard_update
 from bot.handlers.message_handlers import (
     handle_parse_and_check_input,
     handle_save_user_group_info,
 )
 
+IMPORTED = time.perf_counter()
 
-if __name__ == "__main__":
-    # Initialize the database
-    initialize_database()
 
-    # Create the Application and pass it your bot's token.
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+logger = logging.getLogger(__name__)
+
+
+def time_imports(timer: StartupTimer) -> None:
+    """Add the imports of this module to the timer's breakdown, the handlers' as a phase of their own."""
+    timer.mark("imports", at=HANDLERS_STARTED)
+    timer.mark("handlers", at=IMPORTED)
+
+
+def deferred(module: str, name: str):
+    """
+    A callback for the handler called name in bot.handlers.module that imports the module when it first handles an
+    update rather than when the bot starts, for the handlers that few updates need.
+    """
+
+    async def callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        handler = getattr(importlib.import_module(f"bot.handlers.{module}"), name)
+        return await handler(update, context)
+
+    callback.__name__ = name
+    return callback
 
-    # Setup APScheduler to check every 2 hours whether or not to resend debt lists
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(
-        check_and_resend_debt_lists, "interval", hours=2, args=[app]
-    )  # Abstract the interval into a config file
-    scheduler.start()
+
+def build_application(
+    token: str = BOT_TOKEN, api_url: str = BOT_API_URL, repository: Repository = None, post_init=None
+) -> Application:
+    """
+    Create the Application with every handler registered, as the bot runs it.
+
+    Args:
+        token (str, optional): The bot's token. Defaults to BOT_TOKEN.
+        api_url (str, optional): The Bot API server to talk to, e.g. a local fake one for load tests. Defaults to BOT_API_URL, which is Telegram's when unset.
+        repository (Repository, optional): Where the handlers keep users, groups, debt lists and debts. Defaults to the one of STORAGE_BACKEND.
+        post_init (optional): Coroutine function called with the application once run_polling has initialized it, before the first update is fetched. Defaults to None.
+
+    Returns:
+        Application: The application, not yet initialized or started.
+    """
+    # Updates are handled concurrently, so writes from different users reach the database writer together and share
+    # a commit
+    http_version = "2" if BOT_API_HTTP2 else "1.1"
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(
+            InstrumentedRequest(
+                "bot_api",
+                BOT_API_POOL_SIZE,
+                keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+                connect_timeout=BOT_API_CONNECT_TIMEOUT,
+                read_timeout=BOT_API_READ_TIMEOUT,
+                write_timeout=BOT_API_WRITE_TIMEOUT,
+                pool_timeout=BOT_API_POOL_TIMEOUT,
+                http_version=http_version,
+            )
+        )
+        .get_updates_request(
+            InstrumentedRequest(
+                "get_updates",
+                GET_UPDATES_POOL_SIZE,
+                keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+                connect_timeout=GET_UPDATES_CONNECT_TIMEOUT,
+                read_timeout=GET_UPDATES_READ_TIMEOUT,
+                write_timeout=GET_UPDATES_WRITE_TIMEOUT,
+                pool_timeout=GET_UPDATES_POOL_TIMEOUT,
+                http_version=http_version,
+            )
+        )
+    )
+    if api_url:
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    if post_init:
+        builder = builder.post_init(post_init)
+    app = builder.build()
+    # The handlers and jobs find their storage here
+    app.bot_data["repository"] = repository or create_repository()
+
+    # Drop duplicate button presses and rate limited updates before any other handler, group -1 runs first
+    app.add_handler(TypeHandler(Update, handle_guard_update), group=-1)
 
     # Register command handlers
     app.add_handler(
@@ -61,9 +192,31 @@ if __name__ == "__main__":
     app.add_handler(
         CommandHandler("show", handle_command_show, filters.ChatType.PRIVATE)
     )
+    app.add_handler(
+        CommandHandler("find", handle_command_find, filters.ChatType.PRIVATE)
+    )
+    app.add_handler(
+        CommandHandler("repeat", deferred("recurring_handlers", "handle_command_repeat"), filters.ChatType.PRIVATE)
+    )
+    app.add_handler(
+        CommandHandler("balance", handle_command_balance, filters.ChatType.PRIVATE)
+    )
+    app.add_handler(
+        CommandHandler("settle", deferred("group_command_handlers", "handle_command_settle"), filters.ChatType.GROUPS)
+    )
+    app.add_handler(
+        CommandHandler(
+            "groupstats", deferred("group_command_handlers", "handle_command_group_stats"), filters.ChatType.GROUPS
+        )
+    )
+    # A user's own settings in a private chat, the group's in a group
+    app.add_handler(CommandHandler("settings", handle_command_settings))
     app.add_handler(
         CommandHandler("clear", handle_command_clear, filters.ChatType.PRIVATE)
     )
+    app.add_handler(
+        CommandHandler("undo", handle_command_undo, filters.ChatType.PRIVATE)
+    )
     app.add_handler(
         CommandHandler("help", handle_command_help, filters.ChatType.PRIVATE)
     )
@@ -78,6 +231,12 @@ if __name__ == "__main__":
             handle_parse_and_check_input,
         )
     )
+    app.add_handler(
+        MessageHandler(
+            filters.ChatType.PRIVATE & filters.Document.ALL,
+            deferred("upload_handlers", "handle_document_upload"),
+        )
+    )
 
     # Register callback query handlers
     app.add_handler(
@@ -88,10 +247,20 @@ if __name__ == "__main__":
     )
     app.add_handler(CallbackQueryHandler(handle_pay_callback, pattern="^pay:"))
     app.add_handler(CallbackQueryHandler(handle_unpay_callback, pattern="^unpay:"))
+    app.add_handler(CallbackQueryHandler(handle_show_page_callback, pattern="^show:"))
+    app.add_handler(CallbackQueryHandler(handle_find_page_callback, pattern="^find:"))
+    app.add_handler(
+        CallbackQueryHandler(
+            deferred("recurring_handlers", "handle_stop_recurring_callback"), pattern="^stopRecurring:"
+        )
+    )
     app.add_handler(
         CallbackQueryHandler(handle_confirm_clear_callback, pattern="confirmClear")
     )
 
+    # Register the inline query handler, inline mode must also be enabled for the bot with @BotFather
+    app.add_handler(InlineQueryHandler(deferred("inline_handlers", "handle_inline_query")))
+
     # Unknown command handler as the last handler for commands
     app.add_handler(
         MessageHandler(
@@ -105,5 +274,81 @@ if __name__ == "__main__":
         MessageHandler(~filters.ChatType.PRIVATE, handle_save_user_group_info)
     )
 
+    return app
+
+
+def build_scheduler(app: Application) -> AsyncIOScheduler:
+    """Create the scheduler of the bot's periodic jobs, not yet started."""
+    # Setup APScheduler to check every 2 hours whether or not to resend debt lists
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(
+        check_and_resend_debt_lists, "interval", hours=2, args=[app]
+    )  # Abstract the interval into a config file
+    # Move old settled debt lists out of the tables the bot works on
+    scheduler.add_job(archive_debt_lists, "interval", hours=ARCHIVE_INTERVAL_HOURS)
+    # Carry out queued Telegram side effects, including any left unfinished by a restart
+    scheduler.add_job(
+        drain_outbox, "interval", seconds=OUTBOX_POLL_SECONDS, args=[app], max_instances=1
+    )
+    # Delete side effects that were finished long ago
+    scheduler.add_job(prune_outbox, "interval", hours=24, max_instances=1)
+    # Create the recurring debt lists that are due, the outbox drainer posts them
+    scheduler.add_job(
+        materialize_recurring_debt_lists,
+        "interval",
+        minutes=RECURRING_POLL_MINUTES,
+        args=[app.bot_data["repository"]],
+        max_instances=1,
+    )
+    # Keep the rollups /groupstats reads up to date with the event log
+    scheduler.add_job(
+        roll_up_group_stats, "interval", minutes=GROUP_STATS_INTERVAL_MINUTES, max_instances=1
+    )
+    # Back up the database while the bot keeps running
+    scheduler.add_job(backup_database, "interval", hours=BACKUP_INTERVAL_HOURS)
+    scheduler.add_job(log_guard_counters, "interval", minutes=GUARD_REPORT_MINUTES)
+    scheduler.add_job(log_request_pool_metrics, "interval", minutes=REQUEST_METRICS_MINUTES)
+    return scheduler
+
+
+def start_up(timer: StartupTimer) -> Application:
+    """
+    Everything the bot does before it starts polling, each step timed as a phase of startup.
+
+    Args:
+        timer (StartupTimer): The timer of this startup. The bot is ready, and the breakdown logged, once run_polling
+            has initialized the application.
+
+    Returns:
+        Application: The application, with its jobs scheduled.
+    """
+    with timer.phase("schema"):
+        initialize_database()
+        check_placements()
+        # Debt lists whose move into their group's shard was cut short by the last shutdown
+        finish_moves()
+    # Inline queries, group messages and every rendered message read these, so they are loaded before any update is
+    with timer.phase("caches"):
+        cache_seconds = warm_caches()
+    logger.info(
+        "Warmed caches: %s", ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in cache_seconds.items())
+    )
+
+    async def ready(app: Application) -> None:
+        # Initializing asks Telegram who the bot is, one round trip
+        timer.mark("initialize")
+        timer.log_ready()
+
+    with timer.phase("application"):
+        app = build_application(post_init=ready)
+        build_scheduler(app).start()
+    return app
+
+
+if __name__ == "__main__":
+    timer = StartupTimer(STARTED)
+    time_imports(timer)
+    app = start_up(timer)
+
     # Start the bot
     app.run_polling()
@@ -0,0 +1,42 @@
+"""
+In-memory set of the groups each user is known to be in, checked on every group message before the membership is
+written.
+
+Memberships are only ever added, so a pair found here is never stale. A pair that is missing is looked up in the
+database and added once found, which also covers memberships written while the set was being loaded.
+"""
+
+import threading
+from typing import Iterable, Tuple
+
+
+class GroupMemberships:
+    def __init__(self):
+        self._members = {}  # group_id -> set of user_ids
+        # Read and updated from the event loop, and loaded from a thread at startup
+        self._lock = threading.Lock()
+
+    def load(self, groups: Iterable[Tuple[int, Iterable[int]]]) -> None:
+        """
+        Add memberships read from the database.
+
+        Args:
+            groups (Iterable[Tuple[int, Iterable[int]]]): (group_id, user_ids) of every group with members.
+        """
+        members = {group_id: set(user_ids) for group_id, user_ids in groups}
+        with self._lock:
+            for group_id, user_ids in members.items():
+                self._members.setdefault(group_id, set()).update(user_ids)
+
+    def add(self, user_id: int, group_id: int) -> None:
+        with self._lock:
+            self._members.setdefault(group_id, set()).add(user_id)
+
+    def contains(self, user_id: int, group_id: int) -> bool:
+        return user_id in self._members.get(group_id, ())
+
+    def __len__(self) -> int:
+        return sum(len(user_ids) for user_ids in self._members.values())
+
+
+group_memberships = GroupMemberships()
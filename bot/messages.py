@@ -0,0 +1,145 @@
+"""
+The message catalog: every text the bot sends, per language, loaded once from data/bot_messages.json.
+
+The file maps a language tag to its messages, each a str.format template such as "Total: {amount}". Templates are
+parsed when the catalog is loaded, so rendering one only joins its pieces. A language only needs the messages it
+translates, the others fall back along its chain, e.g. pt-BR to pt to the default language.
+"""
+
+import json
+from string import Formatter
+
+from config.config import DEFAULT_LOCALE, MESSAGES_FILE
+
+
+class MessageTemplate:
+    __slots__ = ("text", "_parts")
+
+    def __init__(self, text: str):
+        """
+        Args:
+            text (str): The template, with fields like {name} or {amount:>10}.
+
+        Raises:
+            ValueError: If a field is not a plain name, e.g. {0} or {debt.name}.
+        """
+        self.text = text
+        # (literal text, field name, format spec, conversion), the field is None after the last literal
+        self._parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if field is not None and not field.isidentifier():
+                raise ValueError(f"Field {{{field}}} of {text!r} must be a plain name")
+            self._parts.append((literal, field, spec or "", conversion))
+        if len(self._parts) == 1 and self._parts[0][1] is None:
+            self._parts = None
+
+    def render(self, **values) -> str:
+        if self._parts is None:
+            return self.text
+        pieces = []
+        for literal, field, spec, conversion in self._parts:
+            pieces.append(literal)
+            if field is not None:
+                value = values[field]
+                if conversion == "r":
+                    value = repr(value)
+                elif conversion == "s":
+                    value = str(value)
+                pieces.append(format(value, spec))
+        return "".join(pieces)
+
+    def __repr__(self) -> str:
+        return f"MessageTemplate({self.text!r})"
+
+
+def normalize_locale(locale: str) -> str:
+    return locale.strip().replace("_", "-").lower()
+
+
+def locale_chain(locale: str) -> list:
+    """
+    The languages to look a message up in, most specific first.
+
+    Examples:
+        >>> locale_chain("pt-BR")
+        ['pt-br', 'pt', 'en']
+    """
+    chain = []
+    parts = normalize_locale(locale).split("-") if locale else []
+    while parts:
+        chain.append("-".join(parts))
+        parts.pop()
+    if DEFAULT_LOCALE not in chain:
+        chain.append(DEFAULT_LOCALE)
+    return chain
+
+
+def load_catalog(path: str) -> dict:
+    """
+    Load and parse a message catalog.
+
+    Args:
+        path (str): The JSON file, mapping language tags to {message key: template}.
+
+    Returns:
+        dict: {language: {message key: MessageTemplate}}, with normalized language tags.
+
+    Raises:
+        ValueError: If the default language is missing or a template is invalid.
+    """
+    with open(path, encoding="utf-8") as file:
+        raw = json.load(file)
+    catalog = {
+        normalize_locale(locale): {key: MessageTemplate(text) for key, text in messages.items()}
+        for locale, messages in raw.items()
+    }
+    if DEFAULT_LOCALE not in catalog:
+        raise ValueError(f"{path} has no messages for the default language {DEFAULT_LOCALE}")
+    return catalog
+
+
+catalog = load_catalog(MESSAGES_FILE)
+# language tag -> every message of the language, with fallbacks filled in
+_resolved = {}
+
+
+def messages_for(locale: str) -> dict:
+    """
+    Every message in a language, falling back along its chain for those it does not translate.
+
+    Args:
+        locale (str): The language tag, unknown ones get the default language.
+
+    Returns:
+        dict: {message key: MessageTemplate}, shared, so must not be changed.
+    """
+    messages = _resolved.get(locale)
+    if messages is None:
+        messages = {}
+        for fallback in reversed(locale_chain(locale)):
+            messages.update(catalog.get(fallback, {}))
+        _resolved[locale] = messages
+    return messages
+
+
+def is_known_locale(locale: str) -> bool:
+    """Whether the catalog has messages for the language itself or for a less specific form of it."""
+    normalized = normalize_locale(locale)
+    return normalized in catalog or normalized.split("-")[0] in catalog
+
+
+def render(key: str, locale: str = DEFAULT_LOCALE, **values) -> str:
+    return messages_for(locale)[key].render(**values)
+
+
+class UserError(ValueError):
+    """
+    An error to show the user, as a message of the catalog, so that it can be rendered in the language of the chat it
+    is shown in, see Settings.error. A value can be another UserError, e.g. the problem on a line of a list. Its str()
+    is the message in the default language.
+    """
+
+    def __init__(self, key: str, **values):
+        self.key = key
+        self.values = values
+        super().__init__(render(key, **values))
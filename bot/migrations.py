@@ -0,0 +1,420 @@
+"""
+Schema migrations for the SQLite database.
+
+`Base.metadata.create_all` only creates tables that do not exist yet, so new columns and indexes on existing tables are added here. Each migration runs exactly once, in order, and the number of applied migrations is stored in `PRAGMA user_version`.
+
+A freshly created database already has the latest schema, so it is only stamped with the latest version. Migrations are written against the schema as it was when they were added and must not depend on the current models.
+
+Once a database is up to date, a checksum of the models is stored in `PRAGMA application_id`. At startup a database with the latest version and the checksum of the running code is used as it is, without inspecting its tables, so a change to the models that comes without a migration, such as a new table, still gets created.
+"""
+
+import json
+import logging
+import zlib
+
+from sqlalchemy import Connection, Engine, Table
+
+from config.config import DEFAULT_CURRENCY
+from utils.money import currency_exponent
+
+from .models import SEARCH_INDEX_DDL, Balance, Base, Debt, DebtList, User, normalize_username
+
+logger = logging.getLogger(__name__)
+
+
+def _column_names(conn: Connection, table: str) -> set:
+    return {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    if column not in _column_names(conn, table):
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _create_indexes(conn: Connection, table: Table, *names: str) -> None:
+    for index in table.indexes:
+        if index.name in names:
+            index.create(bind=conn, checkfirst=True)
+
+
+def _migrate_username_resolution(conn: Connection) -> None:
+    """Add case-folded usernames and link existing debts to known users."""
+    _add_column(conn, "users", "username_lower", "VARCHAR")
+    _add_column(conn, "debts", "owed_by_user_name_lower", "VARCHAR")
+    _add_column(conn, "debts", "owed_by_user_id", "INTEGER REFERENCES users (user_id)")
+
+    # SQLite's lower() only folds ASCII, so backfill in Python with the same normalization as the application
+    for user_id, username in conn.exec_driver_sql(
+        "SELECT user_id, username FROM users"
+    ).fetchall():
+        conn.exec_driver_sql(
+            "UPDATE users SET username_lower = ? WHERE user_id = ?",
+            (normalize_username(username), user_id),
+        )
+    for debt_id, owed_by_user_name in conn.exec_driver_sql(
+        "SELECT debt_id, owed_by_user_name FROM debts"
+    ).fetchall():
+        conn.exec_driver_sql(
+            "UPDATE debts SET owed_by_user_name_lower = ? WHERE debt_id = ?",
+            (normalize_username(owed_by_user_name), debt_id),
+        )
+
+    _create_indexes(conn, User.__table__, "ix_users_username_lower")
+    _create_indexes(
+        conn,
+        Debt.__table__,
+        "ix_debts_list_user_id",
+        "ix_debts_list_user_name_lower",
+        "ix_debts_user_name_lower",
+        "ix_debts_user_id",
+    )
+
+    conn.exec_driver_sql(
+        """
+        UPDATE debts SET owed_by_user_id = (
+            SELECT users.user_id FROM users
+            WHERE users.username_lower = debts.owed_by_user_name_lower
+        )
+        WHERE owed_by_user_id IS NULL AND owed_by_user_name_lower IS NOT NULL
+        """
+    )
+
+
+def _migrate_unpaid_counters(conn: Connection) -> None:
+    """Add the denormalized unpaid counters to debt lists and backfill them."""
+    _add_column(conn, "debt_lists", "unpaid_count", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "debt_lists", "unpaid_total", "FLOAT NOT NULL DEFAULT 0")
+    conn.exec_driver_sql(
+        """
+        UPDATE debt_lists SET
+            unpaid_count = (
+                SELECT COUNT(*) FROM debts
+                WHERE debts.list_id = debt_lists.list_id AND NOT debts.paid
+            ),
+            unpaid_total = (
+                SELECT COALESCE(SUM(debts.amount), 0) FROM debts
+                WHERE debts.list_id = debt_lists.list_id AND NOT debts.paid
+            )
+        """
+    )
+    _create_indexes(conn, DebtList.__table__, "ix_debt_lists_open")
+
+
+def _migrate_balances(conn: Connection) -> None:
+    """Backfill the balances rollup from the existing debts."""
+    if "amount" not in _column_names(conn, "balances"):
+        # Created with the minor unit schema, which _migrate_minor_units backfills
+        return
+    conn.exec_driver_sql("DELETE FROM balances")
+    conn.exec_driver_sql(
+        """
+        INSERT INTO balances (group_id, creditor_id, debtor_name, debtor_user_id, amount)
+        SELECT debt_lists.group_id, debt_lists.user_id, debts.owed_by_user_name_lower,
+               MAX(debts.owed_by_user_id), SUM(debts.amount)
+        FROM debts JOIN debt_lists ON debt_lists.list_id = debts.list_id
+        WHERE debt_lists.group_id IS NOT NULL AND NOT debts.paid
+        GROUP BY debt_lists.group_id, debt_lists.user_id, debts.owed_by_user_name_lower
+        """
+    )
+
+
+def _migrate_minor_units(conn: Connection) -> None:
+    """
+    Move amounts from floats to integer minor units with a currency per debt list. Existing lists are assumed to be in the default currency. The old float columns are left in place, unused, since SQLite cannot drop columns on every version we run on.
+    """
+    scale = 10 ** currency_exponent(DEFAULT_CURRENCY)
+    _add_column(
+        conn,
+        "debt_lists",
+        "currency",
+        f"VARCHAR(3) NOT NULL DEFAULT '{DEFAULT_CURRENCY}'",
+    )
+    _add_column(conn, "debt_lists", "unpaid_total_minor", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "debts", "amount_minor", "INTEGER NOT NULL DEFAULT 0")
+    if "amount" in _column_names(conn, "debts"):
+        conn.exec_driver_sql(
+            f"""
+            UPDATE debts SET amount_minor = CAST(ROUND(amount * {scale}) AS INTEGER)
+            WHERE amount IS NOT NULL
+            """
+        )
+    conn.exec_driver_sql(
+        """
+        UPDATE debt_lists SET unpaid_total_minor = (
+            SELECT COALESCE(SUM(debts.amount_minor), 0) FROM debts
+            WHERE debts.list_id = debt_lists.list_id AND NOT debts.paid
+        )
+        """
+    )
+    _create_indexes(conn, Debt.__table__, "ix_debts_list_paid_amount")
+
+    # The rollup is derived data, so rebuild it with the new key instead of converting it
+    conn.exec_driver_sql("DROP TABLE IF EXISTS balances")
+    Balance.__table__.create(bind=conn)
+    conn.exec_driver_sql(
+        """
+        INSERT INTO balances
+            (group_id, creditor_id, debtor_name, currency, debtor_user_id, amount_minor)
+        SELECT debt_lists.group_id, debt_lists.user_id, debts.owed_by_user_name_lower,
+               debt_lists.currency, MAX(debts.owed_by_user_id), SUM(debts.amount_minor)
+        FROM debts JOIN debt_lists ON debt_lists.list_id = debts.list_id
+        WHERE debt_lists.group_id IS NOT NULL AND NOT debts.paid
+        GROUP BY debt_lists.group_id, debt_lists.user_id,
+                 debts.owed_by_user_name_lower, debt_lists.currency
+        """
+    )
+
+
+def _migrate_debt_list_pagination(conn: Connection) -> None:
+    """Index debt lists for keyset pagination by owner."""
+    _create_indexes(conn, DebtList.__table__, "ix_debt_lists_user_updated")
+
+
+def _migrate_debt_list_archival(conn: Connection) -> None:
+    """Index settled debt lists for the archival sweep. The archive table itself is new and created by create_all."""
+    _create_indexes(conn, DebtList.__table__, "ix_debt_lists_settled")
+
+
+def _migrate_search_index(conn: Connection) -> None:
+    """Fill the full-text index with the debt lists that existed before it. create_all has already created it."""
+    conn.exec_driver_sql("DELETE FROM debt_list_fts")
+    conn.exec_driver_sql(
+        """
+        INSERT INTO debt_list_fts (rowid, debt_name, debtors, owner, archived)
+        SELECT debt_lists.list_id, debt_lists.debt_name,
+               (SELECT group_concat(owed_by_user_name, ' ') FROM debts
+                WHERE debts.list_id = debt_lists.list_id),
+               'u' || debt_lists.user_id, 0
+        FROM debt_lists WHERE NOT debt_lists.is_pending
+        """
+    )
+    conn.exec_driver_sql(
+        """
+        INSERT INTO debt_list_fts (rowid, debt_name, debtors, owner, archived)
+        SELECT archived_debt_lists.list_id, archived_debt_lists.debt_name,
+               (SELECT group_concat(json_extract(value, '$[0]'), ' ')
+                FROM json_each(archived_debt_lists.data, '$.debts')),
+               'u' || archived_debt_lists.user_id, 1
+        FROM archived_debt_lists
+        """
+    )
+
+
+def _migrate_event_log(conn: Connection) -> None:
+    """
+    Record a snapshot event for every debt list that existed before the event log, so that replaying the log starts from their state at the time of the migration. create_all has already created the table.
+    """
+    debts = {}
+    for list_id, debt_id, name, amount_minor, paid in conn.exec_driver_sql(
+        "SELECT list_id, debt_id, owed_by_user_name, amount_minor, paid FROM debts ORDER BY debt_id"
+    ):
+        debts.setdefault(list_id, []).append([debt_id, name, amount_minor, bool(paid)])
+
+    def snapshot(list_id: int, **payload) -> tuple:
+        # 9 is the snapshot event kind
+        return (list_id, 9, json.dumps(payload, separators=(",", ":"), ensure_ascii=False))
+
+    rows = [
+        snapshot(
+            list_id,
+            user_id=user_id,
+            debt_name=debt_name,
+            phone_number=phone_number,
+            currency=currency,
+            group_id=group_id,
+            pending=bool(is_pending),
+            archived=False,
+            debts=debts.get(list_id, []),
+        )
+        for list_id, user_id, debt_name, phone_number, currency, group_id, is_pending in conn.exec_driver_sql(
+            "SELECT list_id, user_id, debt_name, phone_number, currency, group_id, is_pending FROM debt_lists"
+        )
+    ]
+    for list_id, user_id, debt_name, currency, group_id, data in conn.exec_driver_sql(
+        "SELECT list_id, user_id, debt_name, currency, group_id, data FROM archived_debt_lists"
+    ).fetchall():
+        data = json.loads(data)
+        rows.append(
+            snapshot(
+                list_id,
+                user_id=user_id,
+                debt_name=debt_name,
+                phone_number=data["phone_number"],
+                currency=currency,
+                group_id=group_id,
+                pending=False,
+                archived=True,
+                # Archived debts were stored without their IDs, which no later event refers to
+                debts=[
+                    [-number, name, amount_minor, True]
+                    for number, (name, _, amount_minor) in enumerate(data["debts"], start=1)
+                ],
+            )
+        )
+    if rows:
+        conn.exec_driver_sql(
+            "INSERT INTO debt_events (list_id, kind, payload, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            rows,
+        )
+
+
+def _migrate_debt_paid_at(conn: Connection) -> None:
+    """
+    Add when each debt was paid, backfilled from the event log for the debts that are paid. Debts paid before the event log existed are left without a time. The analytics rollups are new and created by create_all.
+    """
+    _add_column(conn, "debts", "paid_at", "DATETIME")
+    # 3 is the paid event kind
+    conn.exec_driver_sql(
+        """
+        UPDATE debts SET paid_at = (
+            SELECT MAX(debt_events.created_at) FROM debt_events
+            WHERE debt_events.list_id = debts.list_id AND debt_events.kind = 3
+              AND json_extract(debt_events.payload, '$.debt_id') = debts.debt_id
+        )
+        WHERE debts.paid
+        """
+    )
+
+
+def _migrate_debt_list_ids(conn: Connection) -> None:
+    """
+    Hand out new debt list IDs after every ID used so far, including those of deleted lists that the event log still
+    remembers. The allocator table itself is new and created by create_all.
+    """
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS debt_list_ids (list_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT)"
+    )
+    last_id = conn.exec_driver_sql(
+        """
+        SELECT MAX(list_id) FROM (
+            SELECT MAX(list_id) AS list_id FROM debt_lists
+            UNION ALL SELECT MAX(list_id) FROM archived_debt_lists
+            UNION ALL SELECT MAX(list_id) FROM debt_events
+        )
+        """
+    ).scalar()
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'debt_list_ids'")
+    conn.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) VALUES ('debt_list_ids', ?)", (last_id or 0,)
+    )
+
+
+def _migrate_ambiguous_usernames(conn: Connection) -> None:
+    """
+    Forget the handles that more than one user is saved with. Handles used to be matched case sensitively, so `Bob` and `bob` could both be saved, and the first migration linked their debts to either. The debts written for such a handle are unlinked, and linked again when its holder is next seen.
+    """
+    handles = [
+        username_lower
+        for (username_lower,) in conn.exec_driver_sql(
+            """
+            SELECT username_lower FROM users
+            WHERE username_lower IS NOT NULL
+            GROUP BY username_lower HAVING COUNT(*) > 1
+            """
+        )
+    ]
+    for username_lower in handles:
+        conn.exec_driver_sql(
+            """
+            UPDATE debts SET owed_by_user_id = NULL
+            WHERE owed_by_user_name_lower = ?
+              AND owed_by_user_id IN (SELECT user_id FROM users WHERE username_lower = ?)
+            """,
+            (username_lower, username_lower),
+        )
+        conn.exec_driver_sql("UPDATE users SET username_lower = NULL WHERE username_lower = ?", (username_lower,))
+        conn.exec_driver_sql(
+            """
+            UPDATE balances SET debtor_user_id = (
+                SELECT MAX(debts.owed_by_user_id) FROM debts
+                JOIN debt_lists ON debt_lists.list_id = debts.list_id
+                WHERE debt_lists.group_id = balances.group_id AND debt_lists.user_id = balances.creditor_id
+                  AND debt_lists.currency = balances.currency
+                  AND debts.owed_by_user_name_lower = balances.debtor_name AND NOT debts.paid
+            )
+            WHERE debtor_name = ?
+            """,
+            (username_lower,),
+        )
+
+
+MIGRATIONS = [
+    _migrate_username_resolution,
+    _migrate_unpaid_counters,
+    _migrate_balances,
+    _migrate_minor_units,
+    _migrate_debt_list_pagination,
+    _migrate_debt_list_archival,
+    _migrate_search_index,
+    _migrate_event_log,
+    _migrate_debt_paid_at,
+    _migrate_debt_list_ids,
+    _migrate_ambiguous_usernames,
+]
+
+
+def mark_up_to_date(engine: Engine) -> None:
+    """
+    Stamp a database created from the current models with the latest migration version.
+
+    Args:
+        engine (Engine): The engine connected to the new database.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+
+def run_migrations(engine: Engine) -> None:
+    """
+    Apply all migrations that have not been applied to the database yet.
+
+    Args:
+        engine (Engine): The engine connected to the database to migrate.
+    """
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Applying migration %d: %s", number, migration.__name__)
+            migration(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+
+
+def schema_checksum() -> int:
+    """
+    A checksum of the tables, columns, indexes and full-text index the models define, as stored in `PRAGMA
+    application_id`, a signed 32-bit integer.
+    """
+    parts = []
+    for table in sorted(Base.metadata.tables.values(), key=lambda table: table.name):
+        parts.append(table.name)
+        parts.extend(f"{column.name} {column.type} {column.nullable}" for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    parts.extend(" ".join(statement.split()) for statement in SEARCH_INDEX_DDL)
+    return zlib.crc32("\n".join(parts).encode()) & 0x7FFFFFFF
+
+
+def is_schema_current(engine: Engine) -> bool:
+    """
+    Check whether the database has every migration applied and was last brought up to date by the running code.
+
+    Args:
+        engine (Engine): The engine connected to the database.
+
+    Returns:
+        bool: True if the database can be used without creating tables or migrating it.
+    """
+    with engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        checksum = conn.exec_driver_sql("PRAGMA application_id").scalar()
+    return version == len(MIGRATIONS) and checksum == schema_checksum()
+
+
+def stamp_schema_checksum(engine: Engine) -> None:
+    """
+    Record that the database matches the running code's models, after its tables were created and it was migrated.
+
+    Args:
+        engine (Engine): The engine connected to the database.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA application_id = {schema_checksum()}")
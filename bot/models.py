@@ -1,21 +1,31 @@
 from sqlalchemy import (
+    DDL,
     create_engine,
     event,
     Column,
     Integer,
+    SmallInteger,
     String,
-    Float,
     Boolean,
     ForeignKey,
     Table,
+    Date,
     DateTime,
+    Index,
     func,
+    select,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import column_property, relationship, sessionmaker
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.pool import NullPool
 
-DATABASE_URL = "sqlite:///./debt_tracker.db"
-engine = create_engine(DATABASE_URL, echo=True, pool_size=10, max_overflow=20)
+from config.config import DATABASE_URL, DEFAULT_CURRENCY
+
+# Sessions are closed by garbage collection, so a pool would run dry under load while finished sessions wait to be
+# collected. Opening an SQLite connection is cheap, so each session opens its own.
+engine = create_engine(DATABASE_URL, echo=True, poolclass=NullPool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -33,6 +43,8 @@ class User(Base):
     __tablename__ = "users"
     user_id = Column(Integer, primary_key=True, index=True)
     username = Column(String, index=True)
+    # Case-folded copy of username, used to resolve debts to users
+    username_lower = Column(String, index=True)
     first_name = Column(String)
     last_name = Column(String)
 
@@ -70,6 +82,11 @@ class DebtList(Base):
         default=func.now(),
         onupdate=func.now(),
     )
+    # ISO 4217 code of the currency every debt in the list is in
+    currency = Column(String(3), default=DEFAULT_CURRENCY, nullable=False)
+    # Denormalized from debts, kept in sync by the Debt listeners below
+    unpaid_count = Column(Integer, default=0, nullable=False)
+    unpaid_total_minor = Column(Integer, default=0, nullable=False)
 
     owner = relationship("User", back_populates="debt_lists")
     group = relationship("Group", back_populates="debt_lists", uselist=False)
@@ -78,17 +95,289 @@ class DebtList(Base):
         "Debt", back_populates="debt_list", cascade="delete, delete-orphan"
     )
 
+    __table_args__ = (
+        # Partial index so that sweeps over open lists never touch settled ones
+        Index("ix_debt_lists_open", last_updated, sqlite_where=unpaid_count > 0),
+        # Keyset pagination of a user's lists, newest first
+        Index("ix_debt_lists_user_updated", user_id, last_updated, list_id),
+        # Partial index for the archival sweep, which only looks at settled lists
+        Index("ix_debt_lists_settled", last_updated, sqlite_where=unpaid_count == 0),
+    )
+
 
 class Debt(Base):
     __tablename__ = "debts"
     debt_id = Column(Integer, primary_key=True, index=True)
     list_id = Column(Integer, ForeignKey("debt_lists.list_id"))
     owed_by_user_name = Column(String)
-    amount = Column(Float)
+    # Case-folded copy of owed_by_user_name, used until the debtor is linked
+    owed_by_user_name_lower = Column(String)
+    # Set once the debtor has been seen by the bot, survives username changes
+    owed_by_user_id = Column(Integer, ForeignKey("users.user_id"), nullable=True)
+    # Amount in the minor unit of the debt list's currency, e.g. cents
+    amount_minor = Column(Integer, default=0, nullable=False)
     paid = Column(Boolean, default=False)
+    # When the debt was last marked as paid, None while it is unpaid. Set by the listeners at the bottom of this module
+    paid_at = Column(DateTime, nullable=True)
 
     debt_list = relationship("DebtList", back_populates="debts")
 
+    __table_args__ = (
+        Index("ix_debts_list_user_id", "list_id", "owed_by_user_id"),
+        Index("ix_debts_list_user_name_lower", "list_id", "owed_by_user_name_lower"),
+        Index("ix_debts_user_name_lower", "owed_by_user_name_lower"),
+        Index("ix_debts_user_id", "owed_by_user_id"),
+        # Covers the per-list SUM queries without touching the table
+        Index("ix_debts_list_paid_amount", "list_id", "paid", "amount_minor"),
+    )
+
+
+# Total of every debt in a list, loaded in the same query as the list when undeferred
+DebtList.total_minor = column_property(
+    select(func.coalesce(func.sum(Debt.amount_minor), 0))
+    .where(Debt.list_id == DebtList.list_id)
+    .correlate_except(Debt)
+    .scalar_subquery(),
+    deferred=True,
+)
+
+
+class ArchivedDebtList(Base):
+    """
+    A settled debt list moved out of debt_lists and debts by the archival job, stored as one row with its debts in a compact JSON document.
+    """
+
+    __tablename__ = "archived_debt_lists"
+    # Same ID the list had in debt_lists
+    list_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    group_id = Column(Integer, nullable=True)
+    debt_name = Column(String)
+    currency = Column(String(3), nullable=False)
+    total_minor = Column(Integer, default=0, nullable=False)
+    # last_updated of the list when it was archived
+    settled_at = Column(DateTime)
+    archived_at = Column(DateTime, default=func.now())
+    # {"phone_number": ..., "debts": [[owed_by_user_name, owed_by_user_id, amount_minor], ...]}
+    data = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ix_archived_debt_lists_user", "user_id", "settled_at"),
+        Index("ix_archived_debt_lists_archived_at", "archived_at"),
+    )
+
+
+class RecurringDebtList(Base):
+    """
+    A debt list that is posted to its group again on a schedule, e.g. the rent every month. Each time it is due, a new
+    debt list is created from it, see bot/recurring.py.
+    """
+
+    __tablename__ = "recurring_debt_lists"
+    recurring_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False)
+    group_id = Column(Integer, ForeignKey("groups.group_id"), nullable=False)
+    debt_name = Column(String, nullable=False)
+    phone_number = Column(String)
+    currency = Column(String(3), nullable=False)
+    # [[owed_by_user_name, amount_minor], ...]
+    debts = Column(String, nullable=False)
+    # A crontab expression in the time zone below
+    schedule = Column(String, nullable=False)
+    timezone = Column(String, nullable=False)
+    # When the next list is due, naive UTC. Only the next one is stored, the one after is computed when it is posted
+    next_due = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_recurring_debt_lists_next_due", "next_due"),
+        Index("ix_recurring_debt_lists_user", "user_id"),
+    )
+
+
+class GroupDailyStats(Base):
+    """
+    Rollup of what happened in a group each day, per currency, filled from the event log by update_group_stats in
+    bot/analytics.py. Days are UTC.
+    """
+
+    __tablename__ = "group_daily_stats"
+    group_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    currency = Column(String(3), primary_key=True)
+    lists_sent = Column(Integer, default=0, nullable=False)
+    debts_paid = Column(Integer, default=0, nullable=False)
+    amount_paid_minor = Column(Integer, default=0, nullable=False)
+
+
+class GroupSettleTimes(Base):
+    """
+    Rollup of how long the debts paid in a group each day took to be paid, counted from when their list was sent, as a
+    histogram over the buckets in bot/analytics.py, so medians over any range of days can be read without the debts.
+    """
+
+    __tablename__ = "group_settle_times"
+    group_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    bucket = Column(SmallInteger, primary_key=True)
+    debts = Column(Integer, default=0, nullable=False)
+
+
+class GroupDebtorStats(Base):
+    """Rollup of the debts each debtor paid in a group each day, and the seconds they took to pay them in total."""
+
+    __tablename__ = "group_debtor_stats"
+    group_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    # Normalized username of the debtor, see normalize_username
+    debtor_name = Column(String, primary_key=True)
+    debts_paid = Column(Integer, default=0, nullable=False)
+    settle_seconds = Column(Integer, default=0, nullable=False)
+
+
+class RollupState(Base):
+    """How far each rollup that is filled from the event log has got, by the ID of the last event it has applied."""
+
+    __tablename__ = "rollup_state"
+    name = Column(String, primary_key=True)
+    last_event_id = Column(Integer, default=0, nullable=False)
+
+
+class DebtEvent(Base):
+    """
+    Append-only log of every change to debt lists and their debts, see bot/events.py for the kinds of events and their payloads.
+    """
+
+    __tablename__ = "debt_events"
+    event_id = Column(Integer, primary_key=True)
+    # Not a foreign key, the events of a list outlive it
+    list_id = Column(Integer, nullable=False)
+    kind = Column(SmallInteger, nullable=False)
+    # The user who made the change, None for changes made by the bot itself
+    actor_id = Column(Integer, nullable=True)
+    # Shared by the events of one operation that touches several lists, such as /clear
+    batch_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    payload = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index("ix_debt_events_list", "list_id", "event_id"),
+        Index("ix_debt_events_actor", "actor_id", "kind", "event_id"),
+    )
+
+
+class OutboxMessage(Base):
+    """
+    A Telegram side effect queued in the same transaction as the change it belongs to, see bot/outbox.py.
+    """
+
+    __tablename__ = "outbox"
+    outbox_id = Column(Integer, primary_key=True)
+    action = Column(String(16), nullable=False)
+    chat_id = Column(Integer, nullable=True)
+    message_id = Column(Integer, nullable=True)
+    inline_message_id = Column(String, nullable=True)
+    list_id = Column(Integer, nullable=True)
+    text = Column(String, nullable=True)
+    # Effects with the same key are only ever queued once
+    idempotency_key = Column(String, nullable=True, unique=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=func.now(), nullable=False)
+    created_at = Column(DateTime, default=func.now())
+    # Set once the effect was carried out, or given up on, in which case error says why
+    done_at = Column(DateTime, nullable=True)
+    error = Column(String, nullable=True)
+
+    __table_args__ = (
+        # Partial index so that the drainer only ever looks at pending effects
+        Index(
+            "ix_outbox_pending",
+            "next_attempt_at",
+            "outbox_id",
+            sqlite_where=done_at.is_(None),
+        ),
+    )
+
+
+class Balance(Base):
+    """
+    Rollup of the unpaid amount each debtor owes each creditor in a group, per currency, summed over every debt list that has been sent to the group. Maintained by the listeners at the bottom of this module.
+    """
+
+    __tablename__ = "balances"
+    group_id = Column(Integer, primary_key=True)
+    creditor_id = Column(Integer, primary_key=True)
+    # Normalized username of the debtor, see normalize_username
+    debtor_name = Column(String, primary_key=True)
+    currency = Column(String(3), primary_key=True)
+    debtor_user_id = Column(Integer, nullable=True)
+    amount_minor = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_balances_creditor", "creditor_id", "group_id"),
+        Index("ix_balances_debtor_user_id", "debtor_user_id", "group_id"),
+        Index("ix_balances_debtor_name", "debtor_name"),
+    )
+
+
+class ChatSettings(Base):
+    """
+    A user's or group's own time zone, language and amount format, keyed by chat ID, so groups have negative keys.
+    Unset columns fall back to the defaults in config/config.py. Read through the cache in bot/settings.py.
+    """
+
+    __tablename__ = "chat_settings"
+    chat_id = Column(Integer, primary_key=True)
+    # IANA time zone name, e.g. Asia/Singapore
+    timezone = Column(String, nullable=True)
+    # Language tag of the message catalog, e.g. en or pt-BR
+    locale = Column(String, nullable=True)
+    # One of utils.money.AMOUNT_STYLES
+    amount_style = Column(String, nullable=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class DebtListId(Base):
+    """
+    Hands out the IDs of new debt lists. debt_lists numbers its rows like any rowid table, after the largest ID still
+    in it, so deleting the newest list would give its ID, and the events and queued messages still keyed by it, to the
+    next list. AUTOINCREMENT remembers the largest ID ever handed out in sqlite_sequence instead, and a row is deleted
+    again in the transaction that took it, see database.new_list_id(). With sharding every shard hands out its own,
+    which shards.global_id() makes unique across shards.
+    """
+
+    __tablename__ = "debt_list_ids"
+    list_id = Column(Integer, primary_key=True)
+
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class DebtListShard(Base):
+    """
+    Which shard a debt list is in, for the lists that are not in the shard they were created in. Kept in the shard they
+    were created in, for shards.for_list(), and in the shard they are in, and only used when sharding is on, see
+    bot/shards.py.
+    """
+
+    __tablename__ = "debt_list_shards"
+    list_id = Column(Integer, primary_key=True)
+    shard = Column(SmallInteger, nullable=False)
+
+
+def normalize_username(username: str) -> str:
+    """
+    Normalize a Telegram username for comparison. Telegram handles are case-insensitive and are sometimes written with a leading '@'.
+
+    Args:
+        username (str): The username, with or without a leading '@'.
+
+    Returns:
+        str: The case-folded username without the leading '@', or None if no username was given.
+    """
+    if not username:
+        return None
+    return username.strip().lstrip("@").casefold()
+
 
 # Automatically update the last_updated column in a debt list when a debt is updated
 def debt_after_update_listener(mapper, connection, target):
@@ -100,3 +389,323 @@ def debt_after_update_listener(mapper, connection, target):
 
 
 event.listen(Debt, "after_update", debt_after_update_listener)
+
+
+def _previous_value(target, attribute: str):
+    history = get_history(target, attribute)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, attribute)
+
+
+def _adjust_unpaid_counters(
+    connection, list_id: int, paid: bool, amount_minor: int, sign: int
+):
+    if list_id is None or paid:
+        return
+    connection.execute(
+        DebtList.__table__.update()
+        .where(DebtList.list_id == list_id)
+        .values(
+            unpaid_count=DebtList.unpaid_count + sign,
+            unpaid_total_minor=DebtList.unpaid_total_minor + sign * (amount_minor or 0),
+        )
+    )
+
+
+# Record when a debt is paid, with the database's clock like every other timestamp
+def debt_before_insert_paid_at_listener(mapper, connection, target):
+    if target.paid and target.paid_at is None:
+        target.paid_at = func.now()
+
+
+def debt_before_update_paid_at_listener(mapper, connection, target):
+    if get_history(target, "paid").has_changes():
+        target.paid_at = func.now() if target.paid else None
+
+
+event.listen(Debt, "before_insert", debt_before_insert_paid_at_listener)
+event.listen(Debt, "before_update", debt_before_update_paid_at_listener)
+
+
+# Keep the unpaid counters on a debt list in the same transaction as every change to its debts
+def debt_after_insert_counters_listener(mapper, connection, target):
+    _adjust_unpaid_counters(connection, target.list_id, target.paid, target.amount_minor, 1)
+
+
+def debt_after_update_counters_listener(mapper, connection, target):
+    _adjust_unpaid_counters(
+        connection,
+        _previous_value(target, "list_id"),
+        _previous_value(target, "paid"),
+        _previous_value(target, "amount_minor"),
+        -1,
+    )
+    _adjust_unpaid_counters(connection, target.list_id, target.paid, target.amount_minor, 1)
+
+
+def debt_after_delete_counters_listener(mapper, connection, target):
+    _adjust_unpaid_counters(
+        connection,
+        _previous_value(target, "list_id"),
+        _previous_value(target, "paid"),
+        _previous_value(target, "amount_minor"),
+        -1,
+    )
+
+
+event.listen(Debt, "after_insert", debt_after_insert_counters_listener)
+event.listen(Debt, "after_update", debt_after_update_counters_listener)
+event.listen(Debt, "after_delete", debt_after_delete_counters_listener)
+
+
+def _adjust_balance(
+    connection,
+    group_id: int,
+    creditor_id: int,
+    debtor_name: str,
+    currency: str,
+    debtor_user_id: int,
+    delta: int,
+):
+    if group_id is None or not delta:
+        return
+    balances = Balance.__table__
+    insert_balance = sqlite_insert(balances).values(
+        group_id=group_id,
+        creditor_id=creditor_id,
+        debtor_name=debtor_name,
+        currency=currency,
+        debtor_user_id=debtor_user_id,
+        amount_minor=delta,
+    )
+    connection.execute(
+        insert_balance.on_conflict_do_update(
+            index_elements=[
+                balances.c.group_id,
+                balances.c.creditor_id,
+                balances.c.debtor_name,
+                balances.c.currency,
+            ],
+            set_={
+                "amount_minor": balances.c.amount_minor
+                + insert_balance.excluded.amount_minor,
+                "debtor_user_id": func.coalesce(
+                    insert_balance.excluded.debtor_user_id, balances.c.debtor_user_id
+                ),
+            },
+        )
+    )
+    # Drop settled pairs so the table only holds outstanding balances
+    connection.execute(
+        balances.delete().where(
+            balances.c.group_id == group_id,
+            balances.c.creditor_id == creditor_id,
+            balances.c.debtor_name == debtor_name,
+            balances.c.currency == currency,
+            balances.c.amount_minor == 0,
+        )
+    )
+
+
+def _adjust_debt_balance(
+    connection, list_id, debtor_name, debtor_user_id, paid, amount_minor, sign
+):
+    if list_id is None or paid:
+        return
+    debt_list = connection.execute(
+        select(DebtList.group_id, DebtList.user_id, DebtList.currency).where(
+            DebtList.list_id == list_id
+        )
+    ).first()
+    if debt_list is None:
+        return
+    _adjust_balance(
+        connection,
+        debt_list.group_id,
+        debt_list.user_id,
+        debtor_name,
+        debt_list.currency,
+        debtor_user_id,
+        sign * (amount_minor or 0),
+    )
+
+
+# Keep the balance rollup in the same transaction as every change to a debt
+def debt_after_insert_balance_listener(mapper, connection, target):
+    _adjust_debt_balance(
+        connection,
+        target.list_id,
+        target.owed_by_user_name_lower,
+        target.owed_by_user_id,
+        target.paid,
+        target.amount_minor,
+        1,
+    )
+
+
+def debt_after_update_balance_listener(mapper, connection, target):
+    if not any(
+        get_history(target, attribute).has_changes()
+        for attribute in ("list_id", "owed_by_user_name_lower", "paid", "amount_minor")
+    ):
+        # Only the debtor's user ID can have changed, which does not move any money
+        if target.owed_by_user_id is not None and target.list_id is not None:
+            debt_list = connection.execute(
+                select(DebtList.group_id, DebtList.user_id, DebtList.currency).where(
+                    DebtList.list_id == target.list_id
+                )
+            ).first()
+            if debt_list is not None:
+                connection.execute(
+                    Balance.__table__.update()
+                    .where(
+                        Balance.group_id == debt_list.group_id,
+                        Balance.creditor_id == debt_list.user_id,
+                        Balance.debtor_name == target.owed_by_user_name_lower,
+                        Balance.currency == debt_list.currency,
+                    )
+                    .values(debtor_user_id=target.owed_by_user_id)
+                )
+        return
+    _adjust_debt_balance(
+        connection,
+        _previous_value(target, "list_id"),
+        _previous_value(target, "owed_by_user_name_lower"),
+        target.owed_by_user_id,
+        _previous_value(target, "paid"),
+        _previous_value(target, "amount_minor"),
+        -1,
+    )
+    _adjust_debt_balance(
+        connection,
+        target.list_id,
+        target.owed_by_user_name_lower,
+        target.owed_by_user_id,
+        target.paid,
+        target.amount_minor,
+        1,
+    )
+
+
+def debt_after_delete_balance_listener(mapper, connection, target):
+    _adjust_debt_balance(
+        connection,
+        _previous_value(target, "list_id"),
+        _previous_value(target, "owed_by_user_name_lower"),
+        target.owed_by_user_id,
+        _previous_value(target, "paid"),
+        _previous_value(target, "amount_minor"),
+        -1,
+    )
+
+
+# Debts only count towards a group's balances once their list has been sent to the group
+def debt_list_after_update_balance_listener(mapper, connection, target):
+    previous_group_id = _previous_value(target, "group_id")
+    if previous_group_id == target.group_id:
+        return
+    unpaid_debts = connection.execute(
+        select(
+            Debt.owed_by_user_name_lower,
+            Debt.owed_by_user_id,
+            func.sum(Debt.amount_minor),
+        )
+        .where(Debt.list_id == target.list_id, Debt.paid == False)
+        .group_by(Debt.owed_by_user_name_lower)
+    ).all()
+    for debtor_name, debtor_user_id, amount_minor in unpaid_debts:
+        _adjust_balance(
+            connection,
+            previous_group_id,
+            target.user_id,
+            debtor_name,
+            target.currency,
+            debtor_user_id,
+            -amount_minor,
+        )
+        _adjust_balance(
+            connection,
+            target.group_id,
+            target.user_id,
+            debtor_name,
+            target.currency,
+            debtor_user_id,
+            amount_minor,
+        )
+
+
+event.listen(Debt, "after_insert", debt_after_insert_balance_listener)
+event.listen(Debt, "after_update", debt_after_update_balance_listener)
+event.listen(Debt, "after_delete", debt_after_delete_balance_listener)
+event.listen(DebtList, "after_update", debt_list_after_update_balance_listener)
+
+
+# Full-text index of debt lists for /find, keyed by list ID. Lists are indexed once they are sent to a group and stay
+# searchable after they are archived. The index is maintained by triggers so that Core bulk writes keep it in sync too.
+# Debtor names are only refreshed when a debt is added to or renamed in a sent list, which are rare, so bulk imports
+# into pending lists do not pay for it.
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS debt_list_fts USING fts5(
+        debt_name, debtors, owner, archived UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debt_lists_fts_sent
+    AFTER UPDATE OF is_pending, debt_name ON debt_lists WHEN NOT NEW.is_pending
+    BEGIN
+        INSERT OR REPLACE INTO debt_list_fts (rowid, debt_name, debtors, owner, archived)
+        VALUES (
+            NEW.list_id, NEW.debt_name,
+            (SELECT group_concat(owed_by_user_name, ' ') FROM debts WHERE list_id = NEW.list_id),
+            'u' || NEW.user_id, 0
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debt_lists_fts_delete AFTER DELETE ON debt_lists
+    BEGIN
+        DELETE FROM debt_list_fts WHERE rowid = OLD.list_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debts_fts_insert AFTER INSERT ON debts
+    WHEN (SELECT NOT is_pending FROM debt_lists WHERE list_id = NEW.list_id)
+    BEGIN
+        UPDATE debt_list_fts SET debtors = (
+            SELECT group_concat(owed_by_user_name, ' ') FROM debts WHERE list_id = NEW.list_id
+        ) WHERE rowid = NEW.list_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS debts_fts_rename AFTER UPDATE OF owed_by_user_name ON debts
+    WHEN (SELECT NOT is_pending FROM debt_lists WHERE list_id = NEW.list_id)
+    BEGIN
+        UPDATE debt_list_fts SET debtors = (
+            SELECT group_concat(owed_by_user_name, ' ') FROM debts WHERE list_id = NEW.list_id
+        ) WHERE rowid = NEW.list_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archived_debt_lists_fts_insert AFTER INSERT ON archived_debt_lists
+    BEGIN
+        INSERT OR REPLACE INTO debt_list_fts (rowid, debt_name, debtors, owner, archived)
+        VALUES (
+            NEW.list_id, NEW.debt_name,
+            (SELECT group_concat(json_extract(value, '$[0]'), ' ') FROM json_each(NEW.data, '$.debts')),
+            'u' || NEW.user_id, 1
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archived_debt_lists_fts_delete AFTER DELETE ON archived_debt_lists
+    BEGIN
+        DELETE FROM debt_list_fts WHERE rowid = OLD.list_id;
+    END
+    """,
+]
+
+for statement in SEARCH_INDEX_DDL:
+    event.listen(Base.metadata, "after_create", DDL(statement))
@@ -0,0 +1,79 @@
+"""
+Transactional outbox for Telegram side effects.
+
+A change that has to be announced in a chat adds outbox rows in the same transaction as the change itself, instead of
+calling Telegram directly. The drainer in utils/utils.py then performs the sends, edits and deletes in batches,
+retries them on failure, and writes resulting message IDs back. A crash can therefore never leave a state change
+without its message, or a message without its state change: an unfinished row is simply picked up again after a
+restart.
+
+Debt list messages are rendered when they are sent, not when they are queued, so they always show the latest state and
+follow the chat's current settings.
+"""
+
+from typing import Iterable
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from .models import OutboxMessage
+
+# Send a debt list with its pay/unpay buttons and store the message ID on the list
+SEND_DEBT_LIST = "send_list"
+# Re-render a debt list message, in a chat or posted in inline mode
+EDIT_DEBT_LIST = "edit_list"
+DELETE_MESSAGE = "delete"
+# Send a message of the catalog in the chat's language, optionally followed by a rendered debt list
+NOTIFY = "notify"
+
+
+def send_debt_list(chat_id: int, list_id: int, key: str = None) -> dict:
+    return {
+        "action": SEND_DEBT_LIST,
+        "chat_id": int(chat_id),
+        "list_id": int(list_id),
+        "idempotency_key": key,
+    }
+
+
+def edit_debt_list(
+    list_id: int, chat_id: int = None, message_id: int = None, inline_message_id: str = None
+) -> dict:
+    return {
+        "action": EDIT_DEBT_LIST,
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "inline_message_id": inline_message_id,
+        "list_id": int(list_id),
+    }
+
+
+def delete_message(chat_id: int, message_id: int) -> dict:
+    return {
+        "action": DELETE_MESSAGE,
+        "chat_id": int(chat_id),
+        "message_id": message_id,
+        "idempotency_key": f"delete:{chat_id}:{message_id}",
+    }
+
+
+def notify(chat_id: int, message_key: str, list_id: int = None) -> dict:
+    # Like debt lists, the message is rendered when it is sent, in the language the chat has then
+    return {"action": NOTIFY, "chat_id": int(chat_id), "text": message_key, "list_id": list_id}
+
+
+def enqueue(db: Session, side_effects: Iterable[dict]) -> None:
+    """
+    Queue side effects in the session's transaction. An effect whose idempotency key was queued before is dropped, so
+    retrying the operation that queued it, or a double-tapped button, does not send a message twice.
+
+    Args:
+        db (Session): The session of the change the side effects belong to.
+        side_effects (Iterable[dict]): Side effects built with the functions in this module.
+    """
+    for side_effect in side_effects:
+        db.execute(
+            sqlite_insert(OutboxMessage)
+            .values(**side_effect)
+            .on_conflict_do_nothing(index_elements=[OutboxMessage.idempotency_key])
+        )
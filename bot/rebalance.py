@@ -0,0 +1,428 @@
+"""
+Moving existing data into the shards that SHARD_COUNT asks for, see bot/shards.py. Run with `python -m bot.tools
+rebalance-shards` while the bot is stopped, after turning sharding on, changing SHARD_COUNT or turning sharding off.
+
+Every debt list goes to the shard of its group, or of its owner if it was never sent to a group, and takes its debts,
+events, queued effects and archived copy along. Lists that only the event log remembers, deleted ones that /undo may
+bring back, go where they would be restored. Recurring debt lists follow their group. Each batch of lists is moved in
+one transaction over both databases, so an interrupted run leaves every list in one place and can simply be run again.
+
+Afterwards users are copied to every shard, every list that is not in the shard its ID was handed out in is recorded
+there and where it is, every shard hands out new IDs after all IDs in use, and the balances and analytics rollups of
+every shard are recomputed from its debts and events.
+"""
+
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from operator import attrgetter
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session, joinedload
+
+from config.config import SHARD_COUNT
+
+from . import events, shards
+from .analytics import GROUP_STATS_ROLLUP, update_group_stats
+from .database import _update_debt_list_group, batched, check_balances, get_db, record_event
+from .models import (
+    ArchivedDebtList,
+    Debt,
+    DebtList,
+    DebtListId,
+    DebtListShard,
+    GroupDailyStats,
+    GroupDebtorStats,
+    GroupSettleTimes,
+    OutboxMessage,
+    RecurringDebtList,
+    RollupState,
+    User,
+)
+from .undo import restore_debt_list
+
+# Lists that are not in debt_lists or archived_debt_lists, only in the event log
+_LOGGED_ONLY = """
+    SELECT list_id, kind, payload FROM debt_events
+    WHERE list_id NOT IN (SELECT list_id FROM debt_lists)
+      AND list_id NOT IN (SELECT list_id FROM archived_debt_lists)
+    ORDER BY event_id
+"""
+
+
+def _columns(model, *excluded: str) -> str:
+    return ", ".join(column.name for column in model.__table__.columns if column.name not in excluded)
+
+
+def _marks(values: list) -> str:
+    return ", ".join("?" * len(values))
+
+
+def _path(shard: shards.Shard) -> str:
+    return shard.engine.url.database
+
+
+def _target(group_id: int, user_id: int) -> int:
+    return (user_id if group_id is None else group_id) % SHARD_COUNT
+
+
+@contextmanager
+def _attached(source: shards.Shard, target: shards.Shard):
+    """A connection to the source shard, with the target shard attached as target, committing nothing by itself."""
+    conn = sqlite3.connect(_path(source), isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS target", (_path(target),))
+        yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _placed_lists(shard: shards.Shard) -> list:
+    with sqlite3.connect(_path(shard)) as conn:
+        return [
+            list_id
+            for (list_id,) in conn.execute(
+                "SELECT list_id FROM debt_lists UNION SELECT list_id FROM archived_debt_lists"
+            )
+        ]
+
+
+def _holds_data(shard: shards.Shard) -> bool:
+    with sqlite3.connect(_path(shard)) as conn:
+        return any(
+            conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+            for table in ("debt_lists", "archived_debt_lists", "recurring_debt_lists", DebtListShard.__tablename__)
+        )
+
+
+def _leftover_shards(from_shards: int) -> list:
+    """The shards beyond SHARD_COUNT that exist, up to from_shards and then up to the first that does not."""
+    leftover = []
+    index = SHARD_COUNT
+    while True:
+        shard = shards.open_shard(index)
+        # Shards that were never written to, which SQLite would create empty here, are left out
+        exists = os.path.exists(_path(shard))
+        if not exists and index >= (from_shards or 0):
+            return leftover
+        if exists:
+            leftover.append(shard)
+        index += 1
+
+
+def _last_list_id(shard: shards.Shard, shard_count: int) -> int:
+    """The largest ID a shard has handed out, with IDs encoded for shard_count shards, see shards.global_id()."""
+    with sqlite3.connect(_path(shard)) as conn:
+        local_id = conn.execute(
+            "SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = ?", (DebtListId.__tablename__,)
+        ).fetchone()[0]
+    return local_id * shard_count + shard.index
+
+
+def _lists_to_move(shard: shards.Shard, locations: dict) -> dict:
+    """The lists in a shard that belong in another, as target shard index -> list IDs."""
+    targets = {}
+    with sqlite3.connect(_path(shard)) as conn:
+        for list_id, group_id, user_id in conn.execute(
+            "SELECT list_id, group_id, user_id FROM debt_lists "
+            "UNION ALL SELECT list_id, group_id, user_id FROM archived_debt_lists"
+        ):
+            targets[list_id] = _target(group_id, user_id)
+        for list_id, state in events.replay(conn.execute(_LOGGED_ONLY)).items():
+            # What a list left behind when it moved to the shard it is in stays where it is
+            if list_id not in locations:
+                targets[list_id] = _target(state["group_id"], state["user_id"])
+    moves = {}
+    for list_id, target in targets.items():
+        if target != shard.index:
+            moves.setdefault(target, []).append(list_id)
+    return moves
+
+
+def _move_lists(conn: sqlite3.Connection, list_ids: list) -> None:
+    marks = _marks(list_ids)
+    with _transaction(conn):
+        for model in (DebtList, ArchivedDebtList):
+            columns = _columns(model)
+            conn.execute(
+                f"INSERT INTO target.{model.__tablename__} ({columns}) "
+                f"SELECT {columns} FROM main.{model.__tablename__} WHERE list_id IN ({marks})",
+                list_ids,
+            )
+
+        # Debts are numbered after the target's own, in the order they had, and the events follow their new IDs
+        next_debt_id = conn.execute("SELECT coalesce(max(debt_id), 0) + 1 FROM target.debts").fetchone()[0]
+        debt_columns = _columns(Debt, "debt_id")
+        debts = conn.execute(
+            f"SELECT debt_id, {debt_columns} FROM main.debts WHERE list_id IN ({marks}) ORDER BY debt_id",
+            list_ids,
+        ).fetchall()
+        debt_ids = {debt[0]: new_id for new_id, debt in enumerate(debts, next_debt_id)}
+        conn.executemany(
+            f"INSERT INTO target.debts (debt_id, {debt_columns}) VALUES (?, {_marks(debts[0][1:]) if debts else ''})",
+            [(debt_ids[debt[0]], *debt[1:]) for debt in debts],
+        )
+        conn.executemany(
+            "INSERT INTO target.debt_events (list_id, kind, actor_id, batch_id, created_at, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    list_id,
+                    kind,
+                    actor_id,
+                    batch_id,
+                    created_at,
+                    events.encode_payload(events.remap_debt_ids(kind, json.loads(payload), debt_ids))
+                    if payload
+                    else None,
+                )
+                for list_id, kind, actor_id, batch_id, created_at, payload in conn.execute(
+                    "SELECT list_id, kind, actor_id, batch_id, created_at, payload FROM main.debt_events "
+                    f"WHERE list_id IN ({marks}) ORDER BY event_id",
+                    list_ids,
+                )
+            ],
+        )
+        outbox_columns = _columns(OutboxMessage, "outbox_id")
+        conn.execute(
+            f"INSERT INTO target.outbox ({outbox_columns}) SELECT {outbox_columns} FROM main.outbox "
+            f"WHERE done_at IS NULL AND list_id IN ({marks}) ORDER BY outbox_id",
+            list_ids,
+        )
+        # The search index triggers fire on an update of the name, with the debts in place
+        conn.execute(
+            f"UPDATE target.debt_lists SET debt_name = debt_name WHERE NOT is_pending AND list_id IN ({marks})",
+            list_ids,
+        )
+
+        conn.execute(f"DELETE FROM main.outbox WHERE done_at IS NULL AND list_id IN ({marks})", list_ids)
+        for table in ("debt_events", "debts", "debt_lists", "archived_debt_lists"):
+            conn.execute(f"DELETE FROM main.{table} WHERE list_id IN ({marks})", list_ids)
+
+
+def _move_recurring(conn: sqlite3.Connection, target: shards.Shard) -> int:
+    recurring_ids = [
+        recurring_id
+        for recurring_id, group_id in conn.execute("SELECT recurring_id, group_id FROM main.recurring_debt_lists")
+        if group_id % SHARD_COUNT == target.index
+    ]
+    if not recurring_ids:
+        return 0
+    marks = _marks(recurring_ids)
+    # They get new IDs in the target, and with them new IDs shown to their owners
+    columns = _columns(RecurringDebtList, "recurring_id")
+    with _transaction(conn):
+        conn.execute(
+            f"INSERT INTO target.recurring_debt_lists ({columns}) SELECT {columns} "
+            f"FROM main.recurring_debt_lists WHERE recurring_id IN ({marks}) ORDER BY recurring_id",
+            recurring_ids,
+        )
+        conn.execute(f"DELETE FROM main.recurring_debt_lists WHERE recurring_id IN ({marks})", recurring_ids)
+    return len(recurring_ids)
+
+
+def _rebuild_records(placed: dict, last_id: int) -> None:
+    """
+    Record every list that is not in its home where it is, in its home and in the shard it is in, see shards.place(),
+    and have every shard hand out IDs after last_id.
+
+    Args:
+        placed (dict): The shard index of every list ID in use.
+        last_id (int): The largest list ID handed out so far, in use or not.
+    """
+    records = {shard.index: [] for shard in shards.every()}
+    for list_id, index in placed.items():
+        if list_id % SHARD_COUNT != index:
+            records[list_id % SHARD_COUNT].append((list_id, index))
+            records[index].append((list_id, index))
+    for shard in shards.every():
+        conn = sqlite3.connect(_path(shard), isolation_level=None)
+        try:
+            with _transaction(conn):
+                conn.execute(f"DELETE FROM {DebtListShard.__tablename__}")
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {DebtListShard.__tablename__} (list_id, shard) VALUES (?, ?)",
+                    records[shard.index],
+                )
+                local_id = conn.execute(
+                    "SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = ?", (DebtListId.__tablename__,)
+                ).fetchone()[0]
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (DebtListId.__tablename__,))
+                # The next local ID gives a global ID above last_id, and a sequence is never lowered
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                    (DebtListId.__tablename__, max(local_id, last_id // SHARD_COUNT)),
+                )
+        finally:
+            conn.close()
+
+
+def _rebuild_rollups(shard: shards.Shard) -> None:
+    conn = sqlite3.connect(_path(shard), isolation_level=None)
+    try:
+        with _transaction(conn):
+            for model in (GroupDailyStats, GroupSettleTimes, GroupDebtorStats):
+                conn.execute(f"DELETE FROM {model.__tablename__}")
+            conn.execute(f"DELETE FROM {RollupState.__tablename__} WHERE name = ?", (GROUP_STATS_ROLLUP,))
+    finally:
+        conn.close()
+    with shards.using(shard):
+        check_balances(fix=True)
+        update_group_stats()
+
+
+def rebalance_shards(from_shards: int = None, batch_size: int = 500) -> dict:
+    """
+    Move every debt list, and everything that belongs to it, into the shard it belongs in. The bot must be stopped.
+
+    Args:
+        from_shards (int, optional): How many shards the data is spread over now, if some beyond SHARD_COUNT do not
+            exist. Shards up to SHARD_COUNT, and those after it up to the first that does not exist, are always read.
+        batch_size (int, optional): The number of debt lists moved per transaction. Defaults to 500.
+
+    Returns:
+        dict: lists and recurring, the numbers of debt lists and recurring debt lists moved, renumbered, whether the IDs
+            of recurring debt lists changed, and unused, the paths of the shards beyond SHARD_COUNT, which are empty of
+            debt lists afterwards and can be deleted.
+    """
+    sources = shards.every() + _leftover_shards(from_shards)
+    used = [source.index for source in sources if _holds_data(source)]
+    previous = max(from_shards or 0, max(used, default=0) + 1)
+    last_id = max(_last_list_id(source, previous) for source in sources)
+
+    # list_id -> the shard it is in, not counting what a list left behind when it moved
+    locations = {list_id: source.index for source in sources for list_id in _placed_lists(source)}
+    moved = recurring = 0
+    for source in sources:
+        for target_index, list_ids in _lists_to_move(source, locations).items():
+            with _attached(source, sources[target_index]) as conn:
+                for batch in batched(list_ids, batch_size):
+                    _move_lists(conn, batch)
+            moved += len(list_ids)
+        for target in shards.every():
+            if target is not source:
+                with _attached(source, target) as conn:
+                    recurring += _move_recurring(conn, target)
+
+    user_columns = _columns(User)
+    for target in shards.every()[1:]:
+        with _attached(shards.main, target) as conn, _transaction(conn):
+            conn.execute(f"INSERT OR REPLACE INTO target.users ({user_columns}) SELECT {user_columns} FROM main.users")
+
+    placed = {}
+    for shard in shards.every():
+        with sqlite3.connect(_path(shard)) as conn:
+            # Lists only in the event log first, so that a list in debt_lists or the archive wins over what it left
+            # behind in another shard
+            placed.update((list_id, shard.index) for (list_id,) in conn.execute("SELECT DISTINCT list_id FROM debt_events"))
+    placed.update((list_id, shard.index) for shard in shards.every() for list_id in _placed_lists(shard))
+    _rebuild_records(placed, max([last_id, *placed]))
+
+    if moved or recurring:
+        for shard in shards.every():
+            _rebuild_rollups(shard)
+    return {
+        "lists": moved,
+        "recurring": recurring,
+        # The IDs shown to owners encode the shard with SHARD_COUNT, see shards.global_id()
+        "renumbered": bool(recurring) or previous != SHARD_COUNT,
+        "unused": [_path(source) for source in sources[SHARD_COUNT:]],
+    }
+
+
+def move_debt_list(list_id: int, target) -> None:
+    """
+    Move a debt list that was sent to a group of another shard from the bound shard into the group's, keeping its ID. The list is restored in the target from its current state, the way /undo restores one, so the target's event log, counters, balances and search index see it as a new list, and its group message is queued there in the same transaction. Then the target is recorded in the list's home, see shards.place(), and the list is deleted here. Each step is an operation on the writer of the shard it changes and can be run again, so a move that was cut short is finished by moving the list again, see finish_moves(). Blocks, so it is called off the event loop.
+
+    Args:
+        list_id (int): The ID of the debt list.
+        target (Shard): The shard of the list's group.
+    """
+    source = shards.current()
+    db: Session = next(get_db())
+    debt_list = db.query(DebtList).options(joinedload(DebtList.debts)).filter(DebtList.list_id == list_id).first()
+    if debt_list is None:
+        return
+    state = {
+        "user_id": debt_list.user_id,
+        "debt_name": debt_list.debt_name,
+        "phone_number": debt_list.phone_number,
+        "currency": debt_list.currency,
+        "group_id": debt_list.group_id,
+        "pending": debt_list.is_pending,
+        "deleted": False,
+        "debts": {
+            debt.debt_id: {
+                "name": debt.owed_by_user_name,
+                "amount_minor": debt.amount_minor,
+                "paid": debt.paid,
+            }
+            for debt in sorted(debt_list.debts, key=attrgetter("debt_id"))
+        },
+    }
+    db.close()
+    with shards.using(target):
+        target.writer.run(_receive_debt_list, list_id, state)
+    shards.place(list_id, target)
+    source.writer.run(_delete_moved_debt_list, list_id)
+
+
+def _receive_debt_list(db: Session, list_id: int, state: dict) -> None:
+    if db.get(DebtList, list_id) is not None:
+        # Received by a move that was cut short after this step
+        return
+    # Restored as it was before it was sent, then sent here, so this shard's event log and group stats see the send
+    restore_debt_list(db, list_id, dict(state, group_id=None))
+    _update_debt_list_group(db, list_id, state["group_id"])
+    if shards.home(list_id) is not shards.current():
+        # Recorded with the list, so check_placements() accepts it here even if the move stops before shards.place()
+        shards.record_placement(db, list_id, shards.current().index)
+
+
+def _delete_moved_debt_list(db: Session, list_id: int) -> None:
+    debt_list = db.get(DebtList, list_id)
+    if debt_list is not None:
+        db.delete(debt_list)
+        # Recorded without an actor, since the list lives on in the target and /undo must not bring it back here
+        record_event(db, list_id, events.LIST_DELETED)
+
+
+def finish_moves() -> int:
+    """
+    Finish moving the debt lists whose move into their group's shard was cut short, see move_debt_list(): lists that were sent to a group of another shard and are still here. Run at start-up, before any update is handled.
+
+    Returns:
+        int: The number of debt lists moved.
+    """
+    if not shards.SHARDED:
+        return 0
+    moved = 0
+    for shard in shards.every():
+        db = shard.session_factory()
+        try:
+            # SQLite's % keeps the sign of the group ID, which is negative for groups
+            stranded = db.execute(
+                select(DebtList.list_id, DebtList.group_id).where(
+                    DebtList.group_id.is_not(None),
+                    (DebtList.group_id % SHARD_COUNT + SHARD_COUNT) % SHARD_COUNT != shard.index,
+                )
+            ).all()
+        finally:
+            db.close()
+        with shards.using(shard):
+            for list_id, group_id in stranded:
+                move_debt_list(list_id, shards.for_group(group_id))
+        moved += len(stranded)
+    return moved
@@ -0,0 +1,371 @@
+"""
+Schedules of recurring debt lists, e.g. the rent every month, stored as crontab expressions in the owner's time zone.
+
+Only the next due time of a recurring list is stored, in an indexed column, so finding the lists that are due is one
+range query and no future occurrence is ever expanded. When a list is posted, its next due time is computed from the
+one it was due at, not from now, so occurrences missed while the bot was down are still posted, one after another.
+"""
+
+import json
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from operator import attrgetter
+from zoneinfo import ZoneInfo
+
+from apscheduler.triggers.cron import CronTrigger
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from config.config import RECURRING_HOUR, RECURRING_MIN_INTERVAL_HOURS
+
+from . import events, outbox, shards
+from .database import DEBT_LIST_COLUMNS, debt_list_views, get_db, new_list_id, record_event, refresh_inline_index, users_by_handle
+from .messages import UserError
+from .models import Debt, DebtList, RecurringDebtList, normalize_username
+from .views import DebtListView, DebtView, RecurringDebtListView
+from .writer import after_commit
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def parse_schedule(words: list, timezone: str, now: datetime) -> str:
+    """
+    Turn a schedule as the user writes it into a crontab expression.
+
+    Args:
+        words (list): "monthly" with an optional day of the month, 1 to 28 or "last", "weekly" with an optional
+            weekday, mon to sun, or "cron" followed by the five fields of a crontab expression.
+        timezone (str): The time zone the schedule is in.
+        now (datetime): The current time, naive UTC. Monthly and weekly schedules default to its day.
+
+    Returns:
+        str: The crontab expression. Monthly and weekly lists are due at RECURRING_HOUR.
+
+    Raises:
+        ValueError: If the schedule is not valid, a UserError unless APScheduler rejects the crontab expression.
+    """
+    kind, *values = [word.lower() for word in words] or [""]
+    local_now = now.replace(tzinfo=dt_timezone.utc).astimezone(ZoneInfo(timezone))
+    if kind == "monthly" and len(values) <= 1:
+        day = values[0] if values else str(min(local_now.day, 28))
+        # Later days would skip the months that are too short, "last" is due in every month
+        if day != "last" and not (day.isdigit() and 1 <= int(day) <= 28):
+            raise UserError("scheduleBadDay", day=day)
+        schedule = f"0 {RECURRING_HOUR} {day} * *"
+    elif kind == "weekly" and len(values) <= 1:
+        weekday = values[0][:3] if values else WEEKDAYS[local_now.weekday()]
+        if weekday not in WEEKDAYS:
+            raise UserError("scheduleBadWeekday", weekday=values[0])
+        schedule = f"0 {RECURRING_HOUR} * * {weekday}"
+    elif kind == "cron" and len(values) == 5:
+        # Cron counts weekdays from Sunday and APScheduler from Monday, names mean the same to both
+        if re.search(r"(?<![/\d])\d", values[4]):
+            raise UserError("scheduleCronWeekdays")
+        schedule = " ".join(values)
+    else:
+        raise UserError("scheduleUnknown")
+
+    # APScheduler's ValueError for an invalid expression says what is wrong with it
+    first = next_due(schedule, timezone, now)
+    if first is None:
+        raise UserError("scheduleNeverDue", schedule=schedule)
+    second = next_due(schedule, timezone, first)
+    if second is not None and second - first < timedelta(hours=RECURRING_MIN_INTERVAL_HOURS):
+        raise UserError("scheduleTooOften", hours=RECURRING_MIN_INTERVAL_HOURS)
+    return schedule
+
+
+def next_due(schedule: str, timezone: str, after: datetime) -> datetime:
+    """
+    When a schedule is next due.
+
+    Args:
+        schedule (str): A crontab expression.
+        timezone (str): The time zone the schedule is in.
+        after (datetime): Naive UTC, the result is strictly later.
+
+    Returns:
+        datetime: The next due time, naive UTC, or None if the schedule is never due again.
+    """
+    trigger = CronTrigger.from_crontab(schedule, timezone=ZoneInfo(timezone))
+    after = after.replace(tzinfo=dt_timezone.utc)
+    # With the previous fire time equal to now, APScheduler looks for the first time after it
+    due = trigger.get_next_fire_time(after, after)
+    if due is None:
+        return None
+    return due.astimezone(dt_timezone.utc).replace(tzinfo=None)
+
+
+# Storage
+@shards.fan_out(lambda results: max(filter(None, results), key=attrgetter("list_id"), default=None))
+def get_last_sent_debt_list(user_id: int) -> DebtListView:
+    """
+    Retrieve the debt list a user sent to a group most recently, which /repeat makes recurring.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        DebtListView: The debt list with its debts, or None if the user has not sent one.
+    """
+    db: Session = next(get_db())
+    rows = db.execute(
+        select(*DEBT_LIST_COLUMNS, DebtList.last_updated)
+        .where(DebtList.user_id == user_id, DebtList.group_id.is_not(None))
+        .order_by(DebtList.list_id.desc())
+        .limit(1)
+    ).all()
+    views = debt_list_views(db, rows)
+    return views[0] if views else None
+
+
+def _recurring_view(recurring: RecurringDebtList) -> RecurringDebtListView:
+    return RecurringDebtListView(
+        shards.global_id(recurring.recurring_id),
+        recurring.user_id,
+        recurring.group_id,
+        recurring.debt_name,
+        recurring.phone_number,
+        recurring.currency,
+        tuple(DebtView(name, amount_minor, False) for name, amount_minor in json.loads(recurring.debts)),
+        recurring.schedule,
+        recurring.timezone,
+        recurring.next_due,
+    )
+
+
+def _soonest_first(results: list) -> list:
+    return sorted(shards.concat(results), key=attrgetter("next_due"))
+
+
+@shards.route(lambda debt_list, **_: shards.for_group(debt_list.group_id))
+async def add_recurring_debt_list(debt_list: DebtListView, schedule: str, timezone: str, next_due) -> int:
+    """
+    Make a debt list recurring: a copy of it, with every debt unpaid, is posted to its group each time it is due. Runs
+    on the database writer.
+
+    Args:
+        debt_list (DebtListView): The debt list to copy, with its debts.
+        schedule (str): A crontab expression, see bot/recurring.py.
+        timezone (str): The time zone the schedule is in.
+        next_due (datetime): When the first copy is due, naive UTC.
+
+    Returns:
+        int: The ID of the recurring debt list.
+    """
+    return await shards.current().writer.execute(_add_recurring_debt_list, debt_list, schedule, timezone, next_due)
+
+
+def _add_recurring_debt_list(db: Session, debt_list: DebtListView, schedule: str, timezone: str, next_due) -> int:
+    recurring = RecurringDebtList(
+        user_id=debt_list.user_id,
+        group_id=debt_list.group_id,
+        debt_name=debt_list.debt_name,
+        phone_number=debt_list.phone_number,
+        currency=debt_list.currency,
+        debts=json.dumps(
+            [[debt.owed_by_user_name, debt.amount_minor] for debt in debt_list.debts], ensure_ascii=False
+        ),
+        schedule=schedule,
+        timezone=timezone,
+        next_due=next_due,
+    )
+    db.add(recurring)
+    db.flush()
+    return shards.global_id(recurring.recurring_id)
+
+
+@shards.fan_out(_soonest_first)
+def get_recurring_debt_lists(user_id: int) -> list:
+    """
+    Retrieve a user's recurring debt lists, the one due first first.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        list: A list of RecurringDebtListView.
+    """
+    db: Session = next(get_db())
+    return [
+        _recurring_view(recurring)
+        for recurring in db.scalars(
+            select(RecurringDebtList)
+            .where(RecurringDebtList.user_id == user_id)
+            .order_by(RecurringDebtList.next_due)
+        )
+    ]
+
+
+@shards.by_recurring
+async def delete_recurring_debt_list(recurring_id: int, user_id: int) -> bool:
+    """
+    Stop a recurring debt list, on the database writer. The lists it already posted are kept.
+
+    Args:
+        recurring_id (int): The ID of the recurring debt list.
+        user_id (int): The ID of the user stopping it, who must own it.
+
+    Returns:
+        bool: Whether the recurring debt list was deleted.
+    """
+    return await shards.current().writer.execute(_delete_recurring_debt_list, recurring_id, user_id)
+
+
+def _delete_recurring_debt_list(db: Session, recurring_id: int, user_id: int) -> bool:
+    deleted = db.execute(
+        delete(RecurringDebtList).where(
+            RecurringDebtList.recurring_id == recurring_id, RecurringDebtList.user_id == user_id
+        )
+    ).rowcount
+    return bool(deleted)
+
+
+@shards.fan_out(_soonest_first)
+def get_due_recurring_debt_lists(now, limit: int = 100) -> list:
+    """
+    Retrieve the recurring debt lists that are due, the one due first first. Only the next due time of each is stored,
+    so this is a range scan of the next_due index.
+
+    Args:
+        now (datetime): The current time, naive UTC.
+        limit (int, optional): The most recurring debt lists to return. Defaults to 100.
+
+    Returns:
+        list: A list of RecurringDebtListView.
+    """
+    db: Session = next(get_db())
+    return [
+        _recurring_view(recurring)
+        for recurring in db.scalars(
+            select(RecurringDebtList)
+            .where(RecurringDebtList.next_due <= now)
+            .order_by(RecurringDebtList.next_due)
+            .limit(limit)
+        )
+    ]
+
+
+@shards.by_recurring
+def skip_recurring_debt_list(recurring_id: int, due, next_due) -> None:
+    """
+    Move a recurring debt list on to its next due time without posting it, or delete it if next_due is None. Blocks
+    until the database writer has committed it.
+
+    Args:
+        recurring_id (int): The ID of the recurring debt list.
+        due (datetime): The due time being skipped, nothing is changed if the list is no longer due then.
+        next_due (datetime): The new due time, naive UTC, or None if the schedule is never due again.
+    """
+    shards.current().writer.run(_skip_recurring_debt_list, recurring_id, due, next_due)
+
+
+def _skip_recurring_debt_list(db: Session, recurring_id: int, due, next_due) -> None:
+    condition = (RecurringDebtList.recurring_id == recurring_id, RecurringDebtList.next_due == due)
+    if next_due is None:
+        db.execute(delete(RecurringDebtList).where(*condition))
+    else:
+        db.execute(update(RecurringDebtList).where(*condition).values(next_due=next_due))
+
+
+@shards.by_recurring
+def materialize_recurring_debt_list(recurring_id: int, due, next_due, debt_name: str) -> int:
+    """
+    Post a recurring debt list that is due: create a debt list from it, queue its group message and move the
+    recurring debt list on to its next due time, all in one operation on the database writer, so a crash never posts
+    it twice or not at all. Blocks until it is committed.
+
+    The new list goes through the same steps as one written by hand, created pending, filled and then sent, so the
+    event log, unpaid counters, balances and search index see nothing different.
+
+    Args:
+        recurring_id (int): The ID of the recurring debt list.
+        due (datetime): The due time being posted, nothing is done if the list is no longer due then.
+        next_due (datetime): The new due time, naive UTC, or None to delete the recurring debt list afterwards.
+        debt_name (str): The name of the new debt list.
+
+    Returns:
+        int: The ID of the new debt list, or None if nothing was posted.
+    """
+    return shards.current().writer.run(_materialize_recurring_debt_list, recurring_id, due, next_due, debt_name)
+
+
+def _materialize_recurring_debt_list(db: Session, recurring_id: int, due, next_due, debt_name: str) -> int:
+    recurring = db.get(RecurringDebtList, recurring_id)
+    if recurring is None or recurring.next_due != due:
+        # Stopped, or posted by another run of the job
+        return None
+
+    user_id = recurring.user_id
+    debt_list = DebtList(
+        list_id=new_list_id(db),
+        user_id=user_id,
+        # Set rather than left out, so the balances listener sees the list move from no group to the group below
+        group_id=None,
+        debt_name=debt_name,
+        phone_number=recurring.phone_number,
+        currency=recurring.currency,
+    )
+    db.add(debt_list)
+    db.flush()
+    list_id = debt_list.list_id
+    record_event(
+        db,
+        list_id,
+        events.LIST_CREATED,
+        user_id,
+        user_id=user_id,
+        debt_name=debt_name,
+        phone_number=recurring.phone_number,
+        currency=recurring.currency,
+        group_id=None,
+        pending=True,
+    )
+
+    debts = json.loads(recurring.debts)
+    names_lower = [normalize_username(name) for name, _ in debts]
+    user_ids = users_by_handle(db, names_lower)
+    added = []
+    for (name, amount_minor), name_lower in zip(debts, names_lower):
+        debt = Debt(
+            list_id=list_id,
+            owed_by_user_name=name,
+            owed_by_user_name_lower=name_lower,
+            owed_by_user_id=user_ids.get(name_lower),
+            amount_minor=amount_minor,
+            paid=False,
+        )
+        db.add(debt)
+        added.append(debt)
+    db.flush()
+    for debt in added:
+        record_event(
+            db,
+            list_id,
+            events.DEBT_SET,
+            user_id,
+            debt_id=debt.debt_id,
+            name=debt.owed_by_user_name,
+            amount_minor=debt.amount_minor,
+            paid=False,
+        )
+
+    debt_list.is_pending = False
+    record_event(db, list_id, events.LIST_PENDING, user_id, pending=False)
+    debt_list.group_id = recurring.group_id
+    record_event(db, list_id, events.LIST_SENT, user_id, group_id=int(recurring.group_id))
+    outbox.enqueue(
+        db,
+        [
+            outbox.send_debt_list(
+                recurring.group_id, list_id, key=f"recurring:{recurring_id}:{due:%Y%m%d%H%M}"
+            )
+        ],
+    )
+
+    if next_due is None:
+        db.delete(recurring)
+    else:
+        recurring.next_due = next_due
+    after_commit(db, lambda: refresh_inline_index(debt_list))
+    return list_id
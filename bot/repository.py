@@ -0,0 +1,1131 @@
+"""
+Storage of users, groups, debt lists and debts behind one interface, with a backend chosen by STORAGE_BACKEND.
+
+The handlers and jobs get the repository from context.bot_data["repository"], which bot/main.py fills in with
+create_repository(). The SQL backend is the functions in bot/database.py, bot/recurring.py and bot/analytics.py. The
+memory backend keeps everything in dicts with the same indexes the SQL tables have, for tests and benchmarks that should
+not touch the disk, and as a reference to check the SQL backend against, see benchmarks/repository.py and
+tests/test_repository.py.
+
+What the memory backend covers at runtime is everything the handlers and jobs go through the repository for: users,
+groups and memberships, debt lists and debts, balances, /show, /find, inline queries, /undo, recurring debt lists,
+/groupstats, and the side effects the outbox drainer carries out, which it queues in its side_effects list. Its data is
+lost when the bot exits and is never backed up or sharded. It writes no event log: /undo restores from batches of
+deleted lists it keeps itself. /find matches word prefixes instead of ranking with the full-text index, /groupstats is
+computed from the lists it holds, so deleted lists stop counting, settled lists are never archived and finished side
+effects are never pruned.
+
+What it does not cover is everything that goes to bot/database.py directly. The database is still opened and migrated
+at startup and keeps the chat settings, which /settings changes and every message is rendered in. The archive, outbox
+prune, rollup and backup jobs and the startup warmup of the inline index and group memberships only ever see the
+database, so on the memory backend they run and find nothing to do.
+"""
+
+import asyncio
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from dataclasses import replace
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable
+
+from config.config import DEFAULT_CURRENCY, STORAGE_BACKEND
+
+from . import analytics, database, outbox, recurring, undo
+from .inline_index import DebtListPrefixIndex
+from .models import normalize_username
+from .views import DebtListView, DebtView, GroupStatsView, GroupView, RecurringDebtListView, SearchResultView
+
+
+class Repository(ABC):
+    # Users
+    @abstractmethod
+    async def add_or_update_user(self, user_id: int, username: str, first_name: str, last_name: str) -> int:
+        """Save a user's current details, and link the debts written for their handle to them."""
+
+    @abstractmethod
+    def get_user_groups(self, user_id: int) -> list:
+        """The groups a user is in, as GroupView."""
+
+    @abstractmethod
+    def is_user_in_group(self, user_id: int, group_id: int) -> bool: ...
+
+    @abstractmethod
+    async def associate_user_with_group(self, user_id: int, group_id: int) -> None: ...
+
+    # Groups
+    @abstractmethod
+    async def add_or_update_group(self, group_id: int, group_name: str, group_type: str) -> None: ...
+
+    @abstractmethod
+    def get_group_name(self, group_id: int) -> str:
+        """The group's name, or an empty string if the group is not known."""
+
+    # Debt lists
+    @abstractmethod
+    async def add_debt_list(
+        self,
+        user_id: int,
+        debt_name: str,
+        phone_number: str,
+        group_id: int = None,
+        currency: str = DEFAULT_CURRENCY,
+        debts: Iterable = (),
+    ) -> int:
+        """Create a pending debt list with (owed_by_user_name, amount_minor) debts in one write and return its ID."""
+
+    @abstractmethod
+    def get_debt_list_info(self, list_id: int) -> DebtListView:
+        """The debt list with its debts, in the order they were added, and totals, or None if unknown."""
+
+    @abstractmethod
+    def get_debt_list_name(self, list_id: int) -> str: ...
+
+    @abstractmethod
+    def get_debt_list_totals(self, list_id: int) -> tuple[int, int]:
+        """The total and the outstanding amount of the debt list, in minor units."""
+
+    @abstractmethod
+    def get_debt_list_pending_status(self, list_id: int) -> bool: ...
+
+    @abstractmethod
+    async def update_debt_list_status(self, list_id: int, is_pending: bool) -> None: ...
+
+    @abstractmethod
+    async def update_debt_list_group(self, list_id: int, group_id: int) -> bool:
+        """Send the debt list to a group, which queues its group message. False if it is unknown or was already sent."""
+
+    @abstractmethod
+    def get_debt_lists_by_user_id(self, user_id: int) -> list:
+        """The IDs of the user's debt lists."""
+
+    @abstractmethod
+    def get_debt_list_page(
+        self, user_id: int, status: str = "all", before: tuple = None, after: tuple = None, page_size: int = 5
+    ) -> tuple[list, bool, bool]:
+        """
+        One page of the user's debt lists, "open", "settled" or "all", newest first, paged by (last_updated, list_id)
+        cursors. Returns the lists as DebtListView, whether there are newer lists and whether there are older lists.
+        """
+
+    @abstractmethod
+    def search_debt_lists(self, user_id: int, query: str, offset: int = 0, limit: int = 5) -> tuple[list, bool]:
+        """
+        The user's sent debt lists whose name or debtors have a word starting with every word of the query, best match
+        first, as SearchResultView, and whether there are more.
+        """
+
+    @abstractmethod
+    def search_open_debt_lists(self, user_id: int, query: str, limit: int = 50) -> list:
+        """
+        The IDs of the user's open debt lists, newest first, with every word of the query a prefix of a word in the
+        name, for inline queries.
+        """
+
+    @abstractmethod
+    def get_open_debt_lists(self) -> list:
+        """The debt lists sent to a group that have unpaid debts, as DebtListView without their debts."""
+
+    @abstractmethod
+    async def resend_debt_list(self, list_id: int) -> None:
+        """Queue the replacement of the debt list's group message with a new one at the bottom of the chat."""
+
+    @abstractmethod
+    def get_debt_list_message_info(self, list_id: int) -> tuple[int, int]:
+        """The group and the ID of the debt list's group message, (0, 0) if the list is unknown."""
+
+    @abstractmethod
+    def user_has_pending_debt_list(self, user_id: int) -> int:
+        """The ID of the user's pending debt list, or 0 if there is none."""
+
+    @abstractmethod
+    async def delete_debt_list(self, list_id: int) -> None:
+        """Delete a debt list and its debts, which queues the deletion of its group message."""
+
+    @abstractmethod
+    async def discard_pending_debt_list(self, list_id: int) -> None: ...
+
+    @abstractmethod
+    async def clear_debt_lists(self, user_id: int) -> int:
+        """
+        Delete all of a user's debt lists at once, archived ones included, and return how many there were. /undo brings
+        them all back together.
+        """
+
+    @abstractmethod
+    async def undo_last_deletion(self, user_id: int) -> list:
+        """
+        Restore the debt lists the user deleted most recently, all of them if they were cleared together, and return
+        their IDs. Restored lists with unpaid debts that had been sent are queued to be posted to their group again.
+        """
+
+    # Debts
+    @abstractmethod
+    async def add_or_update_debt(
+        self, list_id: int, owed_by_user_name: str, amount_minor: int, paid: bool = False
+    ) -> int:
+        """Set what a handle owes in a debt list and return the debt's ID."""
+
+    @abstractmethod
+    def add_debts_bulk(self, list_id: int, debts: Iterable, chunk_size: int = 500) -> int:
+        """
+        Add (owed_by_user_name, amount_minor) debts with unique handles to a pending list, returns how many. Blocks, so
+        it is run off the event loop.
+        """
+
+    @abstractmethod
+    def get_debt_status(self, list_id: int, user_id: int, user_name: str) -> tuple:
+        """
+        (True, whether the user's debt is paid), or (False, the key of the message saying why) if the user has no
+        debt in the list.
+        """
+
+    @abstractmethod
+    async def update_debt_status(
+        self, list_id: int, user_id: int, user_name: str, paid: bool, side_effects: Iterable[dict] = ()
+    ) -> tuple:
+        """Mark the user's debt as paid or unpaid, returns (whether it was updated, the message key of why not)."""
+
+    # Balances, over the unpaid debts of the lists sent to a group
+    @abstractmethod
+    def get_user_balances(self, user_id: int) -> dict:
+        """
+        group_id -> [(counterparty, currency, amount_minor)] netted per counterparty, positive when the counterparty
+        owes the user.
+        """
+
+    @abstractmethod
+    def get_group_member_balances(self, group_id: int) -> dict:
+        """currency -> {member: amount_minor} netted per member, positive when the member is owed money."""
+
+    # Recurring debt lists, see bot/recurring.py
+    @abstractmethod
+    def get_last_sent_debt_list(self, user_id: int) -> DebtListView:
+        """The debt list the user sent to a group most recently, with its debts, or None."""
+
+    @abstractmethod
+    async def add_recurring_debt_list(self, debt_list: DebtListView, schedule: str, timezone: str, next_due) -> int:
+        """Post a copy of the debt list, every debt unpaid, each time the crontab schedule is due. Returns its ID."""
+
+    @abstractmethod
+    def get_recurring_debt_lists(self, user_id: int) -> list:
+        """The user's recurring debt lists as RecurringDebtListView, the one due first first."""
+
+    @abstractmethod
+    async def delete_recurring_debt_list(self, recurring_id: int, user_id: int) -> bool:
+        """Stop a recurring debt list the user owns, whether there was one."""
+
+    @abstractmethod
+    def get_due_recurring_debt_lists(self, now, limit: int = 100) -> list:
+        """The recurring debt lists due at or before now, the one due first first."""
+
+    @abstractmethod
+    def skip_recurring_debt_list(self, recurring_id: int, due, next_due) -> None:
+        """Move a recurring debt list still due at due on to next_due, or stop it if that is None. Blocks."""
+
+    @abstractmethod
+    def materialize_recurring_debt_list(self, recurring_id: int, due, next_due, debt_name: str) -> int:
+        """
+        Create and send the debt list of a recurring debt list still due at due, and move it on to next_due, or stop it
+        if that is None. Returns the new list's ID, or None if it was not due. Blocks.
+        """
+
+    # Group stats
+    @abstractmethod
+    def get_group_stats(self, group_id: int, since: date, top: int = 5, min_debts: int = 2) -> GroupStatsView:
+        """
+        What happened in the group from the UTC day since on, and what is outstanding in it now, see bot/analytics.py.
+        """
+
+    # Outbox
+    @abstractmethod
+    def get_due_outbox_messages(self, limit: int) -> list:
+        """The queued side effects that are due, oldest first, as dicts with the columns of the outbox table."""
+
+    @abstractmethod
+    async def finish_outbox_messages(self, results: list, max_attempts: int) -> None:
+        """
+        Record the outcome of (side effect, outcome) pairs, storing the IDs of sent debt list messages on their lists,
+        see finish_outbox_messages in bot/database.py.
+        """
+
+
+class SqlRepository(Repository):
+    """The database, through the functions in bot/database.py."""
+
+    add_or_update_user = staticmethod(database.add_or_update_user)
+    get_user_groups = staticmethod(database.get_user_groups)
+    is_user_in_group = staticmethod(database.is_user_in_group)
+    associate_user_with_group = staticmethod(database.associate_user_with_group)
+    add_or_update_group = staticmethod(database.add_or_update_group)
+    get_group_name = staticmethod(database.get_group_name)
+    add_debt_list = staticmethod(database.add_debt_list)
+    get_debt_list_info = staticmethod(database.get_debt_list_info)
+    get_debt_list_name = staticmethod(database.get_debt_list_name)
+    get_debt_list_totals = staticmethod(database.get_debt_list_totals)
+    get_debt_list_pending_status = staticmethod(database.get_debt_list_pending_status)
+    update_debt_list_status = staticmethod(database.update_debt_list_status)
+    update_debt_list_group = staticmethod(database.update_debt_list_group)
+    get_debt_lists_by_user_id = staticmethod(database.get_debt_lists_by_user_id)
+    user_has_pending_debt_list = staticmethod(database.user_has_pending_debt_list)
+    delete_debt_list = staticmethod(database.delete_debt_list)
+    discard_pending_debt_list = staticmethod(database.discard_pending_debt_list)
+    clear_debt_lists = staticmethod(database.clear_debt_lists)
+    add_or_update_debt = staticmethod(database.add_or_update_debt)
+    add_debts_bulk = staticmethod(database.add_debts_bulk)
+    get_debt_status = staticmethod(database.get_debt_status)
+    update_debt_status = staticmethod(database.update_debt_status)
+    get_user_balances = staticmethod(database.get_user_balances)
+    get_group_member_balances = staticmethod(database.get_group_member_balances)
+    get_debt_list_page = staticmethod(database.get_debt_list_page)
+    search_debt_lists = staticmethod(database.search_debt_lists)
+    search_open_debt_lists = staticmethod(database.search_open_debt_lists)
+    get_open_debt_lists = staticmethod(database.get_open_debt_lists)
+    resend_debt_list = staticmethod(database.resend_debt_list)
+    get_debt_list_message_info = staticmethod(database.get_debt_list_message_info)
+    get_last_sent_debt_list = staticmethod(recurring.get_last_sent_debt_list)
+    add_recurring_debt_list = staticmethod(recurring.add_recurring_debt_list)
+    get_recurring_debt_lists = staticmethod(recurring.get_recurring_debt_lists)
+    delete_recurring_debt_list = staticmethod(recurring.delete_recurring_debt_list)
+    get_due_recurring_debt_lists = staticmethod(recurring.get_due_recurring_debt_lists)
+    skip_recurring_debt_list = staticmethod(recurring.skip_recurring_debt_list)
+    materialize_recurring_debt_list = staticmethod(recurring.materialize_recurring_debt_list)
+    get_group_stats = staticmethod(analytics.get_group_stats)
+    get_due_outbox_messages = staticmethod(database.get_due_outbox_messages)
+    finish_outbox_messages = staticmethod(database.finish_outbox_messages)
+
+    @staticmethod
+    async def undo_last_deletion(user_id: int) -> list:
+        return await asyncio.to_thread(undo.undo_last_deletion, user_id)
+
+
+def _now() -> datetime:
+    # Naive UTC to the second, like the database's CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+# The columns of the outbox table that a side effect may leave out
+_OUTBOX_COLUMNS = {
+    "chat_id": None,
+    "message_id": None,
+    "inline_message_id": None,
+    "list_id": None,
+    "text": None,
+    "idempotency_key": None,
+}
+
+
+def _words(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+class MemoryRepository(Repository):
+    """
+    Everything in dicts, keyed and indexed like the tables. IDs given as strings, as they come out of callback data,
+    are accepted like the database accepts them.
+    """
+
+    def __init__(self):
+        # Handlers run on the event loop, imports in a worker thread
+        self._lock = threading.RLock()
+        self.users = {}
+        # username_lower -> user_id
+        self.users_by_name = {}
+        self.groups = {}
+        # user_id -> {group_id: None}, in the order the user was seen in the groups
+        self.memberships = {}
+        self.debt_lists = {}
+        # user_id -> {list_id: None}
+        self.lists_by_user = {}
+        self.debts = {}
+        # list_id -> {owed_by_user_name_lower: debt_id}
+        self.debts_by_list = {}
+        # Every side effect queued, like the rows of the outbox table, the idempotency keys among them, and
+        # outbox_id -> side effect of the ones not finished yet
+        self.side_effects = []
+        self._side_effect_keys = set()
+        self._unfinished = {}
+        # user_id -> batches of lists the user deleted, newest last, as they were when deleted, for /undo
+        self.deleted = {}
+        # recurring_id -> RecurringDebtListView
+        self.recurring_lists = {}
+        # The open lists by word prefix, like the SQL backend's index but kept up to date by this backend
+        self.open_debt_lists = DebtListPrefixIndex()
+        self._next_list_id = 1
+        self._next_debt_id = 1
+        self._next_recurring_id = 1
+
+    def _queue(self, side_effects: Iterable[dict]) -> None:
+        for side_effect in side_effects:
+            key = side_effect.get("idempotency_key")
+            if key is not None:
+                if key in self._side_effect_keys:
+                    continue
+                self._side_effect_keys.add(key)
+            side_effect = dict(
+                _OUTBOX_COLUMNS,
+                **side_effect,
+                outbox_id=len(self.side_effects) + 1,
+                attempts=0,
+                next_attempt_at=_now(),
+                done_at=None,
+                error=None,
+            )
+            self.side_effects.append(side_effect)
+            self._unfinished[side_effect["outbox_id"]] = side_effect
+
+    # Users
+    async def add_or_update_user(self, user_id: int, username: str, first_name: str, last_name: str) -> int:
+        with self._lock:
+            username_lower = normalize_username(username)
+            user = self.users.get(user_id)
+            if user:
+                username_changed = user["username_lower"] != username_lower
+                if username_changed and self.users_by_name.get(user["username_lower"]) == user_id:
+                    del self.users_by_name[user["username_lower"]]
+            else:
+                username_changed = True
+                user = self.users[user_id] = {"user_id": user_id}
+            user.update(
+                username=username,
+                username_lower=username_lower,
+                first_name=first_name,
+                last_name=last_name,
+            )
+            # A handle names one account at a time, so whoever was saved with it before has given it up
+            previous_holder = self.users_by_name.get(username_lower) if username_lower else None
+            taken_over = previous_holder is not None and previous_holder != user_id
+            if taken_over:
+                self.users[previous_holder]["username_lower"] = None
+                for debts in self.debts_by_list.values():
+                    debt_id = debts.get(username_lower)
+                    if debt_id and self.debts[debt_id]["owed_by_user_id"] == previous_holder:
+                        self.debts[debt_id]["owed_by_user_id"] = user_id
+            if username_lower:
+                self.users_by_name[username_lower] = user_id
+            if username_changed or taken_over:
+                self._link_debts_to_user(user_id, username, username_lower)
+            return user_id
+
+    def _link_debts_to_user(self, user_id: int, username: str, username_lower: str) -> None:
+        # Like the bulk updates of the SQL backend, this does not change when the lists were last updated
+        for debts in self.debts_by_list.values():
+            for name_lower, debt_id in list(debts.items()):
+                debt = self.debts[debt_id]
+                if debt["owed_by_user_id"] is None and username_lower and name_lower == username_lower:
+                    debt["owed_by_user_id"] = user_id
+                elif username_lower and debt["owed_by_user_id"] == user_id and name_lower != username_lower:
+                    # The debt follows the user's new handle
+                    debt["owed_by_user_name"] = username
+                    del debts[name_lower]
+                    debts[username_lower] = debt_id
+
+    def get_user_groups(self, user_id: int) -> list:
+        with self._lock:
+            return [
+                GroupView(group_id, self.groups[group_id]["group_name"])
+                for group_id in self.memberships.get(user_id, ())
+            ]
+
+    def is_user_in_group(self, user_id: int, group_id: int) -> bool:
+        with self._lock:
+            return int(group_id) in self.memberships.get(user_id, ())
+
+    async def associate_user_with_group(self, user_id: int, group_id: int) -> None:
+        with self._lock:
+            group_id = int(group_id)
+            if user_id in self.users and group_id in self.groups:
+                self.memberships.setdefault(user_id, {})[group_id] = None
+
+    # Groups
+    async def add_or_update_group(self, group_id: int, group_name: str, group_type: str) -> None:
+        with self._lock:
+            group_id = int(group_id)
+            self.groups[group_id] = {"group_id": group_id, "group_name": group_name, "group_type": group_type}
+
+    def get_group_name(self, group_id: int) -> str:
+        with self._lock:
+            group = self.groups.get(int(group_id))
+            return group["group_name"] if group else ""
+
+    # Debt lists
+    async def add_debt_list(
+        self,
+        user_id: int,
+        debt_name: str,
+        phone_number: str,
+        group_id: int = None,
+        currency: str = DEFAULT_CURRENCY,
+        debts: Iterable = (),
+    ) -> int:
+        with self._lock:
+            return self._add_debt_list(user_id, debt_name, phone_number, group_id, currency, debts)
+
+    def _add_debt_list(
+        self, user_id: int, debt_name: str, phone_number: str, group_id: int, currency: str, debts: Iterable
+    ) -> int:
+        list_id = self._next_list_id
+        self._next_list_id += 1
+        self.debt_lists[list_id] = {
+            "list_id": list_id,
+            "user_id": user_id,
+            "group_id": group_id,
+            "debt_name": debt_name,
+            "phone_number": phone_number,
+            "currency": currency,
+            "is_pending": True,
+            "message_id": None,
+            "last_updated": _now(),
+            # When the list was sent to its group, for /groupstats
+            "sent_at": None,
+        }
+        self.lists_by_user.setdefault(user_id, {})[list_id] = None
+        self.debts_by_list[list_id] = {}
+        for owed_by_user_name, amount_minor in debts:
+            self._set_debt(list_id, owed_by_user_name, amount_minor, False)
+        return list_id
+
+    def _touch(self, list_id: int) -> None:
+        self.debt_lists[list_id]["last_updated"] = _now()
+
+    def _refresh_open(self, list_id: int) -> None:
+        # Called after a list is sent, paid, unpaid or restored, so that inline queries only ever offer open lists
+        debt_list = self.debt_lists[list_id]
+        if debt_list["group_id"] is not None and not debt_list["is_pending"] and self._unpaid_count(list_id):
+            self.open_debt_lists.add(list_id, debt_list["user_id"], debt_list["debt_name"])
+        else:
+            self.open_debt_lists.remove(list_id)
+
+    def get_debt_list_info(self, list_id: int) -> DebtListView:
+        with self._lock:
+            list_id = int(list_id)
+            debt_list = self.debt_lists.get(list_id)
+            if not debt_list:
+                return None
+            # Debt IDs only grow, so this is the order the debts were added in
+            debts = tuple(
+                DebtView(debt["owed_by_user_name"], debt["amount_minor"], debt["paid"])
+                for debt in (self.debts[debt_id] for debt_id in sorted(self.debts_by_list[list_id].values()))
+            )
+            total_minor, outstanding_minor = self.get_debt_list_totals(list_id)
+            return DebtListView(
+                list_id,
+                debt_list["user_id"],
+                debt_list["group_id"],
+                debt_list["debt_name"],
+                debt_list["phone_number"],
+                debt_list["currency"],
+                debt_list["is_pending"],
+                total_minor=total_minor,
+                outstanding_minor=outstanding_minor,
+                last_updated=debt_list["last_updated"],
+                debts=debts,
+            )
+
+    def get_debt_list_name(self, list_id: int) -> str:
+        with self._lock:
+            debt_list = self.debt_lists.get(int(list_id))
+            return debt_list["debt_name"] if debt_list else ""
+
+    def get_debt_list_totals(self, list_id: int) -> tuple[int, int]:
+        with self._lock:
+            total = outstanding = 0
+            for debt_id in self.debts_by_list.get(int(list_id), {}).values():
+                debt = self.debts[debt_id]
+                total += debt["amount_minor"]
+                if not debt["paid"]:
+                    outstanding += debt["amount_minor"]
+            return total, outstanding
+
+    def get_debt_list_pending_status(self, list_id: int) -> bool:
+        with self._lock:
+            debt_list = self.debt_lists.get(int(list_id))
+            return debt_list["is_pending"] if debt_list else False
+
+    async def update_debt_list_status(self, list_id: int, is_pending: bool) -> None:
+        with self._lock:
+            debt_list = self.debt_lists.get(int(list_id))
+            if debt_list:
+                debt_list["is_pending"] = is_pending
+                self._refresh_open(debt_list["list_id"])
+
+    async def update_debt_list_group(self, list_id: int, group_id: int) -> bool:
+        with self._lock:
+            list_id = int(list_id)
+            debt_list = self.debt_lists.get(list_id)
+            if debt_list is None or debt_list["group_id"] is not None:
+                return False
+            debt_list.update(group_id=int(group_id), sent_at=_now())
+            self._refresh_open(list_id)
+            self._queue([outbox.send_debt_list(group_id, list_id, key=f"send:{list_id}:{group_id}")])
+            return True
+
+    def get_debt_lists_by_user_id(self, user_id: int) -> list:
+        with self._lock:
+            return list(self.lists_by_user.get(user_id, ()))
+
+    def user_has_pending_debt_list(self, user_id: int) -> int:
+        with self._lock:
+            for list_id in self.lists_by_user.get(user_id, ()):
+                if self.debt_lists[list_id]["is_pending"]:
+                    return list_id
+            return 0
+
+    async def delete_debt_list(self, list_id: int) -> None:
+        with self._lock:
+            deleted = self._delete_debt_list(int(list_id))
+            if deleted:
+                self.deleted.setdefault(deleted["user_id"], []).append([deleted])
+
+    def _delete_debt_list(self, list_id: int) -> dict:
+        # Returns the deleted list with its debts, or None if there was none
+        debt_list = self.debt_lists.get(list_id)
+        if not debt_list:
+            return None
+        if debt_list["message_id"]:
+            self._queue([outbox.delete_message(debt_list["group_id"], debt_list["message_id"])])
+        deleted = dict(
+            debt_list,
+            debts=[self.debts[debt_id] for debt_id in sorted(self.debts_by_list[list_id].values())],
+        )
+        self._remove_debt_list(list_id)
+        return deleted
+
+    async def clear_debt_lists(self, user_id: int) -> int:
+        with self._lock:
+            batch = [self._delete_debt_list(list_id) for list_id in list(self.lists_by_user.get(user_id, ()))]
+            if batch:
+                self.deleted.setdefault(user_id, []).append(batch)
+            return len(batch)
+
+    async def undo_last_deletion(self, user_id: int) -> list:
+        with self._lock:
+            batches = self.deleted.get(user_id)
+            if not batches:
+                return []
+            restored = []
+            for deleted in batches.pop():
+                list_id = deleted["list_id"]
+                debt_list = {key: value for key, value in deleted.items() if key != "debts"}
+                # Restored with new debt IDs and without its group message, like the SQL backend restores them
+                debt_list.update(message_id=None, last_updated=_now())
+                self.debt_lists[list_id] = debt_list
+                self.lists_by_user.setdefault(user_id, {})[list_id] = None
+                self.debts_by_list[list_id] = {}
+                for debt in deleted["debts"]:
+                    name = debt["owed_by_user_name"]
+                    self._insert_debt(list_id, name, normalize_username(name), debt["amount_minor"], debt["paid"])
+                if debt_list["group_id"] is not None and not debt_list["is_pending"]:
+                    if any(not debt["paid"] for debt in deleted["debts"]):
+                        self._queue([outbox.send_debt_list(debt_list["group_id"], list_id)])
+                self._refresh_open(list_id)
+                restored.append(list_id)
+            return restored
+
+    def _remove_debt_list(self, list_id: int) -> None:
+        self.open_debt_lists.remove(list_id)
+        debt_list = self.debt_lists.pop(list_id)
+        del self.lists_by_user[debt_list["user_id"]][list_id]
+        for debt_id in self.debts_by_list.pop(list_id).values():
+            del self.debts[debt_id]
+
+    async def discard_pending_debt_list(self, list_id: int) -> None:
+        with self._lock:
+            list_id = int(list_id)
+            debt_list = self.debt_lists.get(list_id)
+            if debt_list and debt_list["is_pending"]:
+                self._remove_debt_list(list_id)
+
+    # Debts
+    async def add_or_update_debt(
+        self, list_id: int, owed_by_user_name: str, amount_minor: int, paid: bool = False
+    ) -> int:
+        with self._lock:
+            list_id = int(list_id)
+            debt_id = self._set_debt(list_id, owed_by_user_name, amount_minor, paid)
+            self._refresh_open(list_id)
+            return debt_id
+
+    def _set_debt(self, list_id: int, owed_by_user_name: str, amount_minor: int, paid: bool) -> int:
+        name_lower = normalize_username(owed_by_user_name)
+        debt_id = self.debts_by_list[list_id].get(name_lower)
+        if debt_id:
+            self.debts[debt_id].update(owed_by_user_name=owed_by_user_name, amount_minor=amount_minor, paid=paid)
+            self._touch(list_id)
+            return debt_id
+        return self._insert_debt(list_id, owed_by_user_name, name_lower, amount_minor, paid)
+
+    def _insert_debt(self, list_id: int, name: str, name_lower: str, amount_minor: int, paid: bool) -> int:
+        debt_id = self._next_debt_id
+        self._next_debt_id += 1
+        self.debts[debt_id] = {
+            "debt_id": debt_id,
+            "list_id": list_id,
+            "owed_by_user_name": name,
+            # Linked straight away if the debtor has been seen
+            "owed_by_user_id": self.users_by_name.get(name_lower),
+            "amount_minor": amount_minor,
+            "paid": paid,
+            # When the debt was marked as paid, for /groupstats
+            "paid_at": None,
+        }
+        self.debts_by_list[list_id][name_lower] = debt_id
+        return debt_id
+
+    def add_debts_bulk(self, list_id: int, debts: Iterable, chunk_size: int = 500) -> int:
+        # Debts are consumed lazily like the SQL backend's, chunk_size does not matter in memory
+        list_id = int(list_id)
+        inserted = 0
+        for name, amount_minor in debts:
+            with self._lock:
+                self._insert_debt(list_id, name, normalize_username(name), amount_minor, False)
+            inserted += 1
+        return inserted
+
+    def _find_debt_for_user(self, list_id: int, user_id: int, user_name: str, link: bool = True) -> dict:
+        # Debts linked to the user come first, then one only known by the user's handle, which is linked on the way
+        # unless this only reads
+        debts = [self.debts[debt_id] for debt_id in self.debts_by_list.get(list_id, {}).values()]
+        for debt in debts:
+            if debt["owed_by_user_id"] == user_id:
+                return debt
+        user_name_lower = normalize_username(user_name)
+        debt_id = self.debts_by_list.get(list_id, {}).get(user_name_lower) if user_name_lower else None
+        if debt_id and self.debts[debt_id]["owed_by_user_id"] is None:
+            debt = self.debts[debt_id]
+            if link:
+                debt["owed_by_user_id"] = user_id
+                self._touch(list_id)
+            return debt
+        return None
+
+    def get_debt_status(self, list_id: int, user_id: int, user_name: str) -> tuple:
+        with self._lock:
+            list_id = int(list_id)
+            if not self.debts_by_list.get(list_id):
+                return False, "listNotFound"
+            debt = self._find_debt_for_user(list_id, user_id, user_name, link=False)
+            if not debt:
+                return False, "notInList"
+            return True, debt["paid"]
+
+    async def update_debt_status(
+        self, list_id: int, user_id: int, user_name: str, paid: bool, side_effects: Iterable[dict] = ()
+    ) -> tuple:
+        with self._lock:
+            list_id = int(list_id)
+            if not self.debts_by_list.get(list_id):
+                return False, "listNotFound"
+            debt = self._find_debt_for_user(list_id, user_id, user_name)
+            if not debt:
+                return False, "notInList"
+
+            changed = debt["paid"] != paid
+            debt["paid"] = paid
+            self._queue(side_effects)
+            if not changed:
+                return True, "No Error"
+            debt["paid_at"] = _now() if paid else None
+
+            self._touch(list_id)
+            self._refresh_open(list_id)
+            debt_list = self.debt_lists[list_id]
+            unpaid_count = sum(
+                not self.debts[debt_id]["paid"] for debt_id in self.debts_by_list[list_id].values()
+            )
+            if paid and unpaid_count == 0:
+                if debt_list["message_id"]:
+                    self._queue([outbox.delete_message(debt_list["group_id"], debt_list["message_id"])])
+                    debt_list["message_id"] = None
+                self._queue([outbox.notify(debt_list["user_id"], "listSettled", list_id=list_id)])
+            elif not paid and unpaid_count == 1:
+                if debt_list["group_id"] is not None and not debt_list["message_id"] and not debt_list["is_pending"]:
+                    self._queue([outbox.send_debt_list(debt_list["group_id"], list_id)])
+            return True, "No Error"
+
+    # Balances
+    def _balances(self) -> dict:
+        # Rows of the SQL backend's balances rollup: (group_id, creditor_id, debtor_name, currency) ->
+        # [debtor_user_id, amount_minor], over the unpaid debts of every list sent to a group
+        balances = {}
+        for debt_list in self.debt_lists.values():
+            if debt_list["group_id"] is None:
+                continue
+            for debtor_name, debt_id in self.debts_by_list[debt_list["list_id"]].items():
+                debt = self.debts[debt_id]
+                if debt["paid"]:
+                    continue
+                balance = balances.setdefault(
+                    (debt_list["group_id"], debt_list["user_id"], debtor_name, debt_list["currency"]), [None, 0]
+                )
+                if debt["owed_by_user_id"] is not None:
+                    balance[0] = debt["owed_by_user_id"]
+                balance[1] += debt["amount_minor"]
+        return {key: balance for key, balance in balances.items() if balance[1]}
+
+    def get_user_balances(self, user_id: int) -> dict:
+        with self._lock:
+            user = self.users.get(user_id)
+            username_lower = user["username_lower"] if user else None
+            # Net each counterparty by user ID where it is known, and by handle otherwise
+            net = {}
+            for (group_id, creditor_id, debtor_name, currency), (debtor_user_id, amount_minor) in self._balances().items():
+                if creditor_id == user_id:
+                    counterparty = f"@{debtor_name}" if debtor_user_id is None else str(debtor_user_id)
+                    key = (group_id, currency, counterparty)
+                    net[key] = net.get(key, 0) + amount_minor
+                if debtor_user_id == user_id or (
+                    debtor_user_id is None and username_lower and debtor_name == username_lower
+                ):
+                    key = (group_id, currency, str(creditor_id))
+                    net[key] = net.get(key, 0) - amount_minor
+
+            balances = {}
+            for (group_id, currency, counterparty), amount_minor in sorted(net.items()):
+                if not amount_minor:
+                    continue
+                name = counterparty
+                if not counterparty.startswith("@") and int(counterparty) in self.users:
+                    other = self.users[int(counterparty)]
+                    name = f"@{other['username']}" if other["username"] else other["first_name"]
+                balances.setdefault(group_id, []).append((name, currency, amount_minor))
+            return balances
+
+    def get_group_member_balances(self, group_id: int) -> dict:
+        with self._lock:
+            group_id = int(group_id)
+            # Members are identified by normalized handle, so debts and credits of the same person net out
+            creditors = {}
+            display_names = {}
+            net = {}
+            for (balance_group_id, creditor_id, debtor_name, currency), (_, amount_minor) in self._balances().items():
+                if balance_group_id != group_id:
+                    continue
+                if creditor_id not in creditors:
+                    user = self.users.get(creditor_id)
+                    creditors[creditor_id] = (user and user["username_lower"]) or f"id:{creditor_id}"
+                    if not user:
+                        display_names[creditors[creditor_id]] = f"User {creditor_id}"
+                    elif not user["username_lower"]:
+                        display_names[creditors[creditor_id]] = user["first_name"]
+                members = net.setdefault(currency, {})
+                members[creditors[creditor_id]] = members.get(creditors[creditor_id], 0) + amount_minor
+                members[debtor_name] = members.get(debtor_name, 0) - amount_minor
+
+            for members in net.values():
+                for member in members:
+                    user_id = self.users_by_name.get(member)
+                    if user_id is not None:
+                        display_names[member] = f"@{self.users[user_id]['username']}"
+            return {
+                currency: {
+                    display_names.get(member, f"@{member}"): amount_minor
+                    for member, amount_minor in members.items()
+                    if amount_minor
+                }
+                for currency, members in net.items()
+            }
+
+    # Paging, search and resending
+    def _unpaid_count(self, list_id: int) -> int:
+        return sum(not self.debts[debt_id]["paid"] for debt_id in self.debts_by_list[list_id].values())
+
+    def get_debt_list_page(
+        self, user_id: int, status: str = "all", before: tuple = None, after: tuple = None, page_size: int = 5
+    ) -> tuple[list, bool, bool]:
+        with self._lock:
+            keys = []
+            for list_id in self.lists_by_user.get(user_id, ()):
+                if status != "all" and (self._unpaid_count(list_id) > 0) != (status == "open"):
+                    continue
+                key = (self.debt_lists[list_id]["last_updated"], list_id)
+                if after is not None:
+                    if key <= tuple(after):
+                        continue
+                elif before is not None and key >= tuple(before):
+                    continue
+                keys.append(key)
+            # In the order they are paged in, with one extra list to find out whether there is another page
+            keys.sort(reverse=after is None)
+            has_more = len(keys) > page_size
+            keys = keys[:page_size]
+            if after is not None:
+                keys.reverse()
+                has_newer, has_older = has_more, True
+            else:
+                has_newer, has_older = before is not None, has_more
+            return [self.get_debt_list_info(list_id) for _, list_id in keys], has_newer, has_older
+
+    def search_debt_lists(self, user_id: int, query: str, offset: int = 0, limit: int = 5) -> tuple[list, bool]:
+        terms = _words(query)
+        if not terms:
+            return [], False
+        with self._lock:
+            ranked = []
+            for list_id in self.lists_by_user.get(user_id, ()):
+                debt_list = self.debt_lists[list_id]
+                # Like the full-text index, which lists are only added to once they are no longer pending
+                if debt_list["is_pending"]:
+                    continue
+                name_words = _words(debt_list["debt_name"])
+                debtor_words = [
+                    word
+                    for debt_id in self.debts_by_list[list_id].values()
+                    for word in _words(self.debts[debt_id]["owed_by_user_name"])
+                ]
+                if not all(any(word.startswith(term) for word in name_words + debtor_words) for term in terms):
+                    continue
+                in_name = sum(any(word.startswith(term) for word in name_words) for term in terms)
+                in_debtors = sum(any(word.startswith(term) for word in debtor_words) for term in terms)
+                total_minor, outstanding_minor = self.get_debt_list_totals(list_id)
+                result = SearchResultView(
+                    list_id,
+                    debt_list["debt_name"],
+                    debt_list["currency"],
+                    total_minor,
+                    outstanding_minor,
+                    False,
+                    debt_list["last_updated"],
+                )
+                # A match in the name counts ten times one in the debtors, like the SQL backend's BM25 weights
+                ranked.append((-(10 * in_name + in_debtors), -list_id, result))
+            ranked.sort(key=lambda row: row[:2])
+            results = [result for _, _, result in ranked[offset : offset + limit + 1]]
+            return results[:limit], len(results) > limit
+
+    def search_open_debt_lists(self, user_id: int, query: str, limit: int = 50) -> list:
+        return self.open_debt_lists.search(user_id, query, limit=limit)
+
+    def get_open_debt_lists(self) -> list:
+        with self._lock:
+            return [
+                replace(self.get_debt_list_info(list_id), debts=None)
+                for list_id, debt_list in self.debt_lists.items()
+                if debt_list["group_id"] is not None and not debt_list["is_pending"] and self._unpaid_count(list_id)
+            ]
+
+    async def resend_debt_list(self, list_id: int) -> None:
+        with self._lock:
+            list_id = int(list_id)
+            debt_list = self.debt_lists.get(list_id)
+            if debt_list is None or debt_list["group_id"] is None:
+                return
+            message_id = debt_list["message_id"]
+            side_effects = []
+            if message_id:
+                side_effects.append(outbox.delete_message(debt_list["group_id"], message_id))
+            side_effects.append(
+                outbox.send_debt_list(
+                    debt_list["group_id"], list_id, key=f"resend:{list_id}:{message_id}" if message_id else None
+                )
+            )
+            self._queue(side_effects)
+            debt_list["message_id"] = None
+
+    def get_debt_list_message_info(self, list_id: int) -> tuple[int, int]:
+        with self._lock:
+            debt_list = self.debt_lists.get(int(list_id))
+            return (debt_list["group_id"], debt_list["message_id"]) if debt_list else (0, 0)
+
+    # Recurring debt lists
+    def get_last_sent_debt_list(self, user_id: int) -> DebtListView:
+        with self._lock:
+            sent = [
+                list_id
+                for list_id in self.lists_by_user.get(user_id, ())
+                if self.debt_lists[list_id]["group_id"] is not None
+            ]
+            return self.get_debt_list_info(max(sent)) if sent else None
+
+    async def add_recurring_debt_list(self, debt_list: DebtListView, schedule: str, timezone: str, next_due) -> int:
+        with self._lock:
+            recurring_id = self._next_recurring_id
+            self._next_recurring_id += 1
+            self.recurring_lists[recurring_id] = RecurringDebtListView(
+                recurring_id,
+                debt_list.user_id,
+                debt_list.group_id,
+                debt_list.debt_name,
+                debt_list.phone_number,
+                debt_list.currency,
+                tuple(DebtView(debt.owed_by_user_name, debt.amount_minor, False) for debt in debt_list.debts),
+                schedule,
+                timezone,
+                next_due,
+            )
+            return recurring_id
+
+    def _soonest_first(self, recurring_lists: Iterable) -> list:
+        return sorted(recurring_lists, key=lambda recurring: (recurring.next_due, recurring.recurring_id))
+
+    def get_recurring_debt_lists(self, user_id: int) -> list:
+        with self._lock:
+            return self._soonest_first(
+                recurring for recurring in self.recurring_lists.values() if recurring.user_id == user_id
+            )
+
+    async def delete_recurring_debt_list(self, recurring_id: int, user_id: int) -> bool:
+        with self._lock:
+            recurring = self.recurring_lists.get(int(recurring_id))
+            if recurring is None or recurring.user_id != user_id:
+                return False
+            del self.recurring_lists[recurring.recurring_id]
+            return True
+
+    def get_due_recurring_debt_lists(self, now, limit: int = 100) -> list:
+        with self._lock:
+            return self._soonest_first(
+                recurring for recurring in self.recurring_lists.values() if recurring.next_due <= now
+            )[:limit]
+
+    def _move_recurring(self, recurring_id: int, due, next_due) -> RecurringDebtListView:
+        # The recurring debt list as it was, or None if it is no longer due at due
+        recurring = self.recurring_lists.get(recurring_id)
+        if recurring is None or recurring.next_due != due:
+            return None
+        if next_due is None:
+            del self.recurring_lists[recurring_id]
+        else:
+            self.recurring_lists[recurring_id] = replace(recurring, next_due=next_due)
+        return recurring
+
+    def skip_recurring_debt_list(self, recurring_id: int, due, next_due) -> None:
+        with self._lock:
+            self._move_recurring(recurring_id, due, next_due)
+
+    def materialize_recurring_debt_list(self, recurring_id: int, due, next_due, debt_name: str) -> int:
+        with self._lock:
+            recurring = self._move_recurring(recurring_id, due, next_due)
+            if recurring is None:
+                # Stopped, or posted by another run of the job
+                return None
+            list_id = self._add_debt_list(
+                recurring.user_id,
+                debt_name,
+                recurring.phone_number,
+                None,
+                recurring.currency,
+                ((debt.owed_by_user_name, debt.amount_minor) for debt in recurring.debts),
+            )
+            self.debt_lists[list_id].update(is_pending=False, group_id=recurring.group_id, sent_at=_now())
+            self._refresh_open(list_id)
+            self._queue(
+                [outbox.send_debt_list(recurring.group_id, list_id, key=f"recurring:{recurring_id}:{due:%Y%m%d%H%M}")]
+            )
+            return list_id
+
+    # Group stats, computed from the lists there are now rather than from rollups of the event log
+    def get_group_stats(self, group_id: int, since: date, top: int = 5, min_debts: int = 2) -> GroupStatsView:
+        with self._lock:
+            group_id = int(group_id)
+            lists_sent = 0
+            # currency -> [debts, amount_minor], and debtor_name -> [debts_paid, settle_seconds]
+            paid = {}
+            settle_times = Counter()
+            debtors = {}
+            for list_id, debt_list in self.debt_lists.items():
+                if debt_list["group_id"] != group_id:
+                    continue
+                sent_at = debt_list["sent_at"]
+                if sent_at is not None and sent_at.date() >= since:
+                    lists_sent += 1
+                for debtor_name, debt_id in self.debts_by_list[list_id].items():
+                    debt = self.debts[debt_id]
+                    paid_at = debt["paid_at"]
+                    if not debt["paid"] or paid_at is None or paid_at.date() < since:
+                        continue
+                    sums = paid.setdefault(debt_list["currency"], [0, 0])
+                    sums[0] += 1
+                    sums[1] += debt["amount_minor"]
+                    if sent_at is None:
+                        continue
+                    settle_seconds = int((paid_at - sent_at).total_seconds())
+                    settle_times[analytics.settle_bucket(settle_seconds)] += 1
+                    debtor = debtors.setdefault(debtor_name, [0, 0])
+                    debtor[0] += 1
+                    debtor[1] += settle_seconds
+
+            outstanding = {}
+            owed = {}
+            for (balance_group_id, _, debtor_name, currency), (_, amount_minor) in self._balances().items():
+                if balance_group_id == group_id:
+                    outstanding[currency] = outstanding.get(currency, 0) + amount_minor
+                    owed[(debtor_name, currency)] = owed.get((debtor_name, currency), 0) + amount_minor
+            slowest_payers = sorted(
+                (
+                    (debtor_name, debts_paid, settle_seconds)
+                    for debtor_name, (debts_paid, settle_seconds) in debtors.items()
+                    if debts_paid >= min_debts
+                ),
+                key=lambda row: (-row[2] / row[1], row[0]),
+            )
+            top_debtors = sorted(
+                ((debtor_name, currency, amount_minor) for (debtor_name, currency), amount_minor in owed.items()),
+                key=lambda row: (-row[2], row[0], row[1]),
+            )
+            return GroupStatsView(
+                lists_sent=lists_sent,
+                paid=tuple((currency, debts, amount_minor) for currency, (debts, amount_minor) in sorted(paid.items())),
+                settle_times=tuple(sorted(settle_times.items())),
+                slowest_payers=tuple(slowest_payers[:top]),
+                outstanding=tuple(
+                    (currency, amount_minor) for currency, amount_minor in sorted(outstanding.items()) if amount_minor
+                ),
+                top_debtors=tuple(top_debtors[:top]),
+            )
+
+    # Outbox
+    def get_due_outbox_messages(self, limit: int) -> list:
+        with self._lock:
+            now = _now()
+            due = sorted(
+                (side_effect for side_effect in self._unfinished.values() if side_effect["next_attempt_at"] <= now),
+                key=lambda side_effect: (side_effect["next_attempt_at"], side_effect["outbox_id"]),
+            )
+            # Copies, like the rows the SQL backend reads
+            return [dict(side_effect) for side_effect in due[:limit]]
+
+    async def finish_outbox_messages(self, results: list, max_attempts: int) -> None:
+        with self._lock:
+            for side_effect, outcome in results:
+                stored = self._unfinished.pop(side_effect["outbox_id"], None)
+                if stored is None:
+                    continue
+                stored["attempts"] += 1
+                if outcome[0] == "done":
+                    stored["done_at"] = _now()
+                    sent_message_id = outcome[1]
+                    if stored["action"] == outbox.SEND_DEBT_LIST and sent_message_id:
+                        debt_list = self.debt_lists.get(stored["list_id"])
+                        if debt_list and debt_list["message_id"] is None:
+                            debt_list["message_id"] = sent_message_id
+                        else:
+                            # The list was deleted, or already has a message, while this one was being sent
+                            self._queue([outbox.delete_message(stored["chat_id"], sent_message_id)])
+                elif outcome[0] == "retry" and stored["attempts"] < max_attempts:
+                    _, delay, error = outcome
+                    stored.update(next_attempt_at=_now() + timedelta(seconds=int(delay)), error=error)
+                    self._unfinished[stored["outbox_id"]] = stored
+                else:
+                    stored.update(done_at=_now(), error=outcome[-1])
+
+
+def create_repository(backend: str = STORAGE_BACKEND) -> Repository:
+    """
+    Create the repository of a storage backend.
+
+    Args:
+        backend (str, optional): "sqlite" or "memory". Defaults to STORAGE_BACKEND.
+
+    Returns:
+        Repository: The repository.
+
+    Raises:
+        ValueError: If the backend is not known.
+    """
+    if backend == "sqlite":
+        return SqlRepository()
+    if backend == "memory":
+        return MemoryRepository()
+    raise ValueError(f"Unknown storage backend {backend!r}, expected sqlite or memory")
@@ -0,0 +1,146 @@
+"""
+HTTP clients for the Bot API that can be tuned separately for fetching updates and for everything else, and that
+measure how busy their connection pools are.
+
+Every request first takes one of the pool's connection slots. The time spent waiting for a slot is the pool checkout
+wait, and the slots in use over time give the pool's utilization. Both show whether a pool is too small before it
+starts failing with pool timeouts.
+"""
+
+import asyncio
+import functools
+import time
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+
+# name -> InstrumentedRequest, for reporting
+request_pools = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context():
+    # Loading the CA certificates takes tens of milliseconds per client, and the bot builds one for each of its pools
+    return httpx.create_ssl_context()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    def __init__(
+        self,
+        name: str,
+        connection_pool_size: int,
+        keepalive_expiry: float = 5.0,
+        pool_timeout: float = 1.0,
+        **kwargs,
+    ):
+        """
+        Args:
+            name (str): The name the pool's metrics are reported under.
+            connection_pool_size (int): The most connections open at once.
+            keepalive_expiry (float, optional): Seconds an idle connection is kept open for the next request, 0 closes
+                every connection after its request. Defaults to 5.
+            pool_timeout (float, optional): Seconds a request waits for one of the pool's connections. Defaults to 1.
+            **kwargs: The other timeouts and the HTTP version, passed on to HTTPXRequest.
+        """
+        # httpx_kwargs override the client arguments HTTPXRequest derives from its own, the limits among them
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            pool_timeout=pool_timeout,
+            httpx_kwargs={
+                "limits": httpx.Limits(
+                    max_connections=connection_pool_size,
+                    max_keepalive_connections=connection_pool_size if keepalive_expiry else 0,
+                    keepalive_expiry=keepalive_expiry or None,
+                ),
+                "verify": _ssl_context(),
+            },
+            **kwargs,
+        )
+
+        self.name = name
+        self.pool_timeout = pool_timeout
+        self.size = connection_pool_size
+        self._slots = asyncio.Semaphore(connection_pool_size)
+        self._in_use = 0
+        self._busy_seconds = 0.0
+        self._started = self._changed = time.monotonic()
+        self.metrics = {
+            "requests": 0,
+            "pool_timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "peak_in_use": 0,
+        }
+        request_pools[name] = self
+
+    def _count_in_use(self, change: int) -> None:
+        now = time.monotonic()
+        self._busy_seconds += self._in_use * (now - self._changed)
+        self._changed = now
+        self._in_use += change
+        self.metrics["peak_in_use"] = max(self.metrics["peak_in_use"], self._in_use)
+
+    def snapshot(self) -> dict:
+        """
+        The pool's metrics since it was created.
+
+        Returns:
+            dict: The counters in metrics, plus in_use, the mean checkout wait in seconds, and utilization, the average
+            share of the pool's connections that were in use.
+        """
+        self._count_in_use(0)
+        elapsed = self._changed - self._started
+        requests = self.metrics["requests"]
+        return {
+            **self.metrics,
+            "size": self.size,
+            "in_use": self._in_use,
+            "wait_seconds_mean": self.metrics["wait_seconds_total"] / requests if requests else 0.0,
+            "utilization": self._busy_seconds / (self.size * elapsed) if elapsed else 0.0,
+        }
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        if pool_timeout is BaseRequest.DEFAULT_NONE:
+            pool_timeout = self.pool_timeout
+        started = time.monotonic()
+        if self._slots.locked():
+            try:
+                await asyncio.wait_for(self._slots.acquire(), pool_timeout)
+            except asyncio.TimeoutError:
+                self.metrics["pool_timeouts"] += 1
+                raise TimedOut(
+                    f"Pool timeout: all {self.size} connections of the {self.name} pool are in use, the request was not sent"
+                ) from None
+        else:
+            # Taking a free slot does not suspend, so event loop lag is not counted as waiting for the pool
+            await self._slots.acquire()
+        waited = time.monotonic() - started
+        self.metrics["requests"] += 1
+        self.metrics["wait_seconds_total"] += waited
+        self.metrics["wait_seconds_max"] = max(self.metrics["wait_seconds_max"], waited)
+
+        self._count_in_use(1)
+        try:
+            # A slot was free, so httpx always finds a free connection and never waits itself
+            return await super().do_request(
+                url,
+                method,
+                request_data=request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        finally:
+            self._count_in_use(-1)
+            self._slots.release()
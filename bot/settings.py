@@ -0,0 +1,148 @@
+"""
+Per-chat settings: the time zone, language and amount format a user or group has chosen with /settings.
+
+Settings are read from the database once per chat and kept in memory, resolved to what rendering needs: the ZoneInfo
+of the time zone and the language's messages from the catalog. Changing a chat's settings replaces its cached copy.
+
+At startup every chat's settings are loaded at once, after which a chat that is not cached has no settings of its own
+and never needs the database.
+"""
+
+from datetime import datetime, timezone as dt_timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from config.config import DEFAULT_AMOUNT_STYLE, DEFAULT_LOCALE, DEFAULT_TIMEZONE
+from utils.money import AMOUNT_STYLES, format_amount
+
+from .database import delete_chat_settings, get_all_chat_settings, get_chat_settings, save_chat_settings
+from .messages import UserError, is_known_locale, messages_for, normalize_locale
+
+
+class Settings:
+    __slots__ = ("timezone", "locale", "amount_style", "messages")
+
+    def __init__(self, timezone: str, locale: str, amount_style: str):
+        self.timezone = ZoneInfo(timezone)
+        self.locale = locale
+        self.amount_style = amount_style
+        self.messages = messages_for(locale)
+
+    def text(self, key: str, **values) -> str:
+        """Render a message of the catalog in the chat's language."""
+        return self.messages[key].render(**values)
+
+    def error(self, error: Exception) -> str:
+        """Render an error for the user in the chat's language, one that is not a UserError as it is."""
+        if not isinstance(error, UserError):
+            return str(error)
+        values = {
+            name: self.error(value) if isinstance(value, UserError) else value for name, value in error.values.items()
+        }
+        return self.text(error.key, **values)
+
+    def amount(self, amount_minor: int, currency: str) -> str:
+        """Format an amount without its currency, in the chat's amount format."""
+        return format_amount(amount_minor, currency, self.amount_style)
+
+    def money(self, amount_minor: int, currency: str) -> str:
+        """Format an amount with its currency, in the chat's amount format and the order of its language."""
+        return self.messages["money"].render(
+            currency=currency, amount=format_amount(amount_minor, currency, self.amount_style)
+        )
+
+    def local_time(self, utc_time: datetime) -> datetime:
+        """Convert a time as stored in the database, naive UTC, to the chat's time zone."""
+        return utc_time.replace(tzinfo=dt_timezone.utc).astimezone(self.timezone)
+
+
+default_settings = Settings(DEFAULT_TIMEZONE, DEFAULT_LOCALE, DEFAULT_AMOUNT_STYLE)
+# chat ID -> Settings, chats without settings of their own share default_settings
+_cache = {}
+# Whether _cache holds every chat that has settings of its own, see load_chat_settings
+_loaded = False
+
+
+def _settings(timezone: str, locale: str, amount_style: str) -> Settings:
+    return Settings(timezone or DEFAULT_TIMEZONE, locale or DEFAULT_LOCALE, amount_style or DEFAULT_AMOUNT_STYLE)
+
+
+def load_chat_settings() -> None:
+    """
+    Cache the settings of every user and group that has chosen any. Called once at startup, the cache is kept up to
+    date by the functions that change settings from then on.
+    """
+    global _loaded
+    _cache.update((chat_id, _settings(*stored)) for chat_id, *stored in get_all_chat_settings())
+    _loaded = True
+
+
+def _read_chat_settings(chat_id: int) -> Settings:
+    stored = get_chat_settings(chat_id)
+    if stored is None:
+        return default_settings
+    return _settings(stored["timezone"], stored["locale"], stored["amount_style"])
+
+
+def chat_settings(chat_id: int = None) -> Settings:
+    """
+    Get a user's or group's settings, from memory after the first time.
+
+    Args:
+        chat_id (int, optional): The ID of the user or group. Defaults to None, for messages that belong to no chat,
+            such as debt lists posted in inline mode.
+
+    Returns:
+        Settings: The chat's settings, with defaults for those it has not chosen.
+    """
+    if chat_id is None:
+        return default_settings
+    settings = _cache.get(chat_id)
+    if settings is None:
+        # Once every chat's settings are loaded, one that is not cached has none of its own
+        settings = default_settings if _loaded else _read_chat_settings(chat_id)
+        _cache[chat_id] = settings
+    return settings
+
+
+async def update_chat_settings(chat_id: int, timezone: str = None, locale: str = None, amount_style: str = None) -> Settings:
+    """
+    Change some of a user's or group's settings, on the database writer.
+
+    Args:
+        chat_id (int): The ID of the user or group.
+        timezone (str, optional): An IANA time zone name, e.g. Europe/Berlin. Defaults to None, which keeps it.
+        locale (str, optional): A language tag, e.g. en. Defaults to None, which keeps it.
+        amount_style (str, optional): One of utils.money.AMOUNT_STYLES. Defaults to None, which keeps it.
+
+    Returns:
+        Settings: The chat's new settings.
+
+    Raises:
+        UserError: If a value is not valid.
+    """
+    changes = {}
+    if timezone is not None:
+        try:
+            changes["timezone"] = ZoneInfo(timezone).key
+        except (ZoneInfoNotFoundError, ValueError):
+            raise UserError("settingsUnknownTimezone", timezone=timezone) from None
+    if locale is not None:
+        if not is_known_locale(locale):
+            raise UserError("settingsUnknownLanguage", language=locale)
+        changes["locale"] = normalize_locale(locale)
+    if amount_style is not None:
+        amount_style = amount_style.lower()
+        if amount_style not in AMOUNT_STYLES:
+            raise UserError("settingsUnknownAmounts", style=amount_style, styles=", ".join(AMOUNT_STYLES))
+        changes["amount_style"] = amount_style
+    if changes:
+        await save_chat_settings(chat_id, **changes)
+        _cache[chat_id] = _read_chat_settings(chat_id)
+    return chat_settings(chat_id)
+
+
+async def reset_chat_settings(chat_id: int) -> Settings:
+    """Go back to the default settings for a user or group."""
+    await delete_chat_settings(chat_id)
+    _cache[chat_id] = default_settings
+    return default_settings
@@ -0,0 +1,71 @@
+"""
+Debt simplification for groups. Turns the net balance of every member of a group into a short list of transfers that settles everyone.
+"""
+
+import heapq
+from typing import Dict, Hashable, List, Tuple
+
+# Balances below this are treated as settled
+EPSILON = 1e-9
+
+
+def plan_settlement(
+    balances: Dict[Hashable, float]
+) -> List[Tuple[Hashable, Hashable, float]]:
+    """
+    Compute a near-minimal set of transfers that settles every balance in a group.
+
+    Members whose debt exactly matches someone's credit are paired first, since a single transfer settles both of them. The rest are settled greedily, always moving money from the member who owes the most to the member who is owed the most, using a heap for each side. Every transfer settles at least one member, so there are never more transfers than members, and the plan takes O(n log n) time.
+
+    Args:
+        balances (Dict[Hashable, float]): The net balance of each member, normally in minor units. Positive means the member is owed money, negative means the member owes money. The balances should sum to zero.
+
+    Returns:
+        List[Tuple[Hashable, Hashable, float]]: A list of (payer, payee, amount) transfers.
+
+    Examples:
+        >>> plan_settlement({"alice": 10, "bob": -4, "carol": -6})
+        [('carol', 'alice', 6), ('bob', 'alice', 4)]
+    """
+    transfers = []
+
+    # Pair up members whose balances cancel out exactly
+    creditors_by_amount: Dict[float, List[Hashable]] = {}
+    for member, amount in balances.items():
+        if amount > EPSILON:
+            creditors_by_amount.setdefault(amount, []).append(member)
+    debtors = []
+    for member, amount in balances.items():
+        if amount >= -EPSILON:
+            continue
+        matching_creditors = creditors_by_amount.get(-amount)
+        if matching_creditors:
+            transfers.append((member, matching_creditors.pop(), -amount))
+        else:
+            # Negated amounts so that the heap pops the largest debt first
+            debtors.append((amount, _order_key(member), member))
+    creditors = [
+        (-amount, _order_key(member), member)
+        for amount, members in creditors_by_amount.items()
+        for member in members
+    ]
+
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    while creditors and debtors:
+        credit, creditor_key, creditor = heapq.heappop(creditors)
+        debit, debtor_key, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debit)
+        transfers.append((debtor, creditor, amount))
+
+        if -credit - amount > EPSILON:
+            heapq.heappush(creditors, (credit + amount, creditor_key, creditor))
+        if -debit - amount > EPSILON:
+            heapq.heappush(debtors, (debit + amount, debtor_key, debtor))
+
+    return transfers
+
+
+def _order_key(member: Hashable) -> str:
+    # Members are not necessarily comparable with each other, so break ties on their string form
+    return str(member)
@@ -0,0 +1,314 @@
+"""
+Optional partitioning of debt lists across several SQLite databases, so that a burst of writes in one busy group only
+holds the write lock of its own shard.
+
+This is for latency isolation, not throughput. A quiet group whose shard is not the busy one's has its writes committed
+without waiting behind the burst, but the total writes per second do not grow with the shards: the writes are bound by
+statement building under the GIL, and every extra writer thread competes for it, so they go down a little as shards are
+added, see benchmarks/sharding.py. Groups that share the busy group's shard still wait behind it.
+
+With SHARD_COUNT above 1, the debt lists of a group live in shard group_id % SHARD_COUNT, together with everything that
+belongs to them: debts, events, queued effects, balances, archived and recurring lists and analytics rollups. Drafts
+that have not been sent to a group yet live in their owner's shard, user_id % SHARD_COUNT, and move to their group's
+shard when they are sent. Shard 0 is the database at DATABASE_URL, which also keeps what is not partitioned: groups,
+memberships and chat settings. Users are copied to every shard, since debts are matched to their debtors by handle.
+
+Each shard has its own database writer and hands out its own debt list IDs, see global_id(), so creating, paying and
+sending a list only ever writes to the shards it is in. A list's ID names the shard it was created in, its home, which
+records where the list went if it moved, see for_list().
+
+The data functions, in bot/database.py and the modules of the features that own them, run on the shard bound with
+using(), or on shard 0 when none is. The decorators below bind the shard of a function's debt list, group or recurring
+list, or run it on every shard and merge the results.
+With SHARD_COUNT at 1 they return the function as it is, so an unsharded bot runs exactly the code it did before.
+"""
+
+import functools
+import inspect
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+from sqlalchemy import create_engine, func, make_url, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import NullPool
+
+from config.config import DATABASE_URL, SHARD_COUNT, SHARD_DATABASE_URL, WRITER_COMMIT_WINDOW, WRITER_MAX_BATCH
+
+from .models import DebtList, DebtListShard, SessionLocal, engine
+from .writer import DatabaseWriter, database_writer
+
+SHARDED = SHARD_COUNT > 1
+
+
+class Shard:
+    def __init__(self, index: int, engine, session_factory, writer: DatabaseWriter):
+        self.index = index
+        self.engine = engine
+        self.session_factory = session_factory
+        self.writer = writer
+
+    def __repr__(self) -> str:
+        return f"Shard({self.index})"
+
+
+def shard_url(index: int) -> str:
+    return DATABASE_URL if index == 0 else SHARD_DATABASE_URL.format(shard=index)
+
+
+def open_shard(index: int) -> Shard:
+    """The engine, sessions and writer of a shard, which for shard 0 are the main database's."""
+    if index == 0:
+        return Shard(0, engine, SessionLocal, database_writer)
+    shard_engine = create_engine(shard_url(index), echo=engine.echo, poolclass=NullPool)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+    writer = DatabaseWriter(session_factory, window=WRITER_COMMIT_WINDOW, max_batch=WRITER_MAX_BATCH)
+    return Shard(index, shard_engine, session_factory, writer)
+
+
+# Engines only open their database on first use, and writers start their thread on the first write
+_shards = [open_shard(index) for index in range(SHARD_COUNT)]
+main = _shards[0]
+
+_bound: ContextVar[Shard] = ContextVar("shard", default=None)
+
+
+def every() -> list:
+    return list(_shards)
+
+
+def current() -> Shard:
+    """The shard bound with using(), or shard 0."""
+    return _bound.get() or main
+
+
+@contextmanager
+def using(shard: Shard):
+    """Run the block on a shard."""
+    token = _bound.set(shard)
+    try:
+        yield shard
+    finally:
+        _bound.reset(token)
+
+
+def each() -> Iterator[Shard]:
+    """
+    Bind every shard in turn, for the body of a for loop. Only the bound shard is visited if there is one, so a
+    function that fans out only reads its own shard when it is called from one that already did.
+    """
+    bound = _bound.get()
+    for shard in [bound] if bound else _shards:
+        with using(shard):
+            yield shard
+
+
+# Routing
+
+def for_group(group_id) -> Shard:
+    return _shards[int(group_id) % SHARD_COUNT]
+
+
+def for_user(user_id) -> Shard:
+    return _shards[int(user_id) % SHARD_COUNT]
+
+
+# list_id -> shard index, read through from the home shards. Entries only change when this process moves a list
+_placements = {}
+
+
+def home(list_id) -> Shard:
+    """The shard a debt list was created in, whose local ID its ID encodes, see global_id()."""
+    return _shards[int(list_id) % SHARD_COUNT]
+
+
+def for_list(list_id) -> Shard:
+    """The shard a debt list is in: its home, unless the home recorded that it moved. IDs come from callback data as strings."""
+    if not SHARDED:
+        return main
+    list_id = int(list_id)
+    index = _placements.get(list_id)
+    if index is None:
+        list_home = home(list_id)
+        db = list_home.session_factory()
+        try:
+            index = db.scalar(select(DebtListShard.shard).where(DebtListShard.list_id == list_id))
+        finally:
+            db.close()
+        if index is None:
+            # Never moved, or not an ID this bot handed out, in which case the home finds nothing either
+            index = list_home.index
+        _placements[list_id] = index
+    return _shards[index]
+
+
+def place(list_id: int, shard: Shard) -> None:
+    """
+    Record that a debt list is now in a shard, after it was moved or restored there: in its home, for for_list(), and in
+    the shard itself, for check_placements(). Each record is written on the writer of the shard it is in, so this blocks
+    and is called off the event loop.
+    """
+    if not SHARDED:
+        return
+    for recorder in {home(list_id), shard}:
+        recorder.writer.run(record_placement, list_id, shard.index)
+    _placements[int(list_id)] = shard.index
+
+
+def record_placement(db: Session, list_id: int, index: int) -> None:
+    """Record in the session's shard that a debt list is in shard index, as a write operation that does not commit."""
+    db.execute(
+        sqlite_insert(DebtListShard)
+        .values(list_id=list_id, shard=index)
+        .on_conflict_do_update(index_elements=[DebtListShard.list_id], set_={"shard": index})
+    )
+
+
+def global_id(local_id: int) -> int:
+    """
+    The ID shown to users of a row in the bound shard whose own IDs are only unique per shard, a debt list or a
+    recurring debt list, which also tells which shard handed it out. Without sharding it is the row's own ID.
+    """
+    return local_id * SHARD_COUNT + current().index
+
+
+def check_placements() -> None:
+    """
+    Refuse to start on data that is not where SHARD_COUNT says it is: debt lists recorded in shards beyond the last,
+    debt lists in the shard after the last, or debt lists outside their home that were never recorded where they are,
+    such as every list of an unsharded database once sharding is turned on. Without sharding, only the shard after the
+    last is looked for, which is left over if sharding was turned off without rebalancing.
+
+    Raises:
+        RuntimeError: If the data has to be rebalanced first.
+    """
+    misplaced = False
+    for shard in _shards if SHARDED else ():
+        db = shard.session_factory()
+        try:
+            misplaced = (db.scalar(select(func.max(DebtListShard.shard))) or 0) >= SHARD_COUNT or db.scalar(
+                select(DebtList.list_id)
+                .where(
+                    DebtList.list_id % SHARD_COUNT != shard.index,
+                    ~select(DebtListShard.list_id)
+                    .where(DebtListShard.list_id == DebtList.list_id, DebtListShard.shard == shard.index)
+                    .exists(),
+                )
+                .limit(1)
+            )
+        finally:
+            db.close()
+        if misplaced:
+            break
+    # Looked at with sqlite3 rather than open_shard(), which would set up an engine and a writer for it
+    following = make_url(shard_url(SHARD_COUNT)).database
+    if not misplaced and os.path.exists(following):
+        with closing(sqlite3.connect(following)) as conn:
+            misplaced = conn.execute(f"SELECT 1 FROM {DebtList.__tablename__} LIMIT 1").fetchone()
+    if misplaced:
+        raise RuntimeError(
+            f"The debt lists are not partitioned into {SHARD_COUNT} shard(s), "
+            "stop the bot and run `python -m bot.tools rebalance-shards` first"
+        )
+
+
+# Decorators for the data functions
+
+def route(locate: Callable) -> Callable:
+    """Run on the shard that locate returns when it is called with the function's arguments by name."""
+
+    def decorator(function: Callable) -> Callable:
+        if not SHARDED:
+            return function
+        signature = inspect.signature(function)
+
+        def shard_of(args: tuple, kwargs: dict) -> Shard:
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            return locate(**arguments.arguments)
+
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with using(shard_of(args, kwargs)):
+                    return await function(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with using(shard_of(args, kwargs)):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Run on the shard of the list_id argument, of the group_id argument, or of the group the list is created in if there
+# is one and of its owner otherwise
+by_list = route(lambda list_id, **_: for_list(list_id))
+by_group = route(lambda group_id, **_: for_group(group_id))
+by_owner = route(
+    lambda user_id, group_id=None, **_: for_user(user_id) if group_id is None else for_group(group_id)
+)
+
+
+def by_recurring(function: Callable) -> Callable:
+    """Run on the shard of the recurring_id argument, a global_id(), which the function is given as its shard's ID."""
+    if not SHARDED:
+        return function
+
+    if inspect.iscoroutinefunction(function):
+
+        @functools.wraps(function)
+        async def wrapper(recurring_id: int, *args, **kwargs):
+            local_id, index = divmod(int(recurring_id), SHARD_COUNT)
+            with using(_shards[index]):
+                return await function(local_id, *args, **kwargs)
+
+    else:
+
+        @functools.wraps(function)
+        def wrapper(recurring_id: int, *args, **kwargs):
+            local_id, index = divmod(int(recurring_id), SHARD_COUNT)
+            with using(_shards[index]):
+                return function(local_id, *args, **kwargs)
+
+    return wrapper
+
+
+def fan_out(merge: Callable[[list], object]) -> Callable:
+    """Run on every shard, see each(), and merge the list of results into one."""
+
+    def decorator(function: Callable) -> Callable:
+        if not SHARDED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return merge([function(*args, **kwargs) for _ in each()])
+
+        return wrapper
+
+    return decorator
+
+
+def concat(results: list) -> list:
+    return [item for result in results for item in result]
+
+
+def first(results: list):
+    """The first result that is not empty, or the first one."""
+    return next((result for result in results if result), results[0])
+
+
+def union(results: list) -> dict:
+    merged = {}
+    for result in results:
+        merged.update(result)
+    return merged
@@ -0,0 +1,81 @@
+"""
+Timing of the bot's startup, and the warmup of the in-memory caches the hot paths read before updates are accepted.
+
+Each phase is timed and the breakdown is logged once the bot is ready, so a slow deploy shows which phase got slower.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .database import load_group_memberships, load_inline_index
+from .settings import load_chat_settings
+
+logger = logging.getLogger(__name__)
+
+# Cache name -> the function that fills it from the database
+CACHES = {
+    "open debt lists": load_inline_index,
+    "group memberships": load_group_memberships,
+    "chat settings": load_chat_settings,
+}
+
+
+class StartupTimer:
+    def __init__(self, started: float = None):
+        """
+        Args:
+            started (float, optional): time.perf_counter() when the process started, e.g. before the imports. Defaults
+                to now.
+        """
+        self.started = time.perf_counter() if started is None else started
+        self.phases = []  # (name, seconds)
+        self._last = self.started
+
+    def mark(self, name: str, at: float = None) -> None:
+        """
+        End a phase that started when the previous one ended.
+
+        Args:
+            name (str): The name of the phase.
+            at (float, optional): time.perf_counter() when the phase ended, if it was taken earlier. Defaults to now.
+        """
+        now = time.perf_counter() if at is None else at
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the phase run in the with block."""
+        self._last = time.perf_counter()
+        yield
+        self.mark(name)
+
+    @property
+    def total(self) -> float:
+        return self._last - self.started
+
+    def log_ready(self) -> None:
+        """Log the time from the start to the end of the last phase, and of each phase."""
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases)
+        logger.info("Ready in %.0f ms: %s", self.total * 1000, phases)
+
+
+def warm_caches() -> dict:
+    """
+    Fill every in-memory cache from the database, each in its own thread and connection. SQLite releases the GIL
+    while it reads, so the caches load side by side rather than one after the other.
+
+    Returns:
+        dict: The seconds each cache took to load, by name.
+    """
+
+    def load(loader) -> float:
+        started = time.perf_counter()
+        loader()
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=len(CACHES), thread_name_prefix="warmup") as pool:
+        futures = {name: pool.submit(load, loader) for name, loader in CACHES.items()}
+    return {name: future.result() for name, future in futures.items()}
@@ -0,0 +1,223 @@
+"""
+Maintenance commands for the bot's database. Run with `python -m bot.tools <command>`.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from bot.archive import archive_settled_debt_lists, purge_archived_debt_lists
+from bot.database import check_balances, check_debt_list_counters, initialize_database
+from bot.backup import create_backup, list_backups, restore_backup, set_paths
+from bot.events import snapshot_payload
+from bot.rebalance import rebalance_shards
+from bot.undo import check_event_log, replay_debt_events
+from config.config import (
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_BATCH_PAUSE,
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_RETENTION_DAYS,
+    BACKUP_DIR,
+    BACKUP_KEEP,
+    BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_PAUSE,
+    SHARD_COUNT,
+)
+
+
+def command_check_counters(args: argparse.Namespace) -> int:
+    mismatches = check_debt_list_counters(fix=args.fix)
+    for list_id, stored, actual in mismatches:
+        print(f"Debt list {list_id}: stored {stored}, actual {actual}")
+    if not mismatches:
+        print("All debt list counters are consistent.")
+    elif args.fix:
+        print(f"Fixed {len(mismatches)} debt list(s).")
+    return 1 if mismatches and not args.fix else 0
+
+
+def command_check_balances(args: argparse.Namespace) -> int:
+    mismatches = check_balances(fix=args.fix)
+    for (group_id, creditor_id, debtor_name, currency), stored, actual in mismatches:
+        print(
+            f"Group {group_id}, creditor {creditor_id}, debtor @{debtor_name} ({currency}): stored {stored}, actual {actual}"
+        )
+    if not mismatches:
+        print("The balances rollup matches the debts.")
+    elif args.fix:
+        print(f"Rebuilt the balances rollup, {len(mismatches)} balance(s) were wrong.")
+    return 1 if mismatches and not args.fix else 0
+
+
+def command_archive(args: argparse.Namespace) -> int:
+    archived = archive_settled_debt_lists(
+        args.older_than_days, batch_size=args.batch_size, pause=ARCHIVE_BATCH_PAUSE
+    )
+    print(f"Archived {archived} settled debt list(s).")
+    purged = purge_archived_debt_lists(
+        args.retention_days, batch_size=args.batch_size, pause=ARCHIVE_BATCH_PAUSE
+    )
+    print(f"Purged {purged} archived debt list(s).")
+    return 0
+
+
+def command_replay(args: argparse.Namespace) -> int:
+    if args.verify:
+        problems = check_event_log()
+        for list_id, problem in problems:
+            print(f"Debt list {list_id}: {problem}")
+        if not problems:
+            print("The event log matches the debt lists.")
+        return 1 if problems else 0
+
+    states = replay_debt_events(until=args.until, list_id=args.list_id)
+    for list_id, state in sorted(states.items()):
+        if state["deleted"] and not args.include_deleted:
+            continue
+        payload = {"list_id": list_id, **snapshot_payload(state)}
+        print(json.dumps(payload, ensure_ascii=False))
+    return 0
+
+
+def command_backup(args: argparse.Namespace) -> int:
+    if args.list:
+        for path in list_backups(args.directory):
+            # With sharding on, the size of the whole set
+            size = sum(os.path.getsize(shard_path) for shard_path in set_paths(path) if os.path.exists(shard_path))
+            print(f"{path}  {size} bytes")
+        return 0
+    backup = create_backup(
+        args.directory, args.keep, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE
+    )
+    print(
+        f"Backed up to {backup['path']} in {backup['duration_seconds']:.1f} s, "
+        f"{backup['size_bytes']} bytes compressed to {backup['compressed_bytes']}."
+    )
+    return 0
+
+
+def command_restore(args: argparse.Namespace) -> int:
+    path = args.path or next(iter(list_backups(BACKUP_DIR)), None)
+    if path is None:
+        print(f"There are no backups in {BACKUP_DIR}.")
+        return 1
+    if not args.yes:
+        answer = input(f"Stop the bot first. Replace the database with {path}? [y/N] ")
+        if answer.strip().lower() != "y":
+            return 1
+    restore_backup(path, pages=BACKUP_PAGES_PER_STEP)
+    print(f"Restored the database from {path}.")
+    return 0
+
+
+def command_rebalance_shards(args: argparse.Namespace) -> int:
+    if not args.yes:
+        answer = input(f"Stop the bot first. Move the debt lists into {SHARD_COUNT} shard(s)? [y/N] ")
+        if answer.strip().lower() != "y":
+            return 1
+    moved = rebalance_shards(from_shards=args.from_shards, batch_size=args.batch_size)
+    print(
+        f"Moved {moved['lists']} debt list(s) and {moved['recurring']} recurring debt list(s) "
+        f"into {SHARD_COUNT} shard(s)."
+    )
+    if moved["renumbered"]:
+        print("Recurring debt lists have new IDs, buttons under earlier /repeat messages may stop the wrong one.")
+    for path in moved["unused"]:
+        print(f"{path} is no longer used and can be deleted.")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m bot.tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    check_counters = subparsers.add_parser(
+        "check-counters", help="Verify the unpaid counters stored on debt lists"
+    )
+    check_counters.add_argument(
+        "--fix", action="store_true", help="Overwrite mismatched counters"
+    )
+    check_counters.set_defaults(func=command_check_counters)
+
+    balances = subparsers.add_parser(
+        "check-balances",
+        help="Verify the balances rollup against a full recomputation from debts",
+    )
+    balances.add_argument(
+        "--fix", action="store_true", help="Rebuild the rollup from the debts"
+    )
+    balances.set_defaults(func=command_check_balances)
+
+    archive = subparsers.add_parser(
+        "archive",
+        help="Archive old settled debt lists and purge archived lists past retention now",
+    )
+    archive.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    archive.add_argument("--retention-days", type=int, default=ARCHIVE_RETENTION_DAYS)
+    archive.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    archive.set_defaults(func=command_archive)
+
+    replay = subparsers.add_parser(
+        "replay",
+        help="Rebuild debt lists from the event log, as they are now or at a point in time",
+    )
+    replay.add_argument(
+        "--until", help="Only replay events up to this UTC time, 'YYYY-MM-DD HH:MM:SS'"
+    )
+    replay.add_argument("--list-id", type=int, help="Only replay this debt list")
+    replay.add_argument(
+        "--include-deleted", action="store_true", help="Also print deleted lists"
+    )
+    replay.add_argument(
+        "--verify",
+        action="store_true",
+        help="Compare the replayed state against the database instead of printing it",
+    )
+    replay.set_defaults(func=command_replay)
+
+    backup = subparsers.add_parser(
+        "backup", help="Take an online backup of the database, safe while the bot is running"
+    )
+    backup.add_argument("--directory", default=BACKUP_DIR)
+    backup.add_argument(
+        "--keep", type=int, default=BACKUP_KEEP, help="Backups to keep, 0 keeps all"
+    )
+    backup.add_argument(
+        "--list", action="store_true", help="List the backups instead of taking one"
+    )
+    backup.set_defaults(func=command_backup)
+
+    restore = subparsers.add_parser(
+        "restore", help="Replace the database with a backup, the bot must be stopped"
+    )
+    restore.add_argument("path", nargs="?", help="The backup to restore, defaults to the newest")
+    restore.add_argument("--yes", action="store_true", help="Do not ask for confirmation")
+    restore.set_defaults(func=command_restore)
+
+    rebalance = subparsers.add_parser(
+        "rebalance-shards",
+        help="Move debt lists into the shards SHARD_COUNT asks for, the bot must be stopped",
+    )
+    rebalance.add_argument(
+        "--from-shards",
+        type=int,
+        help="How many shards the data is spread over now, if some beyond SHARD_COUNT do not exist",
+    )
+    rebalance.add_argument("--batch-size", type=int, default=500, help="Debt lists moved per transaction")
+    rebalance.add_argument("--yes", action="store_true", help="Do not ask for confirmation")
+    rebalance.set_defaults(func=command_rebalance_shards)
+
+    args = parser.parse_args()
+    if args.func is not command_restore:
+        # Migrating first would change a database that is about to be replaced
+        initialize_database()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.WARNING,
+    )
+    raise SystemExit(main())
@@ -0,0 +1,232 @@
+"""
+Undoing deletions, and checking the tables against the event log, by replaying the events of bot/events.py.
+"""
+
+from operator import itemgetter
+
+from sqlalchemy import String, literal, select
+from sqlalchemy.orm import Session, joinedload
+
+from . import events, outbox, shards
+from .database import event_batch, get_db, record_event, refresh_inline_index, users_by_handle
+from .models import Debt, DebtEvent, DebtList, normalize_username
+from .writer import after_commit
+
+
+def _live_states_last(results: list) -> dict:
+    # A list that was moved between shards is deleted in the shards it left and alive in the one it is in
+    states = {}
+    for result in results:
+        for list_id, state in result.items():
+            if list_id not in states or states[list_id]["deleted"]:
+                states[list_id] = state
+    return states
+
+
+@shards.fan_out(_live_states_last)
+def replay_debt_events(until: str = None, list_id: int = None) -> dict:
+    """
+    Rebuild the state of debt lists by replaying the event log, of every shard when sharding is on.
+
+    Args:
+        until (str, optional): Only replay events recorded at or before this UTC time, as 'YYYY-MM-DD HH:MM:SS'. Defaults to None, which replays every event.
+        list_id (int, optional): Only replay the events of this list. Defaults to None.
+
+    Returns:
+        dict: list_id -> state, see bot.events.apply_event.
+    """
+    db: Session = next(get_db())
+    query = select(DebtEvent.list_id, DebtEvent.kind, DebtEvent.payload).order_by(
+        DebtEvent.event_id
+    )
+    if until is not None:
+        # created_at is written by SQLite's CURRENT_TIMESTAMP, so compare against the same text format
+        query = query.where(DebtEvent.created_at <= literal(until, String))
+    if list_id is not None:
+        query = query.where(DebtEvent.list_id == list_id)
+    return events.replay(db.execute(query))
+
+
+@shards.fan_out(shards.concat)
+def check_event_log() -> list:
+    """
+    Compare the current debt lists and debts against the state rebuilt from the event log.
+
+    Returns:
+        list: (list_id, problem) for every list where the two disagree.
+    """
+    db: Session = next(get_db())
+    states = {
+        list_id: state
+        for list_id, state in replay_debt_events().items()
+        if not state["deleted"] and not state["archived"]
+    }
+    problems = []
+    for debt_list in db.query(DebtList).options(joinedload(DebtList.debts)):
+        state = states.pop(debt_list.list_id, None)
+        if state is None:
+            problems.append((debt_list.list_id, "missing from the event log"))
+            continue
+        actual = {
+            debt.debt_id: {
+                "name": debt.owed_by_user_name,
+                "amount_minor": debt.amount_minor,
+                "paid": debt.paid,
+            }
+            for debt in debt_list.debts
+        }
+        if actual != state["debts"]:
+            problems.append((debt_list.list_id, "debts differ from the event log"))
+        if (debt_list.group_id, debt_list.is_pending) != (state["group_id"], state["pending"]):
+            problems.append((debt_list.list_id, "group or status differs from the event log"))
+    for list_id in states:
+        problems.append((list_id, "in the event log but not in the database"))
+    return problems
+
+
+def undo_last_deletion(user_id: int) -> list:
+    """
+    Restore the debt lists a user deleted most recently, e.g. with /clear, by replaying their events up to the deletion, on the database writer of each shard. Blocks until they are restored, so it is run off the event loop. Lists deleted together in one batch are restored together. Restored lists keep their IDs and groups, but get new debt IDs and no group message. When sharding is on, the most recent deletion is the latest of every shard's, and a batch is restored in every shard it deleted lists from.
+
+    Args:
+        user_id (int): The ID of the owner.
+
+    Returns:
+        list: The IDs of the restored debt lists, empty if there is nothing to undo.
+    """
+    last = max(_last_deletions(user_id), key=itemgetter(0, 1), default=None)
+    if last is None:
+        return []
+    _, event_id, batch_id, shard = last
+    if batch_id is None:
+        with shards.using(shards.every()[shard]):
+            return _undo_deletions(user_id, event_id=event_id)
+    return _undo_deletions(user_id, batch_id=batch_id)
+
+
+def _undoable_deletions(user_id: int):
+    deletions = DebtEvent.__table__.alias("deletion")
+    # A deletion can still be undone as long as nothing has happened to its list since
+    later_event = (
+        select(DebtEvent.event_id)
+        .where(
+            DebtEvent.list_id == deletions.c.list_id,
+            DebtEvent.event_id > deletions.c.event_id,
+        )
+        .exists()
+    )
+    return select(
+        deletions.c.event_id, deletions.c.list_id, deletions.c.batch_id, deletions.c.created_at
+    ).where(
+        deletions.c.actor_id == user_id,
+        deletions.c.kind == events.LIST_DELETED,
+        ~later_event,
+    )
+
+
+@shards.fan_out(shards.concat)
+def _last_deletions(user_id: int) -> list:
+    # The (created_at, event_id, batch_id, shard) of the user's last deletion that can be undone, if there is one
+    db: Session = next(get_db())
+    undoable = _undoable_deletions(user_id)
+    last = db.execute(undoable.order_by(undoable.selected_columns.event_id.desc()).limit(1)).first()
+    if last is None:
+        return []
+    return [(last.created_at, last.event_id, last.batch_id, shards.current().index)]
+
+
+@shards.fan_out(shards.concat)
+def _undo_deletions(user_id: int, event_id: int = None, batch_id: int = None) -> list:
+    # Restores the lists of one deletion, or of every deletion in a batch, on the bound shard's writer
+    shard = shards.current()
+    with event_batch():
+        restored = shard.writer.run(_restore_deletions, user_id, event_id, batch_id)
+    # Only once the restore is committed, place() waits on the writers itself so it cannot run on one
+    for list_id in restored:
+        shards.place(list_id, shard)
+    return restored
+
+
+def _restore_deletions(db: Session, user_id: int, event_id: int, batch_id: int) -> list:
+    undoable = _undoable_deletions(user_id)
+    if batch_id is None:
+        to_restore = db.execute(undoable.where(undoable.selected_columns.event_id == event_id)).all()
+    else:
+        to_restore = db.execute(undoable.where(undoable.selected_columns.batch_id == batch_id)).all()
+
+    restored = []
+    for deletion in to_restore:
+        state = events.replay(
+            db.execute(
+                select(DebtEvent.list_id, DebtEvent.kind, DebtEvent.payload)
+                .where(
+                    DebtEvent.list_id == deletion.list_id,
+                    DebtEvent.event_id < deletion.event_id,
+                )
+                .order_by(DebtEvent.event_id)
+            )
+        ).get(deletion.list_id)
+        if state is None or state["user_id"] != user_id:
+            continue
+        debt_list = restore_debt_list(db, deletion.list_id, state)
+        db.refresh(debt_list, ["unpaid_count"])
+        if debt_list.group_id is not None and not debt_list.is_pending and debt_list.unpaid_count:
+            outbox.enqueue(db, [outbox.send_debt_list(debt_list.group_id, debt_list.list_id)])
+        after_commit(db, lambda debt_list=debt_list: refresh_inline_index(debt_list))
+        restored.append(deletion.list_id)
+    # Committed by the writer
+    return restored
+
+
+def restore_debt_list(db: Session, list_id: int, state: dict) -> DebtList:
+    # Inserted as pending and confirmed once its debts exist, so the search index triggers see the whole list
+    debt_list = DebtList(
+        list_id=list_id,
+        user_id=state["user_id"],
+        debt_name=state["debt_name"],
+        phone_number=state["phone_number"],
+        currency=state["currency"],
+        group_id=state["group_id"],
+        is_pending=True,
+    )
+    db.add(debt_list)
+    db.flush()
+    names_lower = [normalize_username(debt["name"]) for debt in state["debts"].values()]
+    user_ids = users_by_handle(db, names_lower)
+    restored_debts = [
+        Debt(
+            list_id=list_id,
+            owed_by_user_name=debt["name"],
+            owed_by_user_name_lower=name_lower,
+            owed_by_user_id=user_ids.get(name_lower),
+            amount_minor=debt["amount_minor"],
+            paid=debt["paid"],
+        )
+        for debt, name_lower in zip(state["debts"].values(), names_lower)
+    ]
+    db.add_all(restored_debts)
+    db.flush()
+    debt_list.is_pending = state["pending"]
+    db.flush()
+
+    restored_state = dict(
+        state,
+        archived=False,
+        debts={
+            debt.debt_id: {
+                "name": debt.owed_by_user_name,
+                "amount_minor": debt.amount_minor,
+                "paid": debt.paid,
+            }
+            for debt in restored_debts
+        },
+    )
+    restored_state.pop("deleted")
+    record_event(
+        db,
+        list_id,
+        events.LIST_SNAPSHOT,
+        state["user_id"],
+        **events.snapshot_payload(restored_state),
+    )
+    return debt_list
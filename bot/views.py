@@ -0,0 +1,91 @@
+"""
+Read models: what the read functions of the storage backends return, instead of ORM objects or dicts.
+
+Views are frozen and slotted, so they are small, cannot be changed by whoever renders them, and never lazy load: they
+are built from plain column queries, without the ORM's identity map, and stay valid after the session is gone.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+
+
+@dataclass(frozen=True, slots=True)
+class DebtView:
+    owed_by_user_name: str
+    amount_minor: int
+    paid: bool
+
+
+@dataclass(frozen=True, slots=True)
+class DebtListView:
+    """
+    A debt list, with its debts in the order they were added. Reads that only need the list itself, such as
+    get_open_debt_lists, leave debts as None rather than loading them.
+    """
+
+    list_id: int
+    user_id: int
+    group_id: int
+    debt_name: str
+    phone_number: str
+    currency: str
+    is_pending: bool
+    total_minor: int
+    outstanding_minor: int
+    last_updated: datetime
+    debts: tuple = None
+
+
+@dataclass(frozen=True, slots=True)
+class GroupView:
+    group_id: int
+    group_name: str
+
+
+@dataclass(frozen=True, slots=True)
+class SearchResultView:
+    """A debt list found by /find, which may have been archived, in which case last_updated is when it was settled."""
+
+    list_id: int
+    debt_name: str
+    currency: str
+    total_minor: int
+    outstanding_minor: int
+    archived: bool
+    last_updated: datetime
+
+
+@dataclass(frozen=True, slots=True)
+class RecurringDebtListView:
+    """A debt list posted again on a schedule, with the debts every new list gets, see bot/recurring.py."""
+
+    recurring_id: int
+    user_id: int
+    group_id: int
+    debt_name: str
+    phone_number: str
+    currency: str
+    debts: tuple
+    schedule: str
+    timezone: str
+    next_due: datetime
+
+
+@dataclass(frozen=True, slots=True)
+class GroupStatsView:
+    """
+    A group's analytics for /groupstats: what happened since a day, from the daily rollups, and what is outstanding
+    now, from the balances.
+    """
+
+    lists_sent: int
+    # (currency, debts, amount_minor) of the debts paid
+    paid: tuple
+    # (bucket, debts) of the time the paid debts took, see bot/analytics.py
+    settle_times: tuple
+    # (debtor_name, debts_paid, settle_seconds) of the debtors who took longest to pay on average, slowest first
+    slowest_payers: tuple
+    # (currency, amount_minor) outstanding in the group
+    outstanding: tuple
+    # (debtor_name, currency, amount_minor) of the debtors who owe the most, most first
+    top_debtors: tuple
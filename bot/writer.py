@@ -0,0 +1,145 @@
+"""
+A single thread that owns the database's write path and commits in groups.
+
+SQLite allows one writer at a time, and every commit waits for the disk. Write operations submitted here are run one
+after another on the writer thread, and everything queued within a short window is committed in one transaction, so a
+burst of button presses costs one fsync instead of one each, and writers never fight over the lock.
+
+An operation is a function that takes the writer's session as its first argument and must not commit. If one
+operation of a group fails, the group is rolled back and its operations are run again one by one, so only the failing
+one reports an error.
+"""
+
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from config.config import WRITER_COMMIT_WINDOW, WRITER_MAX_BATCH
+
+from .models import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def after_commit(db: Session, callback: Callable[[], None]) -> None:
+    """Run a callback on the writer thread once the operation calling this has been committed."""
+    db.info.setdefault("after_commit", []).append(callback)
+
+
+class DatabaseWriter:
+    def __init__(self, session_factory=SessionLocal, window: float = 0.005, max_batch: int = 256):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        # Number of groups committed and operations run, to see how well writes are being grouped
+        self.commits = 0
+        self.operations = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, operation: Callable, *args, **kwargs) -> Future:
+        """
+        Queue a write operation.
+
+        Args:
+            operation (Callable): The operation, called as operation(db, *args, **kwargs) on the writer thread.
+
+        Returns:
+            Future: Resolves to what the operation returned once it is committed, or to its exception.
+        """
+        if self._thread is None:
+            self._start()
+        future = Future()
+        # The operation runs with the caller's context variables, e.g. the event batch it is part of
+        self._queue.put((contextvars.copy_context(), operation, args, kwargs, future))
+        return future
+
+    def run(self, operation: Callable, *args, **kwargs):
+        """Queue a write operation and block until it is committed, for callers outside the event loop."""
+        return self.submit(operation, *args, **kwargs).result()
+
+    async def execute(self, operation: Callable, *args, **kwargs):
+        """Queue a write operation and wait until it is committed, without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(operation, *args, **kwargs))
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="database-writer", daemon=True)
+                self._thread.start()
+
+    def _next_group(self) -> list:
+        group = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(group) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                # Once the window is over, still take whatever is already waiting
+                group.append(
+                    self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+        return [item for item in group if item[-1].set_running_or_notify_cancel()]
+
+    def _work(self) -> None:
+        db: Session = self.session_factory()
+        while True:
+            group = self._next_group()
+            if not group:
+                continue
+            try:
+                results = [
+                    context.run(operation, db, *args, **kwargs)
+                    for context, operation, args, kwargs, _ in group
+                ]
+                self._commit(db)
+            except Exception as error:
+                db.rollback()
+                db.info.pop("after_commit", None)
+                if len(group) == 1:
+                    group[0][-1].set_exception(error)
+                else:
+                    logger.warning("A group of %d writes failed, running them one by one", len(group))
+                    for item in group:
+                        self._run_alone(db, item)
+            else:
+                for (*_, future), result in zip(group, results):
+                    future.set_result(result)
+            finally:
+                self.operations += len(group)
+                # Start the next group with an empty identity map, so nothing is read from a stale object
+                db.close()
+
+    def _run_alone(self, db: Session, item: tuple) -> None:
+        context, operation, args, kwargs, future = item
+        try:
+            result = context.run(operation, db, *args, **kwargs)
+            self._commit(db)
+        except Exception as error:
+            db.rollback()
+            db.info.pop("after_commit", None)
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _commit(self, db: Session) -> None:
+        db.commit()
+        self.commits += 1
+        for callback in db.info.pop("after_commit", []):
+            try:
+                callback()
+            except Exception:
+                logger.exception("After-commit callback failed")
+
+
+# Shared by every write that goes through bot/database.py's writer-backed functions
+database_writer = DatabaseWriter(window=WRITER_COMMIT_WINDOW, max_batch=WRITER_MAX_BATCH)
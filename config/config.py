@@ -6,11 +6,138 @@ load_dotenv()
 
 # Bot token from @BotFather
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Bot API server, e.g. http://127.0.0.1:8081 for a local Bot API server or the fake one in benchmarks/. Telegram's
+# own when unset
+BOT_API_URL = os.getenv("BOT_API_URL")
 
 # Database connection URL
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./debt_tracker.db")
+# Optional sharding: with SHARD_COUNT above 1, debt lists and everything that belongs to them are partitioned by group
+# across SHARD_COUNT databases, shard 0 being the one at DATABASE_URL and shard n at SHARD_DATABASE_URL with {shard}
+# replaced by n, see bot/shards.py. Existing data is moved into its shards with `python -m bot.tools rebalance-shards`.
+# It keeps a busy group's bursts from delaying the writes of groups in other shards, it does not raise the total write
+# throughput, which drops a little with every shard added
+SHARD_COUNT = max(int(os.getenv("SHARD_COUNT", "1")), 1)
+SHARD_DATABASE_URL = os.getenv("SHARD_DATABASE_URL", "sqlite:///./debt_tracker.shard{shard}.db")
+# Where users, groups, debt lists and debts are kept: "sqlite" for the database at DATABASE_URL, or "memory" for
+# plain dicts that are lost when the bot exits and are never backed up. With "memory" the database still holds the
+# chat settings, and the archive, outbox prune, rollup and backup jobs and the startup cache warmup only see the
+# database, see bot/repository.py for exactly what each backend covers
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
 
 # Any other configuration variables can be added here
 # For example, enabling logging, specifying log file paths, etc.
 LOGGING_ENABLED = os.getenv("LOGGING_ENABLED", "true").lower() in ["true", "1", "t"]
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH", "./logs/bot.log")
+
+# Currency used for new debt lists, as an ISO 4217 code
+DEFAULT_CURRENCY = os.getenv("DEFAULT_CURRENCY", "SGD").upper()
+
+# Used by users and groups that have not chosen their own with /settings: an IANA time zone, a language of the message
+# catalog and one of utils.money.AMOUNT_STYLES
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Singapore")
+DEFAULT_LOCALE = os.getenv("DEFAULT_LOCALE", "en")
+DEFAULT_AMOUNT_STYLE = os.getenv("DEFAULT_AMOUNT_STYLE", "plain")
+# Message catalog, with the messages of each language
+MESSAGES_FILE = os.getenv(
+    "MESSAGES_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "bot_messages.json"),
+)
+
+# Uploaded debt list documents
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+# Bots can only download files up to 20 MB
+MAX_IMPORT_FILE_SIZE = int(os.getenv("MAX_IMPORT_FILE_SIZE", str(20 * 1024 * 1024)))
+
+# Number of debt lists shown per page of /show
+SHOW_PAGE_SIZE = int(os.getenv("SHOW_PAGE_SIZE", "5"))
+# Number of results shown per page of /find
+FIND_PAGE_SIZE = int(os.getenv("FIND_PAGE_SIZE", "10"))
+
+# Inline mode: the most lists offered per query, and how long Telegram may cache the answer, in seconds
+INLINE_RESULT_LIMIT = int(os.getenv("INLINE_RESULT_LIMIT", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "10"))
+
+# Settled debt lists are moved to the archive after this many days without changes
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# Archived debt lists are deleted after this many days, 0 keeps them forever
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+# Lists moved per transaction, kept small so the write lock is only held briefly
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+# Pause between batches, in seconds, to let other writers in
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.1"))
+ARCHIVE_INTERVAL_HOURS = int(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+
+# Recurring debt lists: how often to look for due ones, in minutes, the hour of the day monthly and weekly ones are due
+# at in their owner's time zone, and the shortest time allowed between two of them, in hours. Occurrences missed while
+# the bot was down are posted when it is back, unless they were due more than RECURRING_CATCH_UP_DAYS ago
+RECURRING_POLL_MINUTES = int(os.getenv("RECURRING_POLL_MINUTES", "5"))
+RECURRING_HOUR = int(os.getenv("RECURRING_HOUR", "9"))
+RECURRING_MIN_INTERVAL_HOURS = int(os.getenv("RECURRING_MIN_INTERVAL_HOURS", "24"))
+RECURRING_CATCH_UP_DAYS = int(os.getenv("RECURRING_CATCH_UP_DAYS", "62"))
+
+# Group analytics: how often the rollups are brought up to date from the event log, in minutes, and how many events
+# are applied per transaction. /groupstats covers the last GROUP_STATS_DAYS days and ranks the GROUP_STATS_TOP slowest
+# payers among the debtors who paid at least GROUP_STATS_MIN_DEBTS debts
+GROUP_STATS_INTERVAL_MINUTES = int(os.getenv("GROUP_STATS_INTERVAL_MINUTES", "10"))
+GROUP_STATS_BATCH_SIZE = int(os.getenv("GROUP_STATS_BATCH_SIZE", "1000"))
+GROUP_STATS_DAYS = int(os.getenv("GROUP_STATS_DAYS", "30"))
+GROUP_STATS_TOP = int(os.getenv("GROUP_STATS_TOP", "5"))
+GROUP_STATS_MIN_DEBTS = int(os.getenv("GROUP_STATS_MIN_DEBTS", "2"))
+
+# Outbox drainer: effects carried out per batch, how often to look for due effects, in seconds, and how many times
+# an effect is tried before it is given up on
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Effects that were carried out or given up on are deleted after this many days, 0 keeps them forever
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+# Guard against floods: a second press of the same button within this many seconds is dropped, and each user may
+# send bursts of RATE_LIMIT_BURST updates, refilled at RATE_LIMIT_PER_SECOND
+CALLBACK_DEDUP_SECONDS = float(os.getenv("CALLBACK_DEDUP_SECONDS", "2"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "1"))
+# How often the guard's counters are logged, in minutes
+GUARD_REPORT_MINUTES = int(os.getenv("GUARD_REPORT_MINUTES", "60"))
+
+# Online backups of the database, of every shard with sharding on: where they go, how often one is taken, in hours, and
+# how many are kept, 0 keeps all
+BACKUP_DIR = os.getenv("BACKUP_DIR", "./backups")
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "28"))
+# Pages copied per step of a backup, and the pause between steps in seconds, which lets the bot write in between
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.05"))
+
+# Writes that go through the database writer thread and arrive within this many seconds of each other are committed
+# together, up to WRITER_MAX_BATCH at a time
+WRITER_COMMIT_WINDOW = float(os.getenv("WRITER_COMMIT_WINDOW", "0.005"))
+WRITER_MAX_BATCH = int(os.getenv("WRITER_MAX_BATCH", "256"))
+# Updates handled at the same time, so that writes from different users can be committed together
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+
+# HTTP connections to the Bot API. Sends, edits and answers share one pool, long polling for updates has its own, so a
+# burst of sends never delays fetching updates. Timeouts are in seconds, the pool timeout is how long a request may
+# wait for a free connection.
+# The sizes are the ones ApplicationBuilder gives the two pools when it builds them itself, not HTTPXRequest's own
+# default of 1. One connection would make every send wait for the one before it: the outbox drainer sends up to
+# OUTBOX_BATCH_SIZE effects at once and up to CONCURRENT_UPDATES handlers answer at the same time, while 256 leaves
+# room for both with connections only opened as they are needed. Long polling only ever has one request in flight
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "1"))
+GET_UPDATES_POOL_SIZE = int(os.getenv("GET_UPDATES_POOL_SIZE", "1"))
+GET_UPDATES_CONNECT_TIMEOUT = float(os.getenv("GET_UPDATES_CONNECT_TIMEOUT", "5"))
+# Added to the long polling timeout, which PTB adds on top
+GET_UPDATES_READ_TIMEOUT = float(os.getenv("GET_UPDATES_READ_TIMEOUT", "5"))
+GET_UPDATES_WRITE_TIMEOUT = float(os.getenv("GET_UPDATES_WRITE_TIMEOUT", "5"))
+GET_UPDATES_POOL_TIMEOUT = float(os.getenv("GET_UPDATES_POOL_TIMEOUT", "1"))
+# HTTP/2 needs python-telegram-bot[http2]
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "false").lower() in ["true", "1", "t"]
+# Seconds an idle connection is kept open for reuse, 0 turns keep-alive off
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", "5"))
+# How often the connection pools' metrics are logged, in minutes
+REQUEST_METRICS_MINUTES = int(os.getenv("REQUEST_METRICS_MINUTES", "60"))
@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+import pytest
+
+# utils.utils imports bot.database, which opens the database at DATABASE_URL, keep it out of the working directory
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+
+
+@pytest.fixture
+def fresh_database(tmp_path, monkeypatch):
+    """
+    An empty database of the current schema for one test, with a writer of its own and the in-memory caches that
+    mirror the database emptied. Tests run unsharded, so this is shard 0.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+
+    from bot import database, settings, shards
+    from bot.inline_index import open_debt_lists_index
+    from bot.membership import group_memberships
+    from bot.models import SessionLocal
+    from bot.writer import DatabaseWriter
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", poolclass=NullPool)
+    previous_bind = SessionLocal.kw["bind"]
+    SessionLocal.configure(bind=engine)
+    monkeypatch.setattr(shards.main, "engine", engine)
+    # The writer's session is bound when its thread starts, so every test needs a writer of its own
+    monkeypatch.setattr(shards.main, "writer", DatabaseWriter(SessionLocal, window=0.001))
+    monkeypatch.setattr(shards, "_placements", {})
+    monkeypatch.setattr(database, "_saved_users", {})
+    monkeypatch.setattr(group_memberships, "_members", {})
+    monkeypatch.setattr(settings, "_cache", {})
+    monkeypatch.setattr(settings, "_loaded", False)
+    open_debt_lists_index.load([])
+    database.initialize_database()
+    yield engine
+    SessionLocal.configure(bind=previous_bind)
+    engine.dispose()
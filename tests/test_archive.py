@@ -0,0 +1,83 @@
+"""
+Tests of bot/archive.py: settled lists are moved to archived_debt_lists in batches, and archived lists are purged once
+they are past the retention period.
+"""
+
+import asyncio
+
+from sqlalchemy import func, update
+
+from bot import archive, database
+from bot.archive import archive_settled_debt_lists, purge_archived_debt_lists
+from bot.database import get_db
+from bot.models import ArchivedDebtList, Debt, DebtList
+
+
+async def send_list(debt_name: str, debts: list) -> int:
+    list_id = await database.add_debt_list(1, debt_name, "98765432", debts=debts)
+    await database.update_debt_list_status(list_id, False)
+    assert await database.update_debt_list_group(list_id, -100)
+    return list_id
+
+
+def backdate(column, list_ids: list, days: int) -> None:
+    db = next(get_db())
+    db.execute(
+        update(column.class_)
+        .where(column.class_.list_id.in_(list_ids))
+        .values({column.key: func.datetime("now", f"-{days} days")})
+    )
+    db.commit()
+
+
+def test_settled_lists_are_archived_in_batches_and_purged_after_retention(fresh_database, monkeypatch):
+    async def scenario():
+        await database.add_or_update_user(1, "alice", "Alice", None)
+        await database.add_or_update_user(2, "bob", "Bob", None)
+        await database.add_or_update_group(-100, "Flat", "group")
+        settled = []
+        for number in range(5):
+            list_id = await send_list(f"Dinner {number}", [("bob", 100 * (number + 1))])
+            await database.update_debt_status(list_id, 2, "bob", True)
+            settled.append(list_id)
+        recently_settled = await send_list("Lunch", [("bob", 700)])
+        await database.update_debt_status(recently_settled, 2, "bob", True)
+        still_open = await send_list("Taxi", [("bob", 300), ("carol", 300)])
+        await database.update_debt_status(still_open, 2, "bob", True)
+        draft = await database.add_debt_list(1, "Draft", "98765432", debts=[("bob", 100)])
+        return settled, [recently_settled, still_open, draft]
+
+    settled, kept = asyncio.run(scenario())
+    # Only the open list and the draft are as old as the settled lists, the other settled list is recent
+    backdate(DebtList.last_updated, settled + kept[1:], 10)
+
+    batches = []
+    archive_batch = archive._archive_settled_batch
+
+    def counted_batch(*args):
+        batches.append(archive_batch(*args))
+        return batches[-1]
+
+    monkeypatch.setattr(archive, "_archive_settled_batch", counted_batch)
+    assert archive_settled_debt_lists(7, batch_size=2, pause=0) == 5
+    # The last batch is short, which ends the sweep
+    assert batches == [2, 2, 1]
+    assert archive_settled_debt_lists(7, batch_size=2, pause=0) == 0
+
+    db = next(get_db())
+    assert sorted(list_id for (list_id,) in db.query(DebtList.list_id)) == sorted(kept)
+    assert db.query(Debt).filter(Debt.list_id.in_(settled)).count() == 0
+    archived = {row.list_id: row for row in db.query(ArchivedDebtList)}
+    assert sorted(archived) == settled
+    assert [archived[list_id].total_minor for list_id in settled] == [100, 200, 300, 400, 500]
+    assert database.get_debt_list_totals(kept[1]) == (600, 300)
+
+    # Only the lists archived before the cutoff are purged, in batches
+    backdate(ArchivedDebtList.archived_at, settled[:3], 40)
+    backdate(ArchivedDebtList.archived_at, settled[3:4], 20)
+    assert purge_archived_debt_lists(0, batch_size=2, pause=0) == 0
+    assert purge_archived_debt_lists(30, batch_size=2, pause=0) == 3
+
+    db = next(get_db())
+    assert sorted(list_id for (list_id,) in db.query(ArchivedDebtList.list_id)) == settled[3:]
+    assert sorted(list_id for (list_id,) in db.query(DebtList.list_id)) == sorted(kept)
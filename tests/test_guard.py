@@ -0,0 +1,147 @@
+"""
+Tests of the duplicate press and rate limit checks of bot/guard.py, with explicit times, and of the handler that runs
+them before every other handler.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+from bot.guard import CallbackDeduplicator, TokenBucket, counters
+from bot.handlers import guard_handlers
+from bot.messages import render
+
+
+def test_a_second_press_within_the_window_is_a_duplicate():
+    deduplicator = CallbackDeduplicator(window=2)
+
+    assert not deduplicator.is_duplicate(1, "pay:7", now=100)
+    assert deduplicator.is_duplicate(1, "pay:7", now=101.9)
+    # Another button, or another user pressing the same one, is not
+    assert not deduplicator.is_duplicate(1, "unpay:7", now=101.9)
+    assert not deduplicator.is_duplicate(2, "pay:7", now=101.9)
+
+
+def test_a_press_after_the_window_is_let_through():
+    deduplicator = CallbackDeduplicator(window=2)
+
+    assert not deduplicator.is_duplicate(1, "pay:7", now=100)
+    assert not deduplicator.is_duplicate(1, "pay:7", now=102)
+    assert deduplicator.is_duplicate(1, "pay:7", now=103)
+
+
+def test_a_burst_is_allowed_then_throttled_until_tokens_come_back():
+    bucket = TokenBucket(capacity=3, refill_per_second=0.5)
+    now = time.monotonic()
+
+    assert [bucket.allow(1, now=now) for _ in range(3)] == [True, True, True]
+    assert not bucket.allow(1, now=now)
+    # Other users have buckets of their own
+    assert bucket.allow(2, now=now)
+    # One token is back after two seconds, and only one
+    assert bucket.allow(1, now=now + 2)
+    assert not bucket.allow(1, now=now + 2)
+    # The bucket never fills beyond its capacity
+    assert [bucket.allow(1, now=now + 100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_buckets_that_refilled_are_forgotten():
+    bucket = TokenBucket(capacity=2, refill_per_second=1)
+    now = time.monotonic()
+
+    bucket.allow(1, now=now)
+    bucket.allow(2, now=now + 1.5)
+    bucket.allow(3, now=now + 3)
+
+    assert set(bucket._buckets) == {2, 3}
+    # A forgotten user starts again with a full bucket
+    assert [bucket.allow(1, now=now + 3) for _ in range(3)] == [True, True, False]
+
+
+class FakeCallbackQuery:
+    def __init__(self, data: str):
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text: str = None):
+        self.answers.append(text)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text: str):
+        self.replies.append(text)
+
+
+def fake_update(user_id: int, callback_query=None, message=None, chat_type: str = "private"):
+    chat = SimpleNamespace(id=user_id, type=chat_type, PRIVATE="private")
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=chat,
+        callback_query=callback_query,
+        message=message,
+    )
+
+
+@pytest.fixture
+def guard(monkeypatch):
+    """The guard handler with checks and counters of its own, which allow two updates per user and never refill."""
+    monkeypatch.setattr(guard_handlers, "callback_deduplicator", CallbackDeduplicator(window=60))
+    monkeypatch.setattr(guard_handlers, "rate_limiter", TokenBucket(capacity=2, refill_per_second=1e-9))
+    monkeypatch.setattr(guard_handlers, "_warned_users", set())
+    saved = counters.copy()
+    counters.clear()
+    yield guard_handlers.handle_guard_update
+    counters.clear()
+    counters.update(saved)
+
+
+def test_a_duplicate_press_is_stopped_and_counted(guard):
+    first, second = FakeCallbackQuery("pay:7"), FakeCallbackQuery("pay:7")
+
+    asyncio.run(guard(fake_update(1, callback_query=first), None))
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(guard(fake_update(1, callback_query=second), None))
+
+    assert first.answers == []
+    assert second.answers == [None]
+    assert counters == {"updates": 2, "allowed": 1, "duplicate_callbacks": 1}
+
+
+def test_a_throttled_press_is_stopped_and_answered(guard):
+    asyncio.run(guard(fake_update(1, callback_query=FakeCallbackQuery("pay:7")), None))
+    asyncio.run(guard(fake_update(1, callback_query=FakeCallbackQuery("unpay:7")), None))
+    third = FakeCallbackQuery("pay:8")
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(guard(fake_update(1, callback_query=third), None))
+
+    assert third.answers == [render("throttledPress")]
+    assert counters == {"updates": 3, "allowed": 2, "throttled": 1}
+
+
+def test_a_throttled_private_chat_is_warned_once(guard):
+    messages = [FakeMessage() for _ in range(5)]
+    for message in messages[:2]:
+        asyncio.run(guard(fake_update(1, message=message), None))
+    for message in messages[2:]:
+        with pytest.raises(ApplicationHandlerStop):
+            asyncio.run(guard(fake_update(1, message=message), None))
+
+    assert [message.replies for message in messages] == [[], [], [render("throttledMessage")], [], []]
+    assert counters == {"updates": 5, "allowed": 2, "throttled": 3}
+
+
+def test_a_throttled_group_message_is_dropped_silently(guard):
+    messages = [FakeMessage() for _ in range(3)]
+    for message in messages[:2]:
+        asyncio.run(guard(fake_update(1, message=message, chat_type="group"), None))
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(guard(fake_update(1, message=messages[2], chat_type="group"), None))
+
+    assert all(message.replies == [] for message in messages)
+    assert counters["throttled"] == 1
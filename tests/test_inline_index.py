@@ -0,0 +1,93 @@
+"""
+Tests of the prefix index behind inline queries, bot/inline_index.py, on its own and as the database keeps it up to date
+when lists are sent, settled, reopened, deleted and restored.
+"""
+
+import asyncio
+
+from bot import database
+from bot.inline_index import DebtListPrefixIndex, open_debt_lists_index
+from bot.undo import undo_last_deletion
+
+
+def test_every_word_of_the_query_is_a_prefix_of_a_word_of_the_name():
+    index = DebtListPrefixIndex()
+    index.load([(1, 10, "Dinner at Ameen's"), (2, 10, "Late-night taxi"), (3, 10, "dinner"), (4, 20, "Dinner")])
+
+    assert index.search(10, "") == [3, 2, 1]
+    assert index.search(10, "DIN") == [3, 1]
+    assert index.search(10, "din am") == [1]
+    assert index.search(10, "am din") == [1]
+    assert index.search(10, "night TAX") == [2]
+    assert index.search(10, "inner") == []
+    assert index.search(10, "dinner taxi") == []
+    assert index.search(10, "din", limit=1) == [3]
+    assert index.search(20, "din") == [4]
+    assert index.search(30, "") == []
+
+
+def test_adding_a_list_again_replaces_its_words():
+    index = DebtListPrefixIndex()
+    index.add(1, 10, "Dinner")
+    index.add(2, 10, "Taxi")
+    index.add(1, 10, "Lunch")
+
+    assert index.search(10, "din") == []
+    assert index.search(10, "lun") == [1]
+    assert index.search(10, "") == [2, 1]
+
+    index.remove(1)
+    index.remove(1)
+    assert index.search(10, "") == [2]
+    index.remove(2)
+    assert index.search(10, "") == []
+
+
+async def send_list(debt_name: str, debts: list) -> int:
+    list_id = await database.add_debt_list(1, debt_name, "98765432", debts=debts)
+    await database.update_debt_list_status(list_id, False)
+    assert await database.update_debt_list_group(list_id, -100)
+    return list_id
+
+
+def test_the_database_keeps_the_index_to_the_open_lists(fresh_database):
+    def offered(query: str = "") -> list:
+        return open_debt_lists_index.search(1, query)
+
+    async def scenario():
+        await database.add_or_update_user(1, "alice", "Alice", None)
+        await database.add_or_update_user(2, "bob", "Bob", None)
+        await database.add_or_update_group(-100, "Flat", "group")
+        dinner = await send_list("Dinner", [("bob", 1_500), ("carol", 500)])
+        taxi = await send_list("Late taxi", [("bob", 300)])
+        draft = await database.add_debt_list(1, "Dinner draft", "98765432", debts=[("bob", 100)])
+        assert offered() == [taxi, dinner]
+        assert offered("din") == [dinner]
+
+        # Paying one of two debts leaves the list open, settling it takes it out
+        await database.update_debt_status(dinner, 2, "bob", True)
+        assert offered("din") == [dinner]
+        await database.update_debt_status(dinner, 9, "carol", True)
+        assert offered("din") == []
+        await database.update_debt_status(dinner, 2, "bob", False)
+        assert offered("din") == [dinner]
+
+        await database.delete_debt_list(taxi)
+        assert offered() == [dinner]
+        assert await asyncio.to_thread(undo_last_deletion, 1) == [taxi]
+        assert offered("tax") == [taxi]
+
+        await database.clear_debt_lists(1)
+        assert offered() == []
+        assert sorted(await asyncio.to_thread(undo_last_deletion, 1)) == [dinner, taxi, draft]
+        return dinner, taxi
+
+    dinner, taxi = asyncio.run(scenario())
+    assert offered() == [taxi, dinner]
+
+    # What is loaded at startup is what was kept up to date
+    open_debt_lists_index.load([])
+    assert sorted(database._open_debt_list_entries()) == [(dinner, 1, "Dinner"), (taxi, 1, "Late taxi")]
+    database.load_inline_index()
+    assert offered() == [taxi, dinner]
+    assert offered("late") == [taxi]
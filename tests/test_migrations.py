@@ -0,0 +1,80 @@
+"""
+Tests of the schema checksum of bot/migrations.py, which lets startup skip inspecting a database that the running code
+brought up to date, and of how _initialize_schema migrates one that it did not.
+"""
+
+import pytest
+from sqlalchemy import inspect
+
+from bot import migrations
+from bot.database import _initialize_schema
+from bot.migrations import MIGRATIONS, is_schema_current, schema_checksum, stamp_schema_checksum
+from bot.models import ArchivedDebtList
+
+
+def pragma(engine, name: str) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def set_pragma(engine, name: str, value: int) -> None:
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+
+
+@pytest.fixture
+def migrations_run(monkeypatch) -> list:
+    """The engines run_migrations is called with, it still migrates them."""
+    calls = []
+    run_migrations = migrations.run_migrations
+
+    def counted(engine):
+        calls.append(engine)
+        run_migrations(engine)
+
+    monkeypatch.setattr(migrations, "run_migrations", counted)
+    return calls
+
+
+def test_a_stamped_database_is_current(fresh_database, migrations_run):
+    assert pragma(fresh_database, "user_version") == len(MIGRATIONS)
+    assert pragma(fresh_database, "application_id") == schema_checksum()
+    assert is_schema_current(fresh_database)
+
+    _initialize_schema(fresh_database)
+    assert migrations_run == []
+
+
+def test_a_changed_schema_is_not_current_until_stamped(fresh_database, monkeypatch):
+    monkeypatch.setattr(
+        migrations,
+        "SEARCH_INDEX_DDL",
+        migrations.SEARCH_INDEX_DDL + ["CREATE INDEX IF NOT EXISTS ix_test ON debt_lists (debt_name)"],
+    )
+    assert not is_schema_current(fresh_database)
+
+    stamp_schema_checksum(fresh_database)
+    assert is_schema_current(fresh_database)
+
+
+def test_a_missing_stamp_or_migration_is_not_current(fresh_database):
+    set_pragma(fresh_database, "application_id", 0)
+    assert not is_schema_current(fresh_database)
+
+    stamp_schema_checksum(fresh_database)
+    set_pragma(fresh_database, "user_version", len(MIGRATIONS) - 1)
+    assert not is_schema_current(fresh_database)
+
+
+def test_a_database_that_is_not_current_is_migrated_and_stamped(fresh_database, migrations_run):
+    # A table added to the models without a migration, and a migration the database has not had yet
+    ArchivedDebtList.__table__.drop(fresh_database)
+    set_pragma(fresh_database, "application_id", 0)
+    set_pragma(fresh_database, "user_version", len(MIGRATIONS) - 1)
+
+    _initialize_schema(fresh_database)
+
+    assert migrations_run == [fresh_database]
+    assert inspect(fresh_database).has_table(ArchivedDebtList.__tablename__)
+    assert pragma(fresh_database, "user_version") == len(MIGRATIONS)
+    assert is_schema_current(fresh_database)
@@ -0,0 +1,44 @@
+"""
+Tests of the transactional outbox: the side effects a change queues in its own transaction, and how the drainer's
+outcomes are written back, see bot/outbox.py and finish_outbox_messages in bot/database.py.
+"""
+
+import asyncio
+
+from bot import database, outbox
+
+
+def sent_list(group_id: int = -100) -> int:
+    async def create() -> int:
+        list_id = await database.add_debt_list(1, "dinner", "98765432", debts=[("bob", 1_000), ("carol", 2_000)])
+        await database.update_debt_list_status(list_id, False)
+        assert await database.update_debt_list_group(list_id, group_id)
+        return list_id
+
+    return asyncio.run(create())
+
+
+def due(action: str = None) -> list:
+    return [
+        side_effect
+        for side_effect in database.get_due_outbox_messages(100)
+        if action is None or side_effect["action"] == action
+    ]
+
+
+def finish(outcomes: list, max_attempts: int = 3) -> None:
+    asyncio.run(database.finish_outbox_messages(outcomes, max_attempts))
+
+
+def test_second_send_press_is_rejected(fresh_database):
+    list_id = sent_list(-100)
+
+    # Pressed again, for the same group and for another one, before and after the first message went out
+    assert not asyncio.run(database.update_debt_list_group(list_id, -100))
+    assert not asyncio.run(database.update_debt_list_group(list_id, -200))
+    [send] = due(outbox.SEND_DEBT_LIST)
+    finish([(send, ("done", 555))])
+    assert not asyncio.run(database.update_debt_list_group(list_id, -200))
+
+    assert due() == []
+    assert database.get_debt_list_message_info(list_id) == (-100, 555)
@@ -0,0 +1,217 @@
+"""
+Property and fuzz tests for parse_debt_list: random lists are generated together with the debts they stand for, and
+random garbage must be rejected with a report rather than an exception. Each test runs many seeded cases, so a failure
+names the seed that reproduces it.
+"""
+
+import random
+import re
+import string
+from decimal import ROUND_HALF_UP, Decimal
+
+import pytest
+
+from bot.messages import MessageTemplate
+from bot.settings import Settings
+from utils.money import MAX_AMOUNT_MINOR
+from utils.utils import MAX_REPORTED_ERRORS, parse_debt_list
+
+CASES = 300
+HEADER = "Dinner\n98765432\n"
+MODIFIERS = [
+    ("+10% service charge", Decimal("1.1")),
+    ("+9% GST", Decimal("1.09")),
+    ("-5% discount", Decimal("0.95")),
+    ("- 50 %", Decimal("0.5")),
+    ("x1.09", Decimal("1.09")),
+    ("*2", Decimal(2)),
+    ("×0.5", Decimal("0.5")),
+]
+
+
+def random_list(rng: random.Random) -> tuple:
+    """
+    A valid debt list, the (handle, amount in minor units) debts it should parse into, and whether its discounts round
+    an amount away to zero, which is rejected.
+    """
+    names = [f"user{number}" for number in range(rng.randint(1, 12))]
+    lines = []
+    amounts = {}
+    spellings = {}
+    multiplier = Decimal(1)
+
+    def owe(handle: str, amount_minor: int) -> None:
+        spellings.setdefault(handle.casefold(), handle)
+        amounts[handle.casefold()] = amounts.get(handle.casefold(), 0) + amount_minor
+
+    for _ in range(rng.randint(1, 30)):
+        kind = rng.random()
+        amount_minor = rng.randint(1, 1_000_000)
+        amount = f"{amount_minor // 100}.{amount_minor % 100:02d}"
+        handles = [rng.choice([name, name.upper(), name.title()]) for name in rng.sample(names, rng.randint(1, len(names)))]
+        if kind < 0.5:
+            lines.append(f"@{handles[0]} {amount}")
+            owe(handles[0], amount_minor)
+        elif kind < 0.7:
+            lines.append(" ".join(f"@{handle}" for handle in handles) + f" {amount}")
+            for handle in handles:
+                owe(handle, amount_minor)
+        elif kind < 0.9:
+            lines.append(" ".join(f"@{handle}" for handle in handles) + f" {amount} " + rng.choice(["/split", "/SPLIT"]))
+            share, remainder = divmod(amount_minor, len(handles))
+            for index, handle in enumerate(handles):
+                owe(handle, share + (1 if index < remainder else 0))
+        else:
+            line, modifier = rng.choice(MODIFIERS)
+            lines.append(line)
+            multiplier *= modifier
+        if rng.random() < 0.1:
+            lines.append(rng.choice(["", "   "]))
+    if not amounts:
+        lines.append(f"@{names[0]} 1")
+        owe(names[0], 100)
+
+    debts = []
+    rounded_away = False
+    for key, amount_minor in amounts.items():
+        scaled_minor = int((amount_minor * multiplier).to_integral_value(ROUND_HALF_UP))
+        rounded_away |= scaled_minor <= 0 < amount_minor
+        debts.append((spellings[key], scaled_minor))
+    return HEADER + "\n".join(lines), debts, rounded_away
+
+
+def report_count(message: str) -> int:
+    return int(re.match(r"Found (\d+) problem", message).group(1))
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_valid_lists_parse_into_their_debts(seed):
+    text, debts, rounded_away = random_list(random.Random(seed))
+    success, result = parse_debt_list(text)
+    if rounded_away:
+        assert not success
+        return
+    assert success, result
+    assert result == ("Dinner", "98765432", debts)
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_split_shares_add_up_and_differ_by_at_most_one(seed):
+    rng = random.Random(seed)
+    handles = [f"user{number}" for number in range(rng.randint(1, 20))]
+    amount_minor = rng.randint(0, 10**9)
+    text = HEADER + " ".join(f"@{handle}" for handle in handles) + f" {amount_minor / 100:.2f} /split"
+    success, (_, _, debts) = parse_debt_list(text)
+    assert success
+    shares = [share for _, share in debts]
+    assert [handle for handle, _ in debts] == handles
+    assert sum(shares) == amount_minor
+    assert max(shares) - min(shares) <= 1
+    assert shares == sorted(shares, reverse=True)
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_every_bad_line_is_reported(seed):
+    rng = random.Random(seed)
+    text, _, _ = random_list(rng)
+    lines = text.split("\n")
+    bad_lines = [
+        "user1 10",
+        "@user1",
+        "@user1 ten",
+        "@user1 10 20",
+        "@user1 -10",
+        "@user1 1.234",
+        "@ 10",
+        "+10",
+        "service charge",
+        "-100% everything",
+        "x0",
+    ]
+    bad = sorted(rng.sample(range(2, len(lines) + 1), rng.randint(1, min(len(lines) - 1, 30))))
+    for offset, position in enumerate(bad):
+        lines.insert(position + offset, rng.choice(bad_lines))
+    success, message = parse_debt_list("\n".join(lines))
+    assert not success
+    numbers = [
+        line_number for line_number, line in enumerate(lines, start=1) if line in bad_lines and line_number > 2
+    ]
+    assert report_count(message) >= len(numbers)
+    for line_number in numbers[:MAX_REPORTED_ERRORS]:
+        assert f"Line {line_number}:" in message
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_garbage_is_rejected_or_parsed_without_raising(seed):
+    rng = random.Random(seed)
+    alphabet = string.printable + "@%×/@@@@      éß€😀​"
+    text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 400)))
+    success, result = parse_debt_list(text)
+    if success:
+        _, phone_number, debts = result
+        assert phone_number.isdigit()
+        assert debts
+        assert all(0 <= amount_minor < MAX_AMOUNT_MINOR for _, amount_minor in debts)
+    else:
+        assert isinstance(result, str) and result
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_mutated_lists_never_raise(seed):
+    rng = random.Random(seed)
+    text, _, _ = random_list(rng)
+    characters = list(text)
+    for _ in range(rng.randint(1, 10)):
+        position = rng.randrange(len(characters))
+        action = rng.random()
+        if action < 0.4:
+            del characters[position]
+        elif action < 0.8:
+            characters.insert(position, rng.choice("@%x*/.-+ \n0123456789abc"))
+        else:
+            characters[position] = rng.choice("@\n ")
+    success, result = parse_debt_list("".join(characters))
+    assert isinstance(success, bool)
+    if success:
+        assert all(0 <= amount_minor < MAX_AMOUNT_MINOR for _, amount_minor in result[2])
+
+
+@pytest.mark.parametrize("modifier", ["-100%", "-100% discount", "-150%", "x0", "*0.0", "- 200 %"])
+def test_modifiers_that_bring_amounts_to_zero_or_below_are_rejected(modifier):
+    success, message = parse_debt_list(f"{HEADER}@a 10\n{modifier}")
+    assert not success
+    assert "Line 4:" in message and "zero or below" in message
+
+
+def test_two_negative_modifiers_do_not_cancel_out():
+    success, message = parse_debt_list(f"{HEADER}@a 10\n-150%\n-150%")
+    assert not success
+    assert report_count(message) == 2
+
+
+def test_a_modifier_that_rounds_an_amount_to_zero_is_rejected():
+    success, message = parse_debt_list(f"{HEADER}@a 0.01\n@b 10\n-90%")
+    assert not success
+    assert "@a to zero" in message
+    # An amount that was zero to begin with stays allowed
+    assert parse_debt_list(f"{HEADER}@a 0\n@b 10\n-90%") == (True, ("Dinner", "98765432", [("a", 0), ("b", 100)]))
+
+
+def test_too_large_amounts_are_reported_with_the_other_problems():
+    success, message = parse_debt_list(f"{HEADER}@a 9999999999999\nx1000\nnonsense")
+    assert not success
+    assert report_count(message) == 2
+    assert "too large" in message and "Line 5:" in message
+
+
+def test_problems_are_reported_in_the_chat_language():
+    settings = Settings("UTC", "en", "plain")
+    settings.messages = dict(
+        settings.messages,
+        listProblems=MessageTemplate("{count} Fehler in deiner Liste:"),
+        listLine=MessageTemplate("Zeile {number}: {problem}"),
+        amountNotNumber=MessageTemplate("'{text}' ist keine Zahl"),
+    )
+    success, message = parse_debt_list(f"{HEADER}@a zehn", settings=settings)
+    assert not success
+    assert message == "1 Fehler in deiner Liste:\n\nZeile 3: 'zehn' ist keine Zahl"
@@ -0,0 +1,502 @@
+"""
+Tests that run the SQL and the memory backend of bot/repository.py through the same scenarios, which must give the same
+results and queue the same side effects, and tests of what only the SQL backend can run into, such as databases
+migrated from older versions.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bot import database
+from bot.analytics import update_group_stats
+from bot.database import get_db
+from bot.migrations import _migrate_ambiguous_usernames
+from bot.models import Debt, OutboxMessage, User
+from bot.repository import MemoryRepository, SqlRepository, create_repository
+from bot.views import GroupStatsView
+
+
+@pytest.fixture(params=["memory", "sql"])
+def repository(request):
+    if request.param == "memory":
+        return MemoryRepository()
+    request.getfixturevalue("fresh_database")
+    return SqlRepository()
+
+
+def queued(repository) -> list:
+    # (action, chat_id, list_id) of every side effect queued so far, in order
+    if isinstance(repository, MemoryRepository):
+        side_effects = repository.side_effects
+    else:
+        side_effects = next(get_db()).query(OutboxMessage).order_by(OutboxMessage.outbox_id)
+        side_effects = [{"action": row.action, "chat_id": row.chat_id, "list_id": row.list_id} for row in side_effects]
+    return [(side_effect["action"], side_effect["chat_id"], side_effect["list_id"]) for side_effect in side_effects]
+
+
+async def setup_group(repository) -> None:
+    await repository.add_or_update_user(1, "alice", "Alice", None)
+    await repository.add_or_update_user(2, "Bob", "Bob", None)
+    await repository.add_or_update_user(3, None, "Carol", None)
+    await repository.add_or_update_group(-100, "Flat", "group")
+    for user_id in (1, 2, 3):
+        await repository.associate_user_with_group(user_id, -100)
+
+
+async def send_list(repository, user_id: int, debts: list, group_id: int = -100) -> int:
+    list_id = await repository.add_debt_list(user_id, "dinner", "98765432", debts=debts)
+    await repository.update_debt_list_status(list_id, False)
+    assert await repository.update_debt_list_group(list_id, group_id)
+    return list_id
+
+
+def test_debt_list_round_trip(repository):
+    async def scenario():
+        await setup_group(repository)
+        list_id = await send_list(repository, 1, [("bob", 1_500), ("@dan", 500)])
+        await repository.add_or_update_debt(list_id, "Dan", 700)
+        return list_id
+
+    list_id = asyncio.run(scenario())
+
+    info = repository.get_debt_list_info(list_id)
+    assert (info.user_id, info.group_id, info.is_pending) == (1, -100, False)
+    assert [(debt.owed_by_user_name, debt.amount_minor, debt.paid) for debt in info.debts] == [
+        ("bob", 1_500, False),
+        ("Dan", 700, False),
+    ]
+    assert repository.get_debt_list_totals(list_id) == (2_200, 2_200)
+    assert repository.get_debt_lists_by_user_id(1) == [list_id]
+    assert repository.user_has_pending_debt_list(1) == 0
+    assert repository.get_user_groups(2)[0].group_name == "Flat"
+    assert queued(repository) == [("send_list", -100, list_id)]
+
+
+def test_paying_every_debt_settles_the_list(repository):
+    async def scenario():
+        await setup_group(repository)
+        list_id = await send_list(repository, 1, [("bob", 1_500), ("carol", 500)])
+        results = [
+            await repository.update_debt_status(list_id, 2, "Bob", True),
+            await repository.update_debt_status(list_id, 4, "erin", True),
+        ]
+        assert repository.get_debt_status(list_id, 2, "Bob") == (True, True)
+        assert repository.get_debt_list_totals(list_id) == (2_000, 500)
+        # Carol has no handle, her debt was written for one she does not have
+        results.append(await repository.update_debt_status(list_id, 3, None, True))
+        results.append(await repository.update_debt_status(list_id, 9, "carol", True))
+        return list_id, results
+
+    list_id, results = asyncio.run(scenario())
+
+    assert results == [(True, "No Error"), (False, "notInList"), (False, "notInList"), (True, "No Error")]
+    assert repository.get_debt_status(list_id + 100, 2, "bob") == (False, "listNotFound")
+    assert repository.get_debt_list_totals(list_id) == (2_000, 0)
+    assert queued(repository) == [("send_list", -100, list_id), ("notify", 1, list_id)]
+
+
+def test_balances(repository):
+    async def scenario():
+        await setup_group(repository)
+        await send_list(repository, 1, [("bob", 1_500), ("carol", 500)])
+        second = await send_list(repository, 2, [("alice", 400), ("carol", 300)])
+        await repository.update_debt_status(second, 1, "alice", True)
+        # Not sent to the group, so it does not count
+        await repository.add_debt_list(2, "taxi", "98765432", debts=[("alice", 10_000)])
+
+    asyncio.run(scenario())
+
+    assert repository.get_user_balances(1) == {-100: [("@Bob", "SGD", 1_500), ("@carol", "SGD", 500)]}
+    assert repository.get_user_balances(2) == {-100: [("@alice", "SGD", -1_500), ("@carol", "SGD", 300)]}
+    assert repository.get_group_member_balances(-100) == {"SGD": {"@alice": 2_000, "@Bob": -1_200, "@carol": -800}}
+    assert repository.get_group_member_balances(-200) == {}
+
+
+def test_second_send_is_rejected(repository):
+    async def scenario():
+        await setup_group(repository)
+        list_id = await send_list(repository, 1, [("bob", 1_500)])
+        return list_id, await repository.update_debt_list_group(list_id, -200)
+
+    list_id, sent_again = asyncio.run(scenario())
+
+    assert not sent_again
+    assert repository.get_debt_list_info(list_id).group_id == -100
+    assert queued(repository) == [("send_list", -100, list_id)]
+
+
+def test_undo_brings_back_a_cleared_batch(repository):
+    async def scenario():
+        await setup_group(repository)
+        deleted = await send_list(repository, 1, [("bob", 1_500)])
+        await repository.delete_debt_list(deleted)
+        first = await send_list(repository, 1, [("bob", 200), ("carol", 300)])
+        second = await repository.add_debt_list(1, "draft", "98765432", debts=[("carol", 100)])
+        assert await repository.clear_debt_lists(1) == 2
+        assert repository.get_debt_lists_by_user_id(1) == []
+        assert repository.get_user_balances(1) == {}
+
+        restored = await repository.undo_last_deletion(1)
+        assert sorted(restored) == [first, second]
+        assert repository.get_user_balances(1) == {-100: [("@Bob", "SGD", 200), ("@carol", "SGD", 300)]}
+        assert repository.get_debt_list_pending_status(second)
+        # Nothing undone by someone else, then the earlier deletion, then nothing left
+        assert await repository.undo_last_deletion(2) == []
+        assert await repository.undo_last_deletion(1) == [deleted]
+        assert await repository.undo_last_deletion(1) == []
+        return deleted, first
+
+    deleted, first = asyncio.run(scenario())
+
+    assert repository.get_debt_list_totals(deleted) == (1_500, 1_500)
+    assert queued(repository) == [
+        ("send_list", -100, deleted),
+        ("send_list", -100, first),
+        ("send_list", -100, first),
+        ("send_list", -100, deleted),
+    ]
+
+
+def test_linked_debt_follows_its_debtor_to_a_new_handle(repository):
+    async def scenario():
+        await repository.add_or_update_group(-100, "Flat", "group")
+        await repository.add_or_update_user(1, "bob", "Bob", None)
+        list_id = await send_list(repository, 9, [("bob", 1_000)])
+        await repository.add_or_update_user(1, "robert", "Bob", None)
+        # Someone else taking the handle afterwards does not take the debt
+        await repository.add_or_update_user(2, "bob", "Other Bob", None)
+        return list_id
+
+    list_id = asyncio.run(scenario())
+
+    assert [debt.owed_by_user_name for debt in repository.get_debt_list_info(list_id).debts] == ["robert"]
+    assert repository.get_debt_status(list_id, 1, "robert") == (True, False)
+    assert repository.get_debt_status(list_id, 2, "bob")[0] is False
+
+
+def test_debt_written_for_a_stale_handle_goes_to_its_new_holder(repository):
+    async def scenario():
+        await repository.add_or_update_group(-100, "Flat", "group")
+        # User 1 was seen as @bob and has renamed since, without the bot seeing it
+        await repository.add_or_update_user(1, "bob", "Robert", None)
+        list_id = await send_list(repository, 9, [("bob", 1_000)])
+        await repository.add_or_update_user(2, "bob", "Bob", None)
+        await repository.add_or_update_user(1, "robert", "Robert", None)
+        return list_id
+
+    list_id = asyncio.run(scenario())
+
+    assert [debt.owed_by_user_name for debt in repository.get_debt_list_info(list_id).debts] == ["bob"]
+    assert repository.get_debt_status(list_id, 2, "bob") == (True, False)
+    assert repository.get_debt_status(list_id, 1, "robert")[0] is False
+    assert repository.get_user_balances(1) == {}
+    assert [amount_minor for _, _, amount_minor in repository.get_user_balances(2)[-100]] == [-1_000]
+
+
+def add_duplicate_users() -> None:
+    # Saved before handles were case folded, both with the handle bob
+    db = next(get_db())
+    db.add_all(
+        [
+            User(user_id=1, username="Bob", username_lower="bob", first_name="Bob"),
+            User(user_id=2, username="bob", username_lower="bob", first_name="Bobby"),
+        ]
+    )
+    db.commit()
+
+
+def test_handle_saved_for_two_users_links_to_neither(fresh_database):
+    add_duplicate_users()
+
+    async def scenario():
+        list_id = await database.add_debt_list(9, "dinner", "98765432", debts=[("bob", 1_000)])
+        await database.add_or_update_debt(list_id, "BOB", 1_500)
+        assert next(get_db()).query(Debt.owed_by_user_id).filter(Debt.list_id == list_id).scalar() is None
+        # Seen again, user 2 is the one holding the handle
+        await database.add_or_update_user(2, "bob", "Bobby", None)
+        return list_id
+
+    list_id = asyncio.run(scenario())
+
+    db = next(get_db())
+    assert db.query(Debt.owed_by_user_id).filter(Debt.list_id == list_id).scalar() == 2
+    assert dict(db.query(User.user_id, User.username_lower)) == {1: None, 2: "bob"}
+
+
+def test_migration_forgets_handles_saved_for_two_users(fresh_database):
+    add_duplicate_users()
+    list_id = asyncio.run(database.add_debt_list(9, "dinner", "98765432", debts=[("bob", 1_000)]))
+    db = next(get_db())
+    # Linked to either by the first migration
+    db.query(Debt).filter(Debt.list_id == list_id).update({Debt.owed_by_user_id: 1})
+    db.commit()
+
+    with fresh_database.begin() as conn:
+        _migrate_ambiguous_usernames(conn)
+
+    db = next(get_db())
+    assert db.query(Debt.owed_by_user_id).filter(Debt.list_id == list_id).scalar() is None
+    assert dict(db.query(User.user_id, User.username_lower)) == {1: None, 2: None}
+
+
+def test_unchanged_user_is_not_written_again(fresh_database, monkeypatch):
+    writer = database.shards.current().writer
+    writes = []
+    execute = writer.execute
+    monkeypatch.setattr(writer, "execute", lambda operation, *args: writes.append(args) or execute(operation, *args))
+
+    async def scenario():
+        await database.add_or_update_user(1, "alice", "Alice", None)
+        await database.add_or_update_user(1, "alice", "Alice", None)
+        await database.add_or_update_user(1, "alice", "Alice", "Tan")
+
+    asyncio.run(scenario())
+
+    assert writes == [(1, "alice", "Alice", None), (1, "alice", "Alice", "Tan")]
+
+
+def test_undo_after_replacing_a_draft_restores_the_cleared_lists(repository):
+    async def paste(user_id: int, debts: list) -> int:
+        # Like a pasted or uploaded list, which replaces the user's draft
+        list_id = repository.user_has_pending_debt_list(user_id)
+        if list_id:
+            await repository.discard_pending_debt_list(list_id)
+        return await repository.add_debt_list(user_id, "draft", "98765432", debts=debts)
+
+    async def scenario():
+        await setup_group(repository)
+        cleared = await send_list(repository, 1, [("bob", 1_500)])
+        assert await repository.clear_debt_lists(1) == 1
+        await paste(1, [("carol", 100)])
+        draft = await paste(1, [("carol", 200)])
+        assert await repository.undo_last_deletion(1) == [cleared]
+        assert await repository.undo_last_deletion(1) == []
+        return cleared, draft
+
+    cleared, draft = asyncio.run(scenario())
+
+    assert sorted(repository.get_debt_lists_by_user_id(1)) == [cleared, draft]
+    assert repository.user_has_pending_debt_list(1) == draft
+
+
+def test_create_repository_by_backend():
+    assert isinstance(create_repository("memory"), MemoryRepository)
+    assert isinstance(create_repository("sqlite"), SqlRepository)
+    with pytest.raises(ValueError):
+        create_repository("postgres")
+
+
+def test_debt_list_pages(repository):
+    async def scenario():
+        await setup_group(repository)
+        list_ids = [await send_list(repository, 1, [("bob", 100 * number)]) for number in range(1, 4)]
+        await repository.update_debt_status(list_ids[1], 2, "bob", True)
+        return list_ids
+
+    list_ids = asyncio.run(scenario())
+
+    infos = [repository.get_debt_list_info(list_id) for list_id in list_ids]
+    newest_first = [
+        info.list_id for info in sorted(infos, key=lambda info: (info.last_updated, info.list_id), reverse=True)
+    ]
+    first, has_newer, has_older = repository.get_debt_list_page(1, page_size=2)
+    assert ([info.list_id for info in first], has_newer, has_older) == (newest_first[:2], False, True)
+    cursor = (first[-1].last_updated, first[-1].list_id)
+    second, has_newer, has_older = repository.get_debt_list_page(1, before=cursor, page_size=2)
+    assert ([info.list_id for info in second], has_newer, has_older) == (newest_first[2:], True, False)
+    cursor = (second[0].last_updated, second[0].list_id)
+    back, has_newer, has_older = repository.get_debt_list_page(1, after=cursor, page_size=2)
+    assert ([info.list_id for info in back], has_newer, has_older) == (newest_first[:2], False, True)
+
+    assert [info.list_id for info in repository.get_debt_list_page(1, "settled")[0]] == [list_ids[1]]
+    assert sorted(info.list_id for info in repository.get_debt_list_page(1, "open")[0]) == [list_ids[0], list_ids[2]]
+    assert repository.get_debt_list_page(2) == ([], False, False)
+
+
+def test_search_matches_word_prefixes_of_names_and_debtors(repository):
+    async def scenario():
+        await setup_group(repository)
+        dinner = await send_list(repository, 1, [("bob", 1_500), ("carol", 500)])
+        trip = await repository.add_debt_list(1, "Bob's birthday", "98765432", debts=[("dan", 700)])
+        await repository.update_debt_list_status(trip, False)
+        # Drafts are not found until they are sent
+        await repository.add_debt_list(1, "bobsleigh", "98765432", debts=[("erin", 100)])
+        return dinner, trip
+
+    dinner, trip = asyncio.run(scenario())
+
+    def found(query: str, offset: int = 0, limit: int = 5) -> tuple:
+        results, has_more = repository.search_debt_lists(1, query, offset=offset, limit=limit)
+        return [result.list_id for result in results], has_more
+
+    # A match in the name ranks above a match in the debtors
+    assert found("bo") == ([trip, dinner], False)
+    assert found("bo", limit=1) == ([trip], True)
+    assert found("bo", offset=1, limit=1) == ([dinner], False)
+    assert found("din car") == ([dinner], False)
+    assert found("din dan") == ([], False)
+    assert found("!!") == ([], False)
+    assert repository.search_debt_lists(2, "bo") == ([], False)
+    result = repository.search_debt_lists(1, "dinner")[0][0]
+    assert (result.debt_name, result.total_minor, result.outstanding_minor, result.archived) == (
+        "dinner",
+        2_000,
+        2_000,
+        False,
+    )
+
+
+def test_recurring_debt_list_is_posted_once_per_due_time(repository):
+    due = datetime(2026, 1, 1, 18)
+
+    async def scenario():
+        await setup_group(repository)
+        list_id = await send_list(repository, 1, [("bob", 1_500), ("carol", 500)])
+        await repository.update_debt_status(list_id, 2, "bob", True)
+        last_sent = repository.get_last_sent_debt_list(1)
+        assert last_sent.list_id == list_id
+        recurring_id = await repository.add_recurring_debt_list(last_sent, "0 18 1 * *", "UTC", due)
+        return list_id, recurring_id
+
+    list_id, recurring_id = asyncio.run(scenario())
+
+    [recurring] = repository.get_recurring_debt_lists(1)
+    assert (recurring.recurring_id, recurring.group_id, recurring.schedule, recurring.next_due) == (
+        recurring_id,
+        -100,
+        "0 18 1 * *",
+        due,
+    )
+    # Every debt of a copy starts unpaid
+    assert [(debt.owed_by_user_name, debt.amount_minor, debt.paid) for debt in recurring.debts] == [
+        ("bob", 1_500, False),
+        ("carol", 500, False),
+    ]
+    assert repository.get_due_recurring_debt_lists(due - timedelta(minutes=1)) == []
+    assert [recurring.recurring_id for recurring in repository.get_due_recurring_debt_lists(due)] == [recurring_id]
+
+    next_due = datetime(2026, 2, 1, 18)
+    posted = repository.materialize_recurring_debt_list(recurring_id, due, next_due, "dinner (January)")
+    assert repository.materialize_recurring_debt_list(recurring_id, due, next_due, "dinner (January)") is None
+    info = repository.get_debt_list_info(posted)
+    assert (info.debt_name, info.group_id, info.is_pending, info.outstanding_minor) == (
+        "dinner (January)",
+        -100,
+        False,
+        2_000,
+    )
+    assert repository.get_recurring_debt_lists(1)[0].next_due == next_due
+    assert repository.get_last_sent_debt_list(1).list_id == posted
+
+    repository.skip_recurring_debt_list(recurring_id, next_due, None)
+    assert repository.get_recurring_debt_lists(1) == []
+    assert queued(repository) == [("send_list", -100, list_id), ("send_list", -100, posted)]
+
+
+def test_only_the_owner_stops_a_recurring_debt_list(repository):
+    async def scenario():
+        await setup_group(repository)
+        await send_list(repository, 1, [("bob", 1_500)])
+        recurring_id = await repository.add_recurring_debt_list(
+            repository.get_last_sent_debt_list(1), "0 18 1 * *", "UTC", datetime(2026, 1, 1, 18)
+        )
+        return [
+            await repository.delete_recurring_debt_list(recurring_id, 2),
+            await repository.delete_recurring_debt_list(recurring_id, 1),
+            await repository.delete_recurring_debt_list(recurring_id, 1),
+        ]
+
+    assert asyncio.run(scenario()) == [False, True, False]
+    assert repository.get_recurring_debt_lists(1) == []
+
+
+def test_group_stats(repository):
+    async def scenario():
+        await setup_group(repository)
+        first = await send_list(repository, 1, [("bob", 1_500), ("carol", 500)])
+        second = await send_list(repository, 1, [("bob", 300), ("dan", 200)])
+        await repository.update_debt_status(first, 2, "bob", True)
+        await repository.update_debt_status(second, 2, "bob", True)
+
+    asyncio.run(scenario())
+    if isinstance(repository, SqlRepository):
+        # The SQL backend reads rollups, which a job keeps up to date
+        update_group_stats()
+
+    today = datetime.now(timezone.utc).date()
+    stats = repository.get_group_stats(-100, today - timedelta(days=1), top=1, min_debts=2)
+    assert stats.lists_sent == 2
+    assert stats.paid == (("SGD", 2, 1_800),)
+    assert sum(debts for _, debts in stats.settle_times) == 2
+    assert [(name, debts) for name, debts, _ in stats.slowest_payers] == [("bob", 2)]
+    assert stats.outstanding == (("SGD", 700),)
+    assert stats.top_debtors == (("carol", "SGD", 500),)
+
+    assert repository.get_group_stats(-100, today + timedelta(days=1)).lists_sent == 0
+    assert repository.get_group_stats(-200, today) == GroupStatsView(0, (), (), (), (), ())
+
+
+def test_outbox_stores_the_sent_message_and_keeps_retries_queued(repository):
+    async def scenario():
+        await setup_group(repository)
+        list_id = await send_list(repository, 1, [("bob", 1_500)])
+        [send] = repository.get_due_outbox_messages(10)
+        assert (send["action"], send["chat_id"], send["list_id"]) == ("send_list", -100, list_id)
+        await repository.finish_outbox_messages([(send, ("done", 42))], 5)
+        assert repository.get_debt_list_message_info(list_id) == (-100, 42)
+        assert repository.get_due_outbox_messages(10) == []
+        assert [debt_list.list_id for debt_list in repository.get_open_debt_lists()] == [list_id]
+
+        # Resending replaces the group message with a new one
+        await repository.resend_debt_list(list_id)
+        assert repository.get_debt_list_message_info(list_id) == (-100, None)
+        delete, resend = repository.get_due_outbox_messages(10)
+        assert (delete["action"], delete["message_id"], resend["action"]) == ("delete", 42, "send_list")
+        await repository.finish_outbox_messages(
+            [(delete, ("retry", 0, "timed out")), (resend, ("failed", "blocked"))], 5
+        )
+        [retried] = repository.get_due_outbox_messages(10)
+        assert (retried["outbox_id"], retried["attempts"]) == (delete["outbox_id"], 1)
+        await repository.finish_outbox_messages([(retried, ("retry", 0, "timed out"))], 2)
+        assert repository.get_due_outbox_messages(10) == []
+
+    asyncio.run(scenario())
+
+
+def test_inline_search_offers_only_open_lists(repository):
+    def offered(query: str = "") -> list:
+        return repository.search_open_debt_lists(1, query)
+
+    async def scenario():
+        await setup_group(repository)
+        dinner = await send_list(repository, 1, [("bob", 1_500)])
+        draft = await repository.add_debt_list(1, "dinner draft", "98765432", debts=[("bob", 100)])
+        taxi = await repository.add_debt_list(1, "Late taxi", "98765432", debts=[("carol", 300)])
+        await repository.update_debt_list_status(taxi, False)
+        # Not offered until it is sent to a group
+        assert offered() == [dinner]
+        assert await repository.update_debt_list_group(taxi, -100)
+        assert offered() == [taxi, dinner]
+        assert offered("din") == [dinner]
+        assert offered("la TAX") == [taxi]
+        assert offered("dinner taxi") == []
+        assert repository.search_open_debt_lists(2, "") == []
+
+        await repository.update_debt_status(dinner, 2, "bob", True)
+        assert offered() == [taxi]
+        await repository.update_debt_status(dinner, 2, "bob", False)
+        assert offered() == [taxi, dinner]
+
+        await repository.delete_debt_list(taxi)
+        assert offered() == [dinner]
+        assert await repository.undo_last_deletion(1) == [taxi]
+        assert offered() == [taxi, dinner]
+
+        await repository.clear_debt_lists(1)
+        assert offered() == []
+        assert sorted(await repository.undo_last_deletion(1)) == sorted([dinner, draft, taxi])
+        assert offered("") == [taxi, dinner]
+
+    asyncio.run(scenario())
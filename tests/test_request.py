@@ -0,0 +1,70 @@
+"""
+Tests that the connection pools of bot/request.py are built with the limits they are given, against a local HTTP server
+that counts the connections it is sent requests over.
+"""
+
+import asyncio
+
+import pytest
+
+from bot.request import InstrumentedRequest, request_pools
+
+RESPONSE = b'{"ok": true, "result": true}'
+
+
+async def count_connections(request: InstrumentedRequest, requests: int, concurrent: bool = False) -> int:
+    connections = 0
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        nonlocal connections
+        connections += 1
+        # Answers requests until the client closes the connection
+        while True:
+            try:
+                headers = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            for line in headers.lower().split(b"\r\n"):
+                if line.startswith(b"content-length:"):
+                    await reader.readexactly(int(line.split(b":")[1]))
+            # Held for a moment, so that concurrent requests overlap
+            await asyncio.sleep(0.05)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s"
+                % (len(RESPONSE), RESPONSE)
+            )
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/bot1:fake/getMe"
+    await request.initialize()
+    try:
+        if concurrent:
+            await asyncio.gather(*(request.do_request(url, "POST") for _ in range(requests)))
+        else:
+            for _ in range(requests):
+                await request.do_request(url, "POST")
+    finally:
+        await request.shutdown()
+        server.close()
+        request_pools.pop(request.name, None)
+    return connections
+
+
+def test_idle_connections_are_reused():
+    request = InstrumentedRequest("test_keepalive", 2, keepalive_expiry=5)
+    assert asyncio.run(count_connections(request, 3)) == 1
+
+
+def test_no_keepalive_opens_a_connection_per_request():
+    # HTTPXRequest's own limits keep connections alive, so one per request shows the pool's limits were applied
+    request = InstrumentedRequest("test_no_keepalive", 2, keepalive_expiry=0)
+    assert asyncio.run(count_connections(request, 3)) == 3
+
+
+@pytest.mark.parametrize("size", [1, 3])
+def test_concurrent_requests_open_at_most_the_pool_size(size):
+    request = InstrumentedRequest(f"test_size_{size}", size, pool_timeout=5)
+    assert asyncio.run(count_connections(request, 6, concurrent=True)) == size
+    assert request.snapshot()["peak_in_use"] == size
@@ -0,0 +1,254 @@
+"""
+Tests of sharding, see bot/shards.py and bot/rebalance.py. SHARD_COUNT is read when the bot's modules are imported, so
+the tests marked sharded run in a fresh interpreter with SHARD_COUNT=3 that test_sharded starts, on databases of their
+own in a scratch directory, and keep apart by using users and groups of their own. The round trip through the shards
+runs `python -m bot.tools rebalance-shards` on the database of this interpreter.
+"""
+
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from bot import database, shards, undo
+from bot.backup import create_backup, list_backups, restore_backup
+from bot.rebalance import _receive_debt_list, finish_moves, move_debt_list
+
+SHARD_COUNT = 3
+ROOT = Path(__file__).resolve().parent.parent
+
+sharded = pytest.mark.skipif(not shards.SHARDED, reason="runs in the interpreter that test_sharded starts")
+unsharded = pytest.mark.skipif(shards.SHARDED, reason="starts interpreters of its own")
+
+
+def environment(directory: Path, shard_count: int) -> dict:
+    return {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{directory / 'test.db'}",
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_DATABASE_URL": f"sqlite:///{directory / 'shard{shard}.db'}",
+    }
+
+
+def list_ids(path: Path) -> set:
+    with sqlite3.connect(path) as conn:
+        return {list_id for (list_id,) in conn.execute("SELECT list_id FROM debt_lists")}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def sharded_schema():
+    if shards.SHARDED:
+        database.initialize_database()
+
+
+@unsharded
+def test_sharded(tmp_path):
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", __file__],
+        env=environment(tmp_path, SHARD_COUNT),
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout[-5_000:]
+    assert "skipped" in result.stdout and " passed" in result.stdout
+
+
+async def setup_group(user_ids: tuple, group_ids: tuple) -> None:
+    for user_id in user_ids:
+        await database.add_or_update_user(user_id, f"user{user_id}", f"User {user_id}", None)
+    for group_id in group_ids:
+        await database.add_or_update_group(group_id, f"group {group_id}", "group")
+        for user_id in user_ids:
+            await database.associate_user_with_group(user_id, group_id)
+
+
+async def draft(user_id: int, debts: list) -> int:
+    list_id = await database.add_debt_list(user_id, "dinner", "98765432", debts=debts)
+    await database.update_debt_list_status(list_id, False)
+    return list_id
+
+
+def sends(list_id: int) -> list:
+    return [
+        side_effect["shard"]
+        for side_effect in database.get_due_outbox_messages(1_000)
+        if side_effect["list_id"] == list_id and side_effect["action"] == "send_list"
+    ]
+
+
+@sharded
+def test_draft_moves_to_its_group_when_sent():
+    async def scenario():
+        await setup_group((4, 5), (-100,))
+        list_id = await draft(4, [("user5", 1_000)])
+        # Drafts are kept in their owner's shard, which hands out their ID
+        assert shards.home(list_id).index == shards.for_list(list_id).index == 4 % SHARD_COUNT
+        assert await database.update_debt_list_group(list_id, -100)
+        assert not await database.update_debt_list_group(list_id, -100)
+        return list_id
+
+    list_id = asyncio.run(scenario())
+
+    target = shards.for_group(-100)
+    assert target.index == -100 % SHARD_COUNT != 4 % SHARD_COUNT
+    assert shards.for_list(list_id) is target
+    # Read through from the home again, as a restarted bot would
+    shards._placements.clear()
+    assert shards.for_list(list_id) is target
+    assert list_id not in list_ids(shards.home(list_id).engine.url.database)
+    assert list_id in list_ids(target.engine.url.database)
+    assert database.get_debt_list_info(list_id).group_id == -100
+    assert sends(list_id) == [target.index]
+
+
+@sharded
+def test_reads_fan_out_over_every_shard():
+    async def scenario():
+        await setup_group((7, 8), (-200, -201, -202))
+        created = []
+        for group_id in (-200, -201, -202):
+            list_id = await draft(7, [("user8", 100 * -group_id)])
+            assert await database.update_debt_list_group(list_id, group_id)
+            created.append(list_id)
+        await database.update_debt_status(created[0], 8, "user8", True)
+        return created
+
+    created = asyncio.run(scenario())
+
+    assert {shards.for_list(list_id).index for list_id in created} == set(range(SHARD_COUNT))
+    assert sorted(database.get_debt_lists_by_user_id(7)) == sorted(created)
+    assert database.get_user_balances(8) == {
+        -201: [("@user7", "SGD", -20_100)],
+        -202: [("@user7", "SGD", -20_200)],
+    }
+    assert database.check_balances() == []
+    assert undo.check_event_log() == []
+
+
+@sharded
+def test_interrupted_move_is_finished_at_start_up():
+    async def scenario():
+        await setup_group((10, 11), (-300, -301))
+        return await draft(10, [("user11", 500)]), await draft(10, [("user11", 700)])
+
+    stopped_after_send, stopped_after_receive = asyncio.run(scenario())
+    source = shards.for_user(10)
+    for list_id, group_id in ((stopped_after_send, -300), (stopped_after_receive, -301)):
+        assert shards.for_group(group_id) is not source
+        # The group is set in the source, then the bot stops
+        assert source.writer.run(database._update_debt_list_group, list_id, group_id, False)
+    target = shards.for_group(-301)
+    state = {
+        "user_id": 10,
+        "debt_name": "dinner",
+        "phone_number": "98765432",
+        "currency": "SGD",
+        "group_id": -301,
+        "pending": False,
+        "deleted": False,
+        "debts": {1: {"name": "user11", "amount_minor": 700, "paid": False}},
+    }
+    with shards.using(target):
+        # Or stops once the target has the list, before the home recorded where it is
+        target.writer.run(_receive_debt_list, stopped_after_receive, state)
+
+    shards.check_placements()
+    assert finish_moves() == 2
+    assert finish_moves() == 0
+    shards._placements.clear()
+    for list_id, group_id in ((stopped_after_send, -300), (stopped_after_receive, -301)):
+        assert shards.for_list(list_id) is shards.for_group(group_id)
+        assert list_id not in list_ids(source.engine.url.database)
+        assert sends(list_id) == [shards.for_group(group_id).index]
+    assert database.get_debt_list_totals(stopped_after_receive) == (700, 700)
+    # Moving again changes nothing
+    with shards.using(shards.for_list(stopped_after_send)):
+        move_debt_list(stopped_after_send, shards.for_group(-300))
+    assert undo.check_event_log() == []
+
+
+@sharded
+def test_backup_covers_every_shard(tmp_path):
+    async def scenario():
+        await setup_group((13, 14), (-400, -401, -402))
+        created = []
+        for group_id in (-400, -401, -402):
+            list_id = await draft(13, [("user14", 500)])
+            assert await database.update_debt_list_group(list_id, group_id)
+            created.append(list_id)
+        return created
+
+    created = asyncio.run(scenario())
+    backup = create_backup(str(tmp_path), keep=1, pause=0)
+    assert list_backups(str(tmp_path)) == [backup["path"]]
+    assert len(list(tmp_path.iterdir())) == SHARD_COUNT
+
+    async def delete():
+        for list_id in created:
+            await database.delete_debt_list(list_id)
+
+    asyncio.run(delete())
+    assert all(list_id not in list_ids(shards.for_list(list_id).engine.url.database) for list_id in created)
+
+    restore_backup(backup["path"])
+    for list_id, group_id in zip(created, (-400, -401, -402)):
+        assert shards.for_list(list_id) is shards.for_group(group_id)
+        assert list_id in list_ids(shards.for_group(group_id).engine.url.database)
+    # A set missing one of its shards is not restored at all
+    (tmp_path / Path(backup["path"]).name.replace(".db.gz", "-shard2.db.gz")).unlink()
+    with pytest.raises(FileNotFoundError):
+        restore_backup(backup["path"])
+
+
+@unsharded
+def test_rebalance_round_trip(fresh_database, tmp_path):
+    async def scenario():
+        await setup_group((1, 2, 3), (-100, -101, -102))
+        sent = []
+        for number, group_id in enumerate((-100, -101, -102, -100)):
+            list_id = await draft(1, [("user2", 1_000 + number), ("user3", 2_000 + number)])
+            assert await database.update_debt_list_group(list_id, group_id)
+            sent.append(list_id)
+        await database.update_debt_status(sent[1], 2, "user2", True)
+        deleted = await draft(1, [("user3", 300)])
+        await database.update_debt_list_group(deleted, -101)
+        await database.delete_debt_list(deleted)
+        kept = await database.add_debt_list(2, "taxi", "98765432", debts=[("user1", 900)])
+        return sent, deleted, kept
+
+    sent, deleted, kept = asyncio.run(scenario())
+    before = {list_id: database.get_debt_list_info(list_id) for list_id in sent + [kept]}
+    balances = {user_id: database.get_user_balances(user_id) for user_id in (1, 2, 3)}
+
+    def rebalance(shard_count: int) -> None:
+        subprocess.run(
+            [sys.executable, "-m", "bot.tools", "rebalance-shards", "--yes"],
+            env=environment(tmp_path, shard_count),
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+
+    rebalance(SHARD_COUNT)
+    paths = [tmp_path / "test.db"] + [tmp_path / f"shard{index}.db" for index in range(1, SHARD_COUNT)]
+    for index, path in enumerate(paths):
+        expected = {list_id for list_id in sent if before[list_id].group_id % SHARD_COUNT == index}
+        if 2 % SHARD_COUNT == index:
+            expected.add(kept)
+        assert list_ids(path) == expected
+
+    rebalance(1)
+    assert list_ids(paths[0]) == set(before)
+    assert all(not list_ids(path) for path in paths[1:])
+    # Restored with new debt IDs, which views do not show
+    assert {list_id: database.get_debt_list_info(list_id) for list_id in before} == before
+    assert {user_id: database.get_user_balances(user_id) for user_id in (1, 2, 3)} == balances
+    assert database.check_balances() == []
+    assert undo.check_event_log() == []
+    assert undo.undo_last_deletion(1) == [deleted]
@@ -0,0 +1,178 @@
+"""
+Streaming parsers for debt lists uploaded as documents. Rows are read and validated one at a time, so files with thousands of rows are imported with bounded memory.
+"""
+
+import codecs
+import csv
+import os
+from typing import IO, Iterable, Iterator, List, Optional, Tuple, Union
+
+from bot.messages import UserError
+from bot.settings import Settings, chat_settings
+from utils.money import parse_amount
+
+try:
+    import openpyxl
+except ImportError:  # XLSX support is optional
+    openpyxl = None
+
+# Only the first few errors are shown to the user, the rest are counted
+MAX_REPORTED_ERRORS = 20
+
+
+def supported_extensions() -> List[str]:
+    extensions = [".csv"]
+    if openpyxl is not None:
+        extensions.append(".xlsx")
+    return extensions
+
+
+def iter_csv_rows(file: IO[bytes]) -> Iterator[Tuple[int, list]]:
+    """
+    Read the rows of a CSV file one at a time.
+
+    Args:
+        file (IO[bytes]): The CSV file, opened in binary mode.
+
+    Yields:
+        Tuple[int, list]: The 1-based row number and the cells of the row.
+    """
+    text = codecs.getreader("utf-8-sig")(file, errors="replace")
+    for row_number, row in enumerate(csv.reader(text), start=1):
+        yield row_number, row
+
+
+def iter_xlsx_rows(path: str) -> Iterator[Tuple[int, list]]:
+    """
+    Read the rows of the first worksheet of an XLSX file one at a time, without loading the whole workbook.
+
+    Args:
+        path (str): The path to the XLSX file.
+
+    Yields:
+        Tuple[int, list]: The 1-based row number and the cells of the row.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[0]
+        for row_number, row in enumerate(worksheet.iter_rows(values_only=True), start=1):
+            yield row_number, ["" if cell is None else str(cell) for cell in row]
+    finally:
+        workbook.close()
+
+
+def iter_document_rows(path: str, file_name: str) -> Iterator[Tuple[int, list]]:
+    """
+    Read the rows of an uploaded CSV or XLSX document, based on its file name.
+
+    Raises:
+        UserError: If the document type is not supported.
+    """
+    extension = os.path.splitext(file_name or "")[1].lower()
+    if extension not in supported_extensions():
+        raise UserError("uploadUnsupported", extensions=" or ".join(supported_extensions()))
+    if extension == ".xlsx":
+        yield from iter_xlsx_rows(path)
+        return
+    with open(path, "rb") as file:
+        yield from iter_csv_rows(file)
+
+
+def parse_document_caption(caption: str, settings: Settings = None) -> Tuple[bool, Union[str, Tuple[str, str]]]:
+    """
+    Parse the debt name and phone number from the caption of an uploaded document.
+
+    Args:
+        caption (str): The caption, with the debt name on the first line and the phone number on the second.
+        settings (Settings, optional): The settings of the chat the error message is for. Defaults to the default settings.
+
+    Returns:
+        Tuple[bool, Union[str, Tuple[str, str]]]: Whether parsing succeeded, and either an error message in the chat's language or the debt name and phone number.
+    """
+    settings = settings or chat_settings()
+    lines = [line.strip() for line in (caption or "").strip().split("\n")]
+    if len(lines) < 2 or not lines[0]:
+        return False, settings.text("uploadNoCaption")
+    debt_name, phone_number = lines[0], lines[1]
+    if not phone_number.isdigit():
+        return False, settings.text("phoneNotDigits")
+    return True, (debt_name, phone_number)
+
+
+class ImportErrors:
+    """Collects row errors while a document is streamed, keeping only the first few messages."""
+
+    def __init__(self, limit: int = MAX_REPORTED_ERRORS):
+        self.limit = limit
+        self.count = 0
+        self.errors: List[UserError] = []
+
+    def add(self, row_number: int, problem: UserError) -> None:
+        self.count += 1
+        if len(self.errors) < self.limit:
+            self.errors.append(UserError("fileRow", number=row_number, problem=problem))
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def report(self, settings: Settings = None) -> str:
+        """Describe the problems found, in the language of the chat the report is for."""
+        settings = settings or chat_settings()
+        report = settings.text("fileProblems", count=self.count) + "\n\n" + "\n".join(
+            settings.error(error) for error in self.errors
+        )
+        if self.count > len(self.errors):
+            report += "\n" + settings.text("problemsMore", count=self.count - len(self.errors))
+        return report
+
+
+def iter_debt_rows(
+    rows: Iterable[Tuple[int, list]], currency: str, errors: ImportErrors
+) -> Iterator[Tuple[str, int]]:
+    """
+    Validate document rows of the form `@handle, amount` and yield the valid debts. Invalid rows are recorded in errors and skipped, so every problem in the file is found in one pass. Blank rows are ignored, and a first row without a valid amount is treated as a header.
+
+    Args:
+        rows (Iterable[Tuple[int, list]]): The numbered rows of the document.
+        currency (str): The currency the amounts are in.
+        errors (ImportErrors): Where row errors are recorded.
+
+    Yields:
+        Tuple[str, int]: The debtor's handle without the '@', and the amount in minor units.
+    """
+    seen_handles = {}
+    first_row = True
+    for row_number, row in rows:
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+        is_first_row, first_row = first_row, False
+
+        handle = cells[0].lstrip("@") if cells else ""
+        amount_text = cells[1] if len(cells) > 1 else ""
+        try:
+            amount_minor: Optional[int] = parse_amount(amount_text, currency)
+        except UserError as error:
+            if is_first_row:
+                # Header row, e.g. "Handle,Amount"
+                continue
+            amount_minor = None
+            amount_error = error if amount_text else UserError("missingAmount")
+
+        if not handle or " " in handle:
+            errors.add(row_number, UserError("invalidHandle", handle=cells[0]))
+            continue
+        if amount_minor is None:
+            errors.add(row_number, amount_error)
+            continue
+        if any(cells[2:]):
+            errors.add(row_number, UserError("rowExtraCells"))
+            continue
+
+        handle_key = handle.casefold()
+        if handle_key in seen_handles:
+            errors.add(row_number, UserError("rowDuplicate", handle=handle, row=seen_handles[handle_key]))
+            continue
+        seen_handles[handle_key] = row_number
+
+        yield handle, amount_minor
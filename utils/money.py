@@ -0,0 +1,95 @@
+"""
+Helpers for exact money handling. Amounts are stored as integers in the currency's minor unit (e.g. cents), parsed with Decimal and only turned into decimal strings for display.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from bot.messages import UserError
+
+# Number of minor unit digits per ISO 4217 currency, for currencies that do not use 2
+CURRENCY_EXPONENTS = {
+    "BHD": 3,
+    "IDR": 0,
+    "JOD": 3,
+    "JPY": 0,
+    "KRW": 0,
+    "KWD": 3,
+    "OMR": 3,
+    "TND": 3,
+    "VND": 0,
+}
+
+
+# How amounts are written, as (thousands separator, decimal mark)
+AMOUNT_STYLES = {
+    "plain": ("", "."),
+    "comma": (",", "."),
+    "dot": (".", ","),
+    "space": ("\u202f", ","),
+}
+
+
+# Keeps amounts, and sums of many amounts, well inside SQLite's 64-bit integers
+MAX_AMOUNT_MINOR = 10**15
+
+
+def currency_exponent(currency: str) -> int:
+    return CURRENCY_EXPONENTS.get(currency, 2)
+
+
+def parse_amount(text: str, currency: str) -> int:
+    """
+    Parse a decimal amount into the currency's minor unit.
+
+    Args:
+        text (str): The amount, e.g. '9.6'.
+        currency (str): The ISO 4217 currency code.
+
+    Returns:
+        int: The amount in minor units, e.g. 960.
+
+    Raises:
+        UserError: If the text is not a non-negative number with at most as many decimal places as the currency allows, or is unreasonably large.
+
+    Examples:
+        >>> parse_amount("9.6", "SGD")
+        960
+    """
+    try:
+        amount = Decimal(text.strip())
+    except InvalidOperation:
+        raise UserError("amountNotNumber", text=text) from None
+    if not amount.is_finite():
+        raise UserError("amountNotNumber", text=text)
+    if amount < 0:
+        raise UserError("amountNegative", text=text)
+    exponent = currency_exponent(currency)
+    # Check the magnitude before scaling, huge exponents would overflow the decimal context
+    if amount.adjusted() + exponent >= len(str(MAX_AMOUNT_MINOR)) - 1:
+        raise UserError("amountTooLarge", text=text)
+    if amount != amount.quantize(Decimal(1).scaleb(-exponent)):
+        raise UserError("amountTooPrecise", text=text, places=exponent, currency=currency)
+    return int(amount.scaleb(exponent))
+
+
+def format_amount(amount_minor: int, currency: str, style: str = "plain") -> str:
+    """
+    Format an amount in minor units as a decimal string.
+
+    Args:
+        amount_minor (int): The amount in minor units.
+        currency (str): The ISO 4217 currency code.
+        style (str, optional): One of AMOUNT_STYLES. Defaults to "plain".
+
+    Examples:
+        >>> format_amount(960, "SGD")
+        '9.60'
+        >>> format_amount(123456789, "SGD", "dot")
+        '1.234.567,89'
+    """
+    exponent = currency_exponent(currency)
+    if style == "plain":
+        return f"{Decimal(amount_minor).scaleb(-exponent):.{exponent}f}"
+    thousands, decimal_mark = AMOUNT_STYLES[style]
+    text = f"{Decimal(amount_minor).scaleb(-exponent):,.{exponent}f}"
+    return text.replace(",", "\0").replace(".", decimal_mark).replace("\0", thousands)
@@ -1,32 +1,137 @@
-from datetime import datetime, timedelta
+import asyncio
+import logging
+import re
+from datetime import datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal
 from typing import List, Tuple, Union
 
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import ContextTypes
 
-from bot.database import (
-    delete_debt_list_message_info,
-    get_all_debt_lists,
-    get_debt_list_info,
-    update_debt_list_message_info,
+from bot.database import prune_outbox_messages
+
+from bot import outbox
+from bot.analytics import DAY, SETTLE_BUCKET_BOUNDS, median_bucket, update_group_stats
+from bot.archive import archive_settled_debt_lists, purge_archived_debt_lists
+from bot.guard import counters as guard_counters
+from bot.messages import UserError
+from bot.repository import Repository
+from bot.request import request_pools
+from bot.settings import Settings, chat_settings
+from bot.views import DebtListView
+from config.config import (
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_BATCH_PAUSE,
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_RETENTION_DAYS,
+    BACKUP_DIR,
+    BACKUP_KEEP,
+    BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_PAUSE,
+    DEFAULT_CURRENCY,
+    FIND_PAGE_SIZE,
+    GROUP_STATS_BATCH_SIZE,
+    GROUP_STATS_DAYS,
+    GROUP_STATS_MIN_DEBTS,
+    GROUP_STATS_TOP,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_POLL_SECONDS,
+    OUTBOX_RETENTION_DAYS,
+    RECURRING_CATCH_UP_DAYS,
+    SHOW_PAGE_SIZE,
 )
-from datetime import datetime
-from pytz import timezone
+from utils.money import MAX_AMOUNT_MINOR, parse_amount
+
+logger = logging.getLogger(__name__)
+
+
+# A debtor handle, e.g. "@user_1"
+HANDLE_PATTERN = re.compile(r"@(\w+)")
+# A percentage surcharge or discount applied to every debt, e.g. "+10% service charge" or "-5% discount"
+PERCENT_MODIFIER_PATTERN = re.compile(r"([+-])\s*(\d+(?:\.\d+)?)\s*%(?:\s.*)?")
+# A multiplier applied to every debt, e.g. "x1.09" or "*1.09"
+MULTIPLIER_MODIFIER_PATTERN = re.compile(r"[x*×]\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+SPLIT_FLAG = "/split"
+# Only the first few errors are shown to the user, the rest are counted
+MAX_REPORTED_ERRORS = 20
+
 
-from bot.models import DebtList
+def _parse_modifier(line: str) -> Union[Decimal, None]:
+    """Return the multiplier a modifier line stands for, or None if the line is not a modifier."""
+    match = PERCENT_MODIFIER_PATTERN.fullmatch(line)
+    if match:
+        sign, percent = match.groups()
+        percent = Decimal(percent) if sign == "+" else -Decimal(percent)
+        return 1 + percent / 100
+    match = MULTIPLIER_MODIFIER_PATTERN.fullmatch(line)
+    if match:
+        return Decimal(match.group(1))
+    return None
+
+
+def _parse_debt_line(line: str, currency: str) -> List[Tuple[str, int]]:
+    """
+    Parse one debt line into the amount owed by each handle on it. A line lists one or more handles followed by an amount, which every handle owes in full, or which is split evenly between them when the line ends with /split.
+
+    Raises:
+        UserError: If the line is malformed.
+    """
+    tokens = line.split()
+    split = tokens[-1].lower() == SPLIT_FLAG
+    if split:
+        tokens = tokens[:-1]
+
+    handles = []
+    for token in tokens:
+        match = HANDLE_PATTERN.fullmatch(token)
+        if not match:
+            break
+        handles.append(match.group(1))
+    rest = tokens[len(handles) :]
+
+    if not handles:
+        raise UserError("invalidHandle", handle=tokens[0] if tokens else line)
+    if not rest:
+        raise UserError("missingAmount")
+    if len(rest) > 1:
+        raise UserError("unexpectedAfterAmount", text=" ".join(rest[1:]))
+    amount_minor = parse_amount(rest[0], currency)
+
+    if not split:
+        return [(handle, amount_minor) for handle in handles]
+    # Hand out the minor units that do not divide evenly one at a time, starting with the first handle
+    share, remainder = divmod(amount_minor, len(handles))
+    return [
+        (handle, share + (1 if index < remainder else 0))
+        for index, handle in enumerate(handles)
+    ]
 
 
 def parse_debt_list(
     input_text: str,
-) -> Tuple[bool, Union[str, Tuple[str, str, List[Tuple[str, float]]]]]:
+    currency: str = DEFAULT_CURRENCY,
+    settings: Settings = None,
+) -> Tuple[bool, Union[str, Tuple[str, str, List[Tuple[str, int]]]]]:
     """
-    Parses the input text and extracts the debt name, phone number, and debts.
+    Parses the input text and extracts the debt name, phone number, and debts. Every line is validated in a single pass, and all problems are reported together.
+
+    After the debt name and phone number, each line is one of:
+        - `@user 9.6`: the user owes 9.6.
+        - `@a @b 5`: each user owes 5.
+        - `@a @b @c 30 /split`: 30 is split evenly between the users.
+        - `+10% service charge`, `-5% discount` or `x1.09`: every amount is multiplied, after all debts are added up. Modifiers compound in the order they are given, and must leave every amount above zero.
+
+    A handle that appears more than once (in any letter case) owes the sum of its amounts.
 
     Args:
         input_text (str): The input text containing the debt information.
+        currency (str, optional): The currency the amounts are in. Defaults to DEFAULT_CURRENCY.
+        settings (Settings, optional): The settings of the chat the error message is for. Defaults to the default settings.
 
     Returns:
-        Tuple[bool, Union[str, Tuple[str, str, List[Tuple[str, float]]]]]: A tuple containing a boolean value indicating whether the parsing was successful, and either an error message (if parsing failed) or a tuple containing the debt name, phone number, and a list of debts.
+        Tuple[bool, Union[str, Tuple[str, str, List[Tuple[str, int]]]]]: A tuple containing a boolean value indicating whether the parsing was successful, and either an error message in the chat's language (if parsing failed) or a tuple containing the debt name, phone number, and a list of debts with amounts in minor units.
 
     Raises:
         None
@@ -34,117 +139,605 @@ def parse_debt_list(
     Examples:
         >>> input_text = "AMEENS\\n912847392\\n@Alice 10.5\\n@Bob 20.0"
         >>> parse_debt_list(input_text)
-        (True, ('AMEENS', '912847392', [('@Alice', 10.5), ('@Bob', 20.0)]))
+        (True, ('AMEENS', '912847392', [('Alice', 1050), ('Bob', 2000)]))
+        >>> parse_debt_list("AMEENS\\n912847392\\n@a @b @c 10 /split\\n+10% service")
+        (True, ('AMEENS', '912847392', [('a', 367), ('b', 366), ('c', 366)]))
     """
+    settings = settings or chat_settings()
     lines: List[str] = input_text.strip().split("\n")
 
     # Validate the number of lines
     if len(lines) < 3:
-        return (
-            False,
-            "Input must have at least three lines. Make sure there is a name, phone number, and at least one debt. Example:\n\nMacDonalds\n98765432\n@user1 9.6\n@user2 5.4\n@user3 3.0",
-        )
+        return False, settings.text("listTooShort")
+
+    errors = []
 
     # Extract debt name and phone number
     debt_name = lines[0].strip()
     phone_number = lines[1].strip()
     # Validate phone number
     if not phone_number.isdigit():
-        return False, "Phone number must contain only numbers"
+        errors.append(UserError("listLine", number=2, problem=UserError("phoneNotDigits")))
 
-    # Extract debts
-    debts = []
-    for line in lines[2:]:
+    # Extract debts, merging handles case-insensitively and keeping the first spelling
+    amounts = {}
+    spellings = {}
+    multiplier = Decimal(1)
+    for line_number, line in enumerate(lines[2:], start=3):
         line = line.strip()
         if line == "":
             continue
-        if line.startswith("@"):
-            try:
-                username, amount_owed = line.split(" ", 1)
-                debts.append((username[1:], float(amount_owed)))
-            except ValueError:
-                return False, f"Failed to parse debt entry: '{line}'."
+        if not line.startswith("@"):
+            modifier = _parse_modifier(line)
+            if modifier is None:
+                errors.append(
+                    UserError("listLine", number=line_number, problem=UserError("notDebtOrModifier", line=line))
+                )
+            elif modifier <= 0:
+                errors.append(
+                    UserError("listLine", number=line_number, problem=UserError("modifierBelowZero", line=line))
+                )
+            else:
+                multiplier *= modifier
+            continue
+        try:
+            debts = _parse_debt_line(line, currency)
+        except UserError as error:
+            errors.append(UserError("listLine", number=line_number, problem=error))
+            continue
+        for handle, amount_minor in debts:
+            key = handle.casefold()
+            spellings.setdefault(key, handle)
+            amounts[key] = amounts.get(key, 0) + amount_minor
+
+    if not amounts and not errors:
+        errors.append(UserError("listNoDebts"))
+
+    debts = []
+    for key, amount_minor in amounts.items():
+        scaled_minor = (amount_minor * multiplier).to_integral_value(ROUND_HALF_UP)
+        if scaled_minor >= MAX_AMOUNT_MINOR:
+            errors.append(UserError("owedTooLarge", handle=spellings[key]))
+        elif scaled_minor <= 0 < amount_minor:
+            errors.append(UserError("owedRoundedToZero", handle=spellings[key]))
+        debts.append((spellings[key], int(scaled_minor)))
 
+    if errors:
+        message = settings.text("listProblems", count=len(errors)) + "\n\n"
+        message += "\n".join(settings.error(error) for error in errors[:MAX_REPORTED_ERRORS])
+        if len(errors) > MAX_REPORTED_ERRORS:
+            message += "\n" + settings.text("problemsMore", count=len(errors) - MAX_REPORTED_ERRORS)
+        return False, message
     return True, (debt_name, phone_number, debts)
 
 
-def get_debt_list_string(debt_list_id: int) -> str:
-    debt_list_info = get_debt_list_info(debt_list_id)
-    debt_name = debt_list_info.get("debt_name")
-    phone_number = debt_list_info.get("phone_number")
-    debts = debt_list_info.get("debts")
-    last_updated: datetime = debt_list_info.get("last_updated")
-    # Convert the last_updated time to Singapore time
-    last_updated = (
-        timezone("UTC").localize(last_updated).astimezone(timezone("Asia/Singapore"))
-    ).strftime("%Y-%m-%d %H:%M:%S")
-
-    # Continue with the rest of the code
-    message = f"{debt_name}\nPay to: {phone_number}\n\n"
-    message += "\n".join(
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+def truncate_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> str:
+    """Cut a message down to Telegram's length limit, marking that it was cut."""
+    if len(message) <= limit:
+        return message
+    marker = "\n\n[...message too long, cut short]"
+    return message[: limit - len(marker)] + marker
+
+
+def build_pay_keyboard(debt_list_id: int) -> InlineKeyboardMarkup:
+    """Build the pay/unpay buttons that go under every posted debt list."""
+    pay_button = InlineKeyboardButton("✅", callback_data=f"pay:{debt_list_id}")
+    unpay_button = InlineKeyboardButton("❌", callback_data=f"unpay:{debt_list_id}")
+    return InlineKeyboardMarkup([[pay_button, unpay_button]])
+
+
+def format_debt_list(debt_list_info: DebtListView, settings: Settings = None) -> str:
+    """
+    Render a debt list, as returned by get_debt_list_info or get_debt_list_page, as a message.
+
+    Args:
+        debt_list_info (DebtListView): The debt list, with its debts.
+        settings (Settings, optional): The settings of the chat the message is for. Defaults to the default settings.
+
+    Returns:
+        str: The message text.
+    """
+    settings = settings or chat_settings()
+    currency = debt_list_info.currency
+    lines = [
+        settings.text(
+            "debtListTitle",
+            name=debt_list_info.debt_name,
+            phone=debt_list_info.phone_number,
+        ),
+        "",
+    ]
+    for debt in debt_list_info.debts:
+        lines.append(
+            settings.text(
+                "debtPaid" if debt.paid else "debtUnpaid",
+                handle=debt.owed_by_user_name,
+                amount=settings.amount(debt.amount_minor, currency),
+            )
+        )
+    lines.append("")
+    lines.append(
+        settings.text(
+            "debtListTotals",
+            total=settings.money(debt_list_info.total_minor, currency),
+            outstanding=settings.money(debt_list_info.outstanding_minor, currency),
+        )
+    )
+    lines.append("")
+    lines.append(settings.text("debtListUpdated", updated=settings.local_time(debt_list_info.last_updated)))
+    return "\n".join(lines)
+
+
+SHOW_STATUSES = ("open", "settled", "all")
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S"
+
+
+def encode_page_cursor(debt_list_info: DebtListView) -> str:
+    """Encode the (last_updated, list_id) key of a debt list compactly for callback data."""
+    return f"{debt_list_info.last_updated.strftime(CURSOR_TIME_FORMAT)}:{debt_list_info.list_id}"
+
+
+def decode_page_cursor(cursor: str) -> tuple:
+    last_updated, list_id = cursor.split(":")
+    return datetime.strptime(last_updated, CURSOR_TIME_FORMAT), int(list_id)
+
+
+def get_debt_list_page_message(
+    repository: Repository, user_id: int, status: str, before: tuple = None, after: tuple = None
+) -> Tuple[str, InlineKeyboardMarkup]:
+    """
+    Render one page of a user's debt lists with buttons to move between pages and filters.
+
+    Args:
+        repository (Repository): Where the debt lists are kept.
+        user_id (int): The ID of the user.
+        status (str): One of SHOW_STATUSES.
+        before (tuple, optional): Show the page older than this (last_updated, list_id) cursor. Defaults to None.
+        after (tuple, optional): Show the page newer than this (last_updated, list_id) cursor. Defaults to None.
+
+    Returns:
+        Tuple[str, InlineKeyboardMarkup]: The message text and its inline keyboard.
+    """
+    page, has_newer, has_older = repository.get_debt_list_page(
+        user_id, status, before=before, after=after, page_size=SHOW_PAGE_SIZE
+    )
+    settings = chat_settings(user_id)
+
+    if page:
+        message = settings.text(f"showTitle{status.capitalize()}") + "\n\n"
+        message += "\n\n###################################\n\n".join(
+            format_debt_list(debt_list_info, settings) for debt_list_info in page
+        )
+    else:
+        message = settings.text(f"showEmpty{status.capitalize()}")
+
+    buttons = []
+    navigation = []
+    if page and has_newer:
+        navigation.append(
+            InlineKeyboardButton(
+                settings.text("pageNewer"),
+                callback_data=f"show:{status}:after:{encode_page_cursor(page[0])}",
+            )
+        )
+    if page and has_older:
+        navigation.append(
+            InlineKeyboardButton(
+                settings.text("pageOlder"),
+                callback_data=f"show:{status}:before:{encode_page_cursor(page[-1])}",
+            )
+        )
+    if navigation:
+        buttons.append(navigation)
+    buttons.append(
         [
-            f"{'' if debt.get('paid') else '@'}{debt.get('owed_by_user_name')} - {debt.get('amount')} {'✅' if debt.get('paid') else '❌'}"
-            for debt in debts
+            InlineKeyboardButton(
+                settings.text("showFilterSelected", label=settings.text(f"showFilter{other.capitalize()}"))
+                if other == status
+                else settings.text(f"showFilter{other.capitalize()}"),
+                callback_data=f"show:{other}",
+            )
+            for other in SHOW_STATUSES
         ]
     )
+    return truncate_message(message), InlineKeyboardMarkup(buttons)
 
-    message += f"\n\nMessage last updated at {last_updated}"
 
-    return message
+def get_search_results_message(
+    repository: Repository, user_id: int, query: str, offset: int = 0
+) -> Tuple[str, InlineKeyboardMarkup]:
+    """
+    Render one page of '/find' results, with buttons to move between pages. The query itself is not put in the buttons, since callback data is limited to 64 bytes, so the caller keeps it.
+
+    Args:
+        repository (Repository): Where the debt lists are kept.
+        user_id (int): The ID of the user searching.
+        query (str): The search query.
+        offset (int, optional): The number of results to skip. Defaults to 0.
 
+    Returns:
+        Tuple[str, InlineKeyboardMarkup]: The message text and its inline keyboard, which is None if there is only one page.
+    """
+    results, has_more = repository.search_debt_lists(user_id, query, offset=offset, limit=FIND_PAGE_SIZE)
+    settings = chat_settings(user_id)
+    if not results:
+        return settings.text("findNoResults", query=query), None
 
-def is_all_debt_paid(debt_list_id: int) -> bool:
-    debt_list_info = get_debt_list_info(debt_list_id)
-    debts = debt_list_info.get("debts")
-    return all(debt.get("paid") for debt in debts)
+    lines = []
+    for number, result in enumerate(results, start=offset + 1):
+        currency = result.currency
+        if result.outstanding_minor:
+            status = settings.text(
+                "findOutstanding", amount=settings.money(result.outstanding_minor, currency)
+            )
+        else:
+            status = settings.text("findSettledArchived" if result.archived else "findSettled")
+        lines.append(
+            settings.text(
+                "findResult",
+                number=number,
+                name=result.debt_name,
+                total=settings.money(result.total_minor, currency),
+                status=status,
+                updated=settings.local_time(result.last_updated),
+            )
+        )
+    message = settings.text("findTitle", query=query) + "\n\n" + "\n".join(lines)
 
+    navigation = []
+    if offset > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                settings.text("pagePrevious"), callback_data=f"find:{max(offset - FIND_PAGE_SIZE, 0)}"
+            )
+        )
+    if has_more:
+        navigation.append(
+            InlineKeyboardButton(settings.text("pageNext"), callback_data=f"find:{offset + FIND_PAGE_SIZE}")
+        )
+    reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+    return truncate_message(message), reply_markup
 
-async def delete_message(
-    bot: Bot, debt_list_id: int, group_id: int, message_id: int
-) -> None:
+
+def get_recurring_debt_lists_message(repository: Repository, user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
     """
-    Deletes a message from a chat and removes the associated debt list message info.
+    Render a user's recurring debt lists for '/repeat', with a button to stop each of them.
 
     Args:
-        bot (Bot): The bot instance used to delete the message.
-        debt_list_id (int): The ID of the debt list associated with the message.
-        chat_id (int): The ID of the chat where the message is located.
-        message_id (int): The ID of the message to be deleted.
+        repository (Repository): Where the recurring debt lists are kept.
+        user_id (int): The ID of the user.
+
+    Returns:
+        Tuple[str, InlineKeyboardMarkup]: The message text and its inline keyboard, which is None if there are no recurring debt lists.
     """
-    try:
-        # This is in a try-finally block to ensure that the debt list message info is deleted even if an exception occurs (usually because the message does not exist)
-        await bot.delete_message(chat_id=group_id, message_id=message_id)
-    finally:
-        delete_debt_list_message_info(debt_list_id)
+    settings = chat_settings(user_id)
+    recurring_lists = repository.get_recurring_debt_lists(user_id)
+    if not recurring_lists:
+        return settings.text("recurringNone") + "\n\n" + settings.text("repeatUsage"), None
+
+    lines = []
+    buttons = []
+    for number, recurring in enumerate(recurring_lists, start=1):
+        lines.append(
+            settings.text(
+                "recurringItem",
+                number=number,
+                name=recurring.debt_name,
+                total=settings.money(sum(debt.amount_minor for debt in recurring.debts), recurring.currency),
+                schedule=recurring.schedule,
+                due=settings.local_time(recurring.next_due),
+            )
+        )
+        buttons.append(
+            InlineKeyboardButton(
+                settings.text("recurringStopButton", number=number),
+                callback_data=f"stopRecurring:{recurring.recurring_id}",
+            )
+        )
+    message = settings.text("recurringTitle") + "\n\n" + "\n".join(lines)
+    # Three buttons to a row
+    keyboard = [buttons[start : start + 3] for start in range(0, len(buttons), 3)]
+    return truncate_message(message), InlineKeyboardMarkup(keyboard)
+
+
+def _format_duration(seconds: int, settings: Settings) -> str:
+    if seconds < DAY:
+        return settings.text("statsHours", count=seconds // 3600)
+    return settings.text("statsDays", count=seconds // DAY)
+
+
+def get_group_stats_message(repository: Repository, group_id: int) -> str:
+    """
+    Render '/groupstats' for a group: what happened in the last GROUP_STATS_DAYS days and what is outstanding now.
+
+    Args:
+        repository (Repository): Where the group's debt lists are kept.
+        group_id (int): The ID of the group.
+
+    Returns:
+        str: The message text.
+    """
+    settings = chat_settings(group_id)
+    since = (datetime.now(timezone.utc) - timedelta(days=GROUP_STATS_DAYS - 1)).date()
+    stats = repository.get_group_stats(group_id, since, top=GROUP_STATS_TOP, min_debts=GROUP_STATS_MIN_DEBTS)
+    if not (stats.lists_sent or stats.paid or stats.outstanding):
+        return settings.text("statsNone", days=GROUP_STATS_DAYS)
+
+    lines = [
+        settings.text("statsTitle", days=GROUP_STATS_DAYS),
+        "",
+        settings.text("statsListsSent", count=stats.lists_sent),
+    ]
+    for currency, debts, amount_minor in stats.paid:
+        lines.append(settings.text("statsPaid", count=debts, amount=settings.money(amount_minor, currency)))
+    bucket = median_bucket(stats.settle_times)
+    if bucket is not None and bucket < len(SETTLE_BUCKET_BOUNDS):
+        lines.append(settings.text("statsMedian", duration=_format_duration(SETTLE_BUCKET_BOUNDS[bucket], settings)))
+    elif bucket is not None:
+        lines.append(settings.text("statsMedianOver", duration=_format_duration(SETTLE_BUCKET_BOUNDS[-1], settings)))
+    for currency, amount_minor in stats.outstanding:
+        lines.append(settings.text("statsOutstanding", amount=settings.money(amount_minor, currency)))
+
+    if stats.top_debtors:
+        lines += ["", settings.text("statsTopDebtorsTitle")]
+        lines += [
+            settings.text("statsTopDebtor", name=name, amount=settings.money(amount_minor, currency))
+            for name, currency, amount_minor in stats.top_debtors
+        ]
+    if stats.slowest_payers:
+        lines += ["", settings.text("statsSlowestTitle")]
+        lines += [
+            settings.text("statsSlowest", name=name, days=settle_seconds / debts / DAY, count=debts)
+            for name, debts, settle_seconds in stats.slowest_payers
+        ]
+    return truncate_message("\n".join(lines))
 
 
 async def check_and_resend_debt_lists(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now(timezone("UTC"))
+    repository: Repository = context.bot_data["repository"]
+    now = datetime.now(timezone.utc)
     threshold = now - timedelta(hours=16)  # Abstract this into config file
-    debt_lists: List[DebtList] = get_all_debt_lists()
+    # Settled lists have had their message deleted already, so only resend open ones
+    debt_lists: List[DebtListView] = repository.get_open_debt_lists()
 
+    resent = False
     for debt_list in debt_lists:
-        if timezone("UTC").localize(debt_list.last_updated) < threshold:
-            await delete_message(
-                context.bot, debt_list.list_id, debt_list.group_id, debt_list.message_id
+        if debt_list.last_updated.replace(tzinfo=timezone.utc) < threshold:
+            await repository.resend_debt_list(debt_list.list_id)
+            resent = True
+    if resent:
+        await drain_outbox(context)
+
+
+async def _carry_out(bot: Bot, repository: Repository, side_effect: dict) -> tuple:
+    """Perform one queued side effect and return its outcome, in the form finish_outbox_messages expects."""
+    action = side_effect["action"]
+    list_id = side_effect["list_id"]
+    try:
+        if action == outbox.SEND_DEBT_LIST:
+            debt_list_info = repository.get_debt_list_info(list_id)
+            # Nothing to do if the list was deleted, or a retry finds the message was already stored
+            if not debt_list_info or repository.get_debt_list_message_info(list_id)[1]:
+                return ("done", None)
+            message = await bot.send_message(
+                chat_id=side_effect["chat_id"],
+                text=truncate_message(format_debt_list(debt_list_info, chat_settings(side_effect["chat_id"]))),
+                reply_markup=build_pay_keyboard(list_id),
             )
+            return ("done", message.message_id)
+        if action == outbox.EDIT_DEBT_LIST:
+            debt_list_info = repository.get_debt_list_info(list_id)
+            if debt_list_info:
+                await bot.edit_message_text(
+                    text=truncate_message(format_debt_list(debt_list_info, chat_settings(side_effect["chat_id"]))),
+                    chat_id=side_effect["chat_id"],
+                    message_id=side_effect["message_id"],
+                    inline_message_id=side_effect["inline_message_id"],
+                    reply_markup=build_pay_keyboard(list_id),
+                )
+            return ("done", None)
+        if action == outbox.DELETE_MESSAGE:
+            await bot.delete_message(
+                chat_id=side_effect["chat_id"], message_id=side_effect["message_id"]
+            )
+            return ("done", None)
+        if action == outbox.NOTIFY:
+            settings = chat_settings(side_effect["chat_id"])
+            template = settings.messages.get(side_effect["text"])
+            # Effects queued before messages came from the catalog hold the text itself
+            text = template.render() if template else side_effect["text"]
+            if list_id is not None:
+                debt_list_info = repository.get_debt_list_info(list_id)
+                if debt_list_info:
+                    text += "\n\n" + format_debt_list(debt_list_info, settings)
+            await bot.send_message(chat_id=side_effect["chat_id"], text=truncate_message(text))
+            return ("done", None)
+        return ("failed", f"Unknown action {action}")
+    except RetryAfter as error:
+        return ("retry", error.retry_after, str(error))
+    except BadRequest as error:
+        # The effect already happened, e.g. a retry of a delete whose first attempt went through
+        if "not modified" in error.message or "not found" in error.message:
+            return ("done", None)
+        return ("failed", str(error))
+    except Forbidden as error:
+        # The bot was blocked or removed from the chat, retrying will not help
+        return ("failed", str(error))
+    except Exception as error:
+        logger.warning("Outbox %s %s failed: %s", action, side_effect["outbox_id"], error)
+        backoff = min(OUTBOX_POLL_SECONDS * 2 ** side_effect["attempts"], 600)
+        return ("retry", backoff, str(error))
+
 
-            # TODO: Abstract this out along with the one in callback_handlers.py
-            message = get_debt_list_string(debt_list.list_id)
-            pay_button = InlineKeyboardButton(
-                "✅", callback_data=f"pay:{debt_list.list_id}"
+async def _carry_out_in_order(bot: Bot, repository: Repository, side_effects: list) -> list:
+    return [(side_effect, await _carry_out(bot, repository, side_effect)) for side_effect in side_effects]
+
+
+_drain_lock = asyncio.Lock()
+_drain_requested = False
+
+
+async def drain_outbox(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Carry out the queued side effects that are due, in batches, until none are left. Effects in the same chat are carried out in the order they were queued, different chats are worked on concurrently. Runs on a timer, which also picks up whatever was left unfinished by a restart, and is started straight away by handlers that queue effects.
+
+    Args:
+        context (ContextTypes.DEFAULT_TYPE): The context, or application, whose bot carries out the effects queued in
+            its repository.
+    """
+    global _drain_requested
+    repository: Repository = context.bot_data["repository"]
+    if _drain_lock.locked():
+        # The running drain will look for new effects again before it stops
+        _drain_requested = True
+        return
+    async with _drain_lock:
+        while True:
+            _drain_requested = False
+            side_effects = repository.get_due_outbox_messages(OUTBOX_BATCH_SIZE)
+            by_chat = {}
+            for side_effect in side_effects:
+                chat = side_effect["chat_id"] or side_effect["inline_message_id"]
+                by_chat.setdefault(chat, []).append(side_effect)
+            outcomes = await asyncio.gather(
+                *(_carry_out_in_order(context.bot, repository, chat_effects) for chat_effects in by_chat.values())
             )
-            unpay_button = InlineKeyboardButton(
-                "❌", callback_data=f"unpay:{debt_list.list_id}"
+            await repository.finish_outbox_messages(
+                [result for chat_results in outcomes for result in chat_results],
+                OUTBOX_MAX_ATTEMPTS,
             )
-            buttons = [[pay_button, unpay_button]]
-            reply_markup = InlineKeyboardMarkup(buttons)
+            if len(side_effects) < OUTBOX_BATCH_SIZE and not _drain_requested:
+                return
+
 
-            new_message = await context.bot.send_message(
-                chat_id=debt_list.group_id,
-                text=message,
-                reply_markup=reply_markup,
+def kick_outbox(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start draining the outbox in the background, so that effects a handler just queued go out straight away."""
+    context.application.create_task(drain_outbox(context))
+
+
+def archive_debt_lists() -> None:
+    """
+    Move old settled debt lists to the archive and delete archived lists past the retention period. This is a blocking job, so it is run on the scheduler's thread pool rather than the event loop.
+    """
+    archived = archive_settled_debt_lists(
+        ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE
+    )
+    purged = purge_archived_debt_lists(
+        ARCHIVE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE
+    )
+    logger.info("Archived %d debt list(s), purged %d archived list(s)", archived, purged)
+
+
+def prune_outbox() -> None:
+    """
+    Delete the side effects that were finished more than OUTBOX_RETENTION_DAYS ago, so the outbox and its index of
+    idempotency keys do not grow forever. This is a blocking job, so it is run on the scheduler's thread pool rather than the event loop.
+    """
+    pruned = prune_outbox_messages(OUTBOX_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_BATCH_PAUSE)
+    logger.info("Pruned %d finished outbox message(s)", pruned)
+
+
+def materialize_recurring_debt_lists(repository: Repository) -> None:
+    """
+    Post the recurring debt lists that are due, as new debt lists whose group messages the outbox drainer sends. This is a blocking job, so it is run on the scheduler's thread pool rather than the event loop.
+
+    A list that was due several times while the bot was down is posted once for each time, oldest first, but times more than RECURRING_CATCH_UP_DAYS ago are skipped.
+
+    Args:
+        repository (Repository): Where the recurring debt lists are kept.
+    """
+    from bot.recurring import next_due
+
+    # Naive UTC, like next_due in the database
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    floor = now - timedelta(days=RECURRING_CATCH_UP_DAYS)
+    posted = skipped = 0
+    while due_lists := repository.get_due_recurring_debt_lists(now):
+        for recurring in due_lists:
+            due = recurring.next_due
+            if due < floor:
+                repository.skip_recurring_debt_list(
+                    recurring.recurring_id, due, next_due(recurring.schedule, recurring.timezone, floor)
+                )
+                skipped += 1
+                continue
+            settings = chat_settings(recurring.user_id)
+            debt_name = settings.text(
+                "recurringListName", name=recurring.debt_name, due=settings.local_time(due)
             )
+            # The next time is counted from this one, not from now, so the times that were missed are posted too
+            repository.materialize_recurring_debt_list(
+                recurring.recurring_id,
+                due,
+                next_due(recurring.schedule, recurring.timezone, due),
+                debt_name,
+            )
+            posted += 1
+    if posted or skipped:
+        logger.info("Posted %d recurring debt list(s), skipped %d missed too long ago", posted, skipped)
+
+
+def roll_up_group_stats() -> None:
+    """
+    Apply the events logged since the last run to the group analytics rollups that /groupstats reads. This is a blocking job, so it is run on the scheduler's thread pool rather than the event loop.
+    """
+    applied = update_group_stats(batch_size=GROUP_STATS_BATCH_SIZE)
+    if applied:
+        logger.info("Applied %d event(s) to the group analytics rollups", applied)
+
+
+def log_guard_counters() -> None:
+    """Log how many updates the guard let through and how many it shed since the bot started."""
+    shed = guard_counters["duplicate_callbacks"] + guard_counters["throttled"]
+    logger.info(
+        "Guard: %d update(s), %d allowed, %d shed (%d duplicate press(es), %d throttled)",
+        guard_counters["updates"],
+        guard_counters["allowed"],
+        shed,
+        guard_counters["duplicate_callbacks"],
+        guard_counters["throttled"],
+    )
+
 
-            new_message_id = new_message.message_id
-            update_debt_list_message_info(debt_list.list_id, new_message_id)
+def backup_database() -> None:
+    """
+    Take an online backup of the database. This is a blocking job, so it is run on the scheduler's thread pool rather than the event loop.
+    """
+    # Only this job backs up, hours after startup
+    from bot.backup import create_backup
+
+    try:
+        backup = create_backup(
+            BACKUP_DIR, BACKUP_KEEP, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE
+        )
+    except Exception:
+        logger.exception("Backing up the database failed")
+        return
+    logger.info(
+        "Backed up the database to %s in %.1f s, %d bytes compressed to %d",
+        backup["path"],
+        backup["duration_seconds"],
+        backup["size_bytes"],
+        backup["compressed_bytes"],
+    )
+
+
+def log_request_pool_metrics() -> None:
+    """Log how busy each Bot API connection pool is and how long requests waited for a connection."""
+    for name, pool in request_pools.items():
+        metrics = pool.snapshot()
+        logger.info(
+            "HTTP pool %s: %d request(s), %.0f%% utilization, peak %d of %d connections, checkout wait mean %.1f ms max %.1f ms, %d pool timeout(s)",
+            name,
+            metrics["requests"],
+            metrics["utilization"] * 100,
+            metrics["peak_in_use"],
+            metrics["size"],
+            metrics["wait_seconds_mean"] * 1000,
+            metrics["wait_seconds_max"] * 1000,
+            metrics["pool_timeouts"],
+        )